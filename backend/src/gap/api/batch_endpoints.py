@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""OpenAI 兼容的文件与批处理 API 端点
+
+提供 `/v1/files` (上传、查询、下载、删除批处理输入 / 输出文件) 和 `/v1/batches`
+(创建、查询、列出、取消批处理任务)。存储与调度见 `gap.core.processing.batch`。
+所有接口都需要代理 Key 认证。
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, status
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+
+from gap import config
+from gap.api.middleware import verify_proxy_key
+from gap.core.processing.batch import (
+    FILE_PURPOSE_INPUT,
+    SUPPORTED_ENDPOINTS,
+    batch_manager,
+)
+
+logger = logging.getLogger("my_logger")
+
+router = APIRouter(dependencies=[Depends(verify_proxy_key)])
+
+
+class BatchCreateRequest(BaseModel):
+    """POST /v1/batches 的请求体。"""
+
+    input_file_id: str
+    endpoint: str = SUPPORTED_ENDPOINTS[0]
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, Any]] = None
+
+
+def _file_or_404(file_id: str) -> Dict[str, Any]:
+    file_object = batch_manager.get_file(file_id)
+    if file_object is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"文件 {file_id} 不存在。"
+        )
+    return file_object
+
+
+@router.post("/v1/files")
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+) -> Dict[str, Any]:
+    """上传批处理输入文件 (JSONL，purpose 必须为 "batch")。"""
+    if purpose != FILE_PURPOSE_INPUT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"仅支持 purpose='{FILE_PURPOSE_INPUT}' 的文件。",
+        )
+    content = await file.read(config.BATCH_MAX_FILE_BYTES + 1)
+    if len(content) > config.BATCH_MAX_FILE_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"文件超过 {config.BATCH_MAX_FILE_BYTES} 字节的上限。",
+        )
+    file_object = batch_manager.create_file(
+        content, file.filename or "batch_input.jsonl", purpose
+    )
+    logger.info(f"已上传批处理文件 {file_object['id']} ({file_object['bytes']} 字节)。")
+    return file_object
+
+
+@router.get("/v1/files")
+async def list_files(purpose: Optional[str] = None) -> Dict[str, Any]:
+    """列出文件。"""
+    return {"object": "list", "data": batch_manager.list_files(purpose)}
+
+
+@router.get("/v1/files/{file_id}")
+async def get_file(file_id: str) -> Dict[str, Any]:
+    """查询文件信息。"""
+    return _file_or_404(file_id)
+
+
+@router.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str) -> FileResponse:
+    """下载文件内容 (任务执行期间可以下载已写入的部分结果)。"""
+    file_object = _file_or_404(file_id)
+    return FileResponse(
+        batch_manager.file_path(file_id),
+        media_type="application/jsonl",
+        filename=file_object["filename"],
+    )
+
+
+@router.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str) -> Dict[str, Any]:
+    """删除文件。"""
+    _file_or_404(file_id)
+    batch_manager.delete_file(file_id)
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@router.post("/v1/batches")
+async def create_batch(request_data: BatchCreateRequest) -> Dict[str, Any]:
+    """创建批处理任务。"""
+    return batch_manager.create_batch(
+        request_data.input_file_id,
+        request_data.endpoint,
+        request_data.completion_window,
+        request_data.metadata,
+    )
+
+
+@router.get("/v1/batches")
+async def list_batches(limit: int = 20, after: Optional[str] = None) -> Dict[str, Any]:
+    """列出批处理任务 (按创建时间倒序分页)。"""
+    return batch_manager.list_batches(limit=max(1, min(limit, 100)), after=after)
+
+
+@router.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str) -> Dict[str, Any]:
+    """查询任务状态、进度、吞吐和按 Key 的用量 (gap_progress)。"""
+    batch = batch_manager.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"批处理任务 {batch_id} 不存在。",
+        )
+    return batch
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str) -> Dict[str, Any]:
+    """取消任务 (在途条目完成后进入 cancelled 状态)。"""
+    return batch_manager.cancel_batch(batch_id)
@@ -1,6 +1,8 @@
+import base64  # 嵌入向量的 base64 编码
 import logging  # 导入 logging 模块
+import struct  # 嵌入向量打包为 float32
 import time  # 导入 time 模块，用于 /v1/models 端点生成时间戳
-from typing import Any, Dict, List  # 导入类型提示
+from typing import Any, Dict, List, Optional  # 导入类型提示
 
 import httpx  # 导入 httpx 用于类型提示
 from fastapi import (  # 导入 FastAPI 相关组件：路由、HTTP异常、请求对象、依赖注入、状态码
@@ -20,6 +22,10 @@ from gap.api.middleware import verify_proxy_key  # 导入代理密钥验证中
 from gap.api.models import (  # 导入 API 请求和响应模型
     ChatCompletionRequest,
     ChatCompletionResponse,
+    EmbeddingData,
+    EmbeddingRequest,
+    EmbeddingResponse,
+    EmbeddingUsage,
     ModelList,
 )
 from gap.core.dependencies import (  # 导入获取 Key Manager 和 HTTP Client 的依赖函数
@@ -27,11 +33,30 @@ from gap.core.dependencies import (  # 导入获取 Key Manager 和 HTTP Client
     get_key_manager,
     verify_admin_token,
 )
+from gap.core.keys.admission import admission_queue  # 准入等待队列指标
 from gap.core.keys.manager import APIKeyManager  # 导入类型 (新路径)
+from gap.core.processing.disconnect import (  # 因客户端断开而提前结束的流统计
+    stream_cancellation_stats,
+)
+from gap.core.processing.embeddings import (  # 嵌入请求的微批处理与向量缓存
+    embedding_batcher,
+    estimate_embedding_tokens,
+    key_pool_embedder,
+)
 from gap.core.processing.main_handler import (  # 导入核心请求处理函数 (新路径)
     process_request,
 )
+from gap.core.processing.response_cache import (  # 确定性响应缓存的统计
+    response_cache,
+)
+from gap.core.processing.single_flight import (  # 相同非流式请求合并的统计
+    request_coalescer,
+)
+from gap.core.processing.token_count import upstream_token_counter  # countTokens 统计
+from gap.core.processing.token_estimate import token_calibration  # Token 估算校准系数
+from gap.core.security.rate_limit import protect_from_abuse  # 基于 IP 的滥用检查
 from gap.core.services.gemini import GeminiClient  # 导入 Gemini 客户端类 (新路径)
+from gap.core.utils.request_helpers import get_client_ip  # 获取客户端 IP
 
 # --- 此模块内需要的全局变量 ---
 logger = logging.getLogger("my_logger")  # 获取日志记录器实例
@@ -67,10 +92,8 @@ async def list_models(
         elif active_keys_count > 0:
             logger.info("首次请求模型列表，尝试通过远端 API 获取...")
             try:
-                key_to_use = None
-                with key_manager.keys_lock:
-                    if key_manager.api_keys:
-                        key_to_use = key_manager.api_keys[0]
+                active_keys = key_manager.snapshot.active_keys
+                key_to_use = active_keys[0] if active_keys else None
                 if key_to_use:
                     all_models = await GeminiClient.list_available_models(
                         key_to_use, http_client
@@ -162,6 +185,58 @@ async def chat_completions(
     return response  # 返回处理器生成的响应（可能是 StreamingResponse 或 JSONResponse）
 
 
+@router.post("/v1/embeddings", response_model=EmbeddingResponse)
+async def create_embeddings(
+    request_data: EmbeddingRequest,
+    request: Request,
+    auth_data: Dict[str, Any] = Depends(verify_proxy_key),
+    key_manager: APIKeyManager = Depends(get_key_manager),
+    http_client: httpx.AsyncClient = Depends(get_http_client),
+):
+    """
+    生成文本嵌入向量。并发请求在服务端合并为 batchEmbedContents 调用，相同文本命中向量缓存。
+    """
+    await protect_from_abuse(
+        request, config.MAX_REQUESTS_PER_MINUTE, config.MAX_REQUESTS_PER_DAY_PER_IP
+    )
+    texts = (
+        [request_data.input]
+        if isinstance(request_data.input, str)
+        else list(request_data.input)
+    )
+    if not texts or any(not text for text in texts):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="input 不能为空，且不能包含空字符串。",
+        )
+    model_name = request_data.model or config.EMBEDDING_DEFAULT_MODEL
+    if model_name.startswith("models/"):
+        model_name = model_name[len("models/") :]
+
+    vectors = await embedding_batcher.embed(
+        model_name,
+        texts,
+        key_pool_embedder(key_manager, http_client),
+        dimensions=request_data.dimensions,
+        client_ip=get_client_ip(request),
+    )
+
+    def encode(vector: List[float]) -> Any:
+        if request_data.encoding_format == "base64":
+            return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+        return vector
+
+    prompt_tokens = estimate_embedding_tokens(texts)
+    return EmbeddingResponse(
+        data=[
+            EmbeddingData(index=index, embedding=encode(vector))
+            for index, vector in enumerate(vectors)
+        ],
+        model=model_name,
+        usage=EmbeddingUsage(prompt_tokens=prompt_tokens, total_tokens=prompt_tokens),
+    )
+
+
 @router.get("/debug/config", include_in_schema=False)
 async def debug_config():
     """
@@ -246,3 +321,40 @@ async def clear_all_caches() -> Dict[str, Any]:
     logger.info("接收到清空所有缓存的请求")
     # 真实实现应清理所有缓存记录；当前实现仅返回占位结果。
     return {"message": "请求清空所有缓存已接收"}
+
+
+# Key 选择统计端点 (需要管理员令牌)
+@router.get("/v1/admin/key-selection-stats", dependencies=[Depends(verify_admin_token)])
+async def get_key_selection_stats(
+    key_manager: APIKeyManager = Depends(get_key_manager),
+) -> Dict[str, Any]:
+    """
+    返回当前统计周期内按 (Key, 原因, 模型) 聚合的 Key 选择计数器和最近的采样决策轨迹。
+    只读取统计，不会重置周期报告使用的计数器；Key 仅显示前 8 位。
+    """
+    stats = key_manager.get_selection_stats()
+    stats["admission_queue"] = admission_queue.get_stats()
+    stats["token_estimate_calibration"] = token_calibration.get_stats()
+    stats["upstream_token_count"] = upstream_token_counter.get_stats()
+    stats["embedding_batcher"] = embedding_batcher.get_stats()
+    stats["stream_cancellation"] = stream_cancellation_stats.get_stats()
+    stats["request_coalescing"] = request_coalescer.get_stats()
+    stats["response_cache"] = response_cache.get_stats()
+
+    def mask(key: Optional[str]) -> Optional[str]:
+        return f"{key[:8]}..." if key and len(key) > 8 else key
+
+    for counter in stats["counters"]:
+        counter["key"] = mask(counter["key"])
+    stats["traces"] = [
+        {
+            **trace,
+            "selected_key": mask(trace.get("selected_key")),
+            "decisions": [
+                {**decision, "key": mask(decision["key"])}
+                for decision in trace["decisions"]
+            ],
+        }
+        for trace in stats["traces"]
+    ]
+    return stats
@@ -161,6 +161,47 @@ class ModelList(BaseModel):
     data: List[ModelData]  # 包含模型信息的字典列表。
 
 
+# 定义嵌入请求的模型，与 OpenAI API 兼容
+class EmbeddingRequest(BaseModel):
+    """
+    表示 `/v1/embeddings` 端点的请求体结构，兼容 OpenAI API。
+    """
+
+    input: Union[str, List[str]]  # 必需字段：单段文本或文本列表 (不支持 Token ID 数组)。
+    model: Optional[str] = None  # 可选字段：嵌入模型名称，未指定时使用 EMBEDDING_DEFAULT_MODEL。
+    encoding_format: Literal["float", "base64"] = (
+        "float"  # 可选字段：向量的返回格式 (浮点数组或 float32 小端序的 base64)。
+    )
+    dimensions: Optional[int] = Field(None, ge=1)  # 可选字段：输出向量维度。
+    user: Optional[str] = None  # 可选字段：终端用户标识 (仅记录，不影响结果)。
+
+
+class EmbeddingData(BaseModel):
+    """表示嵌入响应中的单个向量。"""
+
+    object: Literal["embedding"] = "embedding"  # 对象类型，固定为 "embedding"
+    index: int  # 对应输入文本的序号
+    embedding: Union[List[float], str]  # 向量 (float 格式为数组，base64 格式为字符串)
+
+
+class EmbeddingUsage(BaseModel):
+    """表示嵌入请求的 Token 使用情况 (上游不返回用量，为本地估算值)。"""
+
+    prompt_tokens: int = 0
+    total_tokens: int = 0
+
+
+class EmbeddingResponse(BaseModel):
+    """
+    表示 `/v1/embeddings` 端点返回的响应结构，兼容 OpenAI API。
+    """
+
+    object: Literal["list"] = "list"  # 对象类型，固定为 "list"
+    data: List[EmbeddingData]  # 与输入顺序一致的向量列表
+    model: str  # 使用的嵌入模型名称
+    usage: EmbeddingUsage = Field(default_factory=EmbeddingUsage)  # Token 使用情况
+
+
 # --- Gemini 原生 API 模型 (用于 /v2 端点) ---
 
 
@@ -298,14 +298,24 @@ async def generate_content_v2(
 
         # --- 更新 Token 计数 ---
         prompt_tokens = None  # 初始化 prompt_tokens
+        completion_tokens = None  # 初始化 completion_tokens
         if (
             isinstance(gemini_response, dict) and "usageMetadata" in gemini_response
         ):  # 检查响应是否为字典且包含 usageMetadata
             prompt_tokens = gemini_response["usageMetadata"].get(
                 "promptTokenCount"
             )  # 获取 promptTokenCount
+            completion_tokens = gemini_response["usageMetadata"].get(
+                "candidatesTokenCount"
+            )  # 获取 candidatesTokenCount
         update_token_counts(
-            proxy_key, model, limits, prompt_tokens, client_ip, today_date_str_pt
+            proxy_key,
+            model,
+            limits,
+            prompt_tokens,
+            client_ip,
+            today_date_str_pt,
+            completion_tokens=completion_tokens,
         )  # 更新 token 计数
 
         # 存储上下文 (如果启用) - 委托给辅助函数
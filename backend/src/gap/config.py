@@ -143,6 +143,144 @@ CACHE_REFRESH_INTERVAL_SECONDS: int = int(
     os.environ.get("CACHE_REFRESH_INTERVAL_SECONDS", "600")
 )
 
+# --- Key 健康度评分配置 ---
+# KEY_SCORE_EWMA_ALPHA: 延迟、成功率和 429 比例的指数加权移动平均 (EWMA) 平滑系数，取值 (0, 1]。默认 0.2。
+KEY_SCORE_EWMA_ALPHA: float = float(os.environ.get("KEY_SCORE_EWMA_ALPHA", "0.2"))
+# KEY_SCORE_LATENCY_REFERENCE_SECONDS: 延迟评分的参考值（秒）。延迟等于该值时延迟分量为 0.5。默认 5 秒。
+KEY_SCORE_LATENCY_REFERENCE_SECONDS: float = float(
+    os.environ.get("KEY_SCORE_LATENCY_REFERENCE_SECONDS", "5")
+)
+# KEY_SCORE_DECAY_HALF_LIFE_SECONDS: 统计数据向初始值衰减的半衰期（秒），使长时间未被使用的 Key 逐渐恢复信誉。默认 900 秒。
+KEY_SCORE_DECAY_HALF_LIFE_SECONDS: float = float(
+    os.environ.get("KEY_SCORE_DECAY_HALF_LIFE_SECONDS", "900")
+)
+# KEY_SCORE_PERSIST_INTERVAL_SECONDS: 将 Key 分数写入数据库 KeyScore 表的间隔时间（秒）。默认 300 秒。
+KEY_SCORE_PERSIST_INTERVAL_SECONDS: int = int(
+    os.environ.get("KEY_SCORE_PERSIST_INTERVAL_SECONDS", "300")
+)
+# SELECTION_TELEMETRY_MAX_COUNTERS: Key 选择统计中 (Key, 原因, 模型) 计数器的最大数量，超出后新组合计入溢出桶。默认 5000。
+SELECTION_TELEMETRY_MAX_COUNTERS: int = int(
+    os.environ.get("SELECTION_TELEMETRY_MAX_COUNTERS", "5000")
+)
+# SELECTION_TRACE_SAMPLE_RATE: 完整记录 Key 选择决策过程的请求采样比例，取值 0~1。默认 0.01。
+SELECTION_TRACE_SAMPLE_RATE: float = float(
+    os.environ.get("SELECTION_TRACE_SAMPLE_RATE", "0.01")
+)
+# SELECTION_TRACE_BUFFER_SIZE: 采样决策轨迹环形缓冲区保留的最近轨迹条数。默认 200。
+SELECTION_TRACE_BUFFER_SIZE: int = int(
+    os.environ.get("SELECTION_TRACE_BUFFER_SIZE", "200")
+)
+# KEY_AFFINITY_MAX_ENTRIES: 内存中用户→Key、缓存内容→Key 关联映射各自保留的最大条目数 (LRU 淘汰)。默认 100000。
+KEY_AFFINITY_MAX_ENTRIES: int = int(
+    os.environ.get("KEY_AFFINITY_MAX_ENTRIES", "100000")
+)
+# KEY_AFFINITY_FLUSH_INTERVAL_SECONDS: 将累积的用户-Key 关联更新批量写入数据库的间隔时间（秒）。默认 30 秒。
+KEY_AFFINITY_FLUSH_INTERVAL_SECONDS: int = int(
+    os.environ.get("KEY_AFFINITY_FLUSH_INTERVAL_SECONDS", "30")
+)
+# CIRCUIT_BREAKER_BASE_SECONDS: Key 熔断器首次断开的基础时长（秒），连续断开时按 2 的幂次指数退避。默认 5 秒。
+CIRCUIT_BREAKER_BASE_SECONDS: float = float(
+    os.environ.get("CIRCUIT_BREAKER_BASE_SECONDS", "5")
+)
+# CIRCUIT_BREAKER_MAX_SECONDS: Key 熔断器单次断开的最长时长（秒）。默认 600 秒。
+CIRCUIT_BREAKER_MAX_SECONDS: float = float(
+    os.environ.get("CIRCUIT_BREAKER_MAX_SECONDS", "600")
+)
+# CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS: 半开状态下探测请求未报告结果时，允许新探测请求的等待时间（秒）。默认 60 秒。
+CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS: float = float(
+    os.environ.get("CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS", "60")
+)
+# CONCURRENCY_LIMIT_ENABLED: 是否启用按 (Key, 模型) 的自适应并发限制 (AIMD)。达到并发上限的 Key 在选择时被跳过。默认启用。
+CONCURRENCY_LIMIT_ENABLED: bool = (
+    os.environ.get("CONCURRENCY_LIMIT_ENABLED", "true").lower() == "true"
+)
+# CONCURRENCY_INITIAL_LIMIT: 每个 (Key, 模型) 的初始并发上限。默认 4。
+CONCURRENCY_INITIAL_LIMIT: float = float(
+    os.environ.get("CONCURRENCY_INITIAL_LIMIT", "4")
+)
+# CONCURRENCY_MIN_LIMIT: 并发上限的下限。默认 1。
+CONCURRENCY_MIN_LIMIT: float = float(os.environ.get("CONCURRENCY_MIN_LIMIT", "1"))
+# CONCURRENCY_MAX_LIMIT: 并发上限的上限。默认 64。
+CONCURRENCY_MAX_LIMIT: float = float(os.environ.get("CONCURRENCY_MAX_LIMIT", "64"))
+# CONCURRENCY_LIMIT_BACKOFF_FACTOR: 上游返回 429 时并发上限的乘性减小系数。默认 0.5。
+CONCURRENCY_LIMIT_BACKOFF_FACTOR: float = float(
+    os.environ.get("CONCURRENCY_LIMIT_BACKOFF_FACTOR", "0.5")
+)
+# CONCURRENCY_LATENCY_BACKOFF_FACTOR: 延迟明显上升时并发上限的乘性减小系数。默认 0.9。
+CONCURRENCY_LATENCY_BACKOFF_FACTOR: float = float(
+    os.environ.get("CONCURRENCY_LATENCY_BACKOFF_FACTOR", "0.9")
+)
+# CONCURRENCY_LATENCY_TOLERANCE: 短期延迟 EWMA 超过长期延迟 EWMA 的多少倍时视为排队增加。默认 2.0。
+CONCURRENCY_LATENCY_TOLERANCE: float = float(
+    os.environ.get("CONCURRENCY_LATENCY_TOLERANCE", "2.0")
+)
+# CONCURRENCY_SHORT_LATENCY_ALPHA / CONCURRENCY_LONG_LATENCY_ALPHA: 短期 / 长期延迟 EWMA 的平滑系数。默认 0.3 / 0.02。
+CONCURRENCY_SHORT_LATENCY_ALPHA: float = float(
+    os.environ.get("CONCURRENCY_SHORT_LATENCY_ALPHA", "0.3")
+)
+CONCURRENCY_LONG_LATENCY_ALPHA: float = float(
+    os.environ.get("CONCURRENCY_LONG_LATENCY_ALPHA", "0.02")
+)
+# KEY_SELECTION_STRATEGY: 缓存关联和粘性会话之外的默认 Key 选择策略。可选值：
+# "score" (评分 + 最近最少选中轮转)、"round_robin" (轮询)、"headroom" (按剩余速率余量加权)、
+# "p2c" (两次随机选择取负载较低者)、"least_outstanding" (在途请求最少)。默认 "score"。
+KEY_SELECTION_STRATEGY: str = os.environ.get("KEY_SELECTION_STRATEGY", "score").strip()
+# KEY_SELECTION_STRATEGY_BY_MODEL: 按模型覆盖选择策略，格式为逗号分隔的 "模型=策略"，
+# 例如 "gemini-2.5-pro=least_outstanding,gemini-2.0-flash=p2c"。默认为空。
+KEY_SELECTION_STRATEGY_BY_MODEL: Dict[str, str] = {
+    model.strip(): strategy.strip()
+    for model, _, strategy in (
+        item.partition("=")
+        for item in os.environ.get("KEY_SELECTION_STRATEGY_BY_MODEL", "").split(",")
+    )
+    if model.strip() and strategy.strip()
+}
+# KEY_SELECTION_SAMPLE_SIZE: "headroom" 策略每次随机抽取并比较的候选 Key 数量。默认 16。
+KEY_SELECTION_SAMPLE_SIZE: int = int(os.environ.get("KEY_SELECTION_SAMPLE_SIZE", "16"))
+# USAGE_STATE_DIR: 使用计数与配额状态 (RPD/TPD、每日总量、IP 计数、耗尽/临时不可用标记) 的快照和增量日志目录。
+# 应用启动时从此目录恢复状态。设为空字符串表示禁用持久化。默认 "data/usage_state"。
+USAGE_STATE_DIR: str = os.environ.get("USAGE_STATE_DIR", "data/usage_state")
+# USAGE_JOURNAL_FLUSH_INTERVAL_SECONDS: 将变化的计数追加到增量日志的间隔时间（秒），即崩溃时最多丢失的计数时长。默认 2 秒。
+USAGE_JOURNAL_FLUSH_INTERVAL_SECONDS: float = float(
+    os.environ.get("USAGE_JOURNAL_FLUSH_INTERVAL_SECONDS", "2")
+)
+# USAGE_SNAPSHOT_INTERVAL_SECONDS: 写入完整快照并清空增量日志的间隔时间（秒）。默认 300 秒。
+USAGE_SNAPSHOT_INTERVAL_SECONDS: int = int(
+    os.environ.get("USAGE_SNAPSHOT_INTERVAL_SECONDS", "300")
+)
+# USAGE_JOURNAL_MAX_BYTES: 增量日志超过此大小（字节）时提前写入快照并清空日志。默认 8 MB。
+USAGE_JOURNAL_MAX_BYTES: int = int(
+    os.environ.get("USAGE_JOURNAL_MAX_BYTES", str(8 * 1024 * 1024))
+)
+# SHARED_STATE_BACKEND: 多 worker 部署时配额状态 (速率限制、RPD/TPD、IP 限流、耗尽标记) 的共享后端。
+# - 'local': 进程内状态，不在 worker 之间共享 (单 worker 部署)。
+# - 'shm': 单机共享内存 (multiprocessing.shared_memory)，适用于同一台机器上的多个 worker。
+# - 'redis': Redis (使用 REDIS_URL)，适用于多台机器。
+# 默认为 'local'。启用共享后端时不再使用 USAGE_STATE_DIR 的文件持久化。
+SHARED_STATE_BACKEND: str = os.environ.get("SHARED_STATE_BACKEND", "local").lower()
+# SHARED_STATE_SHM_NAME: 共享内存段的名称。同一台机器上的多个独立部署需使用不同名称。默认 "gap_shared_state"。
+SHARED_STATE_SHM_NAME: str = os.environ.get("SHARED_STATE_SHM_NAME", "gap_shared_state")
+# SHARED_STATE_SHM_SLOTS: 共享内存状态表的槽位数 (每个 (Key, 模型, 维度) 或计数器占一个槽位，32 字节)。默认 262144。
+SHARED_STATE_SHM_SLOTS: int = int(os.environ.get("SHARED_STATE_SHM_SLOTS", "262144"))
+# SHARED_STATE_SHM_MARKS: 共享内存标记表的条目数 (每日耗尽 / 临时不可用的 Key)。默认 4096。
+SHARED_STATE_SHM_MARKS: int = int(os.environ.get("SHARED_STATE_SHM_MARKS", "4096"))
+# SHARED_STATE_REDIS_PREFIX: Redis 共享状态的键前缀。默认 "gap:state:"。
+SHARED_STATE_REDIS_PREFIX: str = os.environ.get(
+    "SHARED_STATE_REDIS_PREFIX", "gap:state:"
+)
+# SHARED_STATE_REDIS_TIMEOUT_SECONDS: Redis 共享状态的连接和读写超时（秒）。同步调用位于请求路径上，应保持较短。默认 0.5 秒。
+SHARED_STATE_REDIS_TIMEOUT_SECONDS: float = float(
+    os.environ.get("SHARED_STATE_REDIS_TIMEOUT_SECONDS", "0.5")
+)
+# SHARED_STATE_REDIS_RETRY_SECONDS: Redis 连接失败或超时后改用进程内状态的时长（秒），之后重新尝试 Redis。默认 30 秒。
+SHARED_STATE_REDIS_RETRY_SECONDS: float = float(
+    os.environ.get("SHARED_STATE_REDIS_RETRY_SECONDS", "30")
+)
+# SHARED_STATE_SYNC_INTERVAL_SECONDS: 从共享后端同步其他 worker 标记的耗尽 / 临时不可用 Key 的间隔（秒）。默认 2 秒。
+SHARED_STATE_SYNC_INTERVAL_SECONDS: float = float(
+    os.environ.get("SHARED_STATE_SYNC_INTERVAL_SECONDS", "2")
+)
+
 # --- Gemini 安全设置 ---
 # 定义标准的 Gemini API 安全设置，默认将所有类别的阈值设为 BLOCK_NONE (不阻止)。
 safety_settings: List[Dict[str, str]] = [
@@ -234,6 +372,131 @@ ENABLE_STICKY_SESSION: bool = (
     os.environ.get("ENABLE_STICKY_SESSION", "false").lower() == "true"
 )
 
+# --- 流式响应 (SSE) 配置 ---
+# STREAM_COALESCE_MS: 将相邻的文本增量合并为一个 SSE 块的最长等待时间（毫秒）。默认 0，表示不按时间合并。
+# 开启后缓冲中的文本最多延迟此时间发送，上游停顿时也会按时发出。
+STREAM_COALESCE_MS: float = float(os.environ.get("STREAM_COALESCE_MS", "0"))
+# STREAM_COALESCE_MAX_BYTES: 合并缓冲中的文本达到此字节数 (UTF-8) 时立即发送。默认 0，表示不按大小合并。
+# 两项均为 0 时每个文本增量单独发送 (不合并)。
+STREAM_COALESCE_MAX_BYTES: int = int(os.environ.get("STREAM_COALESCE_MAX_BYTES", "0"))
+# ENABLE_STREAM_DISCONNECT_WATCH: 是否在流式响应期间监听客户端断开，断开时立即取消上游 Gemini 流并归还 Key 的额度。默认为 True。
+ENABLE_STREAM_DISCONNECT_WATCH: bool = (
+    os.environ.get("ENABLE_STREAM_DISCONNECT_WATCH", "true").lower() == "true"
+)
+
+# --- Token 估算配置 ---
+# TOKEN_ESTIMATE_MEMO_SIZE: 按消息内容哈希缓存的单条消息 Token 估算值的最大条目数。默认 50000。
+TOKEN_ESTIMATE_MEMO_SIZE: int = int(os.environ.get("TOKEN_ESTIMATE_MEMO_SIZE", "50000"))
+# ENABLE_TOKEN_ESTIMATE_CALIBRATION: 是否根据 API 返回的 promptTokenCount 按模型校准本地 Token 估算。默认为 True。
+ENABLE_TOKEN_ESTIMATE_CALIBRATION: bool = (
+    os.environ.get("ENABLE_TOKEN_ESTIMATE_CALIBRATION", "true").lower() == "true"
+)
+# ENABLE_UPSTREAM_TOKEN_COUNT: 上下文估算值接近截断阈值时，是否调用 Gemini countTokens 获取精确值来决定是否截断。默认为 False。
+ENABLE_UPSTREAM_TOKEN_COUNT: bool = (
+    os.environ.get("ENABLE_UPSTREAM_TOKEN_COUNT", "false").lower() == "true"
+)
+# UPSTREAM_TOKEN_COUNT_MARGIN: 估算值与截断阈值相差不超过阈值的此比例时才调用 countTokens。默认 0.1 (10%)。
+UPSTREAM_TOKEN_COUNT_MARGIN: float = float(
+    os.environ.get("UPSTREAM_TOKEN_COUNT_MARGIN", "0.1")
+)
+# UPSTREAM_TOKEN_COUNT_TIMEOUT_SECONDS: countTokens 调用的超时时间（秒），超时后回退到本地估算。默认 2 秒。
+UPSTREAM_TOKEN_COUNT_TIMEOUT_SECONDS: float = float(
+    os.environ.get("UPSTREAM_TOKEN_COUNT_TIMEOUT_SECONDS", "2")
+)
+# UPSTREAM_TOKEN_COUNT_CACHE_SIZE: 按消息前缀缓存的 countTokens 结果的最大条目数。默认 20000。
+UPSTREAM_TOKEN_COUNT_CACHE_SIZE: int = int(
+    os.environ.get("UPSTREAM_TOKEN_COUNT_CACHE_SIZE", "20000")
+)
+
+# --- 请求重试配置 ---
+# REQUEST_DEADLINE_SECONDS: 单个请求在 Key 选择与重试阶段允许花费的总时间（秒）。默认 120 秒。
+# 超过此时间后不再尝试新的 Key，直接返回最后一次的错误。设为 0 表示不限制。
+REQUEST_DEADLINE_SECONDS: float = float(
+    os.environ.get("REQUEST_DEADLINE_SECONDS", "120")
+)
+# ADMISSION_QUEUE_MAX_DEPTH: 所有 Key 都因容量不足 (并发上限、TPM、熔断等) 而不可用时，允许排队等待的最大请求数。
+# 队列已满时立即返回 503。设为 0 表示禁用等待队列。默认 256。
+ADMISSION_QUEUE_MAX_DEPTH: int = int(os.environ.get("ADMISSION_QUEUE_MAX_DEPTH", "256"))
+# ADMISSION_QUEUE_MAX_WAIT_SECONDS: 单个请求在准入队列中累计等待的最长时间（秒），超过后返回 503。默认 15 秒。
+ADMISSION_QUEUE_MAX_WAIT_SECONDS: float = float(
+    os.environ.get("ADMISSION_QUEUE_MAX_WAIT_SECONDS", "15")
+)
+
+# --- 相同请求合并 (single-flight) 配置 ---
+# ENABLE_REQUEST_COALESCING: 是否合并同时进行中的相同非流式请求 (模型、内容、系统指令和生成参数均相同)。
+# 启用后只有第一个请求调用上游，其余请求等待并共享其结果。默认为 False。
+ENABLE_REQUEST_COALESCING: bool = (
+    os.environ.get("ENABLE_REQUEST_COALESCING", "false").lower() == "true"
+)
+# REQUEST_COALESCING_DETERMINISTIC_ONLY: 是否只合并 temperature 为 0 的请求 (其他请求每次采样结果本应不同)。默认为 True。
+REQUEST_COALESCING_DETERMINISTIC_ONLY: bool = (
+    os.environ.get("REQUEST_COALESCING_DETERMINISTIC_ONLY", "true").lower() == "true"
+)
+# REQUEST_COALESCING_MAX_WAIT_SECONDS: 跟随者等待领导者结果的最长时间（秒），超时后自行调用上游。默认 60 秒。
+REQUEST_COALESCING_MAX_WAIT_SECONDS: float = float(
+    os.environ.get("REQUEST_COALESCING_MAX_WAIT_SECONDS", "60")
+)
+
+# --- 确定性响应缓存配置 ---
+# ENABLE_RESPONSE_CACHE: 是否缓存 temperature 为 0 的请求的补全结果，重复请求直接返回缓存结果而不调用上游。默认为 False。
+ENABLE_RESPONSE_CACHE: bool = (
+    os.environ.get("ENABLE_RESPONSE_CACHE", "false").lower() == "true"
+)
+# RESPONSE_CACHE_HEADER: 按请求控制缓存的请求头。值为 true/1 时即使 temperature 不为 0 也使用缓存，
+# 值为 false/0/bypass 时跳过缓存。默认 "X-Response-Cache"。
+RESPONSE_CACHE_HEADER: str = os.environ.get("RESPONSE_CACHE_HEADER", "X-Response-Cache")
+# RESPONSE_CACHE_TTL_SECONDS: 缓存条目的有效期（秒）。默认 3600 秒。
+RESPONSE_CACHE_TTL_SECONDS: float = float(
+    os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600")
+)
+# RESPONSE_CACHE_MAX_BYTES: 进程内缓存条目的总字节数上限，超过后淘汰最久未使用的条目。默认 64 MB。
+RESPONSE_CACHE_MAX_BYTES: int = int(
+    os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+# RESPONSE_CACHE_BACKEND: 进程内缓存之外的第二级缓存。
+# - 'memory': 只使用进程内缓存。
+# - 'sqlite': 本机 SQLite 文件 (RESPONSE_CACHE_SQLITE_PATH)，重启后仍然有效。
+# - 'redis': Redis (使用 REDIS_URL)，可在多个 worker / 多台机器间共享。
+# 默认为 'memory'。
+RESPONSE_CACHE_BACKEND: str = os.environ.get("RESPONSE_CACHE_BACKEND", "memory").lower()
+# RESPONSE_CACHE_SQLITE_PATH: 'sqlite' 后端的数据库文件路径。默认 "data/response_cache.db"。
+RESPONSE_CACHE_SQLITE_PATH: str = os.environ.get(
+    "RESPONSE_CACHE_SQLITE_PATH", "data/response_cache.db"
+)
+# RESPONSE_CACHE_REDIS_PREFIX: 'redis' 后端的键前缀。默认 "gap:response:"。
+RESPONSE_CACHE_REDIS_PREFIX: str = os.environ.get(
+    "RESPONSE_CACHE_REDIS_PREFIX", "gap:response:"
+)
+
+# --- 批处理 (Batch API) 配置 ---
+# BATCH_STORAGE_DIR: /v1/files 上传的文件、批处理任务状态和结果 JSONL 的存储目录。默认 "data/batches"。
+BATCH_STORAGE_DIR: str = os.environ.get("BATCH_STORAGE_DIR", "data/batches")
+# BATCH_MAX_FILE_BYTES: 单个上传文件的最大字节数。默认 200 MB。
+BATCH_MAX_FILE_BYTES: int = int(
+    os.environ.get("BATCH_MAX_FILE_BYTES", str(200 * 1024 * 1024))
+)
+# BATCH_MAX_CONCURRENCY: 单个批处理任务同时在途的最大条目数 (实际并发在 1 到此值之间按 AIMD 自适应调整)。默认 16。
+BATCH_MAX_CONCURRENCY: int = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))
+# BATCH_HEADROOM_RESERVE: 为交互流量保留的 RPM/TPM 余量比例。Key 池在某个模型上的剩余余量低于此比例时，
+# 批处理暂停派发该模型的新条目。默认 0.2 (保留 20%)。
+BATCH_HEADROOM_RESERVE: float = float(os.environ.get("BATCH_HEADROOM_RESERVE", "0.2"))
+# BATCH_ITEM_MAX_RETRIES: 单个条目因容量不足 (429/503) 被退回后的最大重新排队次数，超过后写入错误文件。默认 20。
+BATCH_ITEM_MAX_RETRIES: int = int(os.environ.get("BATCH_ITEM_MAX_RETRIES", "20"))
+# BATCH_POLL_INTERVAL_SECONDS: 批处理调度器在暂停 (余量不足或有交互请求排队) 时重新检查的间隔（秒）。默认 0.5 秒。
+BATCH_POLL_INTERVAL_SECONDS: float = float(
+    os.environ.get("BATCH_POLL_INTERVAL_SECONDS", "0.5")
+)
+
+# --- 嵌入 (Embeddings) 配置 ---
+# EMBEDDING_DEFAULT_MODEL: /v1/embeddings 请求未指定模型时使用的嵌入模型。默认 "text-embedding-004"。
+EMBEDDING_DEFAULT_MODEL: str = os.environ.get("EMBEDDING_DEFAULT_MODEL", "text-embedding-004")
+# EMBEDDING_MAX_BATCH_SIZE: 合并到一次 batchEmbedContents 调用中的最大文本数 (上游上限为 100)。默认 100。
+EMBEDDING_MAX_BATCH_SIZE: int = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "100"))
+# EMBEDDING_MAX_LINGER_MS: 批次中第一条文本等待其他文本加入的最长时间（毫秒），到时未满也立即发送。默认 10 毫秒。
+EMBEDDING_MAX_LINGER_MS: float = float(os.environ.get("EMBEDDING_MAX_LINGER_MS", "10"))
+# EMBEDDING_CACHE_SIZE: 按 (模型, 维度, 文本) 内容哈希缓存的向量条目数，设为 0 禁用缓存。默认 50000。
+EMBEDDING_CACHE_SIZE: int = int(os.environ.get("EMBEDDING_CACHE_SIZE", "50000"))
+
 # --- HTTP 客户端超时配置 ---
 # HTTP_TIMEOUT_CONNECT: HTTP客户端连接超时时间（秒）。默认 10 秒。
 _default_http_connect_timeout = 10.0
@@ -311,6 +574,23 @@ except ValueError:
     _http_pool_timeout = _default_http_pool_timeout
 HTTP_TIMEOUT_POOL: float = _http_pool_timeout
 
+# --- HTTP 连接池配置 ---
+# 共享 httpx.AsyncClient 的连接池上限，所有 Key 的上游请求复用同一个池。
+# HTTP_MAX_CONNECTIONS: 最大并发连接数。默认 200。
+HTTP_MAX_CONNECTIONS: int = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+# HTTP_MAX_KEEPALIVE_CONNECTIONS: 最大保持活动的空闲连接数。默认 50。
+HTTP_MAX_KEEPALIVE_CONNECTIONS: int = int(
+    os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "50")
+)
+# HTTP_KEEPALIVE_EXPIRY: 空闲连接的保持时间（秒）。默认 30 秒。
+HTTP_KEEPALIVE_EXPIRY: float = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# GEMINI_API_BASE_URL: Gemini REST API 的基础地址 (包含版本号)。
+# 可指向自建反向代理或测试用的模拟上游。
+GEMINI_API_BASE_URL: str = os.environ.get(
+    "GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com/v1beta"
+).rstrip("/")
+
 # --- API 操作超时配置 ---
 # API_TIMEOUT_MODELS_LIST: 获取可用模型列表的超时时间（秒）。默认 60 秒。
 _default_api_models_timeout = 60.0
@@ -93,8 +93,9 @@ class UserKeyAssociation(Base):
 
 class KeyScore(Base):
     """
-    API 密钥分数模型 (目前可能未使用)。
-    设计用于存储每个 Key 对不同模型的评分或优先级。
+    API 密钥分数模型。
+    存储评分引擎 (core/keys/scoring.py) 计算出的每个 Key 对不同模型的健康度分数，
+    用于应用重启后预热 Key 分数缓存。
     对应数据库中的 'key_scores' 表。
     """
 
@@ -106,7 +107,7 @@ class KeyScore(Base):
     key_id = Column(
         Integer, nullable=False, index=True
     )  # 关联的 ApiKey 表的 ID，不允许为空，建立索引
-    score = Column(Float, nullable=False)  # Key 对该模型的分数
+    score = Column(Float, nullable=False)  # Key 对该模型的健康度 (不含余量部分)
 
     def __repr__(self):
         """
@@ -6,7 +6,7 @@
 import logging  # 导入日志模块
 from contextlib import asynccontextmanager  # 导入异步上下文管理器
 from datetime import datetime, timezone  # 导入日期时间处理
-from typing import Any, AsyncGenerator, Dict, List, Optional  # 导入类型提示
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple  # 导入类型提示
 
 import aiosqlite  # 导入异步 SQLite 驱动
 import sqlalchemy  # 导入 SQLAlchemy 核心库
@@ -21,12 +21,10 @@ from sqlalchemy.sql import text  # 导入用于执行原生 SQL 的 text 函数
 from gap.core.database.models import (  # 导入数据库模型
     ApiKey,
     Base,
+    CachedContent,
+    KeyScore,
     UserKeyAssociation,
 )
-from gap.core.tracking import (  # 导入 Key 分数缓存和锁 (路径不变)
-    cache_lock,
-    key_scores_cache,
-)
 
 # --- 数据库路径和 URL 配置 ---
 # 使用 os 模块动态确定数据库文件的绝对路径，增强可移植性
@@ -515,8 +513,6 @@ async def get_key_id_by_cached_content_id(
         Optional[int]: 关联的 Key ID，如果找不到或出错则返回 None。
     """
     # logger.warning("get_key_id_by_cached_content_id 函数尚未完全实现，返回模拟数据。") # 移除警告
-    from gap.core.database.models import CachedContent  # 导入模型
-
     try:
         # 假设 cached_content_id 是 CachedContent.content_id (通常是哈希或 Gemini cache name)
         # 或者，如果它可能是整数 CachedContent.id，则需要类型检查
@@ -524,9 +520,16 @@ async def get_key_id_by_cached_content_id(
             stmt = select(CachedContent.key_id).where(
                 CachedContent.id == cached_content_id
             )
-        else:  # 否则按 content_id (字符串) 查询
-            stmt = select(CachedContent.key_id).where(
-                CachedContent.content_id == cached_content_id
+        else:  # 否则按 content_id (字符串) 或 Gemini 缓存 ID (find_cache 返回的标识符) 查询
+            stmt = (
+                select(CachedContent.key_id)
+                .where(
+                    sqlalchemy.or_(
+                        CachedContent.content_id == cached_content_id,
+                        CachedContent.gemini_cache_id == cached_content_id,
+                    )
+                )
+                .limit(1)
             )
 
         result = await db.execute(stmt)
@@ -595,35 +598,207 @@ async def get_user_last_used_key_id(db: AsyncSession, user_id: str) -> Optional[
         return None
 
 
-async def get_key_scores(model_name: str) -> Dict[str, float]:
+async def get_user_key_associations(
+    db: AsyncSession, limit: int
+) -> List[Tuple[str, str, float]]:
     """
-    (需要实现/可能已废弃) 获取指定模型的 Key 分数。
-    目前从内存缓存 key_scores_cache 获取 (如果存在)。
+    读取最近的用户-Key 关联 (用于启动时加载内存中的粘性会话映射)。
 
     Args:
-        model_name (str): 模型名称。
+        db (AsyncSession): 数据库会话。
+        limit (int): 最多读取的关联条数 (按最后使用时间取最近的)。
 
     Returns:
-        Dict[str, float]: 包含 Key 字符串和对应分数的字典。
+        List[Tuple[str, str, float]]: (user_id, key_string, last_used_timestamp) 列表，
+        按时间从旧到新排列，依次写入映射即可让每个用户保留最近使用的 Key。
     """
-    logger.debug(
-        "get_key_scores 函数可能依赖于内存缓存或未完全实现的数据库逻辑。"
-    )  # 记录警告改为 debug
     try:
-        # TODO: 实现从 KeyScore 表获取分数的逻辑，或者确认是否依赖内存缓存
-        # 暂时从内存缓存获取
-        with cache_lock:  # 使用锁保护缓存访问
-            scores = key_scores_cache.get(
-                model_name, {}
-            )  # 获取模型对应的分数，默认为空字典
-            return scores.copy()  # 返回缓存的副本
+        stmt = (
+            select(
+                UserKeyAssociation.user_id,
+                ApiKey.key_string,
+                UserKeyAssociation.last_used_timestamp,
+            )
+            .join(ApiKey, ApiKey.id == UserKeyAssociation.key_id)
+            .order_by(UserKeyAssociation.last_used_timestamp.desc())
+            .limit(limit)
+        )
+        result = await db.execute(stmt)
+        return [tuple(row) for row in reversed(result.all())]
     except Exception as e:
-        logger.error(
-            f"获取模型 '{model_name}' 的 Key 分数失败: {e}", exc_info=True
-        )  # 记录错误
+        logger.error(f"读取用户-Key 关联失败: {e}", exc_info=True)  # 记录错误
+        return []
+
+
+async def get_cached_content_keys(
+    db: AsyncSession, limit: int
+) -> List[Tuple[str, Optional[str], str]]:
+    """
+    读取未过期的缓存内容与创建它的 Key 的对应关系 (用于启动时加载内存中的缓存关联映射)。
+
+    Args:
+        db (AsyncSession): 数据库会话。
+        limit (int): 最多读取的条数 (按创建时间取最近的)。
+
+    Returns:
+        List[Tuple[str, Optional[str], str]]: (content_id, gemini_cache_id, key_string) 列表，按时间从旧到新排列。
+    """
+    try:
+        now_ts = datetime.now(timezone.utc).timestamp()
+        stmt = (
+            select(
+                CachedContent.content_id,
+                CachedContent.gemini_cache_id,
+                ApiKey.key_string,
+            )
+            .join(ApiKey, ApiKey.id == CachedContent.key_id)
+            .where(CachedContent.expiration_timestamp > now_ts)
+            .order_by(CachedContent.creation_timestamp.desc())
+            .limit(limit)
+        )
+        result = await db.execute(stmt)
+        return [tuple(row) for row in reversed(result.all())]
+    except Exception as e:
+        logger.error(f"读取缓存内容关联 Key 失败: {e}", exc_info=True)  # 记录错误
+        return []
+
+
+async def save_user_key_associations(
+    db: AsyncSession, associations: Dict[str, Tuple[str, float]]
+) -> int:
+    """
+    批量写入用户-Key 关联 (按 user_id + key_id 更新时间戳或插入新记录)，一次提交。
+    只有在 api_keys 表中存在的 Key 会被写入。
+
+    Args:
+        db (AsyncSession): 数据库会话。
+        associations (Dict[str, Tuple[str, float]]): {user_id: (key_string, last_used_timestamp)}。
+
+    Returns:
+        int: 实际写入 (更新或插入) 的条目数量。
+    """
+    key_strings = {key_string for key_string, _ in associations.values()}
+    if not key_strings:
+        return 0
+    result = await db.execute(
+        select(ApiKey.id, ApiKey.key_string).where(ApiKey.key_string.in_(key_strings))
+    )
+    key_ids = {key_string: key_id for key_id, key_string in result.all()}
+    if not key_ids:
+        return 0
+
+    saved = 0
+    try:
+        existing_result = await db.execute(
+            select(UserKeyAssociation).where(
+                UserKeyAssociation.user_id.in_(list(associations))
+            )
+        )
+        existing = {
+            (row.user_id, row.key_id): row for row in existing_result.scalars().all()
+        }
+        for user_id, (key_string, last_used_timestamp) in associations.items():
+            key_id = key_ids.get(key_string)
+            if key_id is None:
+                continue
+            row = existing.get((user_id, key_id))
+            if row is None:
+                db.add(
+                    UserKeyAssociation(
+                        user_id=user_id,
+                        key_id=key_id,
+                        last_used_timestamp=last_used_timestamp,
+                    )
+                )
+            else:
+                row.last_used_timestamp = last_used_timestamp
+            saved += 1
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"批量写入用户-Key 关联失败: {e}", exc_info=True)  # 记录错误
+        raise
+    return saved
+
+
+async def get_key_scores(
+    db: AsyncSession, model_name: Optional[str] = None
+) -> Dict[str, Dict[str, float]]:
+    """
+    从 KeyScore 表读取已持久化的 Key 分数。
+
+    Args:
+        db (AsyncSession): 数据库会话。
+        model_name (Optional[str]): 仅读取指定模型的分数；为 None 时读取全部模型。
+
+    Returns:
+        Dict[str, Dict[str, float]]: 结构为 {model_name: {key_string: score}} 的字典。
+    """
+    try:
+        stmt = select(KeyScore.model_name, ApiKey.key_string, KeyScore.score).join(
+            ApiKey, ApiKey.id == KeyScore.key_id
+        )
+        if model_name is not None:
+            stmt = stmt.where(KeyScore.model_name == model_name)
+        result = await db.execute(stmt)
+        scores: Dict[str, Dict[str, float]] = {}
+        for row_model, key_string, score in result.all():
+            scores.setdefault(row_model, {})[key_string] = score
+        return scores
+    except Exception as e:
+        logger.error(f"读取 Key 分数失败: {e}", exc_info=True)  # 记录错误
         return {}  # 出错时返回空字典
 
 
+async def save_key_scores(
+    db: AsyncSession, scores: Dict[str, Dict[str, float]]
+) -> int:
+    """
+    将 Key 分数写入 KeyScore 表 (按 model_name + key_id 更新或插入)。
+    只有在 api_keys 表中存在的 Key 会被写入 (例如环境变量模式下的 Key 没有数据库 ID，会被跳过)。
+
+    Args:
+        db (AsyncSession): 数据库会话。
+        scores (Dict[str, Dict[str, float]]): 结构为 {model_name: {key_string: score}} 的字典。
+
+    Returns:
+        int: 实际写入 (更新或插入) 的条目数量。
+    """
+    key_strings = {k for model_scores in scores.values() for k in model_scores}
+    if not key_strings:
+        return 0
+    result = await db.execute(
+        select(ApiKey.id, ApiKey.key_string).where(ApiKey.key_string.in_(key_strings))
+    )
+    key_ids = {key_string: key_id for key_id, key_string in result.all()}
+    if not key_ids:
+        return 0
+
+    saved = 0
+    try:
+        for model_name, model_scores in scores.items():
+            existing_result = await db.execute(
+                select(KeyScore).where(KeyScore.model_name == model_name)
+            )
+            existing = {row.key_id: row for row in existing_result.scalars().all()}
+            for key_string, score in model_scores.items():
+                key_id = key_ids.get(key_string)
+                if key_id is None:
+                    continue
+                row = existing.get(key_id)
+                if row is None:
+                    db.add(KeyScore(model_name=model_name, key_id=key_id, score=score))
+                else:
+                    row.score = score
+                saved += 1
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"写入 Key 分数失败: {e}", exc_info=True)  # 记录错误
+        raise
+    return saved
+
+
 async def update_setting(db: AsyncSession, key: str, value: str):
     """
     (重复/可能已废弃) 更新或插入设置项。
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+所有 Key 都饱和时的准入等待队列。
+
+原先找不到可用 Key 时请求先 sleep 0.5 秒再重试，尝试次数用完后返回 503；
+而其中很多请求在几秒后 (某个 Key 的 RPM/TPM 窗口回落或在途请求完成时) 就能成功。
+本模块提供一个有界的等待队列：
+- 只有因容量不足 (并发上限、TPM 预检查、熔断、临时不可用) 而选不到 Key 的请求才进入队列；
+  全部 Key 已尝试或当天耗尽时等待没有意义，直接失败；
+- 等待者按 (优先级, 入队顺序) 排队，某个 Key 释放容量 (并发名额归还、TPM 预留退还、熔断器恢复、
+  每日重置) 时按模型唤醒队首的一个等待者；被唤醒者选到 Key 后把"接力棒"传给下一个等待者，
+  选不到时以原来的位置重新排队；
+- 时间驱动的恢复 (滑动窗口中较早的时间段过期、熔断或临时不可用到期) 由选择时给出的最早恢复时间作为定时唤醒，
+  不做轮询；
+- 队列深度 (ADMISSION_QUEUE_MAX_DEPTH) 和单个请求的累计等待时间 (ADMISSION_QUEUE_MAX_WAIT_SECONDS)
+  有上限，超出时立即拒绝 (503)，并记录入队、唤醒、超时、拒绝次数和等待时间等指标。
+"""
+
+import asyncio  # 等待与唤醒
+import heapq  # 按 (优先级, 入队顺序) 排序的等待者堆
+import itertools  # 入队序号
+import math  # 无穷大表示只能等待释放事件
+import threading  # 保护队列状态的线程锁 (释放事件可能来自其他线程)
+import time  # 时间戳
+from typing import Any, Dict, List, Optional, Tuple
+
+from gap import config  # 应用配置
+
+# 默认优先级 (数值越小越先唤醒)
+DEFAULT_PRIORITY = 10
+# 管理员请求的优先级
+ADMIN_PRIORITY = 0
+
+
+class AdmissionTicket:
+    """
+    一个请求在准入队列中的排队凭证。同一请求多次等待时复用同一凭证，保持原来的排队位置。
+
+    Attributes:
+        priority (int): 优先级，数值越小越先唤醒。
+        seq (int): 首次入队的序号 (同优先级内 FIFO)。
+        waited_seconds (float): 累计等待时间。
+        notified (bool): 最近一次等待是否由容量释放事件唤醒 (选到 Key 后需要传递唤醒)。
+    """
+
+    __slots__ = ("priority", "seq", "waited_seconds", "notified", "_future")
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.waited_seconds = 0.0
+        self.notified = False
+        self._future: Optional[asyncio.Future] = None
+
+
+class AdmissionQueue:
+    """
+    按模型划分的有界准入等待队列。wait() 在事件循环中调用；notify() 可以在任意线程调用。
+    """
+
+    def __init__(
+        self,
+        max_depth: Optional[int] = None,
+        max_wait_seconds: Optional[float] = None,
+    ):
+        self.max_depth = (
+            config.ADMISSION_QUEUE_MAX_DEPTH if max_depth is None else max_depth
+        )
+        self.max_wait_seconds = (
+            config.ADMISSION_QUEUE_MAX_WAIT_SECONDS
+            if max_wait_seconds is None
+            else max_wait_seconds
+        )
+        self._seq = itertools.count()
+        # 模型 -> [(优先级, 入队序号, 条目序号, 凭证)] 最小堆；已结束等待的条目惰性删除
+        self._waiters: Dict[str, List[Tuple[int, int, int, AdmissionTicket]]] = {}
+        self._depth = 0  # 当前正在等待的请求数
+        self._lock = threading.Lock()  # 保护等待者堆和指标 (不在持锁期间获取其他锁)
+        self._stats: Dict[str, float] = {}
+        self._reset_stats_nolock()
+
+    def _reset_stats_nolock(self) -> None:
+        self._stats = {
+            "enqueued": 0,  # 进入等待的次数
+            "notified": 0,  # 被容量释放事件唤醒的次数
+            "timer_wakeups": 0,  # 到达最早恢复时间后被定时唤醒的次数
+            "timed_out": 0,  # 超过等待时间上限或请求截止时间的次数
+            "rejected_full": 0,  # 队列已满被立即拒绝的次数
+            "max_depth_seen": 0,  # 统计周期内的最大队列深度
+            "wait_seconds_total": 0.0,  # 累计等待时间
+            "wait_seconds_max": 0.0,  # 单次等待的最长时间
+        }
+
+    def ticket(self, priority: int = DEFAULT_PRIORITY) -> AdmissionTicket:
+        """创建排队凭证 (请求第一次需要等待时调用)。"""
+        return AdmissionTicket(priority, next(self._seq))
+
+    @property
+    def depth(self) -> int:
+        """当前正在等待的请求数。"""
+        return self._depth
+
+    async def wait(
+        self,
+        model_name: str,
+        ticket: AdmissionTicket,
+        retry_at: Optional[float] = None,
+        deadline_seconds: Optional[float] = None,
+    ) -> bool:
+        """
+        等待该模型的某个 Key 释放容量。
+
+        Args:
+            model_name (str): 模型名称。
+            ticket (AdmissionTicket): 请求的排队凭证。
+            retry_at (Optional[float]): 容量最早可能恢复的时间戳 (time.time() 基准)；
+                None 或 math.inf 表示只能等待释放事件。
+            deadline_seconds (Optional[float]): 请求剩余的截止时间 (秒)，None 表示不限制。
+
+        Returns:
+            bool: 被唤醒 (释放事件或到达最早恢复时间) 时返回 True，应重新选择 Key；
+                  队列已满、超过等待时间上限或请求截止时间时返回 False。
+        """
+        loop = asyncio.get_running_loop()
+        budget = self.max_wait_seconds - ticket.waited_seconds
+        if deadline_seconds is not None:
+            budget = min(budget, deadline_seconds)
+        timeout = budget
+        timer_wakeup = False
+        if retry_at is not None and retry_at != math.inf:
+            delay = max(0.0, retry_at - time.time())
+            if delay < timeout:
+                timeout, timer_wakeup = delay, True
+
+        with self._lock:
+            if budget <= 0:
+                self._stats["timed_out"] += 1
+                return False
+            if self._depth >= self.max_depth:
+                self._stats["rejected_full"] += 1
+                return False
+            future = loop.create_future()
+            ticket._future = future
+            ticket.notified = False
+            heapq.heappush(
+                self._waiters.setdefault(model_name, []),
+                (ticket.priority, ticket.seq, next(self._seq), ticket),
+            )
+            self._depth += 1
+            self._stats["enqueued"] += 1
+            self._stats["max_depth_seen"] = max(
+                self._stats["max_depth_seen"], self._depth
+            )
+
+        started_at = loop.time()
+        notified = False
+        try:
+            notified = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            notified = False
+        finally:
+            waited = loop.time() - started_at
+            ticket.waited_seconds += waited
+            ticket._future = None
+            with self._lock:
+                self._depth -= 1
+                if not future.done():
+                    future.cancel()  # 队列中的条目随之失效
+                heap = self._waiters.get(model_name)
+                if heap is not None and len(heap) > 2 * self._depth + 64:
+                    # 丢弃已结束等待的条目
+                    live = [item for item in heap if item[3]._future is not None]
+                    heapq.heapify(live)
+                    self._waiters[model_name] = live
+                self._stats["wait_seconds_total"] += waited
+                self._stats["wait_seconds_max"] = max(
+                    self._stats["wait_seconds_max"], waited
+                )
+                if notified:
+                    self._stats["notified"] += 1
+                elif timer_wakeup:
+                    self._stats["timer_wakeups"] += 1
+                else:
+                    self._stats["timed_out"] += 1
+        ticket.notified = bool(notified)
+        return bool(notified) or timer_wakeup
+
+    def notify(self, model_name: str, count: int = 1) -> int:
+        """
+        某个 Key 在该模型下释放了容量：按 (优先级, 入队顺序) 唤醒最多 count 个等待者。
+
+        Returns:
+            int: 唤醒的等待者数量。
+        """
+        if not self._depth:  # 无人等待时的快速路径 (不加锁读取，可能短暂过期)
+            return 0
+        woken: List[asyncio.Future] = []
+        with self._lock:
+            heap = self._waiters.get(model_name)
+            while heap and len(woken) < count:
+                ticket = heapq.heappop(heap)[3]
+                future = ticket._future
+                if future is None or future.done():
+                    continue  # 已结束等待
+                woken.append(future)
+            if heap is not None and not heap:
+                del self._waiters[model_name]
+        for future in woken:
+            self._resolve(future)
+        return len(woken)
+
+    def notify_all(self) -> int:
+        """唤醒所有模型的所有等待者 (例如每日配额重置后)。"""
+        with self._lock:
+            models = list(self._waiters)
+        return sum(
+            self.notify(model_name, count=self.max_depth) for model_name in models
+        )
+
+    @staticmethod
+    def _resolve(future: asyncio.Future) -> None:
+        """(内部方法) 在等待者所在的事件循环中唤醒它。"""
+        loop = future.get_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            if not future.done():
+                future.set_result(True)
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+    def get_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        返回队列指标。
+
+        Args:
+            reset (bool): 为 True 时同时清空累计指标，开始新的统计周期。
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["depth"] = self._depth
+            stats["max_depth"] = self.max_depth
+            stats["max_wait_seconds"] = self.max_wait_seconds
+            stats["waiting_by_model"] = {
+                model_name: sum(
+                    1
+                    for _, _, _, ticket in heap
+                    if ticket._future is not None and not ticket._future.done()
+                )
+                for model_name, heap in self._waiters.items()
+            }
+            if reset:
+                self._reset_stats_nolock()
+        return stats
+
+
+# 全局的准入等待队列实例
+admission_queue = AdmissionQueue()
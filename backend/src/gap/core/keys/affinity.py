@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Key 关联映射：用户→Key (粘性会话) 和缓存内容→Key (缓存关联)。
+
+Key 选择的策略 1、2 原先在每次尝试时都查询数据库 (缓存内容 ID → Key ID → Key 字符串、
+用户上次使用的 Key ID → Key 字符串)，调用成功后还要为每个请求执行一次查询、写入和提交。
+本模块在内存中维护两个有界的 LRU 映射：
+- 启动时从 UserKeyAssociation 和 CachedContent 表加载；
+- 映射中没有的标识符只在首次出现时查询一次数据库，结果 (包括"无关联") 写入映射；
+- 用户-Key 关联的更新先写入映射并合并到待写入集合 (同一用户只保留最新一次)，
+  由后台任务周期性地批量写入数据库 (write-behind)。
+因此热路径上的关联查找和更新不产生数据库往返。
+"""
+
+import logging  # 日志记录
+import threading  # 保护映射的线程锁
+import time  # 时间戳
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession  # 异步数据库会话
+
+from gap import config  # 应用配置
+from gap.core.database import utils as db_utils  # 关联表读写
+from gap.core.utils.lru import MISSING, LRUMap  # 线程安全的有界 LRU 映射
+
+logger = logging.getLogger("my_logger")
+
+
+class KeyAffinityStore:
+    """
+    用户→Key 和缓存内容→Key 的内存关联映射，以及用户-Key 关联的合并写回。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None):
+        max_entries = (
+            config.KEY_AFFINITY_MAX_ENTRIES if max_entries is None else max_entries
+        )
+        self.user_keys: LRUMap[str] = LRUMap(max_entries)  # user_id -> Key
+        self.cached_content_keys: LRUMap[str] = LRUMap(max_entries)  # 缓存 ID -> Key
+        # 尚未写入数据库的用户-Key 关联：user_id -> (Key, 最后使用时间戳)
+        self._pending: Dict[str, Tuple[str, float]] = {}
+        self._max_pending = max(1, max_entries)
+        self._pending_lock = threading.Lock()  # 保护 _pending (不在持锁期间获取其他锁)
+
+    # --- 用户→Key (粘性会话) ---
+
+    async def get_user_key(
+        self, user_id: str, db: Optional[AsyncSession] = None
+    ) -> Optional[str]:
+        """
+        返回用户上次成功使用的 Key。映射中没有该用户且提供了 db 时查询一次数据库并缓存结果。
+        """
+        cached = self.user_keys.get(user_id)
+        if cached is not MISSING:
+            return cached  # type: ignore[return-value]
+        key_string: Optional[str] = None
+        if db is not None:
+            key_id = await db_utils.get_user_last_used_key_id(db, user_id)
+            if key_id is not None:
+                key_string = await db_utils.get_key_string_by_id(db, key_id)
+        # 查询期间可能已有新的关联写入，不覆盖
+        if self.user_keys.get(user_id) is MISSING:
+            self.user_keys.set(user_id, key_string)
+        return key_string
+
+    def record_user_key(self, user_id: str, api_key: str) -> None:
+        """记录用户最近一次成功使用的 Key：立即更新映射，并合并到待写入集合。"""
+        now = time.time()
+        self.user_keys.set(user_id, api_key)
+        with self._pending_lock:
+            self._pending.pop(user_id, None)
+            self._pending[user_id] = (api_key, now)
+            if len(self._pending) > self._max_pending:
+                # 写回长时间失败时丢弃最旧的待写入关联，内存中的映射仍然有效
+                self._pending.pop(next(iter(self._pending)))
+
+    # --- 缓存内容→Key (缓存关联) ---
+
+    async def get_cached_content_key(
+        self, cached_content_id: str, db: Optional[AsyncSession] = None
+    ) -> Optional[str]:
+        """
+        返回创建该缓存内容的 Key。映射中没有且提供了 db 时查询一次数据库并缓存结果。
+        """
+        cached = self.cached_content_keys.get(cached_content_id)
+        if cached is not MISSING:
+            return cached  # type: ignore[return-value]
+        key_string: Optional[str] = None
+        if db is not None:
+            key_id = await db_utils.get_key_id_by_cached_content_id(
+                db, cached_content_id
+            )
+            if key_id is not None:
+                key_string = await db_utils.get_key_string_by_id(db, key_id)
+        self.cached_content_keys.set(cached_content_id, key_string)
+        return key_string
+
+    def record_cached_content_key(self, cached_content_id: str, api_key: str) -> None:
+        """记录缓存内容由哪个 Key 创建。"""
+        self.cached_content_keys.set(cached_content_id, api_key)
+
+    # --- 维护 ---
+
+    def forget_key(self, api_key: str) -> None:
+        """移除所有指向该 Key 的关联 (例如 Key 被删除时)。"""
+        self.user_keys.remove_value(api_key)
+        self.cached_content_keys.remove_value(api_key)
+        with self._pending_lock:
+            for user_id in [u for u, (k, _) in self._pending.items() if k == api_key]:
+                del self._pending[user_id]
+
+    def pending_count(self) -> int:
+        """尚未写入数据库的用户-Key 关联数量。"""
+        return len(self._pending)
+
+    async def load(self, db: AsyncSession) -> Tuple[int, int]:
+        """
+        从数据库加载最近的用户-Key 关联和未过期缓存内容的关联 Key。
+
+        Returns:
+            Tuple[int, int]: (加载的用户关联数量, 加载的缓存关联数量)。
+        """
+        associations = await db_utils.get_user_key_associations(
+            db, self.user_keys.max_entries
+        )
+        for user_id, key_string, _ in associations:
+            self.user_keys.set(user_id, key_string)
+        cached_contents = await db_utils.get_cached_content_keys(
+            db, self.cached_content_keys.max_entries
+        )
+        for content_id, gemini_cache_id, key_string in cached_contents:
+            # find_cache 返回 Gemini 缓存 ID，两种标识符都可用于查找
+            for identifier in (content_id, gemini_cache_id):
+                if identifier:
+                    self.cached_content_keys.set(identifier, key_string)
+        logger.info(
+            f"已从数据库加载 {len(associations)} 条用户-Key 关联和 {len(cached_contents)} 条缓存-Key 关联。"
+        )
+        return len(associations), len(cached_contents)
+
+    async def flush(self, db: AsyncSession) -> int:
+        """
+        将累积的用户-Key 关联更新批量写入数据库。
+
+        Returns:
+            int: 写入的关联数量。
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            saved = await db_utils.save_user_key_associations(db, pending)
+        except Exception:
+            # 写入失败时放回待写入集合 (不覆盖期间产生的更新)，留待下次重试
+            self._requeue(pending.items())
+            raise
+        logger.debug(f"已批量写入 {saved} 条用户-Key 关联。")
+        return saved
+
+    def _requeue(self, items: Iterable[Tuple[str, Tuple[str, float]]]) -> None:
+        """(内部方法) 把写入失败的关联放回待写入集合。"""
+        with self._pending_lock:
+            for user_id, value in items:
+                if user_id not in self._pending:
+                    self._pending[user_id] = value
+
+    def reset(self) -> None:
+        """清空映射和待写入集合 (主要用于测试)。"""
+        self.user_keys.clear()
+        self.cached_content_keys.clear()
+        with self._pending_lock:
+            self._pending.clear()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+按模型划分的 Key 候选索引。
+
+策略 3 (基于评分的轮转) 需要在"分数接近最高分"的 Key 中选出最久未被选中的那个。
+逐个遍历所有 Key、再两次完整排序的做法在 Key 数量达到数千时，每次请求和每次重试都要付出
+O(n log n) 的代价。本模块为每个模型维护一个分桶优先队列：
+- 按分数把 Key 分到几何宽度为 SCORE_BAND_RATIO 的细分数段 (band)，band 越小分数越高；
+- 每个分数段内部是以 (上次选中时间, -分数) 为键的最小堆，堆顶即最久未被选中的 Key；
+- 另有一个按分数排序的最大堆，用于取得当前最高分；
+- 轮转范围是分数不低于当前最高分 ROTATION_SCORE_RATIO (95%) 的 Key：分数段是固定的，
+  该范围通常跨越多个分数段，选择时把这些分数段的堆按上次选中时间合并遍历；
+  只有最后一个 (跨越阈值的) 分数段需要逐个比较分数，细分数段使其中低于阈值的 Key 很少；
+- 分数变化、选中后更新时间时压入新条目，旧条目通过序号失效 (惰性删除)；
+- 每日耗尽或临时不可用的 Key 被移出堆，放入按恢复时间排序的挂起堆，到期后自动重新加入。
+因此一次选择只需 O(log n) 的堆操作 (外加本请求已尝试过的 Key 的少量重新压入)。
+"""
+
+import heapq  # 最小堆
+import itertools  # 条目序号生成
+import math  # 计算分数段
+import threading  # 保护索引的线程锁
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 轮转范围：分数不低于当前最高分该比例的 Key 按上次选中时间轮转
+ROTATION_SCORE_RATIO = 0.95
+# 轮转范围对应的分数跨度划分的分数段数，越多则跨越阈值的分数段中需要逐个比较的 Key 越少
+BANDS_PER_ROTATION = 8
+# 分数段的几何宽度：同一分数段内最低分不低于最高分的该比例
+SCORE_BAND_RATIO = ROTATION_SCORE_RATIO ** (1 / BANDS_PER_ROTATION)
+# 分数过低 (包括 0 分) 的 Key 统一归入的最后一个分数段
+MAX_SCORE_BAND = 200 * BANDS_PER_ROTATION
+# 挂起直到被显式恢复
+SUSPEND_INDEFINITELY = math.inf
+
+
+def score_band(score: float) -> int:
+    """返回分数所在的分数段编号，分数越高编号越小。"""
+    if score >= 1.0:
+        return 0
+    if score <= 0.0:
+        return MAX_SCORE_BAND
+    return min(MAX_SCORE_BAND, int(math.log(score) / math.log(SCORE_BAND_RATIO)))
+
+
+class CandidateIndex:
+    """
+    单个模型的 Key 候选索引。
+
+    `pick` 先在轮转范围 (不低于最高分 95%) 内按上次选中时间从早到晚，再按分数段从高到低、
+    段内按上次选中时间从早到晚依次把候选 Key 交给调用方提供的检查函数，
+    选中第一个通过检查的 Key，并把它的上次选中时间更新为当前时间。
+    检查函数可能访问共享状态后端 (网络往返)，因此 `pick` 只在取出候选和放回时持有内部锁，
+    检查期间不持锁：取出的候选 Key 暂时离开堆，其他线程的选择不会同时检查它。
+    所有操作都不会 await，可在事件循环或线程池中调用。
+    """
+
+    def __init__(
+        self,
+        scores: Dict[str, float],
+        last_used: Optional[Dict[str, float]] = None,
+    ):
+        """
+        Args:
+            scores (Dict[str, float]): 初始的 {Key: 分数}。
+            last_used (Optional[Dict[str, float]]): 初始的 {Key: 上次使用时间戳}，缺省为 0。
+        """
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # Key -> (分数段, 上次选中时间, 分数, 序号)；不在其中的 Key 要么被挂起，要么不在索引中
+        self._entries: Dict[str, Tuple[int, float, float, int]] = {}
+        # 分数段 -> [(上次选中时间, -分数, 序号, Key)] 最小堆
+        self._bands: Dict[int, List[Tuple[float, float, int, str]]] = {}
+        # [(-分数, 上次选中时间, 序号, Key)] 最小堆，堆顶为当前最高分 (含失效条目)
+        self._best: List[Tuple[float, float, int, str]] = []
+        # 所有分数段堆中的条目总数 (含失效条目)，用于判断是否需要压缩
+        self._heap_items = 0
+        # 正在进行的选择已从分数段堆中取出、尚未放回的条目：Key -> 序号 (压缩时不重建)
+        self._checked_out: Dict[str, int] = {}
+        # 被挂起的 Key：Key -> (恢复时间, 分数, 上次选中时间)，以及按恢复时间排序的堆
+        self._suspended: Dict[str, Tuple[float, float, float]] = {}
+        self._suspended_heap: List[Tuple[float, str]] = []
+        last_used = last_used or {}
+        with self._lock:
+            for api_key, score in scores.items():
+                self._push_nolock(api_key, score, last_used.get(api_key, 0.0))
+
+    def __len__(self) -> int:
+        """索引中可参与选择的 Key 数量 (不含挂起的 Key)。"""
+        return len(self._entries)
+
+    # --- 内部操作 (调用者必须持有 self._lock) ---
+
+    def _push_nolock(self, api_key: str, score: float, last_used: float) -> None:
+        """压入 Key 的新条目，使其旧条目失效。"""
+        band = score_band(score)
+        seq = next(self._seq)
+        self._entries[api_key] = (band, last_used, score, seq)
+        heapq.heappush(
+            self._bands.setdefault(band, []), (last_used, -score, seq, api_key)
+        )
+        heapq.heappush(self._best, (-score, last_used, seq, api_key))
+        self._heap_items += 1
+        limit = 2 * len(self._entries) + 64
+        if self._heap_items > limit or len(self._best) > limit:
+            self._compact_nolock()
+
+    def _compact_nolock(self) -> None:
+        """丢弃所有失效条目，重建各分数段的堆 (被取出检查的条目由取出它的选择放回)。"""
+        bands: Dict[int, List[Tuple[float, float, int, str]]] = {}
+        for api_key, (band, last_used, score, seq) in self._entries.items():
+            if self._checked_out.get(api_key) == seq:
+                continue
+            bands.setdefault(band, []).append((last_used, -score, seq, api_key))
+        for heap in bands.values():
+            heapq.heapify(heap)
+        self._bands = bands
+        self._best = [
+            (-score, last_used, seq, api_key)
+            for api_key, (_, last_used, score, seq) in self._entries.items()
+        ]
+        heapq.heapify(self._best)
+        self._heap_items = len(self._entries)
+
+    def _is_live(self, item: Tuple[float, float, int, str]) -> bool:
+        """堆条目 (分数段堆或最高分堆) 是否仍对应 Key 的当前状态。"""
+        entry = self._entries.get(item[3])
+        return entry is not None and entry[3] == item[2]
+
+    def _best_score_nolock(self) -> Optional[float]:
+        """当前可参与选择的 Key 中的最高分；没有 Key 时返回 None。"""
+        while self._best and not self._is_live(self._best[0]):
+            heapq.heappop(self._best)
+        return -self._best[0][0] if self._best else None
+
+    def _take_nolock(
+        self,
+        bands: List[int],
+        min_score: float,
+        below: List[Tuple[float, float, int, str]],
+    ) -> Optional[Tuple[float, float, int, str]]:
+        """
+        按上次选中时间合并 bands 中的分数段堆，取出下一个分数不低于 min_score 的有效条目。
+        取出的条目 (包括低于 min_score、追加到 below 的条目) 记为已取出，须由 _restore_nolock 放回。
+        """
+        while True:
+            heaps = [self._bands[band] for band in bands if self._bands.get(band)]
+            if not heaps:
+                return None
+            item = heapq.heappop(min(heaps, key=lambda h: h[0]))
+            self._heap_items -= 1
+            if not self._is_live(item):
+                continue
+            self._checked_out[item[3]] = item[2]
+            if -item[1] >= min_score:
+                return item
+            below.append(item)
+
+    def _drain(
+        self,
+        bands: List[int],
+        check: Callable[[str, float], Tuple[bool, Optional[float]]],
+        min_score: float,
+        skipped: List[Tuple[float, float, int, str]],
+    ) -> Optional[Tuple[float, float, int, str]]:
+        """
+        依次取出 bands 中分数不低于 min_score 的候选，在不持有锁的情况下交给 check，
+        返回第一个通过检查的条目。
+        未通过且不挂起的条目追加到 skipped，由调用者在选择结束后放回；低于 min_score 的条目在返回前放回。
+        """
+        below: List[Tuple[float, float, int, str]] = []
+        try:
+            while True:
+                with self._lock:
+                    item = self._take_nolock(bands, min_score, below)
+                if item is None:
+                    return None
+                accepted, suspend_until = check(item[3], -item[1])
+                if accepted:
+                    return item
+                if suspend_until is None:
+                    skipped.append(item)
+                    continue
+                with self._lock:
+                    self._release_nolock(item)
+                    self._suspend_nolock(item[3], suspend_until)
+        finally:
+            with self._lock:
+                self._restore_nolock(below)
+
+    def _release_nolock(self, item: Tuple[float, float, int, str]) -> None:
+        """清除条目的已取出记录。"""
+        if self._checked_out.get(item[3]) == item[2]:
+            del self._checked_out[item[3]]
+
+    def _restore_nolock(self, items: List[Tuple[float, float, int, str]]) -> None:
+        """把取出但未选中的分数段堆条目放回原分数段 (不触发压缩)。"""
+        for item in items:
+            self._release_nolock(item)
+            entry = self._entries.get(item[3])
+            if entry is None or entry[3] != item[2]:
+                continue  # 期间被挂起或更新，条目已失效
+            heapq.heappush(self._bands.setdefault(entry[0], []), item)
+            self._heap_items += 1
+
+    def _readmit_expired_nolock(self, now: float) -> None:
+        """把挂起时间已到的 Key 重新加入候选堆。"""
+        while self._suspended_heap and self._suspended_heap[0][0] <= now:
+            until, api_key = heapq.heappop(self._suspended_heap)
+            suspended = self._suspended.get(api_key)
+            if suspended is None or suspended[0] != until:
+                continue  # 已被恢复或重新挂起，条目失效
+            del self._suspended[api_key]
+            self._push_nolock(api_key, suspended[1], suspended[2])
+
+    def _suspend_nolock(self, api_key: str, until: float) -> None:
+        """把 Key 移出候选堆，直到 until 时间戳 (或被显式恢复)。"""
+        entry = self._entries.pop(api_key, None)
+        if entry is not None:
+            score, last_used = entry[2], entry[1]
+        elif api_key in self._suspended:
+            _, score, last_used = self._suspended[api_key]
+        else:
+            return  # 不在索引中
+        self._suspended[api_key] = (until, score, last_used)
+        if until != SUSPEND_INDEFINITELY:
+            heapq.heappush(self._suspended_heap, (until, api_key))
+
+    # --- 公共接口 ---
+
+    def pick(
+        self,
+        now: float,
+        check: Callable[[str, float], Tuple[bool, Optional[float]]],
+    ) -> Optional[Tuple[str, float]]:
+        """
+        选出一个 Key。
+
+        Args:
+            now (float): 当前时间戳，用于恢复到期的挂起 Key 并作为选中 Key 的新"上次选中时间"。
+            check (Callable): 候选检查函数，参数为 (Key, 分数)，返回 (是否选中, 挂起到的时间戳)。
+                未选中且挂起时间为 None 的 Key 仅在本次被跳过 (例如本请求已尝试过、Token 预检查失败)；
+                挂起时间不为 None 时把该 Key 移出候选堆直到该时间 (例如临时不可用)。
+
+        Returns:
+            Optional[Tuple[str, float]]: (选中的 Key, 分数)；没有可选 Key 时返回 None。
+        """
+        with self._lock:
+            self._readmit_expired_nolock(now)
+            best = self._best_score_nolock()
+            if best is None:
+                return None
+            # 第一轮：轮转范围可能跨越的所有分数段按上次选中时间合并遍历
+            threshold = best * ROTATION_SCORE_RATIO
+            last_band = score_band(threshold)
+            rotation_bands = [band for band in self._bands if band <= last_band]
+        skipped: List[Tuple[float, float, int, str]] = []
+        selected: Optional[Tuple[float, float, int, str]] = None
+        try:
+            selected = self._drain(rotation_bands, check, threshold, skipped)
+            if selected is None:
+                # 轮转范围内没有可用 Key 时，按分数段从高到低依次退回
+                with self._lock:
+                    bands = sorted(self._bands)
+                for band in bands:
+                    selected = self._drain([band], check, -math.inf, skipped)
+                    if selected is not None:
+                        break
+        finally:
+            with self._lock:
+                self._restore_nolock(skipped)
+                for band in [band for band, heap in self._bands.items() if not heap]:
+                    del self._bands[band]
+                if selected is not None:
+                    self._release_nolock(selected)
+                    entry = self._entries.get(selected[3])
+                    if entry is not None:
+                        # 选中后以当前时间重新压入，使其排到轮转顺序的末尾
+                        self._push_nolock(selected[3], entry[2], now)
+        return None if selected is None else (selected[3], -selected[1])
+
+    def live_score(self, api_key: str, now: float) -> Optional[float]:
+        """返回可参与选择的 Key 的分数；Key 被挂起或不在索引中时返回 None。"""
+        with self._lock:
+            self._readmit_expired_nolock(now)
+            entry = self._entries.get(api_key)
+            return None if entry is None else entry[2]
+
+    def live_scores(self, now: float) -> Dict[str, float]:
+        """返回所有可参与选择的 Key 的 {Key: 分数} (O(n) 复制，供需要全量比较的选择策略使用)。"""
+        with self._lock:
+            self._readmit_expired_nolock(now)
+            return {api_key: entry[2] for api_key, entry in self._entries.items()}
+
+    def mark_selected(self, api_key: str, now: float) -> None:
+        """把 Key 的上次选中时间更新为 now (由不经过 pick 的选择策略在选中 Key 后调用)。"""
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is not None:
+                self._push_nolock(api_key, entry[2], now)
+
+    def update_score(self, api_key: str, score: float) -> None:
+        """更新单个 Key 的分数 (新 Key 会被加入索引)。"""
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry is not None:
+                if entry[2] != score:
+                    self._push_nolock(api_key, score, entry[1])
+            elif api_key in self._suspended:
+                until, _, last_used = self._suspended[api_key]
+                self._suspended[api_key] = (until, score, last_used)
+            else:
+                self._push_nolock(api_key, score, 0.0)
+
+    def replace_scores(self, scores: Dict[str, float]) -> None:
+        """
+        用一组新的分数整体替换索引内容。
+        保留仍存在的 Key 的上次选中时间和挂起状态；不在新分数中的 Key 被移除。
+        """
+        with self._lock:
+            for api_key in [k for k in self._suspended if k not in scores]:
+                del self._suspended[api_key]
+            last_used = {k: entry[1] for k, entry in self._entries.items()}
+            self._entries = {}
+            for api_key, score in scores.items():
+                if api_key in self._suspended:
+                    until, _, suspended_last_used = self._suspended[api_key]
+                    self._suspended[api_key] = (until, score, suspended_last_used)
+                    continue
+                band = score_band(score)
+                self._entries[api_key] = (
+                    band,
+                    last_used.get(api_key, 0.0),
+                    score,
+                    next(self._seq),
+                )
+            self._compact_nolock()
+
+    def suspend(self, api_key: str, until: float = SUSPEND_INDEFINITELY) -> None:
+        """挂起 Key 直到 until 时间戳；默认挂起到被 resume/resume_all 恢复为止。"""
+        with self._lock:
+            self._suspend_nolock(api_key, until)
+
+    def resume(self, api_key: str) -> None:
+        """提前恢复单个被挂起的 Key (例如熔断器探测成功后)。"""
+        with self._lock:
+            suspended = self._suspended.pop(api_key, None)
+            if suspended is not None:
+                self._push_nolock(api_key, suspended[1], suspended[2])
+
+    def resume_all(self) -> None:
+        """恢复所有被挂起的 Key (例如每日配额重置后)。"""
+        with self._lock:
+            for api_key, (_, score, last_used) in self._suspended.items():
+                self._push_nolock(api_key, score, last_used)
+            self._suspended.clear()
+            self._suspended_heap.clear()
+
+    def remove(self, api_key: str) -> None:
+        """从索引中彻底移除 Key。"""
+        with self._lock:
+            self._entries.pop(api_key, None)
+            self._suspended.pop(api_key, None)
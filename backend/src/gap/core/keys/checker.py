@@ -266,14 +266,12 @@ async def check_keys(
         logger.error(error_msg, extra={"key": "N/A", "request_type": "startup"})
 
     # --- 步骤 4: 更新 Key 管理器状态 ---
-    logger.info("准备使用锁更新 Key 管理器状态...")  # 记录日志
-    with key_manager.keys_lock:  # 获取 Key 管理器的锁
-        logger.debug("已获取 key_manager.keys_lock")  # 记录获取锁日志
-        key_manager.api_keys = available_keys_local  # 更新活动 Key 列表
-        key_manager.key_configs = valid_keys_with_config  # 更新有效 Key 的配置字典
-        logger.debug(
-            f"Key 管理器状态更新完成：有效 Key 数量 {len(available_keys_local)}"
-        )  # 记录更新完成日志
+    logger.info("准备更新 Key 管理器状态...")  # 记录日志
+    # 一次性原子替换活动 Key 列表和有效 Key 的配置字典 (Key 状态快照)
+    key_manager.set_keys(available_keys_local, valid_keys_with_config)
+    logger.debug(
+        f"Key 管理器状态更新完成：有效 Key 数量 {len(available_keys_local)}"
+    )  # 记录更新完成日志
 
     logger.info("API 密钥检查和管理器更新完成。")  # 记录最终完成日志
 
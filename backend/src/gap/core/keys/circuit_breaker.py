@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+按 (Key, 模型) 划分的熔断器。
+
+原先任何 429 / 5xx / 超时都会让 Key 固定隔离 60 秒：真正被限流的 Key 恢复得太早，
+随即再次失败；只是偶发一次错误的 Key 却要闲置整整一分钟。
+本模块为每个 (Key, 模型) 维护一个三态熔断器：
+- closed (关闭)：正常参与选择；
+- open (断开)：失败后断开一段时间，时长按连续断开次数指数退避 (base * 2^(n-1)，不超过上限)，
+  并乘以 [0.5, 1.0) 的随机抖动，避免大量 Key 同时恢复；上游给出 RetryInfo 时不短于其建议值；
+- half-open (半开)：断开时间到期后只放行一个探测请求。探测成功则关闭熔断器并清零退避，
+  探测失败则以更长的退避时间重新断开；探测请求超时未报告结果时允许新的探测。
+Key 级别的问题 (鉴权失败、Key 无效) 不经过熔断器，仍由 Key 管理器的临时不可用标记处理。
+"""
+
+import random  # 退避抖动
+import threading  # 保护熔断器状态的线程锁
+import time  # 时间戳
+from dataclasses import dataclass  # 定义熔断器状态
+from typing import Any, Dict, List, Optional, Tuple
+
+from gap import config  # 应用配置
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+@dataclass
+class BreakerState:
+    """
+    单个 (Key, 模型) 的熔断器状态。
+
+    Attributes:
+        state (str): CLOSED / OPEN / HALF_OPEN。
+        trips (int): 连续断开次数，决定下一次的退避时长；成功后清零。
+        open_until (float): 断开状态的结束时间戳。
+        probe_started_at (float): 半开状态下当前探测请求的放行时间戳，0 表示尚未放行。
+        last_issue (Optional[str]): 最近一次断开的原因 (用于日志和报告)。
+    """
+
+    state: str = CLOSED
+    trips: int = 0
+    open_until: float = 0.0
+    probe_started_at: float = 0.0
+    last_issue: Optional[str] = None
+
+
+class KeyCircuitBreaker:
+    """
+    (Key, 模型) 熔断器集合。所有操作均为 O(1)，在内部锁内完成。
+    """
+
+    def __init__(
+        self,
+        base_seconds: Optional[float] = None,
+        max_seconds: Optional[float] = None,
+        probe_timeout_seconds: Optional[float] = None,
+    ):
+        self.base_seconds = (
+            config.CIRCUIT_BREAKER_BASE_SECONDS
+            if base_seconds is None
+            else base_seconds
+        )
+        self.max_seconds = (
+            config.CIRCUIT_BREAKER_MAX_SECONDS if max_seconds is None else max_seconds
+        )
+        self.probe_timeout_seconds = (
+            config.CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS
+            if probe_timeout_seconds is None
+            else probe_timeout_seconds
+        )
+        self._states: Dict[Tuple[str, str], BreakerState] = {}  # (Key, 模型) -> 状态
+        self._lock = threading.Lock()  # 保护 _states (不在持锁期间获取其他锁)
+
+    def allow(
+        self, api_key: str, model_name: str, now: Optional[float] = None
+    ) -> Tuple[bool, Optional[float]]:
+        """
+        判断 Key 在该模型下是否可以发起请求。半开状态下放行的请求即为探测请求。
+
+        Returns:
+            Tuple[bool, Optional[float]]: (是否放行, 不放行时预计可再次尝试的时间戳)。
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._states.get((api_key, model_name))
+            if state is None or state.state == CLOSED:
+                return True, None
+            if state.state == OPEN:
+                if now < state.open_until:
+                    return False, state.open_until
+                state.state = HALF_OPEN  # 断开时间到期，进入半开状态
+                state.probe_started_at = 0.0
+            if (
+                state.probe_started_at
+                and now - state.probe_started_at < self.probe_timeout_seconds
+            ):
+                # 已有探测请求在途，等待其结果
+                return False, state.probe_started_at + self.probe_timeout_seconds
+            state.probe_started_at = now
+            return True, None
+
+    def release_probe(self, api_key: str, model_name: str) -> None:
+        """放行的探测请求最终没有发出 (例如 Token 预检查失败) 时归还探测机会。"""
+        with self._lock:
+            state = self._states.get((api_key, model_name))
+            if state is not None and state.state == HALF_OPEN:
+                state.probe_started_at = 0.0
+
+    def record_success(self, api_key: str, model_name: str) -> bool:
+        """
+        记录一次成功调用：关闭熔断器并清零退避。
+
+        Returns:
+            bool: 熔断器此前是否处于断开或半开状态 (调用方据此恢复 Key 的候选资格)。
+        """
+        with self._lock:
+            state = self._states.pop((api_key, model_name), None)
+        return state is not None and state.state != CLOSED
+
+    def record_failure(
+        self,
+        api_key: str,
+        model_name: str,
+        issue_type: Optional[str] = None,
+        retry_after_seconds: Optional[float] = None,
+        now: Optional[float] = None,
+    ) -> float:
+        """
+        记录一次与 Key 相关的失败 (429 / 5xx / 超时 / 网络错误)，断开熔断器。
+
+        Args:
+            api_key (str): API Key。
+            model_name (str): 模型名称。
+            issue_type (Optional[str]): 失败原因描述。
+            retry_after_seconds (Optional[float]): 上游建议的重试间隔，断开时长不短于该值。
+            now (Optional[float]): 当前时间戳，缺省为 time.time()。
+
+        Returns:
+            float: 断开状态的结束时间戳。
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._states.setdefault((api_key, model_name), BreakerState())
+            if state.state == OPEN and now < state.open_until:
+                # 断开期间到达的失败 (例如断开前已发出的并发请求) 不再延长退避
+                return state.open_until
+            state.trips += 1
+            backoff = min(
+                self.max_seconds, self.base_seconds * 2 ** min(state.trips - 1, 32)
+            )
+            duration = backoff * random.uniform(0.5, 1.0)
+            if retry_after_seconds:
+                duration = max(duration, min(retry_after_seconds, self.max_seconds))
+            state.state = OPEN
+            state.open_until = now + duration
+            state.probe_started_at = 0.0
+            state.last_issue = issue_type
+            return state.open_until
+
+    def get_open_circuits(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """返回所有未关闭的熔断器 (用于报告和调试)。"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [
+                {
+                    "key": api_key,
+                    "model": model_name,
+                    "state": state.state,
+                    "trips": state.trips,
+                    "retry_in_seconds": max(0.0, state.open_until - now),
+                    "last_issue": state.last_issue,
+                }
+                for (api_key, model_name), state in self._states.items()
+            ]
+
+    def forget_key(self, api_key: str) -> None:
+        """移除某个 Key 在所有模型下的熔断器状态。"""
+        with self._lock:
+            for state_key in [k for k in self._states if k[0] == api_key]:
+                del self._states[state_key]
+
+    def reset(self) -> None:
+        """清空所有熔断器状态 (主要用于测试)。"""
+        with self._lock:
+            self._states.clear()
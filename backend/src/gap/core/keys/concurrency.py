@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+按 (Key, 模型) 划分的自适应并发限制 (AIMD)。
+
+Key 选择原先只参考历史计数，一个热门 Key 可能同时承载几十个长上下文请求，直到上游开始返回 429。
+本模块为每个 (Key, 模型) 记录在途请求数，并维护一个自适应的并发上限：
+- 加性增 (Additive Increase)：每次成功调用使上限增加 1/上限，即大约每一"轮"满负载成功后增加 1；
+- 乘性减 (Multiplicative Decrease)：上游返回 429 时上限乘以 CONCURRENCY_LIMIT_BACKOFF_FACTOR；
+- 延迟信号 (类似 TCP Vegas)：短期延迟 EWMA 超过长期延迟 EWMA 的 CONCURRENCY_LATENCY_TOLERANCE 倍时，
+  说明排队开始增加，上限乘以 CONCURRENCY_LATENCY_BACKOFF_FACTOR。
+同一批并发请求的失败只触发一次乘性减：距离上次减小不足一个往返时间 (长期延迟 EWMA) 时不再减小。
+在途请求数达到 floor(上限) 的 Key 在选择时被跳过，完成 (成功、失败或取消) 后释放名额。
+并发名额只在当前进程内统计；多 worker 部署时每个 worker 各自收敛到自己的份额。
+"""
+
+import threading  # 保护并发状态的线程锁
+import time  # 时间戳
+from dataclasses import dataclass  # 定义并发状态
+from typing import Any, Dict, List, Optional, Tuple
+
+from gap import config  # 应用配置
+from gap.core.keys.admission import admission_queue  # 所有 Key 饱和时的准入等待队列
+
+
+@dataclass
+class ConcurrencyState:
+    """
+    单个 (Key, 模型) 的并发状态。
+
+    Attributes:
+        limit (float): 当前的自适应并发上限 (允许的在途请求数为 floor(limit))。
+        inflight (int): 在途请求数。
+        short_latency (float): 短期延迟 EWMA (秒)，0 表示尚无样本。
+        long_latency (float): 长期延迟 EWMA (秒)，作为基线。
+        last_decrease_at (float): 最近一次乘性减的时间戳。
+    """
+
+    limit: float
+    inflight: int = 0
+    short_latency: float = 0.0
+    long_latency: float = 0.0
+    last_decrease_at: float = 0.0
+
+
+class ConcurrencyPermit:
+    """
+    一个在途请求占用的并发名额。release() 是幂等的，可以在多个清理路径上重复调用。
+    """
+
+    __slots__ = ("_limiter", "api_key", "model_name", "_released")
+
+    def __init__(self, limiter: "KeyConcurrencyLimiter", api_key: str, model_name: str):
+        self._limiter = limiter
+        self.api_key = api_key
+        self.model_name = model_name
+        self._released = False
+
+    def release(self) -> None:
+        """归还并发名额 (调用结束、出错、被取消或选中后又被跳过时)，并唤醒一个等待容量的请求。"""
+        if self._released:
+            return
+        self._released = True
+        self._limiter._release(self.api_key, self.model_name)
+
+    def discard(self) -> None:
+        """
+        放弃刚占用的名额 (Key 选择过程中后续检查未通过，请求尚未发出)。
+        不唤醒等待者：容量并没有真正释放，否则被唤醒的请求会互相唤醒而空转。
+        """
+        if self._released:
+            return
+        self._released = True
+        self._limiter._release(self.api_key, self.model_name, notify=False)
+
+
+class KeyConcurrencyLimiter:
+    """
+    (Key, 模型) 自适应并发限制集合。所有操作均为 O(1)，在内部锁内完成。
+    """
+
+    def __init__(
+        self,
+        initial_limit: Optional[float] = None,
+        min_limit: Optional[float] = None,
+        max_limit: Optional[float] = None,
+    ):
+        self.initial_limit = (
+            config.CONCURRENCY_INITIAL_LIMIT if initial_limit is None else initial_limit
+        )
+        self.min_limit = (
+            config.CONCURRENCY_MIN_LIMIT if min_limit is None else min_limit
+        )
+        self.max_limit = (
+            config.CONCURRENCY_MAX_LIMIT if max_limit is None else max_limit
+        )
+        # (Key, 模型) -> 状态
+        self._states: Dict[Tuple[str, str], ConcurrencyState] = {}
+        self._lock = threading.Lock()  # 保护 _states (不在持锁期间获取其他锁)
+
+    def _get_state(self, api_key: str, model_name: str) -> ConcurrencyState:
+        """(内部方法) 获取或创建状态。调用者必须持有 _lock。"""
+        state = self._states.get((api_key, model_name))
+        if state is None:
+            state = ConcurrencyState(limit=float(self.initial_limit))
+            self._states[(api_key, model_name)] = state
+        return state
+
+    def try_acquire(self, api_key: str, model_name: str) -> Optional[ConcurrencyPermit]:
+        """
+        尝试为 Key 在该模型下占用一个并发名额。
+
+        Returns:
+            Optional[ConcurrencyPermit]: 成功时返回名额，Key 已达到并发上限时返回 None。
+        """
+        with self._lock:
+            state = self._get_state(api_key, model_name)
+            # 禁用时只统计在途请求数，不限制
+            if config.CONCURRENCY_LIMIT_ENABLED and state.inflight >= max(
+                1, int(state.limit)
+            ):
+                return None
+            state.inflight += 1
+        return ConcurrencyPermit(self, api_key, model_name)
+
+    def _release(self, api_key: str, model_name: str, notify: bool = True) -> None:
+        """(内部方法) 归还一个并发名额；notify 为 True 时唤醒一个等待该模型容量的请求。"""
+        with self._lock:
+            state = self._states.get((api_key, model_name))
+            if state is not None and state.inflight > 0:
+                state.inflight -= 1
+        if notify:
+            admission_queue.notify(model_name)
+
+    def record_outcome(
+        self,
+        api_key: str,
+        model_name: str,
+        success: bool,
+        latency_seconds: Optional[float] = None,
+        status_code: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> float:
+        """
+        根据一次调用结果调整并发上限。
+
+        Args:
+            api_key (str): API Key。
+            model_name (str): 模型名称。
+            success (bool): 调用是否成功。
+            latency_seconds (Optional[float]): 成功调用的耗时 (秒)。
+            status_code (Optional[int]): 失败调用的 HTTP 状态码；只有 429 会减小上限。
+            now (Optional[float]): 当前时间戳，缺省为 time.time()。
+
+        Returns:
+            float: 调整后的并发上限。
+        """
+        if not config.CONCURRENCY_LIMIT_ENABLED:
+            return float(self.max_limit)
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._get_state(api_key, model_name)
+            if success:
+                if latency_seconds is not None and latency_seconds >= 0:
+                    if state.long_latency <= 0:
+                        state.short_latency = state.long_latency = latency_seconds
+                    else:
+                        state.short_latency += (
+                            config.CONCURRENCY_SHORT_LATENCY_ALPHA
+                            * (latency_seconds - state.short_latency)
+                        )
+                        state.long_latency += config.CONCURRENCY_LONG_LATENCY_ALPHA * (
+                            latency_seconds - state.long_latency
+                        )
+                    if (
+                        state.short_latency
+                        > state.long_latency * config.CONCURRENCY_LATENCY_TOLERANCE
+                    ):
+                        self._decrease(
+                            state, config.CONCURRENCY_LATENCY_BACKOFF_FACTOR, now
+                        )
+                        return state.limit
+                state.limit = min(
+                    float(self.max_limit), state.limit + 1.0 / max(state.limit, 1.0)
+                )
+            elif status_code == 429:
+                self._decrease(state, config.CONCURRENCY_LIMIT_BACKOFF_FACTOR, now)
+            return state.limit
+
+    def _decrease(self, state: ConcurrencyState, factor: float, now: float) -> None:
+        """(内部方法) 乘性减小上限，每个往返时间最多一次。调用者必须持有 _lock。"""
+        if now - state.last_decrease_at < max(1.0, state.long_latency):
+            return
+        state.limit = max(float(self.min_limit), state.limit * factor)
+        state.last_decrease_at = now
+
+    def load(self, api_key: str, model_name: str) -> float:
+        """返回 Key 在该模型下的负载：在途请求数 / 当前允许的在途请求数。"""
+        with self._lock:
+            state = self._states.get((api_key, model_name))
+            if state is None:
+                return 0.0
+            return state.inflight / max(1, int(state.limit))
+
+    def inflight_counts(self, model_name: str) -> Dict[str, int]:
+        """返回该模型下各 Key 的在途请求数 (没有记录的 Key 视为 0)。"""
+        with self._lock:
+            return {
+                api_key: state.inflight
+                for (api_key, state_model), state in self._states.items()
+                if state_model == model_name and state.inflight
+            }
+
+    def get_limits(self) -> List[Dict[str, Any]]:
+        """返回所有 (Key, 模型) 的并发上限和在途请求数 (用于报告和调试)。"""
+        with self._lock:
+            return [
+                {
+                    "key": api_key,
+                    "model": model_name,
+                    "limit": round(state.limit, 2),
+                    "inflight": state.inflight,
+                }
+                for (api_key, model_name), state in self._states.items()
+            ]
+
+    def forget_key(self, api_key: str) -> None:
+        """移除某个 Key 在所有模型下的并发状态。"""
+        with self._lock:
+            for state_key in [k for k in self._states if k[0] == api_key]:
+                del self._states[state_key]
+
+    def reset(self) -> None:
+        """清空所有并发状态 (主要用于测试)。"""
+        with self._lock:
+            self._states.clear()
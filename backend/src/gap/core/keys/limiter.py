@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+按 (Key, 模型) 划分的 RPM / TPM 速率限制器。
+
+原先的 RPM / TPM 计数使用固定窗口：窗口开始 60 秒后计数直接归零，
+在窗口边界前后各发送一轮请求即可在短时间内达到两倍的限额，随后便触发上游 429。
+GCRA / 漏桶也无法避免这一点：桶满后仍按 L / W 的速率持续放行，
+一个长度为 W 的窗口内最多可以放行接近 2L 的用量。
+本模块改用分段滑动窗口计数：
+- 每个窗口 W 划分为 WINDOW_BUCKETS 个时间段 (Δ = W / WINDOW_BUCKETS)，每段只保存一个用量计数；
+- 占用时检查当前段及之前 WINDOW_BUCKETS 段 (共 W + Δ 的时长) 的用量之和，加上本次用量不超过 L 才放行；
+- 任意长度为 W 的时间区间都落在连续 WINDOW_BUCKETS + 1 段之内，且区间内最后一次放行时检查过这些段，
+  因此任意长度为 W 的滑动窗口内的用量都不会超过 L；空闲的 Key 仍可一次性用满 L；
+- 代价是用量要多保留一个时间段才过期，持续满载时的吞吐最低为 L / (W + Δ) (12 段时约为 L 的 92%)。
+
+支持的维度：
+- "rpm": 每分钟请求数；
+- "tpm_input": 每分钟输入 Token 数；
+- "tpm_output": 每分钟输出 Token 数。
+限额为 None 或非正数的维度视为不限制，所有操作对其均为空操作。
+
+Key 选择时通过 reserve() 原子地预留估算的输入 Token (TokenReservation)，
+调用完成后按实际 promptTokenCount 对账，失败或取消时退还。未对账的预留会随时间自然过期，
+最多占用 W + Δ。
+
+配置了共享状态后端 (gap.core.shared_state) 时，各时间段的计数保存在后端中，所有 worker 共用同一份额度。
+占用由后端的 window_reserve 原子地读取检查范围内的所有时间段并累加当前段，每次占用只需一次往返。
+"""
+
+import math  # 无法满足的占用返回无穷大
+import threading  # 保护限流状态的线程锁
+import time  # 时间戳
+from dataclasses import dataclass  # 定义预留记录
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from gap.core.keys.admission import admission_queue  # 所有 Key 饱和时的准入等待队列
+from gap.core.shared_state import (  # 多 worker 共享的状态后端
+    SharedStateBackend,
+    shared_state_backend,
+)
+from gap.core.tracking import RPM_WINDOW_SECONDS, TPM_WINDOW_SECONDS  # 时间窗口常量
+
+# 维度名称 -> (状态数组中的下标, 窗口秒数)
+DIMENSIONS: Dict[str, Tuple[int, int]] = {
+    "rpm": (0, RPM_WINDOW_SECONDS),
+    "tpm_input": (1, TPM_WINDOW_SECONDS),
+    "tpm_output": (2, TPM_WINDOW_SECONDS),
+}
+
+# 每个窗口划分的时间段数。段数越多，满载时的吞吐越接近 L / W，每次检查读取的计数也越多。
+WINDOW_BUCKETS = 12
+
+
+def _bucket_at(window: float, timestamp: float) -> int:
+    """(内部辅助函数) 时间戳所在的时间段编号。"""
+    return int(timestamp // (window / WINDOW_BUCKETS))
+
+
+class KeyRateLimiter:
+    """
+    分段滑动窗口速率限制器。
+    每个 (Key, 模型) 的每个维度最多保存 WINDOW_BUCKETS + 1 个时间段计数，所有操作在内部锁内完成。
+    提供共享状态后端时，时间段计数改为保存在后端的计数器中 (检查与累加由后端保证原子性)。
+    """
+
+    def __init__(self, backend: Optional[SharedStateBackend] = None):
+        # (Key, 模型) -> 各维度的 {时间段编号: 用量}
+        self._buckets: Dict[Tuple[str, str], List[Dict[int, float]]] = {}
+        self._lock = threading.Lock()  # 保护 _buckets (不在持锁期间获取其他锁)
+        self._backend = backend  # 共享状态后端 (None 表示进程内状态)
+
+    @staticmethod
+    def _shared_key(api_key: str, model_name: str, dimension: str, bucket: int) -> str:
+        """(内部方法) 共享状态后端中某个时间段的计数器名称。"""
+        return f"win:{dimension}:{model_name}:{api_key}:{bucket}"
+
+    @staticmethod
+    def _shared_ttl(dimension: str) -> int:
+        """(内部方法) 时间段计数器的过期时间 (秒)，覆盖其参与检查的整个时长。"""
+        window = DIMENSIONS[dimension][1]
+        return int(math.ceil(window * (WINDOW_BUCKETS + 2) / WINDOW_BUCKETS))
+
+    def _local_buckets(
+        self, api_key: str, model_name: str, dimension: str, current: int
+    ) -> Dict[int, float]:
+        """
+        (内部方法) 返回某个维度仍在检查范围内的时间段计数 (移除已过期的时间段)。
+        调用者必须持有 self._lock。
+        """
+        per_dimension = self._buckets.get((api_key, model_name))
+        if per_dimension is None:
+            per_dimension = self._buckets[(api_key, model_name)] = [{}, {}, {}]
+        buckets = per_dimension[DIMENSIONS[dimension][0]]
+        oldest = current - WINDOW_BUCKETS
+        for expired in [b for b in buckets if b < oldest]:
+            del buckets[expired]
+        return buckets
+
+    def _window_counts(
+        self, api_key: str, model_name: str, dimension: str, current: int
+    ) -> List[float]:
+        """(内部方法) 从最早到当前，检查范围内 WINDOW_BUCKETS + 1 个时间段的用量。"""
+        return self._window_counts_many([(api_key, model_name, dimension, current)])[0]
+
+    def _window_counts_many(
+        self, queries: Sequence[Tuple[str, str, str, int]]
+    ) -> List[List[float]]:
+        """
+        (内部方法) 批量读取多个 (Key, 模型, 维度, 当前时间段) 检查范围内的时间段用量。
+        共享后端只需一次读取 (Redis 为一次 MGET)，进程内状态只获取一次锁。
+        """
+        span = WINDOW_BUCKETS + 1
+        if self._backend is not None:
+            counts = self._backend.counter_get_many(
+                [
+                    self._shared_key(api_key, model_name, dimension, b)
+                    for api_key, model_name, dimension, current in queries
+                    for b in range(current - WINDOW_BUCKETS, current + 1)
+                ]
+            )
+            # 退还可能让计数暂时低于 0 (例如并发的退还与过期)，按 0 处理
+            return [
+                [float(max(0, count)) for count in counts[i * span : (i + 1) * span]]
+                for i in range(len(queries))
+            ]
+        with self._lock:
+            result = []
+            for api_key, model_name, dimension, current in queries:
+                buckets = self._local_buckets(api_key, model_name, dimension, current)
+                result.append(
+                    [
+                        buckets.get(b, 0.0)
+                        for b in range(current - WINDOW_BUCKETS, current + 1)
+                    ]
+                )
+            return result
+
+    def try_acquire(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        cost: float = 1,
+        now: Optional[float] = None,
+    ) -> bool:
+        """
+        尝试占用 cost 单位的额度。
+
+        Args:
+            api_key (str): API Key。
+            model_name (str): 模型名称。
+            dimension (str): 维度 ("rpm" / "tpm_input" / "tpm_output")。
+            limit (Optional[float]): 该维度在窗口内的限额，None 或非正数表示不限制。
+            cost (float): 本次占用的用量 (请求数或 Token 数)。
+            now (Optional[float]): 当前时间戳，缺省为 time.time()。
+
+        Returns:
+            bool: 额度充足并已占用时返回 True；会超出限额时不做任何修改并返回 False。
+        """
+        return self._acquire(api_key, model_name, dimension, limit, cost, now)[0]
+
+    def _acquire(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        cost: float,
+        now: Optional[float],
+    ) -> Tuple[bool, float]:
+        """
+        (内部方法) try_acquire 的实现，同时返回占用前检查范围内的用量 (不限制的维度为 0)。
+        用量与是否放行来自同一次检查，调用者无需再单独读取。
+        """
+        if not limit or limit <= 0:
+            return True, 0.0
+        now = time.time() if now is None else now
+        window = DIMENSIONS[dimension][1]
+        current = _bucket_at(window, now)
+        if self._backend is not None:
+            if cost <= 0:
+                counts = self._window_counts(api_key, model_name, dimension, current)
+                return True, sum(counts)
+            # 检查范围内的读取与当前段的累加在后端一次完成 (Redis 为一次 Lua 往返)
+            added, shared_counts = self._backend.window_reserve(
+                [
+                    self._shared_key(api_key, model_name, dimension, b)
+                    for b in range(current - WINDOW_BUCKETS, current + 1)
+                ],
+                int(math.ceil(cost)),
+                int(limit),
+                self._shared_ttl(dimension),
+            )
+            return added, float(sum(shared_counts))
+        with self._lock:
+            buckets = self._local_buckets(api_key, model_name, dimension, current)
+            used = sum(buckets.values())
+            if cost <= 0:
+                return True, used
+            if used + cost > limit + 1e-9:
+                return False, used
+            buckets[current] = buckets.get(current, 0.0) + cost
+            return True, used
+
+    def consume(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        cost: float,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        无条件记录 cost 单位的用量 (用于调用完成后按实际 Token 数记账)。
+        用量可能超出限额，此时在用量过期之前 try_acquire 都会失败。
+        """
+        if not limit or limit <= 0 or cost <= 0:
+            return
+        now = time.time() if now is None else now
+        current = _bucket_at(DIMENSIONS[dimension][1], now)
+        if self._backend is not None:
+            self._backend.counter_add(
+                self._shared_key(api_key, model_name, dimension, current),
+                int(math.ceil(cost)),
+                None,
+                self._shared_ttl(dimension),
+            )
+            return
+        with self._lock:
+            buckets = self._local_buckets(api_key, model_name, dimension, current)
+            buckets[current] = buckets.get(current, 0.0) + cost
+
+    def refund(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        cost: float = 1,
+        now: Optional[float] = None,
+        acquired_at: Optional[float] = None,
+    ) -> None:
+        """
+        退还之前占用但未实际使用的 cost 单位额度，并唤醒一个等待该模型容量的请求。
+
+        用量从占用时所在的时间段中扣除 (acquired_at，缺省为 now)；该时间段已移出检查范围时，
+        这部分用量已经自然过期，不再退还，避免把之后的占用一并抵消。
+        """
+        if not limit or limit <= 0 or cost <= 0:
+            return
+        now = time.time() if now is None else now
+        window = DIMENSIONS[dimension][1]
+        current = _bucket_at(window, now)
+        bucket = _bucket_at(window, now if acquired_at is None else acquired_at)
+        if bucket < current - WINDOW_BUCKETS or bucket > current:
+            return
+        if self._backend is not None:
+            self._backend.counter_add(
+                self._shared_key(api_key, model_name, dimension, bucket),
+                -int(math.ceil(cost)),
+                None,
+                self._shared_ttl(dimension),
+            )
+        else:
+            with self._lock:
+                buckets = self._local_buckets(api_key, model_name, dimension, current)
+                if bucket in buckets:
+                    buckets[bucket] = max(0.0, buckets[bucket] - cost)
+        admission_queue.notify(model_name)
+
+    def available_at(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        cost: float,
+        now: Optional[float] = None,
+    ) -> float:
+        """
+        返回 try_acquire(cost) 最早可能成功的时间戳 (用于准入队列的定时唤醒)。
+        cost 超过整个窗口的限额时永远无法成功，返回 math.inf。
+        """
+        if not limit or limit <= 0 or cost <= 0:
+            return 0.0
+        now = time.time() if now is None else now
+        if cost > limit:
+            return math.inf
+        window = DIMENSIONS[dimension][1]
+        current = _bucket_at(window, now)
+        counts = self._window_counts(api_key, model_name, dimension, current)
+        remaining = sum(counts)
+        if remaining + cost <= limit:
+            return now
+        # 从最早的时间段开始依次过期：第 i 段 (编号 current - WINDOW_BUCKETS + i) 在 current + i + 1 段开始时移出检查范围
+        for offset, count in enumerate(counts):
+            remaining -= count
+            if remaining + cost <= limit:
+                return (current + offset + 1) * window / WINDOW_BUCKETS
+        return math.inf
+
+    def reserve(
+        self,
+        api_key: str,
+        model_name: str,
+        limit: Optional[float],
+        tokens: int,
+        now: Optional[float] = None,
+    ) -> Tuple[Optional["TokenReservation"], float]:
+        """
+        原子地预留 tokens 个 TPM 输入 Token。
+
+        Returns:
+            Tuple[Optional[TokenReservation], float]:
+            - 额度充足时返回预留记录；会超出限额时不做修改并返回 None
+            - 预留前检查范围内的 TPM 输入用量 (与是否放行来自同一次检查，不限制时为 0)
+        """
+        tokens = max(0, int(tokens))
+        now = time.time() if now is None else now
+        acquired, used = self._acquire(
+            api_key, model_name, "tpm_input", limit, tokens, now
+        )
+        if not acquired:
+            return None, used
+        return TokenReservation(self, api_key, model_name, limit, tokens, now), used
+
+    def usage(
+        self,
+        api_key: str,
+        model_name: str,
+        dimension: str,
+        limit: Optional[float],
+        now: Optional[float] = None,
+    ) -> float:
+        """返回检查范围 (当前及之前 WINDOW_BUCKETS 个时间段) 内的用量 (不限制的维度返回 0)。"""
+        if not limit or limit <= 0:
+            return 0.0
+        now = time.time() if now is None else now
+        current = _bucket_at(DIMENSIONS[dimension][1], now)
+        return sum(self._window_counts(api_key, model_name, dimension, current))
+
+    def usage_many(
+        self,
+        queries: Sequence[Tuple[str, str, str, Optional[float]]],
+        now: Optional[float] = None,
+    ) -> List[float]:
+        """
+        批量返回多个 (Key, 模型, 维度, 限额) 在检查范围内的用量 (不限制的维度为 0)。
+        配置了共享后端时所有查询合并为一次读取，用于 Key 评分和余量计算等需要遍历多个 Key / 维度的场景。
+        """
+        now = time.time() if now is None else now
+        limited = [
+            (
+                i,
+                (
+                    api_key,
+                    model_name,
+                    dimension,
+                    _bucket_at(DIMENSIONS[dimension][1], now),
+                ),
+            )
+            for i, (api_key, model_name, dimension, limit) in enumerate(queries)
+            if limit and limit > 0
+        ]
+        result = [0.0] * len(queries)
+        if limited:
+            counts = self._window_counts_many([query for _, query in limited])
+            for (i, _), window_counts in zip(limited, counts):
+                result[i] = sum(window_counts)
+        return result
+
+    def forget_key(self, api_key: str) -> None:
+        """移除某个 Key 在所有模型下的限流状态 (共享后端中的计数会在过期时间后自动失效)。"""
+        with self._lock:
+            for state_key in [k for k in self._buckets if k[0] == api_key]:
+                del self._buckets[state_key]
+
+    def reset(self) -> None:
+        """清空所有限流状态 (主要用于测试)。"""
+        with self._lock:
+            self._buckets.clear()
+
+
+@dataclass
+class TokenReservation:
+    """
+    一次 Key 选择时预留的 TPM 输入 Token。
+    每个预留只结算一次：reconcile() 按实际用量补记或退还差额，release() 全额退还；
+    重复调用为空操作。
+
+    Attributes:
+        limiter (KeyRateLimiter): 预留所在的速率限制器。
+        api_key (str): 预留的 API Key。
+        model_name (str): 模型名称。
+        limit (Optional[float]): 预留时的 TPM 输入限额 (None 表示不限制)。
+        tokens (int): 预留的 Token 数 (估算值)。
+        reserved_at (float): 预留时的时间戳，退还时只扣除该时刻记录、尚未过期的用量。
+        settled (bool): 是否已结算。
+    """
+
+    limiter: KeyRateLimiter
+    api_key: str
+    model_name: str
+    limit: Optional[float]
+    tokens: int
+    reserved_at: float = 0.0
+    settled: bool = False
+
+    def reconcile(self, actual_tokens: Optional[int]) -> None:
+        """
+        按实际输入 Token 数对账：实际多于预留时补记差额，少于预留时退还差额。
+        actual_tokens 为 None 时 (上游未返回用量) 保留估算值作为用量。
+        """
+        if self.settled:
+            return
+        self.settled = True
+        if actual_tokens is None:
+            return
+        difference = int(actual_tokens) - self.tokens
+        if difference > 0:
+            self.limiter.consume(
+                self.api_key, self.model_name, "tpm_input", self.limit, difference
+            )
+        elif difference < 0:
+            self.limiter.refund(
+                self.api_key,
+                self.model_name,
+                "tpm_input",
+                self.limit,
+                -difference,
+                acquired_at=self.reserved_at,
+            )
+
+    def release(self) -> None:
+        """调用失败或被取消时全额退还预留。"""
+        if self.settled:
+            return
+        self.settled = True
+        self.limiter.refund(
+            self.api_key,
+            self.model_name,
+            "tpm_input",
+            self.limit,
+            self.tokens,
+            acquired_at=self.reserved_at,
+        )
+
+
+# 全局速率限制器实例 (配置了共享状态后端时在 worker 之间共享)
+key_rate_limiter = KeyRateLimiter(shared_state_backend)
@@ -7,9 +7,9 @@ import logging  # 用于应用程序的日志记录
 import time  # 用于时间相关操作（例如速率限制、时间戳）
 
 # 导入 datetime 和 pytz 用于处理时间和时区
-from datetime import datetime, timezone  # 添加 timezone 导入
+from datetime import datetime, timedelta, timezone  # 添加 timezone 导入
 from threading import Lock  # 用于线程同步的锁，保护共享资源
-from typing import Any, Dict, List, Optional, Set, Tuple, Union  # 导入类型提示
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union  # 导入类型提示
 
 import pytz
 from sqlalchemy import select
@@ -20,6 +20,32 @@ from gap import config  # 导入应用配置
 # 导入数据库模型和工具函数
 from gap.core.database import utils as db_utils  # 导入数据库工具函数
 from gap.core.database.models import ApiKey  # 导入数据库模型
+from gap.core.keys.admission import admission_queue  # 所有 Key 饱和时的准入等待队列
+from gap.core.keys.affinity import KeyAffinityStore  # 用户/缓存内容与 Key 的关联映射
+from gap.core.keys.candidate_index import CandidateIndex  # 按模型划分的 Key 候选索引
+from gap.core.keys.circuit_breaker import KeyCircuitBreaker  # (Key, 模型) 熔断器
+from gap.core.keys.concurrency import (  # (Key, 模型) 自适应并发限制
+    ConcurrencyPermit,
+    KeyConcurrencyLimiter,
+)
+from gap.core.keys.limiter import (  # RPM / TPM 滑动窗口速率限制器与 Token 预留
+    TokenReservation,
+    key_rate_limiter,
+)
+from gap.core.keys.scoring import key_scoring_engine  # Key 健康度评分引擎
+from gap.core.keys.selection_telemetry import SelectionTelemetry  # Key 选择统计
+from gap.core.keys.snapshot import KeyStateSnapshot  # 不可变的 Key 状态快照
+from gap.core.keys.strategies import (  # 可插拔的 Key 选择策略
+    STRATEGIES,
+    KeySelectionStrategy,
+    SelectionRequest,
+    strategy_name_for_model,
+)
+from gap.core.processing.attempt_context import AttemptContext  # 单个请求的尝试上下文
+from gap.core.shared_state import (  # 多 worker 共享的状态后端
+    run_shared_state_call,
+    shared_state_backend,
+)
 
 # 从 tracking 模块导入共享的数据结构、锁和常量
 from gap.core.tracking import CACHE_REFRESH_INTERVAL_SECONDS  # 常量：RPM/TPM 窗口秒数和缓存刷新间隔秒数
@@ -35,6 +61,14 @@ from gap.core.tracking import (
 # 获取名为 'my_logger' 的日志记录器实例
 logger = logging.getLogger("my_logger")
 
+# 每日配额耗尽的 Key 在候选索引中的挂起时长 (秒)，到期后重新核对快照 (例如日期已切换)
+DAILY_EXHAUSTED_RECHECK_SECONDS = 300
+# 共享状态后端中用于在 worker 之间同步每日耗尽 / 临时不可用 Key 的标记命名空间
+SHARED_DAILY_EXHAUSTED_MARKS = "daily_exhausted"
+SHARED_TEMPORARY_ISSUE_MARKS = "temporary_issues"
+# 每日重置任务使用的时区 (共享的每日耗尽标记在下一次重置时失效)
+_PT_TIMEZONE = pytz.timezone("America/Los_Angeles")
+
 # 导入统一锁管理器
 try:
     from gap.core.concurrency.lock_manager import lock_manager
@@ -64,41 +98,40 @@ class APIKeyManager:
         初始化 APIKeyManager 实例。
         - 初始化存储 API Key 字符串的列表 (api_keys)。
         - 初始化存储 Key 配置信息的字典 (key_configs)。
-        - 创建线程锁 (keys_lock) 以保护对 Key 列表和配置的并发访问。
-        - 初始化用于跟踪当前请求已尝试 Key 的集合 (tried_keys_for_request)。
-        - 初始化存储每日配额耗尽 Key 的字典 (daily_exhausted_keys)。
-        - 初始化存储临时不可用 Key 及其过期时间戳的字典 (temporary_issue_keys)。
+        - 初始化不可变的 Key 状态快照 (_snapshot)，包含活动 Key 列表、Key 配置、
+          每日配额耗尽 Key 和临时不可用 Key 及其过期时间戳。
+        - 创建线程锁 (keys_lock) 用于串行化快照的写入 (读取无需加锁)。
         - 获取当前日期字符串 (_today_date_str)，用于每日配额检查。
         - 初始化用于粘性会话的用户-Key 映射 (user_key_map，目前未使用，逻辑在数据库中)。
-        - 初始化用于记录 Key 选择原因的列表 (key_selection_records) 和对应的锁 (records_lock)。
+        - 初始化有界的 Key 选择统计 (selection_telemetry)：聚合计数器和采样决策轨迹。
+        - 初始化用户/缓存内容与 Key 的内存关联映射 (key_affinity)，用于策略 1、2。
+        - 初始化按 (Key, 模型) 划分的熔断器 (circuit_breaker)。
+        - 初始化按 (Key, 模型) 划分的自适应并发限制 (concurrency_limiter)。
+        - 初始化按模型缓存的 Key 选择策略实例 (_selection_strategies)，用于策略 3。
         """
-        self.api_keys: List[str] = []  # 存储当前有效的 API Key 字符串列表
-        self.key_configs: Dict[str, Dict[str, Any]] = (
-            {}
-        )  # 存储每个 Key 的配置信息 (描述、状态、过期时间等)
+        # 不可变的 Key 状态快照：活动 Key、Key 配置、每日耗尽集合和临时不可用集合。
+        # 读取方直接读取 self._snapshot 引用 (无锁)，写入方在写锁内构建新快照后原子替换。
+        self._snapshot: KeyStateSnapshot = KeyStateSnapshot()
+        # 策略 3 使用的按模型划分的 Key 候选索引，按需从分数缓存构建；活动 Key 集合变化时整体失效
+        self._candidate_indexes: Dict[str, CandidateIndex] = {}
 
         self.keys_lock = (
             Lock()
-        )  # 线程锁，用于保护 self.api_keys 和 self.key_configs 的并发访问 (保留作为备用)
-        self.tried_keys_for_request: Set[str] = (
-            set()
-        )  # 存储在当前单个 API 请求处理过程中已经尝试过的 Key，避免重复尝试
-        self.daily_exhausted_keys: Dict[str, str] = (
-            {}
-        )  # 存储已达到每日配额限制的 Key 及其达到限制的日期 (YYYY-MM-DD)
-        self.temporary_issue_keys: Dict[str, float] = (
-            {}
-        )  # 存储临时不可用的 Key 及其恢复可用的时间戳 (Unix timestamp)
+        )  # 线程锁，仅用于串行化快照的写入方 (保留作为备用)
         self._today_date_str = datetime.now(pytz.timezone("Asia/Shanghai")).strftime(
             "%Y-%m-%d"
         )  # 获取当前上海时区的日期字符串
         # self.user_key_map: Dict[str, str] = defaultdict(str) # 用户-Key 映射，用于粘性会话 (数据库模式下此逻辑在数据库中)
-        self.key_selection_records: List[Dict[str, Any]] = (
-            []
-        )  # 记录 Key 选择过程的详细信息，用于调试和分析
-        self.records_lock = (
-            Lock()
-        )  # 保护 key_selection_records 列表的线程锁 (保留作为备用)
+        # Key 选择过程的统计 (有界的聚合计数器 + 采样决策轨迹)，用于调试和分析
+        self.selection_telemetry = SelectionTelemetry()
+        # 用户→Key (粘性会话) 和缓存内容→Key (缓存关联) 的内存 LRU 映射，关联更新批量写回数据库
+        self.key_affinity = KeyAffinityStore()
+        # 按 (Key, 模型) 划分的熔断器，处理限流、服务端错误、超时等可恢复的失败
+        self.circuit_breaker = KeyCircuitBreaker()
+        # 按 (Key, 模型) 划分的在途请求数和 AIMD 自适应并发上限，达到上限的 Key 在选择时被跳过
+        self.concurrency_limiter = KeyConcurrencyLimiter()
+        # 模型 -> 策略 3 使用的 Key 选择策略实例，按 KEY_SELECTION_STRATEGY(_BY_MODEL) 配置按需创建
+        self._selection_strategies: Dict[str, KeySelectionStrategy] = {}
         self.session_hidden_web_ui_keys: Set[str] = (
             set()
         )  # 存储在当前会话中被"虚拟删除"的 WEB_UI_PASSWORDS
@@ -114,10 +147,77 @@ class APIKeyManager:
             # 回退到传统锁映射
             lock_map = {
                 "api_keys": self.keys_lock,
-                "selection_records": self.records_lock,
             }
             return lock_map.get(lock_name)
 
+    # --- Key 状态快照 ---
+
+    @property
+    def snapshot(self) -> KeyStateSnapshot:
+        """当前的 Key 状态快照 (不可变，读取无需加锁)。"""
+        return self._snapshot
+
+    def _swap_snapshot(self, **changes: Any) -> KeyStateSnapshot:
+        """
+        (内部方法) 基于当前快照构建新版本并原子替换。
+        调用者必须持有 "api_keys" 写锁，且不得在持锁期间 await。
+        活动 Key 集合变化时，候选索引随之失效，下次选择时重新构建。
+        """
+        self._snapshot = self._snapshot.evolve(**changes)
+        if "active_keys" in changes:
+            self._candidate_indexes = {}
+        return self._snapshot
+
+    def set_keys(
+        self, api_keys: List[str], key_configs: Dict[str, Dict[str, Any]]
+    ) -> None:
+        """
+        原子替换活动 Key 列表和 Key 配置 (保留每日耗尽和临时不可用状态)。
+
+        Args:
+            api_keys (List[str]): 新的活动 Key 列表。
+            key_configs (Dict[str, Dict[str, Any]]): 新的 Key 配置字典。
+        """
+        with self._get_lock("api_keys"):
+            self._swap_snapshot(active_keys=api_keys, key_configs=key_configs)
+
+    @property
+    def api_keys(self) -> List[str]:
+        """当前活动 Key 列表的副本 (兼容旧接口，修改返回值不会影响管理器状态)。"""
+        return list(self._snapshot.active_keys)
+
+    @api_keys.setter
+    def api_keys(self, new_api_keys: List[str]) -> None:
+        with self._get_lock("api_keys"):
+            self._swap_snapshot(active_keys=new_api_keys)
+
+    @property
+    def key_configs(self) -> Dict[str, Dict[str, Any]]:
+        """Key 配置字典的浅拷贝 (兼容旧接口)。"""
+        return dict(self._snapshot.key_configs)
+
+    @key_configs.setter
+    def key_configs(self, new_key_configs: Dict[str, Dict[str, Any]]) -> None:
+        with self._get_lock("api_keys"):
+            self._swap_snapshot(key_configs=new_key_configs)
+
+    @property
+    def daily_exhausted_keys(self) -> Dict[str, str]:
+        """每日配额耗尽 Key 及其日期的副本 (兼容旧接口)。"""
+        return dict(self._snapshot.daily_exhausted)
+
+    @property
+    def temporary_issue_keys(self) -> Dict[str, float]:
+        """临时不可用 Key 及其恢复时间戳的副本 (兼容旧接口)。"""
+        return dict(self._snapshot.temporary_issues)
+
+    def _refresh_today_date_str(self) -> str:
+        """(内部方法) 刷新并返回当前上海时区的日期字符串。"""
+        self._today_date_str = datetime.now(pytz.timezone("Asia/Shanghai")).strftime(
+            "%Y-%m-%d"
+        )
+        return self._today_date_str
+
     async def reload_keys(self, db: Optional[AsyncSession] = None):
         """
         根据配置的 KEY_STORAGE_MODE (内存或数据库) 异步重新加载 API Key 列表和配置。
@@ -217,10 +317,9 @@ class APIKeyManager:
             return  # 直接返回
 
         # --- 更新管理器状态 ---
-        # 使用线程锁确保更新过程的原子性
+        # 在写锁内一次性替换快照，读取方要么看到旧状态，要么看到新状态
         with self._get_lock("api_keys"):
-            self.api_keys = new_api_keys  # 更新活动 Key 列表
-            self.key_configs = new_key_configs  # 更新 Key 配置字典
+            self._swap_snapshot(active_keys=new_api_keys, key_configs=new_key_configs)
             # 可选：是否需要在此处重置 daily_exhausted_keys 和 temporary_issue_keys？
             # 决定：暂时不重置，让这些状态在它们各自的逻辑中过期或被清理，
             # 避免 reload 操作意外恢复了实际上仍然受限的 Key。
@@ -237,10 +336,9 @@ class APIKeyManager:
             Optional[Dict[str, Any]]: 包含 Key 配置的字典，如果 Key 不存在则返回 None。
                                       返回的是配置的深拷贝，防止外部修改影响内部状态。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全访问 key_configs
-            config_data = self.key_configs.get(api_key)  # 从字典获取配置
-            # 返回配置的深拷贝，如果找到了配置；否则返回 None
-            return copy.deepcopy(config_data) if config_data else None
+        config_data = self._snapshot.key_configs.get(api_key)  # 从快照获取配置
+        # 返回配置的深拷贝，如果找到了配置；否则返回 None
+        return copy.deepcopy(config_data) if config_data else None
 
     # update_key_config 方法已移除，因为 Key 的更新应通过 API -> 数据库/环境变量 -> reload_keys 的流程完成，
     # 而不是直接修改内存中的 KeyManager 状态。
@@ -273,54 +371,122 @@ class APIKeyManager:
             return None
 
     async def update_user_key_association(
-        self, db: AsyncSession, user_id: str, api_key: str
+        self, db: Optional[AsyncSession], user_id: str, api_key: str
     ) -> None:
         """更新指定用户与 Key 之间的关联信息。
 
-        该方法会将用户最近一次成功使用的 Key 记录到 user_key_associations 表，
-        以支持粘性会话等特性。
+        关联立即写入内存中的用户→Key 映射 (粘性会话下一次请求即可使用)，
+        并由后台任务批量写入 user_key_associations 表，此处不产生数据库往返。
+        db 参数保留以兼容现有调用方。
         """
-        try:
-            from gap.core.database.models import ApiKey, UserKeyAssociation
+        self.key_affinity.record_user_key(user_id, api_key)
+        logger.debug(f"已更新用户 {user_id} 与 Key {api_key[:8]}... 的关联 (待写回数据库)。")
 
-            # 查找对应的 ApiKey 记录
-            stmt_key = select(ApiKey.id).where(ApiKey.key_string == api_key)
-            result_key = await db.execute(stmt_key)
-            key_id = result_key.scalar_one_or_none()
-            if key_id is None:
-                logger.warning(
-                    f"update_user_key_association: 未在数据库中找到 Key {api_key[:8]}...，跳过关联更新。"
-                )
-                return
+    def _reserve_input_tokens(
+        self,
+        api_key: str,
+        model_name: str,
+        model_limits: Dict[str, Any],
+        estimated_input_tokens: int,
+    ) -> Tuple[Optional[TokenReservation], int, int, Optional[int]]:
+        """
+        (内部方法) 对指定 Key 进行 TPM 输入 Token 预检查，通过时原子地预留估算的 Token。
+        检查与占用在速率限制器的同一次加锁内完成，并发请求不会同时通过同一份余量。
 
-            # 插入或更新 UserKeyAssociation 记录
-            now_ts = time.time()
-            stmt_select = select(UserKeyAssociation).where(
-                UserKeyAssociation.user_id == user_id,
-                UserKeyAssociation.key_id == key_id,
-            )
-            result_assoc = await db.execute(stmt_select)
-            assoc_obj = result_assoc.scalar_one_or_none()
-            if assoc_obj is None:
-                assoc_obj = UserKeyAssociation(
-                    user_id=user_id,
-                    key_id=key_id,
-                    last_used_timestamp=now_ts,
-                )
-                db.add(assoc_obj)
-            else:
-                assoc_obj.last_used_timestamp = now_ts
+        Returns:
+            Tuple[Optional[TokenReservation], int, int, Optional[int]]:
+            - Token 预留记录 (未通过预检查时为 None)
+            - 预留前剩余可用输入 Token 容量 (无限制时为 10**18)
+            - 加上本次估算后的潜在 TPM 输入计数
+            - TPM 输入限制 (可能为 None)
+        """
+        tpm_input_limit = model_limits.get("tpm_input")  # 获取 TPM 输入限制
+        # 预留与预留前的滑动窗口用量来自速率限制器的同一次检查
+        reservation, tpm_input_used = key_rate_limiter.reserve(
+            api_key, model_name, tpm_input_limit, estimated_input_tokens
+        )
+        tpm_input_used = int(tpm_input_used)
+        potential_tpm_input = tpm_input_used + estimated_input_tokens
+        if tpm_input_limit is None or tpm_input_limit <= 0:
+            return reservation, 10**18, potential_tpm_input, tpm_input_limit
+        return (
+            reservation,
+            max(0, tpm_input_limit - tpm_input_used),
+            potential_tpm_input,
+            tpm_input_limit,
+        )
+
+    def _try_associated_key(
+        self,
+        snapshot: KeyStateSnapshot,
+        candidate_key: str,
+        reason_prefix: str,
+        model_name: str,
+        model_limits: Dict[str, Any],
+        estimated_input_tokens: int,
+        today_date_str: str,
+        now: float,
+        tried_keys: FrozenSet[str],
+        request_id: Optional[str],
+    ) -> Tuple[
+        Optional[str], int, str, Optional[TokenReservation], Optional[ConcurrencyPermit]
+    ]:
+        """
+        (内部方法) 检查关联 Key (缓存关联或用户粘性会话) 是否可用、未达到并发上限并通过 Token 预检查。
 
-            await db.commit()
-            logger.debug(
-                f"已更新用户 {user_id} 与 Key {api_key[:8]}... 的关联 (key_id={key_id})。"
+        Returns:
+            Tuple[Optional[str], int, str, Optional[TokenReservation], Optional[ConcurrencyPermit]]:
+            (选中的 Key 或 None, 可用输入 Token, 记录的原因, Token 预留, 并发名额)
+        """
+        unavailable = snapshot.unavailable_reason(
+            candidate_key, today_date_str, now, tried_keys
+        )
+        if unavailable:  # Key 不在活动列表、已尝试、当天耗尽或临时不可用
+            reason = f"{reason_prefix} - {unavailable}"
+            logger.warning(f"请求 {request_id} - {reason}")
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            return None, 0, reason, None, None
+
+        allowed, _ = self.circuit_breaker.allow(candidate_key, model_name, now)
+        if not allowed:  # 熔断器断开，或半开状态下已有探测请求在途
+            reason = f"{reason_prefix} - Circuit Open"
+            logger.warning(f"请求 {request_id} - {reason}: {candidate_key[:8]}...")
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            return None, 0, reason, None, None
+
+        permit = self.concurrency_limiter.try_acquire(candidate_key, model_name)
+        if permit is None:  # Key 在该模型下的在途请求数已达到自适应并发上限
+            self.circuit_breaker.release_probe(candidate_key, model_name)
+            reason = f"{reason_prefix} - Concurrency Limit"
+            logger.warning(f"请求 {request_id} - {reason}: {candidate_key[:8]}...")
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            return None, 0, reason, None, None
+
+        logger.debug(
+            f"请求 {request_id} - 关联 Key {candidate_key[:8]}... 可用，进行 Token 预检查..."
+        )
+        reservation, available_input_tokens, potential_tpm_input, tpm_input_limit = (
+            self._reserve_input_tokens(
+                candidate_key, model_name, model_limits, estimated_input_tokens
             )
-        except Exception as e:
-            await db.rollback()
-            logger.error(
-                f"更新用户 {user_id} 与 Key {api_key[:8]}... 的关联失败: {e}",
-                exc_info=True,
+        )
+        if reservation is None:  # --- Token 预检查失败 ---
+            self.circuit_breaker.release_probe(candidate_key, model_name)
+            permit.discard()
+            reason = f"{reason_prefix} - Token Precheck Failed"
+            logger.warning(
+                f"请求 {request_id} - {reason}: {candidate_key[:8]}... 潜在总输入 Token: {potential_tpm_input}, 限制: {tpm_input_limit}"
             )
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            return None, 0, reason, None, None
+
+        # --- Token 预检查通过，选定此 Key ---
+        reason = f"{reason_prefix} - Successful Selection"
+        logger.info(
+            f"请求 {request_id} - {reason}: {candidate_key[:8]}...。可用输入 Token: {available_input_tokens}"
+        )
+        self.record_selection_reason(candidate_key, reason, request_id, model_name)
+        return candidate_key, available_input_tokens, reason, reservation, permit
 
     async def select_best_key(
         self,
@@ -332,13 +498,17 @@ class APIKeyManager:
         request_id: Optional[str] = None,
         cached_content_id: Optional[str] = None,
         db: Optional[AsyncSession] = None,  # 数据库会话，用于数据库模式下的查询
+        attempt_context: Optional[AttemptContext] = None,
     ) -> Tuple[Optional[str], int]:
         """
         基于多种策略异步选择最佳的 API 密钥用于当前请求。
         选择策略优先级：
         1. 缓存关联 Key (如果启用原生缓存且命中缓存)
         2. 用户上次使用 Key (如果启用粘性会话)
-        3. 基于评分和最近最少使用的轮转选择 (回退策略)
+        3. 按模型配置的可插拔选择策略 (回退策略，默认为基于评分和最近最少使用的轮转选择)
+
+        整个选择过程基于进入时读取的同一份 Key 状态快照进行，不持有 Key 管理器的锁，
+        因此数据库查询的 await 不会阻塞其他协程或线程的选择。
 
         Args:
             model_name (str): 请求的目标模型名称。
@@ -349,609 +519,550 @@ class APIKeyManager:
             request_id (Optional[str]): 当前请求的唯一 ID，用于日志跟踪。
             cached_content_id (Optional[str]): 如果缓存命中，传递缓存内容的 ID，用于缓存关联 Key 查找。
             db (Optional[AsyncSession]): 数据库模式下需要传入 SQLAlchemy 异步数据库会话。
+            attempt_context (Optional[AttemptContext]): 当前请求的尝试上下文。其中已尝试的 Key
+                会被排除，选中的 Key 及其输入 Token 预留会被记录到其中，由调用结果对账或退还；
+                未提供时不排除任何 Key，也不保留预留。
 
         Returns:
             Tuple[Optional[str], int]:
             - 第一个元素：选定的最佳 API Key 字符串，如果找不到合适的 Key 则为 None。
             - 第二个元素：选定 Key 当前可用的输入 Token 容量估算值 (基于 TPM 限制)。
-                         如果 Key 没有 TPM 限制或无法估算，可能返回 float('inf') 或 0。
+                         如果 Key 没有 TPM 限制，返回 10**18。
         """
-        # 优先获取 keys_lock，因为后续大部分操作都需要访问共享的 Key 状态
-        with self._get_lock("api_keys"):
-            # --- 跟踪与准备 ---
-            # 增加 Key 选择尝试的总次数 (用于统计)
-            from gap.core import tracking  # 导入 tracking 模块
-
-            with tracking.cache_tracking_lock:  # 获取缓存跟踪锁
-                tracking.key_selection_total_attempts += 1  # 增加总尝试次数
-
-            selected_key: str | None = None  # 初始化选定的 Key 为 None
-            available_input_tokens = 0  # 初始化可用输入 Token 容量为 0
-            reason_prefix = "N/A"  # 初始化 reason_prefix
-            user_association_reason = (
-                "User Assoc. - Skipped"  # 初始化 user_association_reason
-            )
-
-            # --- 准备不可用 Key 集合 ---
-            # 获取当天日期字符串，用于检查每日配额
-            self._today_date_str = datetime.now(
-                pytz.timezone("Asia/Shanghai")
-            ).strftime("%Y-%m-%d")
-            # 获取当天已耗尽配额的 Key 集合
-            daily_exhausted = {
-                k
-                for k, date_str in self.daily_exhausted_keys.items()
-                if date_str == self._today_date_str
-            }
-            # 获取当前请求已经尝试过的 Key 集合 (创建副本以防迭代问题)
-            tried_keys = self.tried_keys_for_request.copy()
-            # 获取当前内存中所有标记为活动的 Key 列表 (创建副本)
-            current_active_keys = self.api_keys[:]
-            # 获取临时不可用的 Key 集合 (is_key_temporarily_unavailable 内部会清理过期标记)
-            temporarily_unavailable_keys = {
-                k for k in current_active_keys if self.is_key_temporarily_unavailable(k)
-            }
-
-            # --- 策略 1: 缓存关联 Key 优先级 ---
-            # 仅在数据库模式、启用原生缓存、提供了缓存 ID 且有数据库会话时执行
-            if (
-                config.KEY_STORAGE_MODE == "database"
-                and config.ENABLE_NATIVE_CACHING
-                and cached_content_id
-                and db
-            ):
-                logger.debug(
-                    f"请求 {request_id} - 策略 1: 尝试缓存关联 Key (Cache ID: {cached_content_id})"
-                )  # 记录日志
-                try:
-                    # 调用数据库工具函数查找与缓存 ID 关联的 Key ID
-                    associated_key_id = await db_utils.get_key_id_by_cached_content_id(
-                        db, cached_content_id
-                    )
-                    if associated_key_id:  # 如果找到了关联的 Key ID
-                        # 根据 Key ID 查找 Key 字符串
-                        associated_key_str = await db_utils.get_key_string_by_id(
-                            db, associated_key_id
+        from gap.core import tracking  # 导入 tracking 模块
+
+        # --- 跟踪与准备 ---
+        with tracking.cache_tracking_lock:  # 获取缓存跟踪锁
+            tracking.key_selection_total_attempts += 1  # 增加总尝试次数
+
+        # 按采样比例记录本次选择的完整决策轨迹
+        trace = self.selection_telemetry.begin_trace(request_id, model_name)
+
+        # 读取一次快照引用，之后的所有判断都基于这份一致的、不可变的数据
+        snapshot = self._snapshot
+        today_date_str = self._refresh_today_date_str()
+        now = time.time()
+        # 获取当前请求已经尝试过的 Key 集合 (每个请求独立，创建不可变副本以防迭代问题)
+        tried_keys = (
+            frozenset(attempt_context.tried_keys) if attempt_context else frozenset()
+        )
+        if attempt_context is not None:
+            attempt_context.capacity_retry_at = None  # 由本次选择重新记录
+
+        selected_key: Optional[str] = None  # 初始化选定的 Key 为 None
+        available_input_tokens = 0  # 初始化可用输入 Token 容量为 0
+        reservation: Optional[TokenReservation] = None  # 选定 Key 时预留的输入 Token
+        permit: Optional[ConcurrencyPermit] = None  # 选定 Key 时占用的并发名额
+
+        # --- 策略 1: 缓存关联 Key 优先级 ---
+        # 仅在数据库模式、启用原生缓存、提供了缓存 ID 且有数据库会话时执行
+        if (
+            config.KEY_STORAGE_MODE == "database"
+            and config.ENABLE_NATIVE_CACHING
+            and cached_content_id
+            and db
+        ):
+            logger.debug(
+                f"请求 {request_id} - 策略 1: 尝试缓存关联 Key (Cache ID: {cached_content_id})"
+            )  # 记录日志
+            reason_prefix = "Cache Assoc."  # 定义日志原因前缀
+            try:
+                # 从内存关联映射查找创建该缓存的 Key (映射未命中时才查询一次数据库)
+                associated_key_str = await self.key_affinity.get_cached_content_key(
+                    cached_content_id, db
+                )
+                if associated_key_str:  # 如果找到了关联的 Key
+                    logger.debug(
+                        f"请求 {request_id} - 找到与缓存 {cached_content_id} 关联的 Key: {associated_key_str[:8]}..."
+                    )  # 记录日志
+                    selected_key, available_input_tokens, _, reservation, permit = (
+                        await run_shared_state_call(
+                            self._try_associated_key,
+                            snapshot,
+                            associated_key_str,
+                            reason_prefix,
+                            model_name,
+                            model_limits,
+                            estimated_input_tokens,
+                            today_date_str,
+                            now,
+                            tried_keys,
+                            request_id,
                         )
-                        if associated_key_str:  # 如果找到了 Key 字符串
-                            logger.debug(
-                                f"请求 {request_id} - 找到与缓存 {cached_content_id} 关联的 Key: {associated_key_str[:8]}..."
-                            )  # 记录日志
-                            reason_prefix = "Cache Assoc."  # 定义日志原因前缀
-                            # --- 检查关联 Key 的可用性 ---
-                            if (
-                                associated_key_str not in current_active_keys
-                            ):  # 是否在当前活动 Key 列表中
-                                reason = f"{reason_prefix} - Key not active/found in manager"  # 不可用原因
-                                logger.warning(
-                                    f"请求 {request_id} - {reason}"
-                                )  # 记录警告
-                                self.record_selection_reason(
-                                    associated_key_str, reason, request_id
-                                )  # 记录选择原因
-                            elif (
-                                associated_key_str in tried_keys
-                            ):  # 是否已在本请求中尝试过
-                                reason = f"{reason_prefix} - Key already tried"
-                                logger.warning(f"请求 {request_id} - {reason}")
-                                self.record_selection_reason(
-                                    associated_key_str, reason, request_id
-                                )
-                            elif (
-                                associated_key_str in daily_exhausted
-                            ):  # 是否已达到每日配额
-                                reason = f"{reason_prefix} - Daily Quota Exhausted"
-                                logger.warning(f"请求 {request_id} - {reason}")
-                                self.record_selection_reason(
-                                    associated_key_str, reason, request_id
-                                )
-                            elif (
-                                associated_key_str in temporarily_unavailable_keys
-                            ):  # 是否临时不可用
-                                reason = f"{reason_prefix} - Temporarily Unavailable"
-                                logger.warning(f"请求 {request_id} - {reason}")
-                                self.record_selection_reason(
-                                    associated_key_str, reason, request_id
-                                )
-                            else:  # --- Key 可用，进行 Token 预检查 ---
-                                logger.debug(
-                                    f"请求 {request_id} - 关联 Key {associated_key_str[:8]}... 可用，进行 Token 预检查..."
-                                )
-                                with usage_lock:  # 获取使用数据锁
-                                    key_usage = usage_data.get(
-                                        associated_key_str, {}
-                                    ).get(
-                                        model_name, {}
-                                    )  # 获取该 Key 对该模型的使用数据
-                                    tpm_input_limit = model_limits.get(
-                                        "tpm_input"
-                                    )  # 获取 TPM 输入限制
-                                    tpm_input_used = key_usage.get(
-                                        "tpm_input_count", 0
-                                    )  # 获取当前 TPM 输入计数
-                                    potential_tpm_input = (
-                                        tpm_input_used + estimated_input_tokens
-                                    )  # 计算潜在的总输入 Token
-                                    # 检查是否会超过 TPM 限制 (如果有限制)
-                                    if (
-                                        tpm_input_limit is None
-                                        or tpm_input_limit <= 0
-                                        or potential_tpm_input <= tpm_input_limit
-                                    ):
-                                        # --- Token 预检查通过，选定此 Key ---
-                                        selected_key = associated_key_str  # 选定 Key
-                                        # 计算剩余可用输入 Token 容量
-                                        available_input_tokens = (
-                                            max(0, tpm_input_limit - tpm_input_used)
-                                            if tpm_input_limit is not None
-                                            and tpm_input_limit > 0
-                                            else 10**18
-                                        )
-                                        reason = f"{reason_prefix} - Successful Selection"  # 成功原因
-                                        logger.info(
-                                            f"请求 {request_id} - {reason}: {selected_key[:8]}...。可用输入 Token: {available_input_tokens}"
-                                        )  # 记录成功日志
-                                        self.record_selection_reason(
-                                            selected_key, reason, request_id
-                                        )  # 记录选择原因
-                                        # 增加成功选择计数
-                                        with tracking.cache_tracking_lock:
-                                            tracking.key_selection_successful_selections += (
-                                                1
-                                            )
-                                        self.tried_keys_for_request.add(
-                                            selected_key
-                                        )  # 将选定的 Key 加入本请求的已尝试集合
-                                        return selected_key, int(
-                                            available_input_tokens
-                                        )  # 返回选定的 Key 和可用 Token 容量
-                                    else:  # --- Token 预检查失败 ---
-                                        reason = f"{reason_prefix} - Token Precheck Failed"  # 失败原因
-                                        logger.warning(
-                                            f"请求 {request_id} - {reason}: {associated_key_str[:8]}... 潜在总输入 Token: {potential_tpm_input}, 限制: {tpm_input_limit}"
-                                        )  # 记录警告
-                                        self.record_selection_reason(
-                                            associated_key_str, reason, request_id
-                                        )  # 记录原因
-                        else:  # 如果根据 Key ID 未找到 Key 字符串
-                            reason = f"{reason_prefix} - Key string not found for ID {associated_key_id}"
-                            logger.warning(f"请求 {request_id} - {reason}")
-                            self.record_selection_reason(
-                                f"ID:{associated_key_id}", reason, request_id
-                            )
-                    else:  # 如果未找到与缓存关联的 Key ID
-                        reason = f"{reason_prefix} - No associated Key ID found"
-                        logger.debug(f"请求 {request_id} - {reason}")
-                        self.record_selection_reason("N/A", reason, request_id)
-                except Exception as e:  # 捕获数据库查询异常
-                    logger.error(
-                        f"请求 {request_id} - 查找缓存关联 Key 时出错: {e}",
-                        exc_info=True,
-                    )  # 记录错误
-                    self.record_selection_reason(
-                        "N/A", "Cache Assoc. - DB Error", request_id
-                    )  # 记录原因
-            elif (
-                config.KEY_STORAGE_MODE == "database"
-                and config.ENABLE_NATIVE_CACHING
-                and not db
-            ):  # 如果需要数据库但未提供会话
-                logger.warning(
-                    f"请求 {request_id} - 数据库模式下原生缓存已启用但未提供 db session，无法查找缓存关联 Key。"
-                )  # 记录警告
-                self.record_selection_reason(
-                    "N/A", "Cache Assoc. - DB Session Missing", request_id
-                )  # 记录原因
-            else:  # 其他跳过缓存关联查找的情况
-                logger.debug(
-                    f"请求 {request_id} - 跳过缓存关联 Key 查找 (非数据库模式或原生缓存禁用或无 Cache ID)。"
-                )  # 记录调试信息
+                    )
+                else:  # 如果未找到与缓存关联的 Key
+                    reason = f"{reason_prefix} - No associated Key ID found"
+                    logger.debug(f"请求 {request_id} - {reason}")
+                    self.record_selection_reason("N/A", reason, request_id, model_name)
+            except Exception as e:  # 捕获数据库查询异常
+                logger.error(
+                    f"请求 {request_id} - 查找缓存关联 Key 时出错: {e}",
+                    exc_info=True,
+                )  # 记录错误
                 self.record_selection_reason(
-                    "N/A", "Cache Assoc. - Skipped", request_id
+                    "N/A", "Cache Assoc. - DB Error", request_id, model_name
                 )  # 记录原因
-
-            # --- 策略 2: 用户上次使用 Key 优先级 (粘性会话) ---
-            user_association_reason = "User Assoc. - Skipped"  # 初始化原因为跳过
-            # 仅在数据库模式、未选定 Key、提供了用户 ID、启用了粘性会话且有数据库会话时执行
-            if (
-                config.KEY_STORAGE_MODE == "database"
-                and selected_key is None
-                and user_id
-                and enable_sticky_session
-                and db
-            ):
-                logger.debug(
-                    f"请求 {request_id} - 策略 2: 尝试用户上次使用 Key (User ID: {user_id})"
-                )  # 记录日志
-                try:
-                    # 调用数据库工具函数获取用户上次使用的 Key ID
-                    last_used_key_id = await db_utils.get_user_last_used_key_id(
-                        db, user_id
+        elif (
+            config.KEY_STORAGE_MODE == "database"
+            and config.ENABLE_NATIVE_CACHING
+            and not db
+        ):  # 如果需要数据库但未提供会话
+            logger.warning(
+                f"请求 {request_id} - 数据库模式下原生缓存已启用但未提供 db session，无法查找缓存关联 Key。"
+            )  # 记录警告
+            self.record_selection_reason(
+                "N/A", "Cache Assoc. - DB Session Missing", request_id, model_name
+            )  # 记录原因
+        else:  # 其他跳过缓存关联查找的情况
+            logger.debug(
+                f"请求 {request_id} - 跳过缓存关联 Key 查找 (非数据库模式或原生缓存禁用或无 Cache ID)。"
+            )  # 记录调试信息
+            self.record_selection_reason(
+                "N/A", "Cache Assoc. - Skipped", request_id, model_name
+            )  # 记录原因
+
+        # --- 策略 2: 用户上次使用 Key 优先级 (粘性会话) ---
+        user_association_reason = "User Assoc. - Skipped"  # 初始化原因为跳过
+        # 仅在数据库模式、未选定 Key、提供了用户 ID、启用了粘性会话且有数据库会话时执行
+        if (
+            config.KEY_STORAGE_MODE == "database"
+            and selected_key is None
+            and user_id
+            and enable_sticky_session
+            and db
+        ):
+            logger.debug(
+                f"请求 {request_id} - 策略 2: 尝试用户上次使用 Key (User ID: {user_id})"
+            )  # 记录日志
+            reason_prefix = "User Assoc."  # 定义日志原因前缀
+            try:
+                # 从内存关联映射获取用户上次使用的 Key (映射未命中时才查询一次数据库)
+                last_used_key_str = await self.key_affinity.get_user_key(user_id, db)
+                if last_used_key_str:  # 如果找到了上次使用的 Key
+                    logger.debug(
+                        f"请求 {request_id} - 用户 {user_id} 上次使用 Key: {last_used_key_str[:8]}..."
+                    )  # 记录日志
+                    (
+                        selected_key,
+                        available_input_tokens,
+                        user_association_reason,
+                        reservation,
+                        permit,
+                    ) = await run_shared_state_call(
+                        self._try_associated_key,
+                        snapshot,
+                        last_used_key_str,
+                        reason_prefix,
+                        model_name,
+                        model_limits,
+                        estimated_input_tokens,
+                        today_date_str,
+                        now,
+                        tried_keys,
+                        request_id,
                     )
-                    if last_used_key_id:  # 如果找到了上次使用的 Key ID
-                        # 根据 Key ID 获取 Key 字符串
-                        last_used_key_str = await db_utils.get_key_string_by_id(
-                            db, last_used_key_id
-                        )
-                        if last_used_key_str:  # 如果找到了 Key 字符串
-                            logger.debug(
-                                f"请求 {request_id} - 用户 {user_id} 上次使用 Key: {last_used_key_str[:8]}..."
-                            )  # 记录日志
-                            reason_prefix = "User Assoc."  # 定义日志原因前缀
-                            # --- 检查上次使用 Key 的可用性 ---
-                            if (
-                                last_used_key_str not in current_active_keys
-                            ):  # 是否在当前活动 Key 列表中
-                                user_association_reason = (
-                                    f"{reason_prefix} - Key not active/found in manager"
-                                )
-                                logger.warning(
-                                    f"请求 {request_id} - {user_association_reason}"
-                                )
-                                self.record_selection_reason(
-                                    last_used_key_str,
-                                    user_association_reason,
-                                    request_id,
-                                )
-                            elif (
-                                last_used_key_str in tried_keys
-                            ):  # 是否已在本请求中尝试过
-                                user_association_reason = (
-                                    f"{reason_prefix} - Key already tried"
-                                )
-                                logger.warning(
-                                    f"请求 {request_id} - {user_association_reason}"
-                                )
-                                self.record_selection_reason(
-                                    last_used_key_str,
-                                    user_association_reason,
-                                    request_id,
-                                )
-                            elif (
-                                last_used_key_str in daily_exhausted
-                            ):  # 是否已达到每日配额
-                                user_association_reason = (
-                                    f"{reason_prefix} - Daily Quota Exhausted"
-                                )
-                                logger.warning(
-                                    f"请求 {request_id} - {user_association_reason}"
-                                )
-                                self.record_selection_reason(
-                                    last_used_key_str,
-                                    user_association_reason,
-                                    request_id,
-                                )
-                            elif (
-                                last_used_key_str in temporarily_unavailable_keys
-                            ):  # 是否临时不可用
-                                user_association_reason = (
-                                    f"{reason_prefix} - Temporarily Unavailable"
-                                )
-                                logger.warning(
-                                    f"请求 {request_id} - {user_association_reason}"
-                                )
-                                self.record_selection_reason(
-                                    last_used_key_str,
-                                    user_association_reason,
-                                    request_id,
-                                )
-                            else:  # --- Key 可用，进行 Token 预检查 ---
-                                logger.debug(
-                                    f"请求 {request_id} - 上次使用 Key {last_used_key_str[:8]}... 可用，进行 Token 预检查..."
-                                )
-                                with usage_lock:  # 获取使用数据锁
-                                    key_usage = usage_data.get(
-                                        last_used_key_str, {}
-                                    ).get(
-                                        model_name, {}
-                                    )  # 获取使用数据
-                                    tpm_input_limit = model_limits.get(
-                                        "tpm_input"
-                                    )  # 获取 TPM 限制
-                                    tpm_input_used = key_usage.get(
-                                        "tpm_input_count", 0
-                                    )  # 获取当前 TPM 计数
-                                    potential_tpm_input = (
-                                        tpm_input_used + estimated_input_tokens
-                                    )  # 计算潜在总输入
-                                    # 检查是否会超过 TPM 限制
-                                    if (
-                                        tpm_input_limit is None
-                                        or tpm_input_limit <= 0
-                                        or potential_tpm_input <= tpm_input_limit
-                                    ):
-                                        # --- Token 预检查通过，选定此 Key ---
-                                        selected_key = last_used_key_str  # 选定 Key
-                                        # 计算剩余可用输入 Token
-                                        available_input_tokens = (
-                                            max(0, tpm_input_limit - tpm_input_used)
-                                            if tpm_input_limit is not None
-                                            and tpm_input_limit > 0
-                                            else 10**18
-                                        )
-                                        user_association_reason = f"{reason_prefix} - Successful Selection"  # 成功原因
-                                        logger.info(
-                                            f"请求 {request_id} - {user_association_reason}: {selected_key[:8]}...。可用输入 Token: {available_input_tokens}"
-                                        )  # 记录成功日志
-                                        self.record_selection_reason(
-                                            selected_key,
-                                            user_association_reason,
-                                            request_id,
-                                        )  # 记录原因
-                                        # 增加成功选择计数
-                                        with tracking.cache_tracking_lock:
-                                            tracking.key_selection_successful_selections += (
-                                                1
-                                            )
-                                        self.tried_keys_for_request.add(
-                                            selected_key
-                                        )  # 加入已尝试集合
-                                        return selected_key, int(
-                                            available_input_tokens
-                                        )  # 返回结果
-                                    else:  # --- Token 预检查失败 ---
-                                        user_association_reason = f"{reason_prefix} - Token Precheck Failed"  # 失败原因
-                                        logger.warning(
-                                            f"请求 {request_id} - {user_association_reason}: {last_used_key_str[:8]}... 潜在总输入 Token: {potential_tpm_input}, 限制: {tpm_input_limit}"
-                                        )  # 记录警告
-                                        self.record_selection_reason(
-                                            last_used_key_str,
-                                            user_association_reason,
-                                            request_id,
-                                        )  # 记录原因
-                        else:  # 如果根据 Key ID 未找到 Key 字符串
-                            user_association_reason = f"{reason_prefix} - Key string not found for ID {last_used_key_id}"
-                            logger.warning(
-                                f"请求 {request_id} - {user_association_reason}"
-                            )
-                            self.record_selection_reason(
-                                f"ID:{last_used_key_id}",
-                                user_association_reason,
-                                request_id,
-                            )
-                    else:  # 如果未找到用户上次使用的 Key
-                        user_association_reason = (
-                            f"{reason_prefix} - No last used Key found"
-                        )
-                        logger.debug(f"请求 {request_id} - {user_association_reason}")
-                        self.record_selection_reason(
-                            "N/A", user_association_reason, request_id
-                        )
-                except Exception as e:  # 捕获数据库查询异常
-                    logger.error(
-                        f"请求 {request_id} - 查找用户上次使用 Key 时出错: {e}",
-                        exc_info=True,
-                    )  # 记录错误
-                    user_association_reason = "User Assoc. - DB Error"
+                else:  # 如果未找到用户上次使用的 Key
+                    user_association_reason = f"{reason_prefix} - No last used Key found"
+                    logger.debug(f"请求 {request_id} - {user_association_reason}")
                     self.record_selection_reason(
-                        "N/A", user_association_reason, request_id
+                        "N/A", user_association_reason, request_id, model_name
                     )
-            elif selected_key is None:  # 如果未执行用户关联查找，记录跳过原因
-                if config.KEY_STORAGE_MODE != "database":
-                    user_association_reason = "User Assoc. - Skipped (Not DB Mode)"
-                elif not user_id:
-                    user_association_reason = "User Assoc. - User ID Missing"
-                elif not enable_sticky_session:
-                    user_association_reason = "User Assoc. - Sticky Session Disabled"
-                elif not db:
-                    user_association_reason = "User Assoc. - DB Session Missing"
-                logger.debug(
-                    f"请求 {request_id} - 跳过用户关联 Key 查找 ({user_association_reason})。"
-                )  # 记录调试信息
+            except Exception as e:  # 捕获数据库查询异常
+                logger.error(
+                    f"请求 {request_id} - 查找用户上次使用 Key 时出错: {e}",
+                    exc_info=True,
+                )  # 记录错误
+                user_association_reason = "User Assoc. - DB Error"
                 self.record_selection_reason(
-                    "N/A", user_association_reason, request_id
-                )  # 记录原因
+                    "N/A", user_association_reason, request_id, model_name
+                )
+        elif selected_key is None:  # 如果未执行用户关联查找，记录跳过原因
+            if config.KEY_STORAGE_MODE != "database":
+                user_association_reason = "User Assoc. - Skipped (Not DB Mode)"
+            elif not user_id:
+                user_association_reason = "User Assoc. - User ID Missing"
+            elif not enable_sticky_session:
+                user_association_reason = "User Assoc. - Sticky Session Disabled"
+            elif not db:
+                user_association_reason = "User Assoc. - DB Session Missing"
+            logger.debug(
+                f"请求 {request_id} - 跳过用户关联 Key 查找 ({user_association_reason})。"
+            )  # 记录调试信息
+            self.record_selection_reason(
+                "N/A", user_association_reason, request_id, model_name
+            )  # 记录原因
+
+        # --- 策略 3: 按模型配置的可插拔选择策略 (回退策略，默认为评分和轮转选择) ---
+        if selected_key is None:  # 如果经过前两种策略仍未选定 Key
+            logger.debug(f"请求 {request_id} - 策略 3: 执行可插拔选择策略。")  # 记录日志
+            # --- 检查分数缓存是否需要刷新 ---
+            self._schedule_score_refresh(model_name, model_limits, request_id, now)
+            selected_key, available_input_tokens, reservation, permit = (
+                await run_shared_state_call(
+                    self._select_by_strategy,
+                    snapshot,
+                    SelectionRequest(
+                        model_name=model_name,
+                        model_limits=model_limits,
+                        estimated_input_tokens=estimated_input_tokens,
+                        user_id=user_id,
+                        request_id=request_id,
+                        now=now,
+                    ),
+                    today_date_str,
+                    tried_keys,
+                    attempt_context,
+                )
+            )
 
-            # --- 策略 3: 基于评分和最近最少使用的轮转选择 (回退策略) ---
-            if selected_key is None:  # 如果经过前两种策略仍未选定 Key
-                logger.debug(
-                    f"请求 {request_id} - 策略 3: 执行评分和轮转选择。"
-                )  # 记录日志
-                # --- 获取 Key 分数 (可能从缓存或数据库) ---
-                with cache_lock:  # 获取分数缓存锁
-                    now = time.time()  # 获取当前时间
-                    # 检查分数缓存是否需要刷新
-                    if (
-                        now - cache_last_updated.get(model_name, 0)
-                        > CACHE_REFRESH_INTERVAL_SECONDS
-                    ):
-                        logger.info(
-                            f"请求 {request_id} - 模型 '{model_name}' 的 Key 分数缓存已过期，正在异步刷新..."
-                        )  # 记录日志
-                        try:
-                            # 创建一个异步任务来更新分数缓存，避免阻塞当前请求
-                            asyncio.create_task(
-                                self._async_update_key_scores(model_name, model_limits)
-                            )
-                        except (
-                            RuntimeError
-                        ):  # 如果当前不在事件循环中 (例如，在同步代码中调用)
-                            logger.warning(
-                                f"请求 {request_id} - 不在异步事件循环中，无法启动异步刷新任务。依赖后台任务或下次调用刷新。"
-                            )  # 记录警告
-                        update_cache_timestamp(
-                            model_name
-                        )  # 更新缓存时间戳，防止短时间内重复触发刷新
-                    # 显式声明scores类型为Dict[str, float]
-                    # 显式声明scores类型
-                    scores: Dict[str, float] = key_scores_cache.get(model_name, {})
-                    # 显式声明available_scores类型
-                    available_scores: Dict[str, float] = {}
-
-                if not scores:  # 如果没有分数数据
-                    logger.warning(
-                        f"请求 {request_id} - 模型 '{model_name}' 没有可用的 Key 分数缓存数据。"
-                    )  # 记录警告
-                    self.record_selection_reason(
-                        "N/A", "Score Selection - No Key Score Cache Data", request_id
-                    )  # 记录原因
-                    # 增加失败选择计数
-                    with tracking.cache_tracking_lock:
-                        tracking.key_selection_failed_selections += 1
-                        tracking.key_selection_failure_reasons[
-                            "Score Selection - No Key Score Cache Data"
-                        ] += 1
-                else:  # 如果有分数数据
-                    # --- 筛选可用的 Key ---
-                    available_scores = {}  # 存储筛选后的 Key 及其分数
-                    reason_prefix = "Score Selection"  # 定义日志原因前缀
-                    # 遍历缓存中的所有 Key 分数
-                    for k, v in scores.items():
-                        # 检查 Key 是否在当前活动的 Key 列表中
-                        if k not in current_active_keys:
-                            self.record_selection_reason(
-                                k,
-                                f"{reason_prefix} - Key not active in manager",
-                                request_id,
-                            )
-                            continue  # 跳过非活动 Key
-                        # 检查 Key 是否已在本请求中尝试过
-                        if k in tried_keys:
-                            self.record_selection_reason(
-                                k, f"{reason_prefix} - Key already tried", request_id
-                            )
-                            continue  # 跳过已尝试 Key
-                        # 检查 Key 是否已达到每日配额
-                        if k in daily_exhausted:
-                            self.record_selection_reason(
-                                k,
-                                f"{reason_prefix} - Daily Quota Exhausted",
-                                request_id,
-                            )
-                            continue  # 跳过每日耗尽 Key
-                        # 检查 Key 是否临时不可用
-                        if k in temporarily_unavailable_keys:
-                            self.record_selection_reason(
-                                k,
-                                f"{reason_prefix} - Temporarily Unavailable",
-                                request_id,
-                            )
-                            continue  # 跳过临时不可用 Key
-                        # 如果 Key 可用，添加到 available_scores 字典
-                        available_scores[k] = v
-
-                    if not available_scores:  # 如果筛选后没有可用的 Key
-                        logger.warning(
-                            f"请求 {request_id} - 模型 '{model_name}' 的所有可用 Key（根据缓存）均已尝试、当天耗尽或临时不可用。"
-                        )  # 记录警告
-                        self.record_selection_reason(
-                            "N/A",
-                            f"{reason_prefix} - All available keys tried/exhausted/unavailable",
-                            request_id,
-                        )  # 记录原因
-                        # 增加失败选择计数
-                        with tracking.cache_tracking_lock:
-                            tracking.key_selection_failed_selections += 1
-                            tracking.key_selection_failure_reasons[
-                                f"{reason_prefix} - All available keys tried/exhausted/unavailable"
-                            ] += 1
-                    else:  # 如果有可用的 Key
-                        # --- 执行轮转选择 ---
-                        # 1. 按分数降序排序
-                        # 显式声明变量类型
-                        sorted_keys_by_score: List[Tuple[str, float]] = sorted(
-                            available_scores.items(),
-                            key=lambda item: item[1],
-                            reverse=True,
-                        )
-                        # 2. 确定轮转范围 (例如，分数在前 95% 的 Key)
-                        rotation_threshold = 0.95  # 定义轮转阈值
-                        best_score: float = (
-                            sorted_keys_by_score[0][1] if sorted_keys_by_score else 0.0
-                        )
-                        # 筛选出分数在阈值范围内的 Key
-                        keys_in_rotation_range: List[Tuple[str, float]] = [
-                            (k, score)
-                            for k, score in sorted_keys_by_score
-                            if score >= best_score * rotation_threshold
-                        ]
-
-                        # 3. 在轮转范围内的 Key 中，按最近最少使用排序
-                        with usage_lock:  # 获取使用数据锁
-                            # 对轮转范围内的 Key 按 last_used_timestamp 升序排序（越小越优先）
-                            sorted_keys_for_rotation: List[Tuple[str, float]] = sorted(
-                                keys_in_rotation_range,
-                                key=lambda item: usage_data.get(item[0], {})
-                                .get(model_name, {})
-                                .get(
-                                    "last_used_timestamp", 0.0
-                                ),  # 获取上次使用时间戳，默认为 0
-                            )
-                            # 4. 遍历排序后的 Key，进行 Token 预检查并选择第一个通过的 Key
-                            for candidate_key, candidate_score in sorted_keys_for_rotation:  # type: ignore
-                                key_usage = usage_data.get(candidate_key, {}).get(
-                                    model_name, {}
-                                )  # 获取使用数据
-                                tpm_input_limit = model_limits.get(
-                                    "tpm_input"
-                                )  # 获取 TPM 限制
-                                tpm_input_used = key_usage.get(
-                                    "tpm_input_count", 0
-                                )  # 获取当前 TPM 计数
-                                potential_tpm_input = (
-                                    tpm_input_used + estimated_input_tokens
-                                )  # 计算潜在总输入
-                                # 检查是否会超过 TPM 限制
-                                if (
-                                    tpm_input_limit is None
-                                    or tpm_input_limit <= 0
-                                    or potential_tpm_input <= tpm_input_limit
-                                ):
-                                    # --- Token 预检查通过，选定此 Key ---
-                                    selected_key = candidate_key  # 选定 Key
-                                    # 计算剩余可用输入 Token
-                                    available_input_tokens = (
-                                        max(0, tpm_input_limit - tpm_input_used)
-                                        if tpm_input_limit is not None
-                                        and tpm_input_limit > 0
-                                        else 10**18
-                                    )
-                                    reason = f"{reason_prefix} - Successful Selection (Score: {candidate_score:.4f})"  # 成功原因
-                                    logger.info(
-                                        f"请求 {request_id} - {reason}: {selected_key[:8]}...。可用输入 Token: {available_input_tokens}"
-                                    )  # 记录成功日志
-                                    self.record_selection_reason(
-                                        selected_key, reason, request_id
-                                    )  # 记录原因
-                                    # 增加成功选择计数
-                                    with tracking.cache_tracking_lock:
-                                        tracking.key_selection_successful_selections += (
-                                            1
-                                        )
-                                    break  # 找到合适的 Key，跳出循环
-                                else:  # --- Token 预检查失败 ---
-                                    reason = f"{reason_prefix} - Token Precheck Failed"  # 失败原因
-                                    logger.warning(
-                                        f"请求 {request_id} - {reason}: {candidate_key[:8]}... 潜在总输入 Token: {potential_tpm_input}, 限制: {tpm_input_limit}"
-                                    )  # 记录警告
-                                    self.record_selection_reason(
-                                        candidate_key, reason, request_id
-                                    )  # 记录原因
-                                    continue  # 继续检查下一个候选 Key
-
-            # --- 最终检查和返回 ---
-            if selected_key:  # 如果最终选定了一个 Key
-                # 将选定的 Key 加入本请求的已尝试集合
-                self.tried_keys_for_request.add(selected_key)
-                return selected_key, int(
-                    available_input_tokens
-                )  # 返回选定的 Key 和可用 Token 容量
-            else:  # 如果所有策略都尝试后仍未选定 Key
-                final_reason = "Final Failure - No suitable key found after all strategies"  # 最终失败原因
-                logger.error(f"请求 {request_id} - {final_reason}")  # 记录错误日志
+        # --- 最终检查和返回 ---
+        if selected_key:  # 如果最终选定了一个 Key
+            # 增加成功选择计数
+            with tracking.cache_tracking_lock:
+                tracking.key_selection_successful_selections += 1
+            # 将选定的 Key 加入本请求的已尝试集合，并由尝试上下文持有 Token 预留和并发名额
+            if attempt_context is not None:
+                attempt_context.mark_tried(selected_key)
+                attempt_context.hold_token_reservation(reservation)
+                attempt_context.hold_concurrency_permit(permit)
+            else:
+                # 没有尝试上下文时无人对账和归还，退化为仅预检查，不保留预留和名额
+                if reservation is not None:
+                    reservation.release()
+                if permit is not None:
+                    permit.discard()
+            self.selection_telemetry.end_trace(trace, selected_key)
+            return selected_key, int(
+                available_input_tokens
+            )  # 返回选定的 Key 和可用 Token 容量
+
+        final_reason = "Final Failure - No suitable key found after all strategies"  # 最终失败原因
+        logger.error(f"请求 {request_id} - {final_reason}")  # 记录错误日志
+        self.record_selection_reason(
+            "N/A", final_reason, request_id, model_name
+        )  # 记录原因
+        # 增加失败选择计数
+        with tracking.cache_tracking_lock:
+            tracking.key_selection_failed_selections += 1
+            tracking.key_selection_failure_reasons[final_reason] += 1
+        self.selection_telemetry.end_trace(trace, None)
+        return None, 0  # 返回 None 表示未选定 Key
+
+    def _get_candidate_index(
+        self,
+        snapshot: KeyStateSnapshot,
+        model_name: str,
+        model_limits: Dict[str, Any],
+    ) -> CandidateIndex:
+        """
+        (内部方法) 获取模型的 Key 候选索引，不存在时从分数缓存构建。
+        如果缓存中缺少部分活动 Key 的分数 (例如首次请求或新加入的 Key)，先由评分引擎同步计算。
+        """
+        index = self._candidate_indexes.get(model_name)
+        if index is not None:
+            return index
+        with cache_lock:
+            scores: Dict[str, float] = dict(key_scores_cache.get(model_name, {}))
+        if snapshot.active_keys and not snapshot.active_key_set.issubset(scores):
+            scores = key_scoring_engine.refresh_model_scores(
+                model_name, snapshot.active_keys, model_limits
+            )
+        with usage_lock:  # 以最近一次成功使用的时间作为初始的"上次选中时间"
+            last_used = {
+                k: usage_data.get(k, {})
+                .get(model_name, {})
+                .get("last_used_timestamp", 0.0)
+                for k in scores
+            }
+        index = CandidateIndex(scores, last_used)
+        # 并发构建时以先写入者为准
+        return self._candidate_indexes.setdefault(model_name, index)
+
+    def get_selection_strategy(self, model_name: str) -> KeySelectionStrategy:
+        """返回模型在策略 3 中使用的 Key 选择策略 (首次调用时按配置创建)。"""
+        strategy = self._selection_strategies.get(model_name)
+        if strategy is None:
+            strategy_cls = STRATEGIES[strategy_name_for_model(model_name)]
+            strategy = self._selection_strategies.setdefault(
+                model_name, strategy_cls(self.concurrency_limiter)
+            )
+        return strategy
+
+    def set_selection_strategy(self, model_name: str, strategy_name: str) -> None:
+        """
+        在运行时切换模型的 Key 选择策略。
+
+        Raises:
+            ValueError: 策略名称未知。
+        """
+        if strategy_name not in STRATEGIES:
+            raise ValueError(f"未知的 Key 选择策略: {strategy_name}")
+        self._selection_strategies[model_name] = STRATEGIES[strategy_name](
+            self.concurrency_limiter
+        )
+
+    def _schedule_score_refresh(
+        self,
+        model_name: str,
+        model_limits: Dict[str, Any],
+        request_id: Optional[str],
+        now: float,
+    ) -> None:
+        """
+        (内部方法) 模型的 Key 分数缓存过期时，在当前事件循环中启动一次异步刷新。
+        策略 3 的选择可能在线程池中执行，因此刷新任务在进入选择之前由调用者启动。
+        """
+        with cache_lock:  # 获取分数缓存锁 (不嵌套其他锁)
+            needs_refresh = (
+                now - cache_last_updated.get(model_name, 0)
+                > CACHE_REFRESH_INTERVAL_SECONDS
+            )
+            if needs_refresh:
+                update_cache_timestamp(
+                    model_name
+                )  # 更新缓存时间戳，防止短时间内重复触发刷新
+        if not needs_refresh:
+            return
+        logger.info(
+            f"请求 {request_id} - 模型 '{model_name}' 的 Key 分数缓存已过期，正在异步刷新..."
+        )  # 记录日志
+        try:
+            # 创建一个异步任务来更新分数缓存，避免阻塞当前请求
+            asyncio.create_task(self._async_update_key_scores(model_name, model_limits))
+        except RuntimeError:  # 如果当前不在事件循环中 (例如，在同步代码中调用)
+            logger.warning(
+                f"请求 {request_id} - 不在异步事件循环中，无法启动异步刷新任务。依赖后台任务或下次调用刷新。"
+            )  # 记录警告
+
+    def _select_by_strategy(
+        self,
+        snapshot: KeyStateSnapshot,
+        request: SelectionRequest,
+        today_date_str: str,
+        tried_keys: FrozenSet[str],
+        attempt_context: Optional[AttemptContext] = None,
+    ) -> Tuple[
+        Optional[str], int, Optional[TokenReservation], Optional[ConcurrencyPermit]
+    ]:
+        """
+        (内部方法) 策略 3：按模型配置的选择策略 (默认为评分和最近最少选中的轮转选择)。
+        策略决定候选 Key 的检查顺序；本方法提供的检查函数负责可用性、熔断器、并发上限、
+        Token 预检查与预留，选出第一个通过检查的 Key。因容量不足跳过的候选 Key 及其最早恢复时间
+        记录到 attempt_context.capacity_retry_at，供准入队列使用。
+        检查会访问共享状态后端，后端为远程 (Redis) 时调用者通过 run_shared_state_call 在线程池中执行本方法。
+
+        Returns:
+            Tuple[Optional[str], int, Optional[TokenReservation], Optional[ConcurrencyPermit]]:
+            (选中的 Key 或 None, 可用输入 Token 容量, Token 预留, 并发名额)
+        """
+        from gap.core import tracking  # 导入 tracking 模块
+
+        model_name = request.model_name
+        model_limits = request.model_limits
+        estimated_input_tokens = request.estimated_input_tokens
+        request_id = request.request_id
+        now = request.now
+        strategy = self.get_selection_strategy(model_name)
+        reason_prefix = strategy.reason_prefix  # 定义日志原因前缀
+        index = self._get_candidate_index(snapshot, model_name, model_limits)
+
+        if not snapshot.active_keys:  # 如果没有任何活动 Key，也就没有分数数据
+            reason = f"{reason_prefix} - No Key Score Cache Data"
+            logger.warning(
+                f"请求 {request_id} - 模型 '{model_name}' 没有可用的 Key 分数缓存数据。"
+            )  # 记录警告
+            self.record_selection_reason(
+                "N/A", reason, request_id, model_name
+            )  # 记录原因
+            with tracking.cache_tracking_lock:
+                tracking.key_selection_failed_selections += 1
+                tracking.key_selection_failure_reasons[reason] += 1
+            return None, 0, None, None
+
+        available_input_tokens = 0
+        precheck_failed = False
+        reservation: Optional[TokenReservation] = None
+        permit: Optional[ConcurrencyPermit] = None
+
+        def note_capacity_shortage(retry_at: Optional[float]) -> None:
+            """记录因容量不足跳过的候选 Key，供准入队列决定是否等待以及定时唤醒的时间。"""
+            if attempt_context is not None:
+                attempt_context.note_capacity_shortage(retry_at)
+
+        def check_candidate(
+            candidate_key: str, candidate_score: float
+        ) -> Tuple[bool, Optional[float]]:
+            """逐个检查索引给出的候选 Key：可用性、本请求是否已尝试、熔断器、并发上限、Token 预检查与预留。"""
+            nonlocal available_input_tokens, precheck_failed, reservation, permit
+            unavailable = snapshot.unavailable_reason(
+                candidate_key, today_date_str, now, tried_keys
+            )
+            if unavailable:  # 跳过非活动、已尝试、当天耗尽或临时不可用的 Key
                 self.record_selection_reason(
-                    "N/A", final_reason, request_id
-                )  # 记录原因
-                # 增加失败选择计数
-                with tracking.cache_tracking_lock:
-                    tracking.key_selection_failed_selections += 1
-                    tracking.key_selection_failure_reasons[final_reason] += 1
-                return None, 0  # 返回 None 表示未选定 Key
+                    candidate_key,
+                    f"{reason_prefix} - {unavailable}",
+                    request_id,
+                    model_name,
+                )
+                if unavailable == "Daily Quota Exhausted":
+                    return False, now + DAILY_EXHAUSTED_RECHECK_SECONDS
+                if unavailable == "Temporarily Unavailable":
+                    recover_at = snapshot.temporary_issues[candidate_key]
+                    note_capacity_shortage(recover_at)
+                    return False, recover_at
+                return False, None  # 仅对本请求不可用，保留在索引中
+            allowed, retry_at = self.circuit_breaker.allow(candidate_key, model_name, now)
+            if not allowed:  # 熔断器断开，或半开状态下已有探测请求在途
+                self.record_selection_reason(
+                    candidate_key,
+                    f"{reason_prefix} - Circuit Open",
+                    request_id,
+                    model_name,
+                )
+                note_capacity_shortage(retry_at)
+                return False, retry_at
+            candidate_permit = self.concurrency_limiter.try_acquire(
+                candidate_key, model_name
+            )
+            if candidate_permit is None:  # 在途请求数已达到自适应并发上限，请求完成后即可再选
+                self.circuit_breaker.release_probe(candidate_key, model_name)
+                self.record_selection_reason(
+                    candidate_key,
+                    f"{reason_prefix} - Concurrency Limit",
+                    request_id,
+                    model_name,
+                )
+                note_capacity_shortage(None)  # 在途请求完成时由释放事件唤醒
+                return False, None
+            candidate_reservation, available, potential_tpm_input, tpm_input_limit = (
+                self._reserve_input_tokens(
+                    candidate_key, model_name, model_limits, estimated_input_tokens
+                )
+            )
+            if candidate_reservation is not None:
+                available_input_tokens = available
+                reservation = candidate_reservation
+                permit = candidate_permit
+                return True, None
+            # --- Token 预检查失败 ---
+            self.circuit_breaker.release_probe(candidate_key, model_name)
+            candidate_permit.discard()
+            precheck_failed = True
+            reason = f"{reason_prefix} - Token Precheck Failed"
+            logger.warning(
+                f"请求 {request_id} - {reason}: {candidate_key[:8]}... 潜在总输入 Token: {potential_tpm_input}, 限制: {tpm_input_limit}"
+            )  # 记录警告
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            note_capacity_shortage(
+                key_rate_limiter.available_at(
+                    candidate_key,
+                    model_name,
+                    "tpm_input",
+                    tpm_input_limit,
+                    estimated_input_tokens,
+                    now,
+                )
+            )
+            return False, None
+
+        picked = strategy.select(request, index, snapshot.active_keys, check_candidate)
+        if picked is not None:  # --- 选定 Key ---
+            candidate_key, candidate_score = picked
+            reason = f"{reason_prefix} - Successful Selection (Score: {candidate_score:.4f})"
+            logger.info(
+                f"请求 {request_id} - {reason}: {candidate_key[:8]}...。可用输入 Token: {available_input_tokens}"
+            )  # 记录成功日志
+            self.record_selection_reason(candidate_key, reason, request_id, model_name)
+            return candidate_key, available_input_tokens, reservation, permit
+
+        if not precheck_failed:  # 没有任何 Key 可用 (而不是全部未通过 Token 预检查)
+            reason = f"{reason_prefix} - All available keys tried/exhausted/unavailable"
+            logger.warning(
+                f"请求 {request_id} - 模型 '{model_name}' 的所有可用 Key（根据缓存）均已尝试、当天耗尽或临时不可用。"
+            )  # 记录警告
+            self.record_selection_reason(
+                "N/A", reason, request_id, model_name
+            )  # 记录原因
+            with tracking.cache_tracking_lock:
+                tracking.key_selection_failed_selections += 1
+                tracking.key_selection_failure_reasons[reason] += 1
+        return None, 0, None, None
+
+    def record_call_outcome(
+        self,
+        api_key: str,
+        model_name: str,
+        success: bool,
+        latency_seconds: Optional[float] = None,
+        status_code: Optional[int] = None,
+        limits: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        记录一次 API 调用结果：交给评分引擎更新 Key 分数并同步到该模型的候选索引，
+        同时调整 Key 在该模型下的自适应并发上限。参数含义见 KeyScoringEngine.record_outcome。
+        """
+        score = key_scoring_engine.record_outcome(
+            api_key,
+            model_name,
+            success=success,
+            latency_seconds=latency_seconds,
+            status_code=status_code,
+            limits=limits,
+        )
+        circuit_recovered = success and self.circuit_breaker.record_success(
+            api_key, model_name
+        )
+        self.concurrency_limiter.record_outcome(
+            api_key,
+            model_name,
+            success=success,
+            latency_seconds=latency_seconds,
+            status_code=status_code,
+        )
+        index = self._candidate_indexes.get(model_name)
+        if index is not None and self._snapshot.is_active(api_key):
+            index.update_score(api_key, score)
+            if circuit_recovered:  # 探测成功，熔断器关闭，Key 立即恢复候选资格
+                index.resume(api_key)
+        if circuit_recovered:
+            admission_queue.notify(model_name)
+
+    def trip_circuit(
+        self,
+        api_key: str,
+        model_name: str,
+        issue_type: Optional[str] = None,
+        retry_after_seconds: Optional[float] = None,
+    ) -> float:
+        """
+        断开 Key 在该模型下的熔断器 (限流、服务端错误、超时、网络错误等可恢复的失败)，
+        并在该模型的候选索引中挂起 Key 直到断开结束。
+
+        Args:
+            api_key (str): 出错的 API Key。
+            model_name (str): 模型名称。
+            issue_type (Optional[str]): 失败原因描述，用于日志记录。
+            retry_after_seconds (Optional[float]): 上游建议的重试间隔 (秒)。
+
+        Returns:
+            float: 断开状态的结束时间戳。
+        """
+        open_until = self.circuit_breaker.record_failure(
+            api_key, model_name, issue_type, retry_after_seconds
+        )
+        index = self._candidate_indexes.get(model_name)
+        if index is not None:
+            index.suspend(api_key, open_until)
+        reason_suffix = f" (原因: {issue_type})" if issue_type else ""
+        logger.warning(
+            f"API Key {api_key[:10]}... 在模型 {model_name} 下熔断 {max(0.0, open_until - time.time()):.1f} 秒{reason_suffix}。"
+        )  # 记录警告日志
+        return open_until
 
     def _is_key_daily_exhausted_nolock(self, api_key: str) -> bool:
         """
         (内部方法) 检查 API 密钥是否已达到每日配额限制。
-        此方法不获取 keys_lock，调用者需要确保已持有锁。
+        基于当前快照判断，无需加锁。
 
         Args:
             api_key (str): 要检查的 API Key 字符串。
@@ -959,42 +1070,57 @@ class APIKeyManager:
         Returns:
             bool: 如果 Key 已达到当日配额限制，返回 True；否则返回 False。
         """
-        # 检查 daily_exhausted_keys 字典中是否存在该 Key，并且其记录的日期是否与当天日期相同
-        return self.daily_exhausted_keys.get(api_key) == self._today_date_str
+        return self._snapshot.is_daily_exhausted(api_key, self._today_date_str)
 
     def mark_key_daily_exhausted(self, api_key: str):
         """
         将指定的 API 密钥标记为当天已耗尽配额。
-        记录当前日期到 daily_exhausted_keys 字典。
+        记录当前日期到快照的 daily_exhausted 映射中。
 
         Args:
             api_key (str): 要标记的 API Key 字符串。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全修改共享字典
-            self.daily_exhausted_keys[api_key] = (
-                self._today_date_str
-            )  # 记录 Key 和当天日期
-            logger.warning(
-                f"API Key {api_key[:10]}... 已达到每日配额限制。"
-            )  # 记录警告日志
+        today_date_str = self._refresh_today_date_str()
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            daily_exhausted = {
+                k: d
+                for k, d in self._snapshot.daily_exhausted.items()
+                if d == today_date_str  # 顺便清理前一天的过期标记
+            }
+            daily_exhausted[api_key] = today_date_str  # 记录 Key 和当天日期
+            self._swap_snapshot(daily_exhausted=daily_exhausted)
+        self._suspend_in_indexes(api_key, time.time() + DAILY_EXHAUSTED_RECHECK_SECONDS)
+        if shared_state_backend is not None:  # 通知其他 worker，标记在下一次每日重置时失效
+            next_reset = (
+                datetime.now(_PT_TIMEZONE) + timedelta(days=1)
+            ).replace(hour=0, minute=0, second=0, microsecond=0)
+            shared_state_backend.set_mark(
+                SHARED_DAILY_EXHAUSTED_MARKS, api_key, next_reset.timestamp()
+            )
+        logger.warning(f"API Key {api_key[:10]}... 已达到每日配额限制。")  # 记录警告日志
 
     def reset_daily_exhausted_keys(self):
         """
         重置所有 API 密钥的每日配额耗尽标记。
         此方法通常在每日重置任务中调用。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全修改共享字典
-            keys_count = len(self.daily_exhausted_keys)
-            self.daily_exhausted_keys.clear()  # 清空所有每日配额耗尽标记
-            if keys_count > 0:
-                logger.info(
-                    f"已重置 {keys_count} 个 API Key 的每日配额耗尽标记。"
-                )  # 记录日志
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            keys_count = len(self._snapshot.daily_exhausted)
+            self._swap_snapshot(daily_exhausted={})  # 清空所有每日配额耗尽标记
+        if shared_state_backend is not None:
+            shared_state_backend.clear_marks(SHARED_DAILY_EXHAUSTED_MARKS)
+        for index in list(self._candidate_indexes.values()):
+            index.resume_all()  # 仍处于临时不可用的 Key 会在下次选择时被重新挂起
+        admission_queue.notify_all()  # 唤醒等待容量的请求
+        if keys_count > 0:
+            logger.info(
+                f"已重置 {keys_count} 个 API Key 的每日配额耗尽标记。"
+            )  # 记录日志
 
     def is_key_temporarily_unavailable(self, api_key: str) -> bool:
         """
         检查指定的 API 密钥当前是否因临时问题（例如，短暂的 API 错误）而不可用。
-        同时会清理掉已经过期的临时不可用标记。
+        基于当前快照判断，无需加锁；已过期的标记视为可用，并在下一次写入时被清理。
 
         Args:
             api_key (str): 要检查的 API Key 字符串。
@@ -1002,23 +1128,7 @@ class APIKeyManager:
         Returns:
             bool: 如果 Key 当前处于临时不可用状态，返回 True；否则返回 False。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全访问和修改共享字典
-            # 获取该 Key 的过期时间戳，如果不存在则为 None
-            expiration_timestamp = self.temporary_issue_keys.get(api_key)
-            # 检查是否存在过期时间戳，并且该时间戳是否已小于当前时间
-            if expiration_timestamp and expiration_timestamp < time.time():
-                # 如果标记已过期，从字典中安全地移除该 Key 的条目
-                self.temporary_issue_keys.pop(
-                    api_key, None
-                )  # pop 避免 Key 不存在时出错
-                logger.info(
-                    f"API Key {api_key[:10]}... 的临时问题标记已过期，恢复可用。"
-                )  # 记录恢复日志
-                return False  # 返回 False 表示 Key 不再临时不可用
-            # 如果存在未过期的标记，或者标记不存在，根据 expiration_timestamp 是否为 None 判断
-            return (
-                expiration_timestamp is not None
-            )  # 如果存在时间戳 (未过期)，则返回 True
+        return self._snapshot.is_temporarily_unavailable(api_key)
 
     def mark_key_temporarily_unavailable(
         self, api_key: str, duration_seconds: int = 60, issue_type: Optional[str] = None
@@ -1032,38 +1142,107 @@ class APIKeyManager:
             duration_seconds (int, optional): 临时不可用的持续时间（秒）。默认为 60 秒。
             issue_type (Optional[str], optional): 触发临时不可用状态的原因描述，用于日志记录。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全修改共享字典
-            # 计算并存储 Key 恢复可用的时间戳
-            self.temporary_issue_keys[api_key] = time.time() + duration_seconds
-            reason_suffix = f" (原因: {issue_type})" if issue_type else ""
-            logger.warning(
-                f"API Key {api_key[:10]}... 临时不可用 {duration_seconds} 秒{reason_suffix}。"
-            )  # 记录警告日志
+        now = time.time()
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            # 复制未过期的标记 (顺便清理已过期的条目)，并写入新的恢复时间戳
+            temporary_issues = {
+                k: ts for k, ts in self._snapshot.temporary_issues.items() if ts >= now
+            }
+            temporary_issues[api_key] = now + duration_seconds
+            self._swap_snapshot(temporary_issues=temporary_issues)
+        self._suspend_in_indexes(api_key, now + duration_seconds)
+        if shared_state_backend is not None:  # 通知其他 worker
+            shared_state_backend.set_mark(
+                SHARED_TEMPORARY_ISSUE_MARKS, api_key, now + duration_seconds
+            )
+        reason_suffix = f" (原因: {issue_type})" if issue_type else ""
+        logger.warning(
+            f"API Key {api_key[:10]}... 临时不可用 {duration_seconds} 秒{reason_suffix}。"
+        )  # 记录警告日志
+
+    def restore_quota_state(
+        self, daily_exhausted: Dict[str, str], temporary_issues: Dict[str, float]
+    ) -> Tuple[int, int]:
+        """
+        合并从持久化状态或共享状态后端恢复的每日耗尽标记和临时不可用标记。
+        只保留当天的耗尽标记和尚未过期的临时不可用标记 (恢复时间更晚的标记覆盖已有标记)。
+
+        Returns:
+            Tuple[int, int]: (新增的每日耗尽 Key 数量, 新增或延长的临时不可用 Key 数量)。
+        """
+        today_date_str = self._refresh_today_date_str()
+        now = time.time()
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            snapshot = self._snapshot
+            restored_exhausted = {
+                k: d
+                for k, d in daily_exhausted.items()
+                if d == today_date_str and snapshot.daily_exhausted.get(k) != d
+            }
+            restored_temporary = {
+                k: ts
+                for k, ts in temporary_issues.items()
+                if ts >= now and ts > snapshot.temporary_issues.get(k, 0.0)
+            }
+            if restored_exhausted or restored_temporary:  # 没有新标记时不替换快照
+                self._swap_snapshot(
+                    daily_exhausted={**snapshot.daily_exhausted, **restored_exhausted},
+                    temporary_issues={
+                        **snapshot.temporary_issues,
+                        **restored_temporary,
+                    },
+                )
+        for api_key in restored_exhausted:
+            self._suspend_in_indexes(api_key, now + DAILY_EXHAUSTED_RECHECK_SECONDS)
+        for api_key, until in restored_temporary.items():
+            self._suspend_in_indexes(api_key, until)
+        return len(restored_exhausted), len(restored_temporary)
+
+    def sync_shared_marks(self) -> Tuple[int, int]:
+        """
+        从共享状态后端拉取其他 worker 标记的每日耗尽和临时不可用 Key，合并到本进程的快照。
+        由后台任务周期性调用；未配置共享状态后端时为空操作。
+
+        Returns:
+            Tuple[int, int]: (新增的每日耗尽 Key 数量, 新增或延长的临时不可用 Key 数量)。
+        """
+        if shared_state_backend is None:
+            return 0, 0
+        now = time.time()
+        today_date_str = self._refresh_today_date_str()
+        daily_exhausted = {
+            k: today_date_str
+            for k in shared_state_backend.get_marks(SHARED_DAILY_EXHAUSTED_MARKS, now)
+        }
+        temporary_issues = shared_state_backend.get_marks(
+            SHARED_TEMPORARY_ISSUE_MARKS, now
+        )
+        return self.restore_quota_state(daily_exhausted, temporary_issues)
+
+    def _suspend_in_indexes(self, api_key: str, until: float) -> None:
+        """(内部方法) 在所有模型的候选索引中挂起 Key，直到 until 时间戳。"""
+        for index in list(self._candidate_indexes.values()):
+            index.suspend(api_key, until)
 
     def record_selection_reason(
-        self, key: str, reason: str, request_id: Optional[str] = None
+        self,
+        key: str,
+        reason: str,
+        request_id: Optional[str] = None,
+        model_name: Optional[str] = None,
     ):
         """
         记录在 Key 选择过程中，某个 Key 被选中或被跳过的原因。
         用于调试和分析 Key 选择策略的效果。
+        记录只累加到有界的聚合计数器 (并写入被采样请求的决策轨迹)，内存占用不随流量增长。
 
         Args:
             key (str): 相关的 API Key 字符串 (或 "N/A" 表示未涉及特定 Key)。
             reason (str): 选择或跳过的具体原因。
             request_id (Optional[str]): 与此记录关联的请求 ID。
+            model_name (Optional[str]): 请求的模型名称。
         """
-        with self._get_lock("selection_records"):  # 获取记录列表的锁
-            # 将记录信息（Key、原因、请求 ID、时间戳）添加到列表中
-            self.key_selection_records.append(
-                {
-                    "key": key,  # 相关 Key
-                    "reason": reason,  # 原因描述
-                    "request_id": request_id,  # 请求 ID
-                    "timestamp": datetime.now(
-                        pytz.timezone("Asia/Shanghai")
-                    ).isoformat(),  # 记录时间 (带时区)
-                }
-            )
+        self.selection_telemetry.record(key, reason, model_name, request_id)
 
     def get_active_keys_count(self) -> int:
         """
@@ -1072,32 +1251,31 @@ class APIKeyManager:
         Returns:
             int: 活动 API 密钥的数量。
         """
-        with self._get_lock("api_keys"):  # 获取锁以安全访问 api_keys 列表
-            return len(self.api_keys)  # 返回列表长度
+        return len(self._snapshot.active_keys)  # 基于快照，无需加锁
 
     def is_key_valid(self, api_key: str) -> bool:
         """
         检查给定的 API Key 是否有效（存在于管理器中，且处于活动状态，未过期）。
         """
-        with self._get_lock("api_keys"):
-            if api_key not in self.api_keys:  # 首先检查是否在活动 Key 列表中
-                return False
+        snapshot = self._snapshot  # 读取一次快照，保证判断基于一致的状态
+        if not snapshot.is_active(api_key):  # 首先检查是否在活动 Key 列表中
+            return False
 
-            key_config = self.key_configs.get(api_key)  # 获取 Key 配置
-            if not key_config:  # 如果没有配置，则认为无效
-                return False
+        key_config = snapshot.key_configs.get(api_key)  # 获取 Key 配置
+        if not key_config:  # 如果没有配置，则认为无效
+            return False
 
-            # 检查 is_active 状态
-            if not key_config.get("is_active", False):
-                return False
+        # 检查 is_active 状态
+        if not key_config.get("is_active", False):
+            return False
 
-            # 检查过期时间
-            expires_at = key_config.get("expires_at")
-            # 使用时区感知的当前时间
-            if expires_at and expires_at < datetime.now(timezone.utc):
-                return False
+        # 检查过期时间
+        expires_at = key_config.get("expires_at")
+        # 使用时区感知的当前时间
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            return False
 
-            return True  # 所有检查通过，Key 有效
+        return True  # 所有检查通过，Key 有效
 
     def is_admin_key(self, api_key: str) -> bool:
         """检查给定的 API Key 是否是管理员 Key。"""
@@ -1136,12 +1314,11 @@ class APIKeyManager:
 
     async def remove_api_key(self, key_id: str) -> bool:
         """与性能测试兼容的删除接口，根据配置中的 id 查找并删除 Key。"""
-        with self._get_lock("api_keys"):
-            target_key_string: Optional[str] = None
-            for key_string, conf in self.key_configs.items():
-                if conf.get("id") == key_id:
-                    target_key_string = key_string
-                    break
+        target_key_string: Optional[str] = None
+        for key_string, conf in self._snapshot.key_configs.items():
+            if conf.get("id") == key_id:
+                target_key_string = key_string
+                break
         if not target_key_string:
             logger.warning(f"尝试移除不存在的 Key id={key_id}")
             return False
@@ -1151,40 +1328,38 @@ class APIKeyManager:
         self, model_name: str, model_limits: Dict[str, Any]
     ):
         """
-        (内部异步方法) 异步更新指定模型的 Key 分数缓存。
-        此方法应在后台任务中调用，以避免阻塞主请求处理。
-        目前依赖于 db_utils.get_key_scores 的实现。
+        (内部异步方法) 更新指定模型的 Key 分数缓存。
+        由评分引擎基于实时健康度统计和当前 RPM/TPM 余量重新计算所有活动 Key 的分数。
+        此方法在后台任务中调用，以避免阻塞主请求处理。
 
         Args:
             model_name (str): 需要更新分数的模型名称。
-            model_limits (Dict[str, Any]): 该模型的限制配置 (可能在评分计算中使用)。
+            model_limits (Dict[str, Any]): 该模型的限制配置 (用于计算余量)。
         """
         try:
-            # TODO: 实现或确认 db_utils.get_key_scores 的逻辑
-            # 假设 db_utils.get_key_scores 是一个异步函数，从数据库或其他来源获取分数
-            new_scores = await db_utils.get_key_scores(model_name)  # 调用函数获取新分数
-            with cache_lock:  # 获取分数缓存锁
-                key_scores_cache[model_name] = new_scores  # 更新缓存
-            logger.info(
-                f"模型 '{model_name}' 的 Key 分数缓存已成功更新。"
-            )  # 记录成功日志
+            new_scores = key_scoring_engine.refresh_model_scores(
+                model_name, self._snapshot.active_keys, model_limits
+            )
+            index = self._candidate_indexes.get(model_name)
+            if index is not None:
+                index.replace_scores(new_scores)
+            logger.debug(f"模型 '{model_name}' 的 Key 分数缓存已成功更新。")
         except Exception as e:  # 捕获更新过程中可能发生的异常
             logger.error(
                 f"更新模型 '{model_name}' 的 Key 分数缓存时出错: {e}", exc_info=True
             )  # 记录错误日志
 
-    def get_and_clear_all_selection_records(self) -> List[Dict[str, Any]]:
+    def get_selection_stats(self, reset: bool = False) -> Dict[str, Any]:
         """
-        获取当前存储的所有 Key 选择记录，并清空记录列表。
-        通常用于定期导出或分析选择日志。
+        获取 Key 选择统计：按 (Key, 原因, 模型) 聚合的计数器和采样的决策轨迹。
+
+        Args:
+            reset (bool): 为 True 时同时清空计数器，开始新的统计周期 (报告任务使用)。
 
         Returns:
-            List[Dict[str, Any]]: 包含所有 Key 选择记录的列表。
+            Dict[str, Any]: 见 SelectionTelemetry.snapshot。
         """
-        with self._get_lock("selection_records"):  # 获取记录列表的锁
-            records = copy.deepcopy(self.key_selection_records)  # 创建记录列表的深拷贝
-            self.key_selection_records.clear()  # 清空原始记录列表
-            return records  # 返回记录的副本
+        return self.selection_telemetry.snapshot(reset=reset)
 
     # load_keys_from_db 方法已移除，功能合并到 reload_keys 中。
 
@@ -1296,20 +1471,7 @@ class APIKeyManager:
                 # 因为 self.key_configs 是以 key_string 为键的。
                 # 除非在填充 CachedContent.key_id 时有特殊约定。
                 # 遍历 self.key_configs 效率不高，且没有直接的 ID 关联。
-                # 我们可以尝试从 self.key_configs 中找到一个 'id' 字段匹配的（如果存在这样的字段）
-                with self._get_lock("api_keys"):  # 保护对 key_configs 的访问
-                    # 添加类型注解
-                    for key_str, conf in self.key_configs.items():  # type: ignore
-                        # 假设内存配置中可能有一个 'id' 字段（虽然目前没有明确定义）
-                        # 或者如果 key_id 恰好是某种索引或特殊值
-                        # 这是一个不完美的匹配，因为内存模式的 key_configs 通常不包含数据库 ID
-                        # 但如果 CachedContent.key_id 被用来存储了 key_string (不推荐)
-                        # if key_str == str(api_key_id_to_find): # 这是一个错误的假设
-                        #    return self.get_key_config(key_str) # get_key_config 返回深拷贝
-
-                        # 更现实的是，如果内存模式下，我们无法仅凭整数 ID 找到 Key
-                        pass  # 暂时无法仅凭整数 ID 在内存模式下可靠查找
-
+                # 内存模式的 key_configs 通常不包含数据库 ID，暂时无法仅凭整数 ID 可靠查找。
                 logger.warning(
                     f"在 KEY_STORAGE_MODE='memory' 时，通过整数 api_key_id ({api_key_id_to_find}) "
                     f"从内存 key_configs 查找 API Key 详细信息的功能受限或不支持。"
@@ -1340,13 +1502,13 @@ class APIKeyManager:
         Returns:
             bool: 如果成功添加返回 True，如果 Key 已存在则返回 False。
         """
-        with self._get_lock("api_keys"):  # 获取锁
-            if key_string in self.api_keys:  # 检查 Key 是否已存在
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            snapshot = self._snapshot
+            if snapshot.is_active(key_string):  # 检查 Key 是否已存在
                 logger.warning(
                     f"内存模式：尝试添加已存在的 Key: {key_string[:8]}..."
                 )  # 记录警告
                 return False  # 返回 False
-            self.api_keys.append(key_string)  # 添加到 Key 列表
             # 更新 config_data 以包含 _ui_generated 标记，并确保其他字段存在
             # 显式声明类型
             updated_config_data: Dict[str, Any] = {
@@ -1362,7 +1524,12 @@ class APIKeyManager:
                 ),
                 "_ui_generated": True,  # 添加 UI 生成标记
             }
-            self.key_configs[key_string] = updated_config_data  # 添加到配置字典
+            new_key_configs = dict(snapshot.key_configs)
+            new_key_configs[key_string] = updated_config_data  # 添加到配置字典
+            self._swap_snapshot(
+                active_keys=snapshot.active_keys + (key_string,),  # 添加到 Key 列表
+                key_configs=new_key_configs,
+            )
             logger.info(
                 f"内存模式：成功添加临时 Key (UI生成): {key_string[:8]}..."
             )  # 记录成功日志
@@ -1379,8 +1546,9 @@ class APIKeyManager:
         Returns:
             bool: 如果成功更新返回 True，如果 Key 不存在则返回 False。
         """
-        with self._get_lock("api_keys"):  # 获取锁
-            if key_string not in self.key_configs:  # 检查 Key 是否存在于配置中
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            snapshot = self._snapshot
+            if key_string not in snapshot.key_configs:  # 检查 Key 是否存在于配置中
                 logger.warning(
                     f"内存模式：尝试更新不存在的 Key: {key_string[:8]}..."
                 )  # 记录警告
@@ -1388,7 +1556,13 @@ class APIKeyManager:
             # 过滤掉不允许直接更新的字段 (例如 key_string 本身)
             allowed_updates = {k: v for k, v in updates.items() if k != "key_string"}
             # 更新配置字典中对应 Key 的信息
-            self.key_configs[key_string].update(allowed_updates)
+            # 快照中的配置不可原地修改，复制后替换
+            new_key_configs = dict(snapshot.key_configs)
+            new_key_configs[key_string] = {
+                **snapshot.key_configs[key_string],
+                **allowed_updates,
+            }
+            self._swap_snapshot(key_configs=new_key_configs)
             logger.info(
                 f"内存模式：成功更新临时 Key {key_string[:8]}... 的配置: {allowed_updates}"
             )  # 记录成功日志
@@ -1404,23 +1578,24 @@ class APIKeyManager:
         Returns:
             bool: 如果成功删除（或 Key 原本就不存在于配置中）返回 True，否则返回 False。
         """
-        with self._get_lock("api_keys"):  # 获取锁
-            key_existed_in_list = False  # 标记 Key 是否在列表中存在过
-            try:
-                if key_string in self.api_keys:  # 检查 Key 是否在活动列表中
-                    self.api_keys.remove(key_string)  # 从列表中移除
-                    key_existed_in_list = True  # 标记存在过
-            except (
-                ValueError
-            ):  # 处理 remove 可能抛出的 ValueError (如果并发导致 Key 已被移除)
-                logger.warning(
-                    f"内存模式：尝试从 api_keys 列表删除 Key {key_string[:8]}... 时出错 (可能已不存在)。"
+        with self._get_lock("api_keys"):  # 串行化快照写入
+            snapshot = self._snapshot
+            key_existed_in_list = snapshot.is_active(key_string)  # 检查 Key 是否在活动列表中
+            # 无论 Key 是否在活动列表中，都尝试从配置字典中移除
+            config_removed = key_string in snapshot.key_configs
+            if key_existed_in_list or config_removed:
+                new_key_configs = dict(snapshot.key_configs)
+                new_key_configs.pop(key_string, None)
+                self._swap_snapshot(
+                    active_keys=[k for k in snapshot.active_keys if k != key_string],
+                    key_configs=new_key_configs,
                 )
-
-            # 无论列表删除是否成功，都尝试从配置字典中移除
-            config_removed = (
-                self.key_configs.pop(key_string, None) is not None
-            )  # pop 返回被移除的值或 None
+                # 已删除的 Key 不应再出现在分数缓存和限流状态中
+                key_scoring_engine.forget_key(key_string)
+                key_rate_limiter.forget_key(key_string)
+                self.key_affinity.forget_key(key_string)
+                self.circuit_breaker.forget_key(key_string)
+                self.concurrency_limiter.forget_key(key_string)
 
             # 可选：是否需要清理其他相关状态？
             # 例如：usage_data, daily_exhausted_keys, temporary_issue_keys
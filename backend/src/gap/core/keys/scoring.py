@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Key 健康度评分引擎。
+
+Key 选择的策略 3 (基于评分的轮转) 依赖 `tracking.key_scores_cache` 中每个模型下各 Key 的分数。
+本模块根据真实的调用结果维护每个 (Key, 模型) 的健康度统计，并据此计算分数：
+- 延迟：成功调用耗时的指数加权移动平均 (EWMA)；
+- 成功率：调用成功 (1) / 失败 (0) 的 EWMA；
+- 429 比例：调用被限流 (1) / 未被限流 (0) 的 EWMA；
+- 剩余余量：RPM / TPM 滑动窗口内相对模型限制的剩余比例 (实时读取速率限制器)。
+
+每次记录调用结果时只重新计算对应 Key 的分数 (增量更新)；周期性刷新会重新计算整个模型，
+使余量恢复和统计衰减得以反映。健康度 (不含余量部分) 会定期写入数据库 KeyScore 表，
+并在启动时预热加载，作为尚无实时样本的 Key 的健康度先验；余量始终实时读取，不会被持久化后再次混合。
+"""
+
+import logging  # 日志记录
+import threading  # 保护统计数据的线程锁
+import time  # 时间戳
+from dataclasses import dataclass  # 定义统计数据结构
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession  # 异步数据库会话
+
+from gap import config  # 应用配置
+from gap.core.database import utils as db_utils  # KeyScore 表读写
+from gap.core.keys.limiter import key_rate_limiter  # RPM / TPM 滑动窗口用量
+from gap.core.tracking import (  # 分数缓存及对应的锁
+    cache_last_updated,
+    cache_lock,
+    key_scores_cache,
+)
+
+logger = logging.getLogger("my_logger")
+
+# 分数各组成部分的权重 (健康度部分合计为 1，再与余量按 HEALTH_WEIGHT 加权)
+SUCCESS_WEIGHT = 0.5  # 成功率
+RATE_LIMIT_WEIGHT = 0.25  # 未被 429 限流的比例
+LATENCY_WEIGHT = 0.25  # 延迟分量
+HEALTH_WEIGHT = 0.8  # 健康度在最终分数中的占比，其余为 RPM/TPM 剩余余量
+# 实时样本数达到该值时，实时健康度与预热先验分数各占一半
+WARM_PRIOR_SAMPLES = 5
+
+
+@dataclass
+class KeyHealthStats:
+    """
+    单个 (Key, 模型) 组合的健康度统计。
+
+    Attributes:
+        latency_ewma (Optional[float]): 成功调用延迟 (秒) 的 EWMA，尚无样本时为 None。
+        success_rate (float): 调用成功率的 EWMA，初始为 1.0。
+        rate_limit_rate (float): 429 限流比例的 EWMA，初始为 0.0。
+        samples (int): 已记录的调用结果数量。
+        last_outcome_at (float): 最近一次记录调用结果的时间戳。
+    """
+
+    latency_ewma: Optional[float] = None
+    success_rate: float = 1.0
+    rate_limit_rate: float = 0.0
+    samples: int = 0
+    last_outcome_at: float = 0.0
+
+    def decayed(self, now: float) -> Tuple[float, float]:
+        """
+        返回按时间衰减后的 (成功率, 429 比例)。
+        长时间没有新样本时，两者按半衰期逐渐回归初始值，避免 Key 因一次故障被永久冷落。
+        """
+        half_life = config.KEY_SCORE_DECAY_HALF_LIFE_SECONDS
+        if half_life <= 0 or self.last_outcome_at <= 0:
+            return self.success_rate, self.rate_limit_rate
+        factor = 0.5 ** (max(0.0, now - self.last_outcome_at) / half_life)
+        return 1.0 - (1.0 - self.success_rate) * factor, self.rate_limit_rate * factor
+
+
+class KeyScoringEngine:
+    """
+    Key 健康度评分引擎。
+    维护每个 (Key, 模型) 的健康度统计，并把计算出的分数写入 `key_scores_cache`。
+    """
+
+    def __init__(self):
+        self._stats: Dict[Tuple[str, str], KeyHealthStats] = {}  # (Key, 模型) -> 统计
+        self._model_latency: Dict[str, float] = {}  # 模型 -> 所有 Key 的延迟 EWMA
+        self._warm_scores: Dict[str, Dict[str, float]] = {}  # 模型 -> {Key: 预热健康度}
+        self._health: Dict[str, Dict[str, float]] = (
+            {}
+        )  # 模型 -> {Key: 最近计算的健康度}
+        self._dirty_models: Set[str] = set()  # 分数变化后尚未持久化的模型
+        self._lock = threading.Lock()  # 保护以上数据 (不在持锁期间获取其他锁)
+
+    # --- 记录调用结果 ---
+
+    def record_outcome(
+        self,
+        api_key: str,
+        model_name: str,
+        success: bool,
+        latency_seconds: Optional[float] = None,
+        status_code: Optional[int] = None,
+        limits: Optional[Dict[str, Any]] = None,
+    ) -> float:
+        """
+        记录一次 API 调用结果，并增量更新该 Key 在该模型下的分数。
+
+        Args:
+            api_key (str): 本次调用使用的 API Key。
+            model_name (str): 本次调用的模型名称。
+            success (bool): 调用是否成功。
+            latency_seconds (Optional[float]): 调用耗时 (秒)，仅在成功时计入延迟 EWMA。
+            status_code (Optional[int]): 失败时的 HTTP 状态码，429 会计入限流比例。
+            limits (Optional[Dict[str, Any]]): 模型限制配置，未提供时从 config.MODEL_LIMITS 读取。
+
+        Returns:
+            float: 更新后的分数。
+        """
+        if not api_key or not model_name:
+            return 0.0
+        now = time.time()
+        alpha = config.KEY_SCORE_EWMA_ALPHA
+        headroom = self._headroom(api_key, model_name, limits, now)
+        with self._lock:
+            stats = self._stats.setdefault((api_key, model_name), KeyHealthStats())
+            # 先把过去的衰减折算进统计值，再叠加本次样本
+            stats.success_rate, stats.rate_limit_rate = stats.decayed(now)
+            stats.success_rate += alpha * (
+                (1.0 if success else 0.0) - stats.success_rate
+            )
+            stats.rate_limit_rate += alpha * (
+                (1.0 if status_code == 429 else 0.0) - stats.rate_limit_rate
+            )
+            if success and latency_seconds is not None and latency_seconds >= 0:
+                stats.latency_ewma = (
+                    latency_seconds
+                    if stats.latency_ewma is None
+                    else stats.latency_ewma
+                    + alpha * (latency_seconds - stats.latency_ewma)
+                )
+                model_latency = self._model_latency.get(model_name)
+                self._model_latency[model_name] = (
+                    latency_seconds
+                    if model_latency is None
+                    else model_latency + alpha * (latency_seconds - model_latency)
+                )
+            stats.samples += 1
+            stats.last_outcome_at = now
+            score = self._compute_score_nolock(api_key, model_name, headroom, now)
+            self._dirty_models.add(model_name)
+        with cache_lock:
+            key_scores_cache[model_name][api_key] = score
+        return score
+
+    # --- 分数计算 ---
+
+    def _headroom(
+        self,
+        api_key: str,
+        model_name: str,
+        limits: Optional[Dict[str, Any]],
+        now: float,
+    ) -> float:
+        """
+        (内部方法) 计算 Key 在 RPM / TPM 滑动窗口内的剩余余量比例 (0~1)。
+        未配置限制的维度视为余量充足。
+        """
+        if limits is None:
+            limits = config.MODEL_LIMITS.get(model_name) or {}
+        dimensions = [
+            (dimension, limits.get(dimension))
+            for dimension in ("rpm", "tpm_input", "tpm_output")
+            if limits.get(dimension) and limits[dimension] > 0
+        ]
+        if not dimensions:
+            return 1.0
+        # 所有维度合并为一次读取 (共享后端时为一次往返)
+        used = key_rate_limiter.usage_many(
+            [
+                (api_key, model_name, dimension, limit)
+                for dimension, limit in dimensions
+            ],
+            now,
+        )
+        headroom = min(1.0 - u / limit for (_, limit), u in zip(dimensions, used))
+        return max(0.0, min(1.0, headroom))
+
+    def _compute_score_nolock(
+        self, api_key: str, model_name: str, headroom: float, now: float
+    ) -> float:
+        """
+        (内部方法) 计算分数，调用者必须持有 self._lock。
+        健康度 = 成功率、未限流比例和延迟分量的加权和；尚无足够实时样本时与预热分数混合。
+        最终分数 = 健康度与剩余余量的加权和，取值 0~1。
+        """
+        stats = self._stats.get((api_key, model_name))
+        reference = config.KEY_SCORE_LATENCY_REFERENCE_SECONDS
+        if stats is None:
+            success_rate, rate_limit_rate, latency, samples = 1.0, 0.0, None, 0
+        else:
+            success_rate, rate_limit_rate = stats.decayed(now)
+            latency, samples = stats.latency_ewma, stats.samples
+        if latency is None:
+            # 尚无延迟样本时使用该模型的整体延迟，避免未使用过的 Key 被偏好或冷落
+            latency = self._model_latency.get(model_name, reference)
+        latency_factor = reference / (reference + latency) if reference > 0 else 1.0
+        health = (
+            SUCCESS_WEIGHT * success_rate
+            + RATE_LIMIT_WEIGHT * (1.0 - rate_limit_rate)
+            + LATENCY_WEIGHT * latency_factor
+        )
+        warm_score = self._warm_scores.get(model_name, {}).get(api_key)
+        if warm_score is not None:
+            confidence = samples / (samples + WARM_PRIOR_SAMPLES)
+            health = confidence * health + (1.0 - confidence) * warm_score
+        # 只有健康度会被持久化，余量部分每次计算时实时读取
+        self._health.setdefault(model_name, {})[api_key] = health
+        return HEALTH_WEIGHT * health + (1.0 - HEALTH_WEIGHT) * headroom
+
+    def refresh_model_scores(
+        self,
+        model_name: str,
+        api_keys: Iterable[str],
+        limits: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, float]:
+        """
+        重新计算指定模型下所有给定 Key 的分数，并整体替换该模型的分数缓存。
+        尚无任何样本的 Key 也会得到分数 (来自预热分数或默认统计)，从而参与评分选择。
+
+        Args:
+            model_name (str): 模型名称。
+            api_keys (Iterable[str]): 需要计算分数的 Key (通常为当前活动 Key)。
+            limits (Optional[Dict[str, Any]]): 模型限制配置。
+
+        Returns:
+            Dict[str, float]: 新的 {Key: 分数} 映射。
+        """
+        now = time.time()
+        keys = list(api_keys)
+        headrooms = {k: self._headroom(k, model_name, limits, now) for k in keys}
+        with self._lock:
+            new_scores = {
+                k: self._compute_score_nolock(k, model_name, headrooms[k], now)
+                for k in keys
+            }
+            self._dirty_models.add(model_name)
+        with cache_lock:
+            key_scores_cache[model_name] = new_scores
+            cache_last_updated[model_name] = now
+        return new_scores
+
+    def get_key_health(self, model_name: str) -> Dict[str, Dict[str, Any]]:
+        """
+        返回指定模型下各 Key 的健康度统计副本 (用于报告和调试)。
+        """
+        now = time.time()
+        with self._lock:
+            result = {}
+            for (api_key, stats_model), stats in self._stats.items():
+                if stats_model != model_name:
+                    continue
+                success_rate, rate_limit_rate = stats.decayed(now)
+                result[api_key] = {
+                    "latency_ewma": stats.latency_ewma,
+                    "success_rate": success_rate,
+                    "rate_limit_rate": rate_limit_rate,
+                    "samples": stats.samples,
+                }
+            return result
+
+    def forget_key(self, api_key: str) -> None:
+        """移除某个 Key 的全部统计和预热分数 (例如 Key 被删除时)。"""
+        with self._lock:
+            for stats_key in [k for k in self._stats if k[0] == api_key]:
+                del self._stats[stats_key]
+            for scores in self._warm_scores.values():
+                scores.pop(api_key, None)
+            for health in self._health.values():
+                health.pop(api_key, None)
+        with cache_lock:
+            for scores in key_scores_cache.values():
+                scores.pop(api_key, None)
+
+    # --- 持久化 ---
+
+    async def load_scores(self, db: AsyncSession) -> int:
+        """
+        从 KeyScore 表预热加载健康度：作为尚无实时样本的 Key 的健康度先验，并据此写入分数缓存。
+        启动时尚无滑动窗口用量，写入缓存的分数按余量充足计算，下一次刷新时再按实时余量修正。
+
+        Returns:
+            int: 加载的健康度条目数量。
+        """
+        stored_health = await db_utils.get_key_scores(db)
+        loaded = 0
+        with self._lock:
+            for model_name, health in stored_health.items():
+                self._warm_scores[model_name] = dict(health)
+                loaded += len(health)
+        with cache_lock:
+            for model_name, health in stored_health.items():
+                key_scores_cache[model_name].update(
+                    {
+                        k: HEALTH_WEIGHT * h + (1.0 - HEALTH_WEIGHT)
+                        for k, h in health.items()
+                    }
+                )
+        logger.info(f"已从数据库预热加载 {loaded} 条 Key 健康度。")
+        return loaded
+
+    async def persist_scores(self, db: AsyncSession) -> int:
+        """
+        将自上次持久化以来有变化的模型的健康度写入 KeyScore 表。
+        写入的是不含余量部分的健康度：余量只反映当时的滑动窗口用量，重启后没有意义。
+
+        Returns:
+            int: 写入的健康度条目数量。
+        """
+        with self._lock:
+            dirty_models, self._dirty_models = self._dirty_models, set()
+            health_to_save = {
+                model_name: dict(self._health.get(model_name, {}))
+                for model_name in dirty_models
+            }
+        if not dirty_models:
+            return 0
+        try:
+            saved = await db_utils.save_key_scores(db, health_to_save)
+        except Exception:
+            # 写入失败时恢复脏标记，留待下次重试
+            with self._lock:
+                self._dirty_models.update(dirty_models)
+            raise
+        logger.debug(f"已将 {saved} 条 Key 健康度写入数据库。")
+        return saved
+
+    def reset(self) -> None:
+        """清空所有统计、预热分数和脏标记 (主要用于测试)。"""
+        with self._lock:
+            self._stats.clear()
+            self._model_latency.clear()
+            self._warm_scores.clear()
+            self._health.clear()
+            self._dirty_models.clear()
+
+
+# 全局评分引擎实例
+key_scoring_engine = KeyScoringEngine()
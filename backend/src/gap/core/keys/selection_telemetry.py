@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Key 选择过程的有界统计。
+
+原先每次选择都会为每个被考察的 Key (包括被跳过的 Key) 追加一条记录字典，
+直到报告任务运行时才清空，高 QPS、多 Key 时两次报告之间会积累数百万条记录。
+本模块改为固定大小的结构：
+- 计数器：按 (Key, 原因, 模型) 聚合的次数，条目数有上限，超出后新组合计入溢出桶；
+- 决策轨迹：按比例采样的完整选择过程 (每个被考察的 Key 及原因)，保存在环形缓冲区中。
+无论流量多大，内存占用都保持不变。报告任务和管理接口读取这些数据。
+"""
+
+import random  # 轨迹采样
+import re  # 原因字符串归一化
+import threading  # 保护计数器和缓冲区的线程锁
+import time  # 时间戳
+from collections import deque  # 环形缓冲区
+from contextvars import ContextVar  # 当前请求 (协程) 正在采样的轨迹
+from datetime import datetime  # 统计周期起始时间
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import pytz  # 时区 (与原选择记录的时间格式一致)
+
+from gap import config  # 应用配置
+
+# 超出计数器上限后，新的 (Key, 原因, 模型) 组合计入此 Key 名下
+OVERFLOW_KEY = "(overflow)"
+# 单条轨迹最多记录的决策数，防止 Key 很多时单条轨迹无限增长
+MAX_TRACE_DECISIONS = 100
+# 原因中随请求变化的部分 (分数、数据库 ID 等)，计数时去除以免组合数无限增长
+_VOLATILE_REASON_PARTS = re.compile(r"\s*\([^()]*\d[^()]*\)|\b\d+\b")
+
+# 当前协程正在采样的决策轨迹 (未采样时为 None)
+_current_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar(
+    "selection_trace", default=None
+)
+
+
+def normalize_reason(reason: str) -> str:
+    """去除原因字符串中的分数、ID 等可变部分，例如 "... (Score: 0.9312)" -> "..."。"""
+    return _VOLATILE_REASON_PARTS.sub(
+        lambda m: "" if m.group(0).lstrip().startswith("(") else "N", reason
+    ).strip()
+
+
+class SelectionTelemetry:
+    """
+    Key 选择统计：有上限的聚合计数器 + 采样决策轨迹的环形缓冲区。
+    """
+
+    def __init__(
+        self,
+        max_counters: Optional[int] = None,
+        sample_rate: Optional[float] = None,
+        buffer_size: Optional[int] = None,
+    ):
+        self.max_counters = (
+            config.SELECTION_TELEMETRY_MAX_COUNTERS
+            if max_counters is None
+            else max_counters
+        )
+        self.sample_rate = (
+            config.SELECTION_TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        )
+        # (Key, 原因, 模型) -> 次数
+        self._counters: Dict[Tuple[str, str, str], int] = {}
+        self._overflowed = 0  # 计入溢出桶的次数
+        self._traces: Deque[Dict[str, Any]] = deque(
+            maxlen=max(
+                1,
+                (
+                    config.SELECTION_TRACE_BUFFER_SIZE
+                    if buffer_size is None
+                    else buffer_size
+                ),
+            )
+        )
+        self._since = self._now_iso()  # 当前统计周期的起始时间
+        self._lock = threading.Lock()  # 保护以上数据 (不在持锁期间获取其他锁)
+
+    @staticmethod
+    def _now_iso() -> str:
+        return datetime.now(pytz.timezone("Asia/Shanghai")).isoformat()
+
+    # --- 记录 ---
+
+    def record(
+        self,
+        key: str,
+        reason: str,
+        model_name: Optional[str] = None,
+        request_id: Optional[str] = None,
+    ) -> None:
+        """
+        记录某个 Key 被选中或被跳过的原因：累加聚合计数，并写入当前采样的轨迹 (如有)。
+
+        Args:
+            key (str): 相关的 API Key 字符串 (或 "N/A" 表示未涉及特定 Key)。
+            reason (str): 选择或跳过的具体原因。
+            model_name (Optional[str]): 请求的模型名称。
+            request_id (Optional[str]): 请求 ID (仅用于轨迹)。
+        """
+        counter_key = (key, normalize_reason(reason), model_name or "N/A")
+        with self._lock:
+            if counter_key in self._counters:
+                self._counters[counter_key] += 1
+            elif len(self._counters) < self.max_counters:
+                self._counters[counter_key] = 1
+            else:
+                overflow_key = (OVERFLOW_KEY, counter_key[1], counter_key[2])
+                self._counters[overflow_key] = self._counters.get(overflow_key, 0) + 1
+                self._overflowed += 1
+        trace = _current_trace.get()
+        if trace is not None and len(trace["decisions"]) < MAX_TRACE_DECISIONS:
+            trace["decisions"].append({"key": key, "reason": reason})
+
+    def begin_trace(self, request_id: Optional[str], model_name: str) -> Optional[Any]:
+        """
+        按采样比例为一次 Key 选择开启决策轨迹。
+
+        Returns:
+            Optional[Any]: 被采样时返回传给 end_trace 的句柄，否则为 None。
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        trace = {
+            "request_id": request_id,
+            "model": model_name,
+            "timestamp": self._now_iso(),
+            "started_at": time.monotonic(),
+            "decisions": [],
+        }
+        return trace, _current_trace.set(trace)
+
+    def end_trace(self, handle: Optional[Any], selected_key: Optional[str]) -> None:
+        """结束采样的决策轨迹，记录最终结果并放入环形缓冲区。"""
+        if handle is None:
+            return
+        trace, token = handle
+        _current_trace.reset(token)
+        trace["selected_key"] = selected_key
+        trace["duration_ms"] = round(
+            (time.monotonic() - trace.pop("started_at")) * 1000, 3
+        )
+        with self._lock:
+            self._traces.append(trace)
+
+    # --- 读取 ---
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        返回当前统计周期的计数器和采样轨迹副本。
+
+        Args:
+            reset (bool): 为 True 时同时清空计数器并开始新的统计周期 (轨迹保留)。
+
+        Returns:
+            Dict[str, Any]: {"since", "counters": [{"key", "reason", "model", "count"}],
+            "overflowed", "traces"}。
+        """
+        with self._lock:
+            counters, overflowed, since = self._counters, self._overflowed, self._since
+            traces = list(self._traces)
+            if reset:
+                self._counters, self._overflowed = {}, 0
+                self._since = self._now_iso()
+            else:
+                counters = dict(counters)
+        counter_list: List[Dict[str, Any]] = [
+            {"key": key, "reason": reason, "model": model, "count": count}
+            for (key, reason, model), count in sorted(
+                counters.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+        return {
+            "since": since,
+            "counters": counter_list,
+            "overflowed": overflowed,
+            "traces": traces,
+        }
+
+    def reset(self) -> None:
+        """清空计数器和轨迹 (主要用于测试)。"""
+        with self._lock:
+            self._counters, self._overflowed = {}, 0
+            self._traces.clear()
+            self._since = self._now_iso()
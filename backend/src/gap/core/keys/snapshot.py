@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+API Key 状态快照。
+
+Key 选择是请求热路径上的操作，读远多于写。APIKeyManager 将活动 Key、Key 配置、
+每日耗尽集合和临时不可用集合打包成一个不可变、带版本号的快照对象：
+- 读取方 (select_best_key 等) 只需读取一次 `manager.snapshot` 引用，之后的所有判断
+  都基于这份一致的数据，无需持有任何锁，也就不会在 await 期间占用锁；
+- 写入方 (reload、标记耗尽/临时不可用、内存模式增删改) 在短暂的写锁内基于旧快照
+  构建新快照，然后一次性替换引用 (在 CPython 中属性赋值是原子的)。
+"""
+
+import time  # 用于判断临时不可用标记是否过期
+from dataclasses import dataclass, field, replace  # 用于定义不可变快照
+from types import MappingProxyType  # 只读字典视图
+from typing import Any, Dict, FrozenSet, Mapping, Optional, Tuple
+
+# 空的只读映射，作为快照字段的默认值
+_EMPTY_MAPPING: Mapping[str, Any] = MappingProxyType({})
+
+
+@dataclass(frozen=True)
+class KeyStateSnapshot:
+    """
+    不可变的 Key 状态快照。
+
+    Attributes:
+        version (int): 快照版本号，每次替换时递增，便于调试和观测。
+        active_keys (Tuple[str, ...]): 当前活动 Key 列表 (保持加载顺序)。
+        active_key_set (FrozenSet[str]): 活动 Key 集合，用于 O(1) 成员判断。
+        key_configs (Mapping[str, Dict[str, Any]]): Key 配置的只读映射。
+        daily_exhausted (Mapping[str, str]): 每日配额耗尽的 Key 及其耗尽日期 (YYYY-MM-DD)。
+        temporary_issues (Mapping[str, float]): 临时不可用的 Key 及其恢复可用的时间戳。
+    """
+
+    version: int = 0
+    active_keys: Tuple[str, ...] = ()
+    active_key_set: FrozenSet[str] = frozenset()
+    key_configs: Mapping[str, Dict[str, Any]] = field(
+        default_factory=lambda: _EMPTY_MAPPING
+    )
+    daily_exhausted: Mapping[str, str] = field(default_factory=lambda: _EMPTY_MAPPING)
+    temporary_issues: Mapping[str, float] = field(
+        default_factory=lambda: _EMPTY_MAPPING
+    )
+
+    def evolve(self, **changes: Any) -> "KeyStateSnapshot":
+        """
+        基于当前快照创建下一个版本的快照。
+        未修改的字段在新旧快照之间共享 (它们本身是不可变的)。
+        """
+        if "active_keys" in changes:
+            changes["active_keys"] = tuple(changes["active_keys"])
+            changes["active_key_set"] = frozenset(changes["active_keys"])
+        for name in ("key_configs", "daily_exhausted", "temporary_issues"):
+            if name in changes and not isinstance(changes[name], MappingProxyType):
+                changes[name] = MappingProxyType(dict(changes[name]))
+        return replace(self, version=self.version + 1, **changes)
+
+    # --- 只读查询 ---
+
+    def is_active(self, api_key: str) -> bool:
+        """Key 是否在活动列表中。"""
+        return api_key in self.active_key_set
+
+    def is_daily_exhausted(self, api_key: str, today_date_str: str) -> bool:
+        """Key 是否在指定日期已耗尽每日配额。"""
+        return self.daily_exhausted.get(api_key) == today_date_str
+
+    def is_temporarily_unavailable(
+        self, api_key: str, now: Optional[float] = None
+    ) -> bool:
+        """Key 是否处于未过期的临时不可用状态 (过期的标记视为可用，由写入方惰性清理)。"""
+        expiration_timestamp = self.temporary_issues.get(api_key)
+        if expiration_timestamp is None:
+            return False
+        return expiration_timestamp >= (time.time() if now is None else now)
+
+    def unavailable_reason(
+        self,
+        api_key: str,
+        today_date_str: str,
+        now: float,
+        tried_keys: FrozenSet[str] = frozenset(),
+    ) -> Optional[str]:
+        """
+        返回 Key 当前不可选的原因；如果 Key 可选，返回 None。
+        原因字符串与选择记录 (record_selection_reason) 中使用的后缀保持一致。
+        """
+        if api_key not in self.active_key_set:
+            return "Key not active/found in manager"
+        if api_key in tried_keys:
+            return "Key already tried"
+        if self.is_daily_exhausted(api_key, today_date_str):
+            return "Daily Quota Exhausted"
+        if self.is_temporarily_unavailable(api_key, now):
+            return "Temporarily Unavailable"
+        return None
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+可插拔的 Key 选择策略。
+
+缓存关联和用户粘性会话之后的回退选择原先固定为"评分 + 最近最少选中轮转"。
+本模块把这一步抽象为 KeySelectionStrategy：策略拿到模型的候选索引、活动 Key 列表和请求元数据
+(SelectionRequest)，按自己的顺序把候选 Key 交给 Key 管理器提供的检查函数 (可用性、熔断器、
+并发上限、Token 预检查与预留)，返回第一个通过检查的 Key。内置策略：
+- "score"：评分 + 最近最少选中轮转 (CandidateIndex.pick，默认)；
+- "round_robin"：按活动 Key 顺序轮询；
+- "headroom"：随机抽取 KEY_SELECTION_SAMPLE_SIZE 个候选，按 分数 × 剩余 RPM/TPM 余量 加权随机排序；
+- "p2c"：两次随机选择 (power of two choices)，取并发负载较低者；
+- "least_outstanding"：在途请求最少者优先 (O(n) 比较所有候选)。
+策略按模型通过 KEY_SELECTION_STRATEGY / KEY_SELECTION_STRATEGY_BY_MODEL 配置。
+"""
+
+import logging  # 日志记录
+import random  # 随机抽样
+import threading  # 保护轮询游标的线程锁
+from dataclasses import dataclass  # 定义请求元数据
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+
+from gap import config  # 应用配置
+from gap.core.keys.candidate_index import CandidateIndex  # 按模型划分的 Key 候选索引
+from gap.core.keys.concurrency import KeyConcurrencyLimiter  # 在途请求数与并发上限
+from gap.core.keys.limiter import key_rate_limiter  # RPM / TPM 速率限制器
+
+logger = logging.getLogger("my_logger")
+
+# 候选检查函数：参数为 (Key, 分数)，返回 (是否选中, 挂起到的时间戳)，含义同 CandidateIndex.pick
+CandidateCheck = Callable[[str, float], Tuple[bool, Optional[float]]]
+
+
+@dataclass(frozen=True)
+class SelectionRequest:
+    """
+    交给选择策略的请求元数据。
+
+    Attributes:
+        model_name (str): 目标模型名称。
+        model_limits (Dict[str, Any]): 该模型的速率限制配置。
+        estimated_input_tokens (int): 估算的输入 Token 数量。
+        user_id (Optional[str]): 发起请求的用户 ID。
+        request_id (Optional[str]): 请求 ID，用于日志跟踪。
+        now (float): 本次选择使用的当前时间戳。
+    """
+
+    model_name: str
+    model_limits: Dict[str, Any]
+    estimated_input_tokens: int
+    user_id: Optional[str]
+    request_id: Optional[str]
+    now: float
+
+
+class KeySelectionStrategy:
+    """
+    Key 选择策略的基类。子类实现 select()，并设置 name (配置中的名称) 和
+    reason_prefix (记录选择原因时使用的前缀)。
+    """
+
+    name = ""
+    reason_prefix = ""
+
+    def __init__(self, concurrency_limiter: KeyConcurrencyLimiter):
+        self.concurrency_limiter = concurrency_limiter
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        """
+        选出一个 Key。
+
+        Args:
+            request (SelectionRequest): 请求元数据。
+            index (CandidateIndex): 模型的候选索引 (分数和挂起状态)。
+            active_keys (Sequence[str]): 快照中的活动 Key 列表。
+            check (CandidateCheck): 候选检查函数，通过检查即完成 Token 预留和并发名额占用。
+
+        Returns:
+            Optional[Tuple[str, float]]: (选中的 Key, 分数)；没有可选 Key 时返回 None。
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _offer(
+        index: CandidateIndex,
+        api_key: str,
+        score: float,
+        now: float,
+        check: CandidateCheck,
+    ) -> bool:
+        """(内部方法) 把一个候选 Key 交给检查函数；需要挂起的 Key 同步挂起到索引中。"""
+        accepted, suspend_until = check(api_key, score)
+        if accepted:
+            index.mark_selected(api_key, now)
+            return True
+        if suspend_until is not None:
+            index.suspend(api_key, suspend_until)
+        return False
+
+    def _offer_in_order(
+        self,
+        index: CandidateIndex,
+        candidates: Iterable[Tuple[str, float]],
+        now: float,
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        """(内部方法) 按给定顺序依次检查候选 Key，返回第一个通过检查的。"""
+        for api_key, score in candidates:
+            if self._offer(index, api_key, score, now, check):
+                return api_key, score
+        return None
+
+    def _shuffled_candidates(
+        self, index: CandidateIndex, now: float, exclude: Iterable[str] = ()
+    ) -> List[Tuple[str, float]]:
+        """(内部方法) 随机顺序的全部可选候选 Key，作为抽样策略的回退。"""
+        excluded = set(exclude)
+        candidates = [
+            item for item in index.live_scores(now).items() if item[0] not in excluded
+        ]
+        random.shuffle(candidates)
+        return candidates
+
+
+class ScoreRotationStrategy(KeySelectionStrategy):
+    """评分 + 最近最少选中轮转：分数段从高到低，段内选最久未被选中的 Key。"""
+
+    name = "score"
+    reason_prefix = "Score Selection"
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        return index.pick(request.now, check)
+
+
+class RoundRobinStrategy(KeySelectionStrategy):
+    """按活动 Key 的加载顺序轮询，跳过挂起的 Key，忽略分数。"""
+
+    name = "round_robin"
+    reason_prefix = "Round Robin Selection"
+
+    def __init__(self, concurrency_limiter: KeyConcurrencyLimiter):
+        super().__init__(concurrency_limiter)
+        self._cursors: Dict[str, int] = {}  # 模型 -> 下一次开始检查的位置
+        self._lock = threading.Lock()  # 保护 _cursors (不在持锁期间调用检查函数)
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        total = len(active_keys)
+        if total == 0:
+            return None
+        with self._lock:
+            start = self._cursors.get(request.model_name, 0)
+            self._cursors[request.model_name] = (start + 1) % total
+        for offset in range(total):
+            position = (start + offset) % total
+            api_key = active_keys[position]
+            score = index.live_score(api_key, request.now)
+            if score is None:
+                continue
+            if self._offer(index, api_key, score, request.now, check):
+                with self._lock:
+                    self._cursors[request.model_name] = (position + 1) % total
+                return api_key, score
+        return None
+
+
+class HeadroomWeightedStrategy(KeySelectionStrategy):
+    """随机抽取一批候选，按 分数 × 剩余速率余量 加权随机排序后依次检查。"""
+
+    name = "headroom"
+    reason_prefix = "Headroom Selection"
+
+    def _headrooms(
+        self, api_keys: Sequence[str], request: SelectionRequest
+    ) -> Dict[str, float]:
+        """
+        (内部方法) 各 Key 在 RPM 和 TPM 输入两个维度上扣除本次请求后剩余余量的较小比例。
+        所有候选的用量合并为一次读取 (共享后端时为一次往返)。
+        """
+        dimensions = [
+            (dimension, request.model_limits.get(dimension), cost)
+            for dimension, cost in (
+                ("rpm", 1),
+                ("tpm_input", request.estimated_input_tokens),
+            )
+            if request.model_limits.get(dimension)
+            and request.model_limits[dimension] > 0
+        ]
+        headrooms = {api_key: 1.0 for api_key in api_keys}
+        if not dimensions:
+            return headrooms
+        queries = [
+            (api_key, request.model_name, dimension, limit)
+            for api_key in api_keys
+            for dimension, limit, _ in dimensions
+        ]
+        used = iter(key_rate_limiter.usage_many(queries, request.now))
+        for api_key in api_keys:
+            for _, limit, cost in dimensions:
+                headrooms[api_key] = min(
+                    headrooms[api_key], max(0.0, (limit - next(used) - cost) / limit)
+                )
+        return headrooms
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        sample_size = min(len(active_keys), max(1, config.KEY_SELECTION_SAMPLE_SIZE))
+        weighted: List[Tuple[float, str, float]] = []
+        scores = {
+            api_key: index.live_score(api_key, request.now)
+            for api_key in random.sample(active_keys, sample_size)
+        }
+        sampled = [api_key for api_key, score in scores.items() if score is not None]
+        headrooms = self._headrooms(sampled, request)
+        for api_key in sampled:
+            score = scores[api_key]
+            weight = max(score, 0.0) * headrooms[api_key]
+            # 加权随机排序 (Efraimidis-Spirakis)：u^(1/w) 越大越靠前，权重为 0 的排在最后
+            order = random.random() ** (1.0 / weight) if weight > 0 else -1.0
+            weighted.append((order, api_key, score))
+        weighted.sort(reverse=True)
+        selected = self._offer_in_order(
+            index, ((k, s) for _, k, s in weighted), request.now, check
+        )
+        if selected is not None:
+            return selected
+        # 样本全部不可用时，随机顺序检查其余候选
+        return self._offer_in_order(
+            index,
+            self._shuffled_candidates(index, request.now, (k for _, k, _ in weighted)),
+            request.now,
+            check,
+        )
+
+
+class PowerOfTwoChoicesStrategy(KeySelectionStrategy):
+    """每轮随机抽取两个候选，先检查并发负载 (在途 / 允许在途) 较低者，分数高者优先打破平局。"""
+
+    name = "p2c"
+    reason_prefix = "P2C Selection"
+    max_rounds = 8  # 随机抽样的最大轮数，之后回退到随机顺序检查所有候选
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        total = len(active_keys)
+        if total == 0:
+            return None
+        offered = set()
+        for _ in range(min(self.max_rounds, total)):
+            pair = []
+            for position in random.sample(range(total), min(2, total)):
+                api_key = active_keys[position]
+                if api_key in offered:
+                    continue
+                score = index.live_score(api_key, request.now)
+                if score is not None:
+                    pair.append(
+                        (
+                            self.concurrency_limiter.load(api_key, request.model_name),
+                            -score,
+                            api_key,
+                        )
+                    )
+            pair.sort()
+            for _, negative_score, api_key in pair:
+                offered.add(api_key)
+                if self._offer(index, api_key, -negative_score, request.now, check):
+                    return api_key, -negative_score
+        return self._offer_in_order(
+            index,
+            self._shuffled_candidates(index, request.now, offered),
+            request.now,
+            check,
+        )
+
+
+class LeastOutstandingStrategy(KeySelectionStrategy):
+    """在途请求最少的 Key 优先，在途数相同时分数高者优先，其余随机。"""
+
+    name = "least_outstanding"
+    reason_prefix = "Least Outstanding Selection"
+
+    def select(
+        self,
+        request: SelectionRequest,
+        index: CandidateIndex,
+        active_keys: Sequence[str],
+        check: CandidateCheck,
+    ) -> Optional[Tuple[str, float]]:
+        inflight = self.concurrency_limiter.inflight_counts(request.model_name)
+        candidates = list(index.live_scores(request.now).items())
+        random.shuffle(candidates)  # 在途数和分数都相同的 Key 之间随机
+        candidates.sort(key=lambda item: (inflight.get(item[0], 0), -item[1]))
+        return self._offer_in_order(index, candidates, request.now, check)
+
+
+# 配置名称 -> 策略类
+STRATEGIES: Dict[str, Type[KeySelectionStrategy]] = {
+    strategy.name: strategy
+    for strategy in (
+        ScoreRotationStrategy,
+        RoundRobinStrategy,
+        HeadroomWeightedStrategy,
+        PowerOfTwoChoicesStrategy,
+        LeastOutstandingStrategy,
+    )
+}
+
+
+def strategy_name_for_model(model_name: str) -> str:
+    """返回模型配置的选择策略名称；未知的名称记录警告并回退到 "score"。"""
+    name = config.KEY_SELECTION_STRATEGY_BY_MODEL.get(
+        model_name, config.KEY_SELECTION_STRATEGY
+    )
+    if name not in STRATEGIES:
+        logger.warning(
+            f"未知的 Key 选择策略 '{name}' (模型 {model_name})，使用 'score'。"
+        )
+        return ScoreRotationStrategy.name
+    return name
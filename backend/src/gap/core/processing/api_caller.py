@@ -4,6 +4,7 @@ import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import httpx
+from fastapi import Request
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -19,11 +20,16 @@ from gap.config import safety_settings, safety_settings_g2
 from gap.core.cache.manager import CacheManager
 from gap.core.context.store import ContextStore
 from gap.core.keys.manager import APIKeyManager
+from gap.core.processing.attempt_context import AttemptContext
 from gap.core.processing.error_handler import _handle_api_call_exception
-from gap.core.processing.stream_handler import generate_stream_response
+from gap.core.processing.stream_handler import (
+    GuardedStreamingResponse,
+    generate_stream_response,
+)
+from gap.core.processing.token_estimate import calibrate_from_usage
 from gap.core.processing.utils import update_token_counts
 from gap.core.services.gemini import GeminiClient
-from gap.core.tracking import usage_data, usage_lock
+from gap.core.tracking import mark_usage_dirty, usage_data, usage_lock
 from gap.core.utils.response_wrapper import ResponseWrapper
 
 logger = logging.getLogger("my_logger")
@@ -48,6 +54,9 @@ async def attempt_api_call(
     user_id: Optional[str] = None,
     db: Optional[AsyncSession] = None,
     context_store: ContextStore | None = None,
+    attempt_context: Optional[AttemptContext] = None,
+    http_request: Optional[Request] = None,
+    response_cache_key: Optional[str] = None,
 ) -> Tuple[
     Optional[Union[StreamingResponse, ChatCompletionResponse]],
     Optional[Dict[str, Any]],
@@ -55,6 +64,22 @@ async def attempt_api_call(
 ]:
     """
     Attempts to call the Gemini API with the given key and content.
+
+    If an ``attempt_context`` is given, the key is recorded as tried for this
+    request whenever the call fails, so a retry never picks it again. The
+    input-token reservation held by the context is reconciled with the actual
+    ``promptTokenCount`` on success, released on failure, and handed over to the
+    stream generator for streaming calls. The key's concurrency permit is
+    returned as soon as the upstream call finishes, or handed over to the
+    stream generator together with the reservation; the streaming response
+    releases both if the generator is never started.
+    ``http_request`` lets the stream generator detect client disconnects and
+    cancel the upstream stream immediately.
+    ``response_cache_key`` is handed to the stream generator, which stores the
+    completed stream in the response cache; non-stream results are stored by
+    the caller.
+    Non-stream outcomes (latency on success, status on failure) feed the key
+    scoring engine; stream outcomes are recorded by the stream handler.
     """
     response: Optional[Union[StreamingResponse, ChatCompletionResponse]] = None
     error_info: Optional[Dict[str, Any]] = None
@@ -71,8 +96,23 @@ async def attempt_api_call(
         is_stream = chat_request.stream
 
         if is_stream:
+            # 流式调用的预留和并发名额由流生成器在流结束、出错或被取消时结算和归还
+            token_reservation = (
+                attempt_context.take_token_reservation() if attempt_context else None
+            )
+            concurrency_permit = (
+                attempt_context.take_concurrency_permit() if attempt_context else None
+            )
             response_id = f"chatcmpl-{int(time.time() * 1000)}"
-            response = StreamingResponse(
+
+            def release_stream_resources() -> None:
+                # 流生成器从未开始迭代时 (例如客户端在响应发出前断开)，由响应负责退还和归还
+                if token_reservation is not None:
+                    token_reservation.release()
+                if concurrency_permit is not None:
+                    concurrency_permit.release()
+
+            response = GuardedStreamingResponse(
                 generate_stream_response(
                     gemini_client_instance=gemini_client_instance,
                     chat_request=chat_request,
@@ -93,7 +133,15 @@ async def attempt_api_call(
                     client_ip=client_ip,
                     today_date_str_pt=today_date_str_pt,
                     context_store=context_store,
+                    token_reservation=token_reservation,
+                    concurrency_permit=concurrency_permit,
+                    token_estimates=(
+                        attempt_context.token_estimates if attempt_context else None
+                    ),
+                    http_request=http_request,
+                    response_cache_key=response_cache_key,
                 ),
+                on_close=release_stream_resources,
                 media_type="text/event-stream",
             )
             logger.info(
@@ -102,13 +150,19 @@ async def attempt_api_call(
             return response, None, False
 
         else:
-            response_obj = await gemini_client_instance.complete_chat(
-                request=chat_request,
-                contents=contents,
-                safety_settings=current_safety_settings,
-                system_instruction=system_instruction,
-                cached_content_id=cached_content_id_to_use,
-            )
+            call_started_at = time.monotonic()
+            try:
+                response_obj = await gemini_client_instance.complete_chat(
+                    request=chat_request,
+                    contents=contents,
+                    safety_settings=current_safety_settings,
+                    system_instruction=system_instruction,
+                    cached_content_id=cached_content_id_to_use,
+                )
+            finally:
+                # 上游调用结束 (成功、失败或被取消)，归还并发名额
+                if attempt_context is not None:
+                    attempt_context.release_concurrency_permit()
 
             if isinstance(response_obj, ResponseWrapper):
                 usage = Usage(
@@ -140,17 +194,35 @@ async def attempt_api_call(
                 )
                 raise TypeError("Unexpected response type from API call")
 
+            key_manager.record_call_outcome(
+                current_api_key,
+                model_name,
+                success=True,
+                latency_seconds=time.monotonic() - call_started_at,
+                limits=limits,
+            )
+
             with usage_lock:
                 key_usage = usage_data.setdefault(current_api_key, {}).setdefault(
                     model_name, {}
                 )
                 key_usage["last_used_timestamp"] = time.time()
+                mark_usage_dirty(current_api_key, model_name)
                 logger.debug(
                     f"Non-stream success, updated last_used_timestamp for {current_api_key[:8]}..."
                 )
 
             if isinstance(response, ChatCompletionResponse) and response.usage:
                 prompt_tokens = response.usage.prompt_tokens
+                if cached_content_id_to_use is None:
+                    # 缓存内容的 Token 也计入 promptTokenCount，只用未使用缓存的调用校准本地估算
+                    calibrate_from_usage(
+                        attempt_context.token_estimates if attempt_context else None,
+                        model_name,
+                        contents,
+                        system_instruction,
+                        prompt_tokens,
+                    )
                 update_token_counts(
                     current_api_key,
                     model_name,
@@ -158,11 +230,22 @@ async def attempt_api_call(
                     prompt_tokens,
                     client_ip,
                     today_date_str_pt,
+                    completion_tokens=response.usage.completion_tokens,
+                    reservation=(
+                        attempt_context.take_token_reservation()
+                        if attempt_context
+                        else None
+                    ),
                 )
             else:
                 logger.warning(
                     f"Non-stream success but no usage metadata (Key: {current_api_key[:8]}...)."
                 )
+                if attempt_context is not None:
+                    # 没有实际用量可对账，保留估算值作为本次用量
+                    reservation = attempt_context.take_token_reservation()
+                    if reservation is not None:
+                        reservation.reconcile(None)
 
             if enable_native_caching and content_to_cache_on_success:
                 try:
@@ -211,5 +294,10 @@ async def attempt_api_call(
             key_manager=key_manager,
             is_stream=chat_request.stream,
             request_id=request_id,
+            model_name=model_name,
         )
+        if attempt_context is not None:
+            attempt_context.mark_tried(current_api_key)
+            attempt_context.release_token_reservation()
+            attempt_context.release_concurrency_permit()
         return None, error_info, needs_retry_from_exception
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+单个请求的 API 调用尝试上下文。
+
+每个请求在进入 Key 选择与重试循环时创建一个 AttemptContext，并将其显式传递给
+select_and_prepare_key、APIKeyManager.select_best_key 和 attempt_api_call。
+已尝试的 Key、尝试预算、截止时间、Token 估算以及当前尝试的 Token 预留和并发名额都只属于当前请求，
+并发请求之间不会互相清空或污染排除列表。
+"""
+
+import math  # 容量恢复时间未知时使用无穷大
+import time  # 用于计算截止时间 (单调时钟)
+from dataclasses import dataclass, field  # 用于定义上下文数据类
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from gap.core.keys.concurrency import ConcurrencyPermit  # 选择 Key 时占用的并发名额
+from gap.core.keys.limiter import TokenReservation  # 选择 Key 时预留的输入 Token
+from gap.core.processing.token_estimate import (  # 逐条消息 Token 估算缓存
+    TokenEstimateCache,
+)
+
+
+@dataclass
+class AttemptContext:
+    """
+    单个请求的 Key 尝试状态。
+
+    Attributes:
+        request_id (str): 请求 ID，用于日志跟踪。
+        max_attempts (int): 允许的最大尝试次数 (尝试预算)。
+        deadline (Optional[float]): 截止时间 (time.monotonic() 基准)，None 表示不限制。
+        tried_keys (Set[str]): 本请求中已经尝试过 (或应跳过) 的 Key。
+        attempt_count (int): 已开始的尝试次数。
+        estimated_input_tokens (Optional[int]): 缓存的输入 Token 估算值，同一请求内只计算一次。
+        token_estimates (TokenEstimateCache): 逐条消息的 Token 估算缓存，
+            供 Key 选择、动态截断和上下文保存共用，每条消息只序列化一次。
+        token_reservation (Optional[TokenReservation]): 当前尝试选中 Key 时预留的输入 Token，
+            由调用结果对账或退还。
+        concurrency_permit (Optional[ConcurrencyPermit]): 当前尝试选中 Key 时占用的并发名额，
+            上游调用结束时归还。
+        capacity_retry_at (Optional[float]): 最近一次 Key 选择因容量不足 (并发上限、TPM、熔断、
+            临时不可用) 而跳过候选 Key 时，容量最早可能恢复的时间戳；math.inf 表示只能等待释放事件，
+            None 表示没有候选 Key 是因容量不足被跳过的 (等待没有意义)。
+    """
+
+    request_id: str
+    max_attempts: int
+    deadline: Optional[float] = None
+    tried_keys: Set[str] = field(default_factory=set)
+    attempt_count: int = 0
+    estimated_input_tokens: Optional[int] = None
+    token_estimates: TokenEstimateCache = field(default_factory=TokenEstimateCache)
+    token_reservation: Optional[TokenReservation] = None
+    concurrency_permit: Optional[ConcurrencyPermit] = None
+    capacity_retry_at: Optional[float] = None
+
+    @classmethod
+    def create(
+        cls,
+        request_id: str,
+        max_attempts: int,
+        timeout_seconds: Optional[float] = None,
+        model_name: Optional[str] = None,
+    ) -> "AttemptContext":
+        """
+        创建尝试上下文。
+
+        Args:
+            request_id (str): 请求 ID。
+            max_attempts (int): 最大尝试次数。
+            timeout_seconds (Optional[float]): 从现在起允许的总时长 (秒)，None 或 <= 0 表示不限制。
+            model_name (Optional[str]): 请求的模型名称，Token 估算使用该模型的校准系数。
+        """
+        deadline = (
+            time.monotonic() + timeout_seconds
+            if timeout_seconds and timeout_seconds > 0
+            else None
+        )
+        return cls(
+            request_id=request_id,
+            max_attempts=max_attempts,
+            deadline=deadline,
+            token_estimates=TokenEstimateCache(model_name),
+        )
+
+    def mark_tried(self, api_key: Optional[str]) -> None:
+        """将 Key 记录为本请求已尝试过，之后的选择会排除它。"""
+        if api_key:
+            self.tried_keys.add(api_key)
+
+    def is_tried(self, api_key: str) -> bool:
+        """Key 是否已在本请求中尝试过。"""
+        return api_key in self.tried_keys
+
+    def remaining_seconds(self) -> Optional[float]:
+        """距离截止时间的剩余秒数，None 表示不限制。"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def is_expired(self) -> bool:
+        """是否已超过截止时间。"""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def start_attempt(self) -> bool:
+        """
+        开始一次新的尝试。
+
+        Returns:
+            bool: 如果尝试预算和截止时间都允许，递增计数并返回 True；否则返回 False。
+        """
+        if self.attempt_count >= self.max_attempts or self.is_expired():
+            return False
+        self.attempt_count += 1
+        return True
+
+    def refund_attempt(self) -> None:
+        """退还一次尝试 (在准入队列中等待容量的那次选择不计入尝试预算)。"""
+        if self.attempt_count > 0:
+            self.attempt_count -= 1
+
+    def note_capacity_shortage(self, retry_at: Optional[float]) -> None:
+        """记录一个因容量不足被跳过的候选 Key 及其容量最早恢复时间 (None 表示只能等待释放事件)。"""
+        retry_at = math.inf if retry_at is None else retry_at
+        if self.capacity_retry_at is None or retry_at < self.capacity_retry_at:
+            self.capacity_retry_at = retry_at
+
+    def get_estimated_input_tokens(
+        self,
+        contents: List[Dict[str, Any]],
+        estimator: Callable[[List[Dict[str, Any]]], int],
+    ) -> int:
+        """返回缓存的输入 Token 估算值；首次调用时使用 estimator 计算并缓存。"""
+        if self.estimated_input_tokens is None:
+            self.estimated_input_tokens = estimator(contents)
+        return self.estimated_input_tokens
+
+    def hold_token_reservation(self, reservation: Optional[TokenReservation]) -> None:
+        """保存本次尝试的 Token 预留；上一次尝试尚未结算的预留会被全额退还。"""
+        self.release_token_reservation()
+        self.token_reservation = reservation
+
+    def take_token_reservation(self) -> Optional[TokenReservation]:
+        """取出当前预留并转交给调用方 (例如流式响应生成器)，由调用方负责结算。"""
+        reservation, self.token_reservation = self.token_reservation, None
+        return reservation
+
+    def release_token_reservation(self) -> None:
+        """全额退还当前尚未结算的预留 (调用失败、跳过 Key 或请求被取消时)。"""
+        reservation, self.token_reservation = self.token_reservation, None
+        if reservation is not None:
+            reservation.release()
+
+    def hold_concurrency_permit(self, permit: Optional[ConcurrencyPermit]) -> None:
+        """保存本次尝试的并发名额；上一次尝试尚未归还的名额会被归还。"""
+        self.release_concurrency_permit()
+        self.concurrency_permit = permit
+
+    def take_concurrency_permit(self) -> Optional[ConcurrencyPermit]:
+        """取出当前并发名额并转交给调用方 (例如流式响应生成器)，由调用方负责归还。"""
+        permit, self.concurrency_permit = self.concurrency_permit, None
+        return permit
+
+    def release_concurrency_permit(self) -> None:
+        """归还当前的并发名额 (调用结束、跳过 Key 或请求被取消时)。"""
+        permit, self.concurrency_permit = self.concurrency_permit, None
+        if permit is not None:
+            permit.release()
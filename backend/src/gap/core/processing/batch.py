@@ -0,0 +1,873 @@
+# -*- coding: utf-8 -*-
+"""
+OpenAI 兼容的批处理 (/v1/files + /v1/batches)：用 Key 池的空闲余量离线执行 JSONL 任务。
+
+离线评测原先每个条目都是一次独立的 HTTP 请求，与交互流量争抢同一批 Key。
+本模块接收 OpenAI 格式的批处理输入文件 (每行 {"custom_id", "method", "url", "body"})，
+由每个任务一个的调度协程把条目逐个交给 process_request 的 Key 选择与重试流程执行：
+- 只在 Key 池还有余量时派发：某个模型的 RPM/TPM 剩余余量低于 BATCH_HEADROOM_RESERVE，
+  或准入队列中有交互请求在等待时，暂停派发新条目；
+- 批处理条目不进入准入队列 (wait_for_capacity=False)，所有 Key 饱和时直接返回 429/503，
+  由调度器退避后重新排队；并发数按 AIMD 自适应 (成功时加性增加，被退回时减半)，
+  上限为 BATCH_MAX_CONCURRENCY；
+- 结果逐行追加到输出 / 错误 JSONL (OpenAI 的 batch_output 格式)，任务状态先写临时文件再原子替换；
+  重启后按输出和错误文件中已有的 custom_id 跳过已完成的条目继续执行
+  (忽略崩溃时写了一半的最后一行)；
+- 任务对象除 OpenAI 字段外附带 gap_progress：在途条目数、当前并发、最近一分钟的吞吐
+  以及按 Key (仅前 8 位) 统计的请求数和 Token 用量。
+"""
+
+import asyncio  # 调度协程
+import contextlib  # 无数据库时的空上下文
+import heapq  # 退避中的条目 (按可重试时间排序)
+import json  # 文件和状态的序列化格式
+import logging  # 日志记录
+import os  # 文件操作
+import time  # 时间戳
+import uuid  # 文件、任务和结果行 ID
+from collections import deque  # 待派发条目和吞吐窗口
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from fastapi import HTTPException, Request, status
+from pydantic import ValidationError
+
+from gap import config  # 应用配置
+from gap.api.models import ChatCompletionRequest  # 条目请求体的校验模型
+from gap.core.keys.admission import admission_queue  # 交互请求的准入等待队列
+from gap.core.keys.limiter import key_rate_limiter  # Key 的 RPM/TPM 用量
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+    from gap.core.keys.manager import APIKeyManager
+
+logger = logging.getLogger("my_logger")
+
+# 目前支持的批处理端点
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+# 支持的完成时间窗口 -> 秒数
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+# 文件用途
+FILE_PURPOSE_INPUT = "batch"
+FILE_PURPOSE_OUTPUT = "batch_output"
+# 任务状态
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+# 视为容量不足 (退避后重新排队) 的状态码
+BACKPRESSURE_STATUS_CODES = (
+    status.HTTP_429_TOO_MANY_REQUESTS,
+    status.HTTP_503_SERVICE_UNAVAILABLE,
+)
+# 创建任务时最多记录的输入校验错误条数
+MAX_VALIDATION_ERRORS = 100
+# 吞吐统计的滑动窗口（秒）
+THROUGHPUT_WINDOW_SECONDS = 60.0
+# 运行中任务状态文件的最短写入间隔（秒）
+STATE_SAVE_INTERVAL_SECONDS = 2.0
+# Key 池余量的缓存时间（秒），避免每次派发都遍历所有 Key
+HEADROOM_CACHE_SECONDS = 0.2
+# 退避的最长时间（秒）
+MAX_BACKOFF_SECONDS = 30.0
+
+# 执行单个条目的函数：请求体 -> (响应体, 实际使用的 Key)；失败时抛出 HTTPException
+ItemDispatcher = Callable[
+    [Dict[str, Any]], Awaitable[Tuple[Dict[str, Any], Optional[str]]]
+]
+
+
+def _mask_key(api_key: Optional[str]) -> str:
+    """Key 只保留前 8 位 (状态文件和进度中不出现完整 Key)。"""
+    if not api_key:
+        return "unknown"
+    return f"{api_key[:8]}..." if len(api_key) > 8 else api_key
+
+
+def pool_headroom(
+    key_manager: Optional["APIKeyManager"],
+    model_name: Optional[str],
+    now: Optional[float] = None,
+) -> float:
+    """
+    Key 池在某个模型上 RPM 和 TPM 输入两个维度剩余余量比例的较小值 (0.0 - 1.0)。
+
+    当天已耗尽的 Key 不计入；模型没有配置限制或未提供 Key 管理器时返回 1.0。
+    """
+    if key_manager is None or not model_name:
+        return 1.0
+    limits = config.MODEL_LIMITS.get(model_name) or {}
+    snapshot = key_manager.snapshot
+    now = time.time() if now is None else now
+    available = [k for k in snapshot.active_keys if k not in snapshot.daily_exhausted]
+    headroom = 1.0
+    for dimension in ("rpm", "tpm_input"):
+        limit = limits.get(dimension)
+        if not limit or limit <= 0:
+            continue
+        if not available:
+            return 0.0
+        # 所有 Key 的用量合并为一次读取 (共享后端时为一次往返)
+        used = key_rate_limiter.usage_many(
+            [(api_key, model_name, dimension, limit) for api_key in available], now
+        )
+        spare = sum(max(0.0, limit - u) for u in used)
+        headroom = min(headroom, spare / (limit * len(available)))
+    return headroom
+
+
+def app_dispatcher(app: "FastAPI") -> ItemDispatcher:
+    """
+    创建通过 process_request 执行条目的派发函数 (使用应用的 Key 管理器、HTTP 客户端和数据库会话)。
+
+    条目跳过按 IP 的滥用检查、不进入准入队列、不使用上下文补全，且始终以非流式执行。
+    """
+    from gap.core.processing.main_handler import process_request
+
+    async def dispatch(body: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+        try:
+            chat_request = ChatCompletionRequest(**{**body, "stream": False})
+        except (ValidationError, TypeError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        http_request = Request(
+            {
+                "type": "http",
+                "app": app,
+                "method": "POST",
+                "path": SUPPORTED_ENDPOINTS[0],
+                "query_string": b"",
+                "headers": [],
+                "client": ("batch", 0),
+            }
+        )
+        outcome: Dict[str, Any] = {}
+        session_factory = getattr(app.state, "AsyncSessionFactory", None)
+        async with (
+            session_factory() if session_factory else contextlib.nullcontext()
+        ) as db:
+            response = await process_request(
+                chat_request=chat_request,
+                http_request=http_request,
+                request_type="non-stream",
+                auth_data={"key": None, "config": {"enable_context_completion": False}},
+                key_manager=app.state.key_manager,
+                http_client=app.state.http_client,
+                cache_manager_instance=getattr(app.state, "cache_manager", None),
+                db=db,
+                enforce_ip_limits=False,
+                wait_for_capacity=False,
+                outcome=outcome,
+            )
+        if hasattr(response, "model_dump"):
+            response = response.model_dump()
+        return response, outcome.get("api_key")
+
+    return dispatch
+
+
+class _BatchRun:
+    """
+    一个正在执行的任务的运行时状态 (不持久化)。
+
+    Attributes:
+        concurrency (float): 当前允许的在途条目数 (AIMD 调整，取整后使用)。
+        in_flight (int): 当前在途条目数。
+        pending (int): 等待派发 (含退避中) 的条目数。
+        paused_reason (Optional[str]): 最近一次暂停派发的原因。
+        cancel_requested (bool): 是否已请求取消。
+        recent (Deque[Tuple[float, int]]): 最近完成的条目 (完成时间, Token 总数)，用于吞吐统计。
+        batch (Optional[Dict[str, Any]]): 调度协程持有的最新任务对象 (比状态文件更新)。
+    """
+
+    def __init__(self):
+        self.batch: Optional[Dict[str, Any]] = None
+        self.concurrency = 1.0
+        self.in_flight = 0
+        self.pending = 0
+        self.paused_reason: Optional[str] = None
+        self.cancel_requested = False
+        self.recent: Deque[Tuple[float, int]] = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.last_saved = 0.0
+
+    def throughput(self, now: float) -> Dict[str, float]:
+        """最近 THROUGHPUT_WINDOW_SECONDS 秒内每分钟完成的条目数和 Token 数。"""
+        while self.recent and self.recent[0][0] < now - THROUGHPUT_WINDOW_SECONDS:
+            self.recent.popleft()
+        scale = 60.0 / THROUGHPUT_WINDOW_SECONDS
+        return {
+            "requests_per_minute": round(len(self.recent) * scale, 2),
+            "tokens_per_minute": round(sum(t for _, t in self.recent) * scale, 2),
+        }
+
+
+class BatchManager:
+    """
+    批处理文件与任务的存储和调度。
+
+    文件保存在 <storage_dir>/files/<file_id>.jsonl (元数据为同名 .json)，
+    任务状态保存在 <storage_dir>/batches/<batch_id>.json。
+    start() 之后新建的任务立即开始执行，重启前未完成的任务在 start() 时恢复。
+    """
+
+    def __init__(self, storage_dir: Optional[str] = None):
+        self.storage_dir = storage_dir or config.BATCH_STORAGE_DIR
+        self._files_dir = os.path.join(self.storage_dir, "files")
+        self._batches_dir = os.path.join(self.storage_dir, "batches")
+        self._dispatcher: Optional[ItemDispatcher] = None
+        self._key_manager: Optional["APIKeyManager"] = None
+        self._runs: Dict[str, _BatchRun] = {}
+        self._headroom_cache: Dict[str, Tuple[float, float]] = {}
+
+    # --- 存储 ---
+
+    def _ensure_dirs(self) -> None:
+        os.makedirs(self._files_dir, exist_ok=True)
+        os.makedirs(self._batches_dir, exist_ok=True)
+
+    @staticmethod
+    def _write_json(path: str, data: Dict[str, Any]) -> None:
+        """先写临时文件再原子替换。"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def file_path(self, file_id: str) -> str:
+        """文件内容的存储路径。"""
+        return os.path.join(self._files_dir, f"{os.path.basename(file_id)}.jsonl")
+
+    def _file_meta_path(self, file_id: str) -> str:
+        return os.path.join(self._files_dir, f"{os.path.basename(file_id)}.json")
+
+    def _batch_path(self, batch_id: str) -> str:
+        return os.path.join(self._batches_dir, f"{os.path.basename(batch_id)}.json")
+
+    def create_file(
+        self, content: bytes, filename: str, purpose: str
+    ) -> Dict[str, Any]:
+        """保存上传的文件，返回 OpenAI 格式的文件对象。"""
+        self._ensure_dirs()
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self.file_path(file_id), "wb") as f:
+            f.write(content)
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        self._write_json(self._file_meta_path(file_id), meta)
+        return self.get_file(file_id)  # type: ignore[return-value]
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """返回文件对象 (bytes 为当前大小，输出文件在任务执行期间持续增长)；不存在时返回 None。"""
+        meta = self._read_json(self._file_meta_path(file_id))
+        if meta is None:
+            return None
+        try:
+            meta["bytes"] = os.path.getsize(self.file_path(file_id))
+        except OSError:
+            meta["bytes"] = 0
+        return meta
+
+    def list_files(self, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按创建时间倒序列出文件。"""
+        if not os.path.isdir(self._files_dir):
+            return []
+        files = [
+            self.get_file(name[: -len(".json")])
+            for name in os.listdir(self._files_dir)
+            if name.endswith(".json")
+        ]
+        return sorted(
+            (f for f in files if f and (purpose is None or f["purpose"] == purpose)),
+            key=lambda f: f["created_at"],
+            reverse=True,
+        )
+
+    def delete_file(self, file_id: str) -> bool:
+        """删除文件及其元数据。"""
+        existed = False
+        for path in (self.file_path(file_id), self._file_meta_path(file_id)):
+            try:
+                os.remove(path)
+                existed = True
+            except FileNotFoundError:
+                pass
+        return existed
+
+    def _save_batch(self, batch: Dict[str, Any]) -> None:
+        self._write_json(self._batch_path(batch["id"]), batch)
+
+    # --- 任务 ---
+
+    def _parse_input(
+        self, file_id: str, endpoint: str
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], List[Dict[str, Any]]]:
+        """读取输入文件，返回 ([(custom_id, body)], 校验错误列表)。"""
+        items: List[Tuple[str, Dict[str, Any]]] = []
+        errors: List[Dict[str, Any]] = []
+        seen: Set[str] = set()
+
+        def error(line: int, code: str, message: str) -> None:
+            if len(errors) < MAX_VALIDATION_ERRORS:
+                errors.append({"code": code, "message": message, "line": line})
+
+        with open(self.file_path(file_id), "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError:
+                    error(line_no, "invalid_json_line", "该行不是合法的 JSON。")
+                    continue
+                custom_id = (
+                    request.get("custom_id") if isinstance(request, dict) else None
+                )
+                if not isinstance(custom_id, str) or not custom_id:
+                    error(line_no, "missing_required_parameter", "缺少 custom_id。")
+                elif custom_id in seen:
+                    error(
+                        line_no,
+                        "duplicate_custom_id",
+                        f"custom_id '{custom_id}' 重复。",
+                    )
+                elif str(request.get("method", "")).upper() != "POST":
+                    error(line_no, "invalid_method", "method 必须为 POST。")
+                elif request.get("url") != endpoint:
+                    error(
+                        line_no,
+                        "mismatched_url",
+                        f"url 必须与任务的 endpoint ({endpoint}) 一致。",
+                    )
+                elif not isinstance(request.get("body"), dict):
+                    error(line_no, "invalid_body", "body 必须是 JSON 对象。")
+                else:
+                    seen.add(custom_id)
+                    items.append((custom_id, request["body"]))
+        if not items and not errors:
+            error(0, "empty_file", "输入文件中没有任何请求。")
+        return items, errors
+
+    def create_batch(
+        self,
+        input_file_id: str,
+        endpoint: str,
+        completion_window: str = "24h",
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        创建批处理任务。参数不合法时抛出 HTTPException (400/404)；
+        输入文件中有不合法的行时任务以 failed 状态创建 (errors 中列出问题行)。
+        """
+        input_file = self.get_file(input_file_id)
+        if input_file is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"文件 {input_file_id} 不存在。",
+            )
+        if input_file["purpose"] != FILE_PURPOSE_INPUT:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"输入文件的 purpose 必须为 '{FILE_PURPOSE_INPUT}'。",
+            )
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"不支持的 endpoint: {endpoint}。支持: {', '.join(SUPPORTED_ENDPOINTS)}。",
+            )
+        if completion_window not in COMPLETION_WINDOWS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"不支持的 completion_window: {completion_window}。",
+            )
+
+        self._ensure_dirs()
+        now = int(time.time())
+        items, errors = self._parse_input(input_file_id, endpoint)
+        batch: Dict[str, Any] = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": len(items), "completed": 0, "failed": 0},
+            "metadata": metadata,
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "per_key": {},
+        }
+        if errors:
+            batch["status"] = "failed"
+            batch["failed_at"] = now
+            batch["errors"] = {"object": "list", "data": errors}
+            logger.warning(
+                f"批处理任务 {batch['id']}: 输入文件校验失败 ({len(errors)} 个问题)。"
+            )
+        self._save_batch(batch)
+        logger.info(
+            f"已创建批处理任务 {batch['id']} (输入文件 {input_file_id}, {len(items)} 个条目, 状态 {batch['status']})。"
+        )
+        if batch["status"] == "validating" and self._dispatcher is not None:
+            self._launch(batch["id"])
+        return self.get_batch(batch["id"])  # type: ignore[return-value]
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """返回任务对象和 gap_progress；不存在时返回 None。"""
+        run = self._runs.get(batch_id)
+        if run is not None and run.batch is not None:
+            batch = json.loads(json.dumps(run.batch))
+        else:
+            batch = self._read_json(self._batch_path(batch_id))
+        if batch is None:
+            return None
+        progress: Dict[str, Any] = {
+            "usage": batch.pop("usage", {}),
+            "per_key": batch.pop("per_key", {}),
+            "running": run is not None,
+        }
+        if run is not None:
+            progress.update(
+                {
+                    "in_flight": run.in_flight,
+                    "pending": run.pending,
+                    "concurrency": int(run.concurrency),
+                    "paused_reason": run.paused_reason,
+                    **run.throughput(time.time()),
+                }
+            )
+        started = batch.get("in_progress_at")
+        finished = (
+            batch.get("completed_at")
+            or batch.get("cancelled_at")
+            or batch.get("expired_at")
+        )
+        done = batch["request_counts"]["completed"] + batch["request_counts"]["failed"]
+        if started and done:
+            elapsed = max(1.0, (finished or time.time()) - started)
+            progress["average_requests_per_minute"] = round(done * 60.0 / elapsed, 2)
+        batch["gap_progress"] = progress
+        return batch
+
+    def list_batches(
+        self, limit: int = 20, after: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """按创建时间倒序分页列出任务 (OpenAI list 格式)。"""
+        batches: List[Dict[str, Any]] = []
+        if os.path.isdir(self._batches_dir):
+            for name in os.listdir(self._batches_dir):
+                if name.endswith(".json"):
+                    batch = self.get_batch(name[: -len(".json")])
+                    if batch is not None:
+                        batches.append(batch)
+        batches.sort(key=lambda b: (b["created_at"], b["id"]), reverse=True)
+        if after:
+            ids = [b["id"] for b in batches]
+            batches = batches[ids.index(after) + 1 :] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit,
+        }
+
+    def cancel_batch(self, batch_id: str) -> Dict[str, Any]:
+        """请求取消任务：停止派发新条目，等待在途条目完成后进入 cancelled 状态。"""
+        run = self._runs.get(batch_id)
+        batch = (
+            run.batch
+            if run is not None and run.batch is not None
+            else self._read_json(self._batch_path(batch_id))
+        )
+        if batch is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"批处理任务 {batch_id} 不存在。",
+            )
+        if batch["status"] not in ("validating", "in_progress"):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"状态为 {batch['status']} 的任务无法取消。",
+            )
+        batch["status"] = "cancelling"
+        batch["cancelling_at"] = int(time.time())
+        self._save_batch(batch)
+        if run is not None:
+            run.cancel_requested = True
+        else:
+            # 没有在执行 (调度器未启动)：直接结束
+            batch["status"] = "cancelled"
+            batch["cancelled_at"] = int(time.time())
+            self._save_batch(batch)
+        logger.info(f"批处理任务 {batch_id}: 已请求取消。")
+        return self.get_batch(batch_id)  # type: ignore[return-value]
+
+    # --- 调度 ---
+
+    async def start(
+        self,
+        dispatcher: ItemDispatcher,
+        key_manager: Optional["APIKeyManager"] = None,
+    ) -> int:
+        """
+        启动调度：之后创建的任务立即执行，并恢复重启前未完成的任务。
+
+        Returns:
+            int: 恢复的任务数。
+        """
+        self._dispatcher = dispatcher
+        self._key_manager = key_manager
+        self._ensure_dirs()
+        resumed = 0
+        for name in sorted(os.listdir(self._batches_dir)):
+            if not name.endswith(".json"):
+                continue
+            batch = self._read_json(os.path.join(self._batches_dir, name))
+            if batch and batch.get("status") in ACTIVE_STATUSES:
+                self._launch(batch["id"])
+                resumed += 1
+        if resumed:
+            logger.info(f"已恢复 {resumed} 个未完成的批处理任务。")
+        return resumed
+
+    async def stop(self) -> None:
+        """停止所有调度协程 (在途条目被取消，下次启动时重新执行)。"""
+        runs = list(self._runs.values())
+        for run in runs:
+            if run.task is not None:
+                run.task.cancel()
+        for run in runs:
+            if run.task is not None:
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await run.task
+        self._dispatcher = None
+
+    async def wait(self, batch_id: str) -> None:
+        """等待某个任务的调度协程结束 (主要用于测试)。"""
+        run = self._runs.get(batch_id)
+        if run is not None and run.task is not None:
+            await asyncio.shield(run.task)
+
+    def _launch(self, batch_id: str) -> None:
+        if batch_id in self._runs:
+            return
+        run = _BatchRun()
+        self._runs[batch_id] = run
+        run.task = asyncio.get_running_loop().create_task(self._run(batch_id, run))
+
+    def _spare_capacity(self, model_name: Optional[str]) -> Optional[str]:
+        """返回暂停派发的原因；可以派发时返回 None。"""
+        if admission_queue.depth > 0:
+            return "interactive_requests_waiting"
+        key = model_name or ""
+        now = time.monotonic()
+        cached = self._headroom_cache.get(key)
+        if cached is None or now - cached[0] > HEADROOM_CACHE_SECONDS:
+            cached = (now, pool_headroom(self._key_manager, model_name))
+            self._headroom_cache[key] = cached
+        if cached[1] <= config.BATCH_HEADROOM_RESERVE:
+            return "headroom_reserved"
+        return None
+
+    def _open_result_file(self, batch: Dict[str, Any], field: str) -> str:
+        """任务的输出 / 错误文件 (首次执行时创建)，返回文件 ID。"""
+        file_id = batch.get(field)
+        if file_id and self.get_file(file_id) is not None:
+            return file_id
+        suffix = "output" if field == "output_file_id" else "errors"
+        created = self.create_file(
+            b"", f"{batch['id']}_{suffix}.jsonl", FILE_PURPOSE_OUTPUT
+        )
+        batch[field] = created["id"]
+        return created["id"]
+
+    def _completed_ids(self, file_id: str) -> Set[str]:
+        """读取结果文件中已写入的 custom_id，并截掉崩溃时写了一半的最后一行。"""
+        path = self.file_path(file_id)
+        with open(path, "rb") as f:
+            data = f.read()
+        complete = data[: data.rfind(b"\n") + 1]
+        if len(complete) != len(data):
+            with open(path, "r+b") as f:
+                f.truncate(len(complete))
+        done: Set[str] = set()
+        for line in complete.splitlines():
+            try:
+                done.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError, TypeError):
+                continue
+        return done
+
+    async def _run(self, batch_id: str, run: _BatchRun) -> None:
+        """任务的调度协程。"""
+        try:
+            await self._drive(batch_id, run)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"批处理任务 {batch_id} 执行异常: {e}", exc_info=True)
+            batch = self._read_json(self._batch_path(batch_id))
+            if batch is not None:
+                batch["status"] = "failed"
+                batch["failed_at"] = int(time.time())
+                batch["errors"] = {
+                    "object": "list",
+                    "data": [
+                        {"code": "internal_error", "message": str(e), "line": None}
+                    ],
+                }
+                self._save_batch(batch)
+        finally:
+            self._runs.pop(batch_id, None)
+
+    async def _drive(self, batch_id: str, run: _BatchRun) -> None:
+        batch = self._read_json(self._batch_path(batch_id))
+        if batch is None:
+            return
+        run.batch = batch
+        items, _ = self._parse_input(batch["input_file_id"], batch["endpoint"])
+        output_id = self._open_result_file(batch, "output_file_id")
+        error_id = self._open_result_file(batch, "error_file_id")
+        succeeded = self._completed_ids(output_id)
+        failed = self._completed_ids(error_id) - succeeded
+        batch["request_counts"].update(
+            {"total": len(items), "completed": len(succeeded), "failed": len(failed)}
+        )
+        if batch["status"] == "cancelling":
+            run.cancel_requested = True
+        elif batch["status"] == "validating":
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+        self._save_batch(batch)
+
+        # (custom_id, body, 已退避次数)
+        pending: Deque[Tuple[str, Dict[str, Any], int]] = deque(
+            (custom_id, body, 0)
+            for custom_id, body in items
+            if custom_id not in succeeded and custom_id not in failed
+        )
+        delayed: List[Tuple[float, int, Tuple[str, Dict[str, Any], int]]] = []
+        in_flight: Dict[asyncio.Task, Tuple[str, Dict[str, Any], int]] = {}
+        poll = config.BATCH_POLL_INTERVAL_SECONDS
+        max_concurrency = max(1, config.BATCH_MAX_CONCURRENCY)
+        dispatcher = self._dispatcher
+        assert dispatcher is not None
+        logger.info(f"批处理任务 {batch_id}: 开始执行，剩余 {len(pending)} 个条目。")
+
+        with (
+            open(self.file_path(output_id), "a", encoding="utf-8") as output_file,
+            open(self.file_path(error_id), "a", encoding="utf-8") as error_file,
+        ):
+
+            def write_result(
+                custom_id: str,
+                status_code: Optional[int],
+                body: Optional[Dict[str, Any]],
+                error: Optional[Dict[str, Any]] = None,
+            ) -> None:
+                line = {
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": custom_id,
+                    "response": (
+                        {
+                            "status_code": status_code,
+                            "request_id": f"req_{uuid.uuid4().hex[:8]}",
+                            "body": body,
+                        }
+                        if status_code is not None
+                        else None
+                    ),
+                    "error": error,
+                }
+                target = (
+                    output_file if status_code == status.HTTP_200_OK else error_file
+                )
+                target.write(json.dumps(line, ensure_ascii=False) + "\n")
+                target.flush()
+                counts = batch["request_counts"]
+                counts["completed" if target is output_file else "failed"] += 1
+
+            def save(force: bool = False) -> None:
+                now = time.monotonic()
+                if force or now - run.last_saved >= STATE_SAVE_INTERVAL_SECONDS:
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+                    error_file.flush()
+                    os.fsync(error_file.fileno())
+                    self._save_batch(batch)
+                    run.last_saved = now
+
+            def record_success(
+                response_body: Dict[str, Any], api_key: Optional[str]
+            ) -> None:
+                usage = response_body.get("usage") or {}
+                prompt = int(usage.get("prompt_tokens") or 0)
+                completion = int(usage.get("completion_tokens") or 0)
+                totals = batch["usage"]
+                totals["prompt_tokens"] += prompt
+                totals["completion_tokens"] += completion
+                totals["total_tokens"] += prompt + completion
+                per_key = batch["per_key"].setdefault(
+                    _mask_key(api_key),
+                    {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0},
+                )
+                per_key["requests"] += 1
+                per_key["prompt_tokens"] += prompt
+                per_key["completion_tokens"] += completion
+                run.recent.append((time.time(), prompt + completion))
+
+            try:
+                while pending or delayed or in_flight:
+                    if time.time() >= batch["expires_at"] or run.cancel_requested:
+                        if not in_flight:
+                            break
+                    else:
+                        now = time.monotonic()
+                        while delayed and delayed[0][0] <= now:
+                            pending.append(heapq.heappop(delayed)[2])
+                        run.paused_reason = None
+                        while pending and len(in_flight) < int(run.concurrency):
+                            reason = self._spare_capacity(pending[0][1].get("model"))
+                            if reason is not None:
+                                run.paused_reason = reason
+                                break
+                            item = pending.popleft()
+                            in_flight[asyncio.ensure_future(dispatcher(item[1]))] = item
+                    run.in_flight = len(in_flight)
+                    run.pending = len(pending) + len(delayed)
+
+                    if not in_flight:
+                        await asyncio.sleep(poll)
+                        continue
+                    done, _ = await asyncio.wait(
+                        in_flight, timeout=poll, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        custom_id, body, retries = in_flight.pop(task)
+                        try:
+                            response_body, api_key = task.result()
+                        except HTTPException as e:
+                            if e.status_code in BACKPRESSURE_STATUS_CODES:
+                                # 容量不足：并发减半，条目退避后重新排队
+                                run.concurrency = max(1.0, run.concurrency / 2)
+                                if retries < config.BATCH_ITEM_MAX_RETRIES:
+                                    backoff = min(
+                                        MAX_BACKOFF_SECONDS, poll * 2**retries
+                                    )
+                                    heapq.heappush(
+                                        delayed,
+                                        (
+                                            time.monotonic() + backoff,
+                                            id(body),
+                                            (custom_id, body, retries + 1),
+                                        ),
+                                    )
+                                    continue
+                            write_result(
+                                custom_id,
+                                e.status_code,
+                                {
+                                    "error": {
+                                        "message": str(e.detail),
+                                        "type": (
+                                            "invalid_request_error"
+                                            if e.status_code < 500
+                                            else "server_error"
+                                        ),
+                                        "code": e.status_code,
+                                    }
+                                },
+                            )
+                        except Exception as e:
+                            logger.error(
+                                f"批处理任务 {batch_id}: 条目 {custom_id} 执行异常: {e}",
+                                exc_info=True,
+                            )
+                            write_result(
+                                custom_id,
+                                status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                {"error": {"message": str(e), "type": "server_error"}},
+                            )
+                        else:
+                            record_success(response_body, api_key)
+                            write_result(custom_id, status.HTTP_200_OK, response_body)
+                            # 成功：并发加性增加 (每个窗口约 +1)
+                            run.concurrency = min(
+                                float(max_concurrency),
+                                run.concurrency + 1.0 / run.concurrency,
+                            )
+                    save()
+
+                now = int(time.time())
+                run.in_flight = run.pending = 0
+                if run.cancel_requested:
+                    batch["status"] = "cancelled"
+                    batch["cancelled_at"] = now
+                elif pending or delayed:
+                    for custom_id, _, _ in list(pending) + [d[2] for d in delayed]:
+                        write_result(
+                            custom_id,
+                            None,
+                            None,
+                            {
+                                "code": "batch_expired",
+                                "message": "任务超过完成时间窗口，条目未执行。",
+                            },
+                        )
+                    batch["status"] = "expired"
+                    batch["expired_at"] = now
+                else:
+                    batch["status"] = "completed"
+                    batch["finalizing_at"] = batch["completed_at"] = now
+            finally:
+                for task in in_flight:
+                    task.cancel()
+                save(force=True)
+
+        if batch["request_counts"]["failed"] == 0 and batch["status"] != "expired":
+            self.delete_file(error_id)
+            batch["error_file_id"] = None
+            self._save_batch(batch)
+        counts = batch["request_counts"]
+        logger.info(
+            f"批处理任务 {batch_id}: {batch['status']} (成功 {counts['completed']}, 失败 {counts['failed']}, 共 {counts['total']})。"
+        )
+
+
+# 全局实例
+batch_manager = BatchManager()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+流式响应的客户端断开检测。
+在客户端断开 SSE 连接时立即取消正在等待上游数据的流生成器，
+而不是等到下一个数据块写入失败时才发现断开，从而及时停止上游生成并归还 Key 的额度。
+"""
+
+import asyncio  # 导入异步 IO 库
+import logging  # 导入日志库
+import threading  # 导入线程库
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Optional  # 导入类型提示
+
+from fastapi import Request  # 导入 FastAPI 请求对象
+
+logger = logging.getLogger("my_logger")
+
+
+class DisconnectWatcher:
+    """
+    监听一个 HTTP 请求的 http.disconnect 消息。
+    请求体已在进入端点前读完，之后 receive() 只会在客户端断开 (或响应完成) 时返回，
+    因此监听任务阻塞在 receive() 上即可在断开的同时得到通知，无需轮询。
+    断开时如果流生成器正在等待上游数据 (见 guard())，取消其所在的任务。
+    """
+
+    def __init__(self, http_request: Request):
+        self._request = http_request
+        self._task: Optional[asyncio.Task] = None  # 监听任务
+        self._consumer: Optional[asyncio.Task] = None  # 消费流生成器的任务
+        self._cancel_requested = False  # 是否由本监听器发起了取消
+        self.awaiting_upstream = False  # 流生成器当前是否在等待上游数据
+        self.disconnected = False  # 是否已检测到客户端断开
+
+    def start(self) -> None:
+        """在消费流生成器的任务中调用，启动监听任务。"""
+        self._consumer = asyncio.current_task()
+        self._task = asyncio.create_task(self._watch())
+
+    def stop(self) -> None:
+        """流结束时停止监听。"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _watch(self) -> None:
+        """(内部辅助函数) 等待 http.disconnect 消息，收到后取消正在等待上游的消费任务。"""
+        try:
+            while True:
+                message = await self._request.receive()
+                if message.get("type") == "http.disconnect":
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as watch_err:
+            # receive 不可用 (例如合成的请求对象)：放弃检测，断开仍会在写入失败时被发现
+            logger.debug(f"客户端断开监听不可用: {watch_err}")
+            return
+        self.disconnected = True
+        consumer = self._consumer
+        if self.awaiting_upstream and consumer is not None and not consumer.done():
+            self._cancel_requested = True
+            consumer.cancel()
+
+    def consume_cancel(self) -> bool:
+        """
+        在流生成器捕获到 CancelledError 时调用。
+        如果取消是本监听器发起的，撤销任务上的取消请求；返回是否已检测到客户端断开。
+        """
+        if self._cancel_requested and self._consumer is not None:
+            self._cancel_requested = False
+            # Task.uncancel() 只在 Python 3.11+ 提供；3.10 的任务没有取消计数，
+            # 被捕获的 CancelledError 不会再次抛出，清除本监听器的标志即可
+            uncancel = getattr(self._consumer, "uncancel", None)
+            if uncancel is not None:
+                uncancel()
+        return self.disconnected
+
+    async def guard(self, source: AsyncIterable[Any]) -> AsyncIterator[Any]:
+        """
+        包装上游异步迭代器，标记流生成器何时在等待上游数据。
+        只有在等待上游时才会被取消；数据块正在写给客户端时发生的断开，在请求下一个上游数据块之前处理。
+        """
+        iterator = source.__aiter__()
+        try:
+            while True:
+                if self.disconnected:
+                    # 断开发生在数据块写给客户端期间：不再向上游请求下一个数据块
+                    raise asyncio.CancelledError()
+                self.awaiting_upstream = True
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    self.awaiting_upstream = False
+                yield item
+        finally:
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+class StreamCancellationStats:
+    """
+    统计因客户端断开而提前结束的流。
+    节省的 Token 按剩余的输出预算 (max_tokens 或模型输出上限减去已生成的 Token) 计算，是上限估计。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.cancelled_streams = 0  # 提前结束的流数
+        self.output_tokens_generated = 0  # 这些流在断开前已生成的输出 Token (估算)
+        self.output_tokens_saved = 0  # 剩余输出预算之和 (上限估计)
+
+    def record(self, generated_tokens: int, saved_tokens: int) -> None:
+        """记录一个因客户端断开而提前结束的流。"""
+        with self._lock:
+            self.cancelled_streams += 1
+            self.output_tokens_generated += max(0, generated_tokens)
+            self.output_tokens_saved += max(0, saved_tokens)
+
+    def get_stats(self) -> Dict[str, int]:
+        """返回统计数据。"""
+        with self._lock:
+            return {
+                "cancelled_streams": self.cancelled_streams,
+                "output_tokens_generated": self.output_tokens_generated,
+                "output_tokens_saved": self.output_tokens_saved,
+            }
+
+    def reset(self) -> None:
+        """清空统计 (主要用于测试)。"""
+        with self._lock:
+            self.cancelled_streams = 0
+            self.output_tokens_generated = 0
+            self.output_tokens_saved = 0
+
+
+# 全局统计实例
+stream_cancellation_stats = StreamCancellationStats()
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+/v1/embeddings 的服务端微批处理与内容哈希向量缓存。
+
+RAG 索引程序会发送大量只含一两段短文本的嵌入请求，逐个转发会让每段文本都消耗一次 RPM。
+本模块把同一模型 (及相同输出维度) 的并发请求合并成 batchEmbedContents 调用：
+- 文本先按 (模型, 维度, 文本) 的内容哈希查询向量缓存 (EMBEDDING_CACHE_SIZE 条的 LRU)，命中的直接返回；
+- 未命中的文本进入该模型的待发批次；批次达到 EMBEDDING_MAX_BATCH_SIZE 条时立即发送，
+  否则在第一条文本入队 EMBEDDING_MAX_LINGER_MS 毫秒后发送；
+- 同一段文本在批次中或正在上游计算时再次出现，直接等待同一个结果，不重复发送；
+- 批次结果按顺序分发给各个调用方；批次失败时，批次内所有文本的调用方收到同一个异常。
+一次上游调用只占用一个 Key 的一次 RPM，RPM 消耗按平均批大小 (batch_factor) 成比例下降。
+"""
+
+import asyncio  # 批次定时与结果分发
+import hashlib  # 内容哈希
+import logging  # 日志
+import threading  # 保护统计计数
+import time  # 调用耗时
+import uuid  # 请求 ID
+from collections import Counter  # 按 IP 汇总 Token
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import httpx
+from fastapi import HTTPException, status
+
+from gap import config  # 应用配置
+from gap.core.keys.admission import DEFAULT_PRIORITY, admission_queue  # 准入等待队列
+from gap.core.keys.manager import APIKeyManager
+from gap.core.processing.attempt_context import AttemptContext
+from gap.core.processing.error_handler import _handle_api_call_exception
+from gap.core.processing.token_estimate import estimate_text_tokens
+from gap.core.processing.utils import update_token_counts
+from gap.core.services.gemini import GeminiClient
+from gap.core.utils.lru import LRUMap  # 线程安全的有界 LRU 映射
+from gap.core.utils.request_helpers import get_current_timestamps
+
+logger = logging.getLogger("my_logger")
+
+# 对一个批次调用上游的函数：(模型, 输出维度, 文本列表, 各文本来源 IP) -> 向量列表 (顺序与文本一致)
+EmbedFunction = Callable[
+    [str, Optional[int], List[str], List[str]], Awaitable[List[List[float]]]
+]
+
+
+def embedding_cache_key(model_name: str, dimensions: Optional[int], text: str) -> str:
+    """向量缓存的键：(模型, 输出维度, 文本) 的内容哈希。"""
+    return hashlib.blake2b(
+        f"{model_name}\0{dimensions or 0}\0{text}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def estimate_embedding_tokens(texts: Sequence[str]) -> int:
+    """估算一组文本的输入 Token 数 (batchEmbedContents 不返回用量)。"""
+    return sum(max(1, int(estimate_text_tokens(text) + 0.5)) for text in texts)
+
+
+class _PendingBatch:
+    """一个模型 (及输出维度) 正在收集中的批次。"""
+
+    __slots__ = ("texts", "client_ips", "futures", "embed_fn", "timer")
+
+    def __init__(self, embed_fn: EmbedFunction):
+        self.texts: List[str] = []
+        self.client_ips: List[str] = []
+        self.futures: Dict[str, asyncio.Future] = {}  # 内容哈希 -> 结果
+        self.embed_fn = embed_fn
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """
+    按模型合并并发嵌入请求的微批处理器 (带内容哈希向量缓存)。在事件循环中使用。
+
+    Attributes:
+        inputs (int): 调用方请求的文本总数。
+        cache_hits (int): 向量缓存命中的文本数。
+        coalesced (int): 与批次中或正在计算的相同文本合并的文本数。
+        upstream_calls (int): 发出的 batchEmbedContents 调用次数。
+        upstream_texts (int): 发往上游的文本总数。
+        failures (int): 失败的上游批次数。
+    """
+
+    def __init__(
+        self,
+        max_batch_size: Optional[int] = None,
+        max_linger_ms: Optional[float] = None,
+        cache_size: Optional[int] = None,
+    ):
+        self.max_batch_size = max(
+            1,
+            (
+                max_batch_size
+                if max_batch_size is not None
+                else config.EMBEDDING_MAX_BATCH_SIZE
+            ),
+        )
+        self.max_linger_seconds = (
+            max_linger_ms
+            if max_linger_ms is not None
+            else config.EMBEDDING_MAX_LINGER_MS
+        ) / 1000.0
+        cache_size = (
+            cache_size if cache_size is not None else config.EMBEDDING_CACHE_SIZE
+        )
+        self._cache: Optional[LRUMap[List[float]]] = (
+            LRUMap(cache_size) if cache_size > 0 else None
+        )
+        self._pending: Dict[Tuple[str, Optional[int]], _PendingBatch] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}  # 已发往上游、尚未返回的文本
+        self._tasks: Set[asyncio.Task] = set()  # 持有发送任务的引用，防止被回收
+        self._lock = threading.Lock()
+        self.inputs = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_texts = 0
+        self.failures = 0
+
+    async def embed(
+        self,
+        model_name: str,
+        texts: Sequence[str],
+        embed_fn: EmbedFunction,
+        dimensions: Optional[int] = None,
+        client_ip: str = "Unknown",
+    ) -> List[List[float]]:
+        """
+        返回 texts 的向量 (顺序一致)。未命中缓存的文本与其他调用方的文本合并发送。
+
+        Args:
+            model_name (str): 嵌入模型名称。
+            texts (Sequence[str]): 要计算向量的文本。
+            embed_fn (EmbedFunction): 对一个批次调用上游的函数 (批次使用第一个入队者提供的函数)。
+            dimensions (Optional[int]): 输出维度，None 表示模型默认维度。
+            client_ip (str): 调用方 IP，用于按 IP 记录 Token 消耗。
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        waits: List[Tuple[int, asyncio.Future]] = []
+        hits = coalesced = 0
+        for index, text in enumerate(texts):
+            digest = embedding_cache_key(model_name, dimensions, text)
+            if self._cache is not None:
+                cached = self._cache.get(digest, None)
+                if cached is not None:
+                    results[index] = cached  # type: ignore[assignment]
+                    hits += 1
+                    continue
+            future, is_new = self._enqueue(
+                model_name, dimensions, text, digest, embed_fn, client_ip
+            )
+            coalesced += not is_new
+            waits.append((index, future))
+        with self._lock:
+            self.inputs += len(texts)
+            self.cache_hits += hits
+            self.coalesced += coalesced
+        if waits:
+            # 结果被多个调用方共享：单个调用方被取消时不能取消共享的结果
+            vectors = await asyncio.gather(*(asyncio.shield(f) for _, f in waits))
+            for (index, _), vector in zip(waits, vectors):
+                results[index] = vector
+        return results  # type: ignore[return-value]
+
+    def _enqueue(
+        self,
+        model_name: str,
+        dimensions: Optional[int],
+        text: str,
+        digest: str,
+        embed_fn: EmbedFunction,
+        client_ip: str,
+    ) -> Tuple[asyncio.Future, bool]:
+        """(内部方法) 把文本加入待发批次，返回 (结果, 是否为新文本)。"""
+        in_flight = self._in_flight.get(digest)
+        if in_flight is not None:
+            return in_flight, False
+        group = (model_name, dimensions)
+        batch = self._pending.get(group)
+        if batch is None:
+            batch = _PendingBatch(embed_fn)
+            self._pending[group] = batch
+        existing = batch.futures.get(digest)
+        if existing is not None:
+            return existing, False
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch.futures[digest] = future
+        batch.texts.append(text)
+        batch.client_ips.append(client_ip)
+        if len(batch.texts) >= self.max_batch_size:
+            self._flush(group)
+        elif batch.timer is None:
+            batch.timer = loop.call_later(self.max_linger_seconds, self._flush, group)
+        return future, True
+
+    def _flush(self, group: Tuple[str, Optional[int]]) -> None:
+        """(内部方法) 发送该分组的待发批次。"""
+        batch = self._pending.pop(group, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._in_flight.update(batch.futures)
+        task = asyncio.get_running_loop().create_task(self._send(group, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+        self, group: Tuple[str, Optional[int]], batch: _PendingBatch
+    ) -> None:
+        """(内部方法) 调用上游并把结果分发给等待者。"""
+        model_name, dimensions = group
+        digests = list(batch.futures)
+        with self._lock:
+            self.upstream_calls += 1
+            self.upstream_texts += len(batch.texts)
+        try:
+            vectors = await batch.embed_fn(
+                model_name, dimensions, batch.texts, batch.client_ips
+            )
+        except asyncio.CancelledError:
+            for digest in digests:
+                future = self._in_flight.pop(digest, None)
+                if future is not None:
+                    future.cancel()
+            raise
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            for digest in digests:
+                future = self._in_flight.pop(digest, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                    future.exception()  # 标记异常已被读取 (所有等待者都可能已取消)
+            return
+        for digest, vector in zip(digests, vectors):
+            if self._cache is not None:
+                self._cache.set(digest, vector)
+            future = self._in_flight.pop(digest, None)
+            if future is not None and not future.done():
+                future.set_result(vector)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回批处理和缓存统计；batch_factor 为平均每次上游调用合并的文本数。"""
+        with self._lock:
+            return {
+                "inputs": self.inputs,
+                "cache_hits": self.cache_hits,
+                "coalesced": self.coalesced,
+                "upstream_calls": self.upstream_calls,
+                "upstream_texts": self.upstream_texts,
+                "failures": self.failures,
+                "batch_factor": (
+                    round(self.upstream_texts / self.upstream_calls, 2)
+                    if self.upstream_calls
+                    else 0.0
+                ),
+                "cached_vectors": len(self._cache) if self._cache is not None else 0,
+                "max_batch_size": self.max_batch_size,
+                "max_linger_ms": self.max_linger_seconds * 1000.0,
+            }
+
+    def clear(self) -> None:
+        """清空向量缓存和统计 (待发和进行中的批次不受影响)。"""
+        if self._cache is not None:
+            self._cache.clear()
+        with self._lock:
+            self.inputs = self.cache_hits = self.coalesced = 0
+            self.upstream_calls = self.upstream_texts = self.failures = 0
+
+
+def key_pool_embedder(
+    key_manager: APIKeyManager, http_client: httpx.AsyncClient
+) -> EmbedFunction:
+    """
+    创建通过 Key 池调用 batchEmbedContents 的批次函数。
+
+    与聊天请求相同：按模型选择 Key (预留输入 Token 和并发名额)，失败时按错误类型决定是否换 Key 重试，
+    所有 Key 因容量不足暂时不可用时进入准入队列等待；成功后按来源 IP 记录 Token 消耗。
+    """
+
+    async def embed_batch(
+        model_name: str,
+        dimensions: Optional[int],
+        texts: List[str],
+        client_ips: List[str],
+    ) -> List[List[float]]:
+        request_id = f"emb_{uuid.uuid4().hex[:8]}"
+        limits = config.MODEL_LIMITS.get(model_name) or {}
+        tokens_by_ip: Counter = Counter()
+        for text, client_ip in zip(texts, client_ips):
+            tokens_by_ip[client_ip] += estimate_embedding_tokens([text])
+        estimated_tokens = sum(tokens_by_ip.values())
+        attempt_context = AttemptContext.create(
+            request_id=request_id,
+            max_attempts=key_manager.get_active_keys_count() + 1,
+            timeout_seconds=config.REQUEST_DEADLINE_SECONDS,
+            model_name=model_name,
+        )
+        admission_ticket = None
+        last_error_info: Optional[Dict[str, Any]] = None
+        try:
+            while attempt_context.start_attempt():
+                selected_key, _ = await key_manager.select_best_key(
+                    model_name=model_name,
+                    model_limits=limits,
+                    estimated_input_tokens=estimated_tokens,
+                    request_id=request_id,
+                    attempt_context=attempt_context,
+                )
+                if not selected_key:
+                    if attempt_context.capacity_retry_at is None:
+                        break
+                    if admission_ticket is None:
+                        admission_ticket = admission_queue.ticket(DEFAULT_PRIORITY)
+                    if not await admission_queue.wait(
+                        model_name,
+                        admission_ticket,
+                        retry_at=attempt_context.capacity_retry_at,
+                        deadline_seconds=attempt_context.remaining_seconds(),
+                    ):
+                        break
+                    attempt_context.refund_attempt()
+                    continue
+                if admission_ticket is not None and admission_ticket.notified:
+                    admission_ticket.notified = False
+                    admission_queue.notify(model_name)
+
+                call_started_at = time.monotonic()
+                try:
+                    vectors = await GeminiClient(
+                        selected_key, http_client
+                    ).batch_embed_contents(model_name, texts, dimensions)
+                except Exception as exc:
+                    last_error_info, needs_retry = await _handle_api_call_exception(
+                        exc=exc,
+                        current_api_key=selected_key,
+                        key_manager=key_manager,
+                        is_stream=False,
+                        request_id=request_id,
+                        model_name=model_name,
+                    )
+                    attempt_context.release_token_reservation()
+                    attempt_context.release_concurrency_permit()
+                    if needs_retry:
+                        continue
+                    break
+                attempt_context.release_concurrency_permit()
+                key_manager.record_call_outcome(
+                    selected_key,
+                    model_name,
+                    success=True,
+                    latency_seconds=time.monotonic() - call_started_at,
+                    limits=limits,
+                )
+                _, today_date_str_pt = get_current_timestamps()
+                reservation = attempt_context.take_token_reservation()
+                for client_ip, tokens in tokens_by_ip.items():
+                    update_token_counts(
+                        selected_key,
+                        model_name,
+                        limits,
+                        tokens,
+                        client_ip,
+                        today_date_str_pt,
+                        reservation=reservation,
+                    )
+                    reservation = None  # 预留只对账一次，其余 IP 的用量直接记入
+                logger.info(
+                    f"嵌入批次 {request_id}: {len(texts)} 条文本 (Key: {selected_key[:8]}..., Model: {model_name})"
+                )
+                return vectors
+        finally:
+            attempt_context.release_token_reservation()
+            attempt_context.release_concurrency_permit()
+
+        raw_status = (last_error_info or {}).get(
+            "code", status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        try:
+            status_code = int(raw_status)
+        except (TypeError, ValueError):
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        raise HTTPException(
+            status_code=status_code,
+            detail=(last_error_info or {}).get(
+                "message", "所有可用 API Key 均尝试失败或达到限制。"
+            ),
+        )
+
+    return embed_batch
+
+
+# 全局实例
+embedding_batcher = EmbeddingBatcher()
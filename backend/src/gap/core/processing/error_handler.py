@@ -57,6 +57,49 @@ def _format_api_error(http_err: httpx.HTTPStatusError) -> Tuple[str, int]:
     return error_message, status_code
 
 
+def _parse_retry_delay(http_error: httpx.HTTPStatusError) -> Optional[float]:
+    """
+    (内部辅助函数) 从错误响应中解析上游建议的重试间隔 (秒)。
+    依次检查 Google API 错误详情中的 RetryInfo.retryDelay (例如 "31s") 和 Retry-After 响应头。
+
+    Returns:
+        Optional[float]: 建议的重试间隔秒数；无法解析时返回 None。
+    """
+    try:
+        error_detail = http_error.response.json()
+        for detail in (error_detail or {}).get("error", {}).get("details", []):
+            if detail.get("@type") == "type.googleapis.com/google.rpc.RetryInfo":
+                retry_delay = str(detail.get("retryDelay", "")).rstrip("s")
+                if retry_delay:
+                    return float(retry_delay)
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        pass
+    retry_after = http_error.response.headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+
+def _quarantine_key(
+    key_manager: APIKeyManager,
+    api_key: str,
+    model_name: Optional[str],
+    issue_type: str,
+    retry_after_seconds: Optional[float] = None,
+) -> None:
+    """
+    (内部辅助函数) 隔离出现可恢复错误 (限流、服务端错误、超时、网络错误) 的 Key。
+    已知模型时断开该 (Key, 模型) 的熔断器 (指数退避 + 半开探测)；否则回退为整个 Key 临时不可用 60 秒。
+    """
+    if model_name:
+        key_manager.trip_circuit(api_key, model_name, issue_type, retry_after_seconds)
+    else:
+        key_manager.mark_key_temporarily_unavailable(
+            api_key, duration_seconds=60, issue_type=issue_type
+        )
+
+
 def _handle_429_daily_quota(
     http_error: httpx.HTTPStatusError,
     api_key: Optional[str],
@@ -122,11 +165,13 @@ async def _handle_http_error_in_attempt(
     key_manager: APIKeyManager,
     is_stream: bool,  # 标记是否为流式请求 (用于日志)
     request_id: Optional[str] = None,  # 请求 ID (用于日志)
+    model_name: Optional[str] = None,  # 模型名称 (用于熔断器)
 ) -> Tuple[Dict[str, Any], bool]:
     """
     (内部辅助函数) 处理在单次 API 调用尝试 (`_attempt_api_call`) 中发生的 `httpx.HTTPStatusError`。
     根据 HTTP 状态码判断错误类型，格式化错误信息，并决定是否需要重试（通常意味着尝试其他 Key）。
-    对于特定错误（如 429 每日配额、400 Key 无效、401/403），会调用 Key 管理器标记 Key 状态。
+    对于特定错误（如 429 每日配额、400 Key 无效、401/403），会调用 Key 管理器标记 Key 状态；
+    429 (非每日配额) 和 5xx 会断开该 (Key, 模型) 的熔断器。
 
     Args:
         http_err (httpx.HTTPStatusError): 捕获到的 HTTP 状态错误异常。
@@ -134,6 +179,7 @@ async def _handle_http_error_in_attempt(
         key_manager (APIKeyManager): Key 管理器实例。
         is_stream (bool): 当前请求是否为流式请求。
         request_id (Optional[str]): 当前请求的 ID。
+        model_name (Optional[str]): 当前请求的模型名称。
 
     Returns:
         Tuple[Dict[str, Any], bool]:
@@ -163,10 +209,14 @@ async def _handle_http_error_in_attempt(
         )
         needs_retry = True  # 这些通常是临时性问题，需要重试 (尝试其他 Key 或稍后重试)
         logger.warning(f"HTTP 状态码 {status_code} 表示服务器临时错误，标记需要重试。")
-        # 标记 Key 临时不可用
+        # 断开该 Key 在此模型下的熔断器
         if current_api_key:
-            key_manager.mark_key_temporarily_unavailable(
-                current_api_key, duration_seconds=60, issue_type=f"HTTP {status_code}"
+            _quarantine_key(
+                key_manager,
+                current_api_key,
+                model_name,
+                f"HTTP {status_code}",
+                _parse_retry_delay(http_err),
             )
 
     elif status_code == 429:  # 请求过多 (速率限制或配额)
@@ -184,10 +234,14 @@ async def _handle_http_error_in_attempt(
             logger.warning(
                 "HTTP 状态码 429 (非每日配额) 表示当前 Key 速率限制，标记无需重试。"
             )
-            # 仍然标记 Key 临时不可用，以便 Key 选择器避开
+            # 断开该 Key 在此模型下的熔断器，以便 Key 选择器避开 (退避不短于上游建议的重试间隔)
             if current_api_key:
-                key_manager.mark_key_temporarily_unavailable(
-                    current_api_key, duration_seconds=60, issue_type="Rate Limit (429)"
+                _quarantine_key(
+                    key_manager,
+                    current_api_key,
+                    model_name,
+                    "Rate Limit (429)",
+                    _parse_retry_delay(http_err),
                 )
 
     elif status_code in [401, 403]:  # 未授权或禁止访问
@@ -237,10 +291,13 @@ async def _handle_api_call_exception(
     key_manager: APIKeyManager,
     is_stream: bool,
     request_id: Optional[str] = None,
+    model_name: Optional[str] = None,
 ) -> Tuple[Dict[str, Any], bool]:
     """
     (内部辅助函数) 统一处理在 `_attempt_api_call` 中捕获到的各类异常。
     根据异常类型调用不同的处理逻辑，格式化错误信息，并决定是否需要重试。
+    如果提供了模型名称，与 Key 相关的失败 (限流、服务端错误、认证错误、超时、网络错误)
+    会被记录到 Key 健康度评分中。
 
     Args:
         exc (Exception): 捕获到的异常对象。
@@ -248,6 +305,7 @@ async def _handle_api_call_exception(
         key_manager (APIKeyManager): Key 管理器实例。
         is_stream (bool): 当前请求是否为流式请求。
         request_id (Optional[str]): 当前请求的 ID。
+        model_name (Optional[str]): 当前请求的模型名称 (用于记录 Key 健康度)。
 
     Returns:
         Tuple[Dict[str, Any], bool]:
@@ -264,7 +322,7 @@ async def _handle_api_call_exception(
     if isinstance(exc, httpx.HTTPStatusError):  # --- 处理 HTTP 状态错误 ---
         # 调用专门处理 HTTP 错误的函数
         error_info, needs_retry = await _handle_http_error_in_attempt(
-            exc, current_api_key, key_manager, is_stream, request_id
+            exc, current_api_key, key_manager, is_stream, request_id, model_name
         )
     elif isinstance(exc, httpx.TimeoutException):  # --- 处理请求超时 ---
         error_message = f"请求超时 (Key: {current_api_key[:8] if current_api_key else 'N/A'}, Request: {request_id}): {exc}"
@@ -273,11 +331,9 @@ async def _handle_api_call_exception(
         error_info["type"] = "timeout_error"
         error_info["code"] = 504  # Gateway Timeout
         needs_retry = True  # 超时通常是临时问题，需要重试
-        # 标记 Key 临时不可用
+        # 断开该 Key 在此模型下的熔断器
         if current_api_key:
-            key_manager.mark_key_temporarily_unavailable(
-                current_api_key, duration_seconds=60, issue_type="Timeout"
-            )
+            _quarantine_key(key_manager, current_api_key, model_name, "Timeout")
     elif isinstance(exc, httpx.RequestError):  # --- 处理其他网络请求错误 ---
         error_message = f"网络连接错误 (Key: {current_api_key[:8] if current_api_key else 'N/A'}, Request: {request_id}): {exc}"
         logger.error(error_message)  # 记录错误
@@ -285,10 +341,10 @@ async def _handle_api_call_exception(
         error_info["type"] = "connection_error"
         error_info["code"] = 503  # Service Unavailable
         needs_retry = True  # 网络问题通常是临时的，需要重试
-        # 标记 Key 临时不可用
+        # 断开该 Key 在此模型下的熔断器
         if current_api_key:
-            key_manager.mark_key_temporarily_unavailable(
-                current_api_key, duration_seconds=60, issue_type="Connection Error"
+            _quarantine_key(
+                key_manager, current_api_key, model_name, "Connection Error"
             )
     else:  # --- 处理其他所有未预料到的异常 ---
         error_message = f"API 调用中发生未知内部错误 (Key: {current_api_key[:8] if current_api_key else 'N/A'}, Request: {request_id}): {exc}"
@@ -298,6 +354,20 @@ async def _handle_api_call_exception(
         error_info["code"] = 500
         needs_retry = False  # 未知内部错误通常不建议自动重试
 
+    # --- 记录到 Key 健康度评分 ---
+    # 请求体问题 (非 Key 无效的 400) 和内部错误与 Key 本身无关，不计入 Key 的失败
+    key_related_failure = error_info["type"] not in (
+        "invalid_request_error",
+        "internal_error",
+    ) or "API key not valid" in str(error_info["message"])
+    if current_api_key and model_name and key_related_failure:
+        key_manager.record_call_outcome(
+            current_api_key,
+            model_name,
+            success=False,
+            status_code=error_info["code"],
+        )
+
     return error_info, needs_retry
 
 
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import logging
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
+import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from gap import config
 from gap.core.keys.manager import APIKeyManager
-from gap.core.processing.utils import estimate_token_count, truncate_context
+from gap.core.processing.attempt_context import AttemptContext
+from gap.core.processing.token_count import upstream_token_counter
+from gap.core.processing.token_estimate import TokenEstimateCache
+from gap.core.processing.utils import truncate_context
+from gap.core.services.gemini import GeminiClient
 
 logger = logging.getLogger("my_logger")
 
@@ -21,10 +27,22 @@ async def select_and_prepare_key(
     request_id: str,
     cached_content_id: Optional[str],
     db: AsyncSession,
+    attempt_context: Optional[AttemptContext] = None,
+    http_client: Optional[httpx.AsyncClient] = None,
 ) -> Tuple[Optional[str], List[Dict[str, Any]], bool]:
     """
     Selects the best API key and prepares the content (including dynamic truncation).
 
+    When an ``attempt_context`` is given, keys already tried by this request are
+    excluded, the selected key and its input-token reservation are recorded in it,
+    and the input token estimate is computed only once per request. Per-message
+    estimates are cached on the context and reused by dynamic truncation. The
+    reservation is released again if the key has to be skipped.
+
+    With ``ENABLE_UPSTREAM_TOKEN_COUNT`` and an ``http_client``, borderline
+    truncation decisions use the selected key to call countTokens (see
+    ``token_count.UpstreamTokenCounter``).
+
     Returns:
         Tuple[Optional[str], List[Dict[str, Any]], bool]:
         - selected_key: The selected API key (or None).
@@ -32,7 +50,19 @@ async def select_and_prepare_key(
         - should_skip: Whether the selected key should be skipped (e.g. due to context limit).
     """
     merged_contents_for_estimation = initial_contents + gemini_contents
-    estimated_input_tokens = estimate_token_count(merged_contents_for_estimation)
+    token_estimates = (
+        attempt_context.token_estimates
+        if attempt_context is not None
+        else TokenEstimateCache(model_name)
+    )
+    if attempt_context is not None:
+        estimated_input_tokens = attempt_context.get_estimated_input_tokens(
+            merged_contents_for_estimation, token_estimates.estimate
+        )
+    else:
+        estimated_input_tokens = token_estimates.estimate(
+            merged_contents_for_estimation
+        )
     logger.debug(
         f"Request {request_id}: Estimated input tokens: {estimated_input_tokens}"
     )
@@ -46,6 +76,7 @@ async def select_and_prepare_key(
         request_id=request_id,
         cached_content_id=cached_content_id,
         db=db,
+        attempt_context=attempt_context,
     )
 
     if not selected_key:
@@ -62,16 +93,45 @@ async def select_and_prepare_key(
             contents=merged_contents_for_api,
             model_name=model_name,
             dynamic_max_tokens_limit=dynamic_limit_for_truncation,
+            token_estimates=token_estimates,
+            precise_counter=_build_precise_counter(
+                selected_key, model_name, http_client, token_estimates
+            ),
         )
     )
 
     if context_over_limit_after_truncation:
         logger.error(
-            f"Request {request_id}: Context over limit after dynamic truncation ({estimate_token_count(truncated_contents_for_api)} tokens). Skipping key."
+            f"Request {request_id}: Context over limit after dynamic truncation ({token_estimates.estimate(truncated_contents_for_api)} tokens). Skipping key."
         )
         key_manager.record_selection_reason(
             selected_key, "Context Over Limit After Dynamic Truncation", request_id
         )
+        if attempt_context is not None:
+            attempt_context.release_token_reservation()
+            attempt_context.release_concurrency_permit()
         return selected_key, [], True
 
     return selected_key, truncated_contents_for_api, False
+
+
+def _build_precise_counter(
+    api_key: str,
+    model_name: str,
+    http_client: Optional[httpx.AsyncClient],
+    token_estimates: TokenEstimateCache,
+) -> Optional[Callable[[List[Dict[str, Any]]], Awaitable[Optional[int]]]]:
+    """Returns a countTokens-backed counter for truncate_context, or None if disabled."""
+    if not config.ENABLE_UPSTREAM_TOKEN_COUNT or http_client is None:
+        return None
+    client = GeminiClient(api_key, http_client)
+
+    async def count_suffix(suffix: List[Dict[str, Any]]) -> int:
+        return await client.count_tokens(model_name, suffix)
+
+    async def precise_counter(contents: List[Dict[str, Any]]) -> Optional[int]:
+        return await upstream_token_counter.count(
+            model_name, contents, count_suffix, token_estimates
+        )
+
+    return precise_counter
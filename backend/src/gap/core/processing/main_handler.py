@@ -14,10 +14,11 @@
 import asyncio
 import logging
 import uuid
-from typing import Any, Dict, Literal
+from typing import Any, Dict, Literal, Optional
 
 import httpx
 from fastapi import Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from gap import config
@@ -29,16 +30,27 @@ from gap.core.dependencies import (
     get_http_client,
     get_key_manager,
 )
+from gap.core.keys.admission import (
+    ADMIN_PRIORITY,
+    DEFAULT_PRIORITY,
+    admission_queue,
+)
 from gap.core.keys.manager import APIKeyManager
 from gap.core.processing.api_caller import attempt_api_call
+from gap.core.processing.attempt_context import AttemptContext
 from gap.core.processing.key_selection import select_and_prepare_key
 from gap.core.processing.post_processing import handle_post_processing
 from gap.core.processing.request_prep import (
     prepare_context_and_messages,
     validate_model_name,
 )
+from gap.core.processing.response_cache import (
+    is_cacheable_request,
+    replay_as_sse,
+    response_cache,
+)
+from gap.core.processing.single_flight import request_coalescer, request_fingerprint
 from gap.core.context.store import ContextStore
-from gap.core.processing.utils import estimate_token_count
 from gap.core.security.rate_limit import protect_from_abuse
 from gap.core.tracking import track_cache_hit, track_cache_miss
 from gap.core.utils.request_helpers import get_client_ip, get_current_timestamps
@@ -56,11 +68,26 @@ async def process_request(
     http_client: httpx.AsyncClient = Depends(get_http_client),
     cache_manager_instance: CacheManager = Depends(get_cache_manager),
     db: AsyncSession = Depends(get_db_session),
+    enforce_ip_limits: bool = True,
+    wait_for_capacity: bool = True,
+    outcome: Optional[Dict[str, Any]] = None,
 ):
     """
     处理来自 API 端点的聊天补全请求的核心逻辑。
     负责：上下文加载、消息转换、缓存查找、Key 选择、API 调用尝试与重试、
     结果处理、Token 计数更新、上下文保存等。
+
+    批处理任务 (gap.core.processing.batch) 复用同一流程，并通过以下参数调整行为：
+    enforce_ip_limits 为 False 时跳过按 IP 的滥用检查 (批处理在提交时已经过认证，
+    条目不应占用提交者的 IP 配额)；wait_for_capacity 为 False 时所有 Key 饱和后不进入准入队列，
+    直接返回 503，由调用方自行退避；outcome 不为 None 时，成功后写入 "api_key" (实际使用的 Key)。
+
+    启用 ENABLE_REQUEST_COALESCING 时，同时进行中的相同非流式请求只由第一个请求选择 Key 并调用上游，
+    其余请求等待其结果 (最多 REQUEST_COALESCING_MAX_WAIT_SECONDS 秒) 并各自完成后处理。
+    领导者不等待容量 (wait_for_capacity 为 False) 且因 429/503 失败时，跟随者不接收该错误，各自调用上游。
+
+    启用 ENABLE_RESPONSE_CACHE 时，temperature 为 0 (或通过 RESPONSE_CACHE_HEADER 显式启用) 的请求
+    先查找响应缓存，命中时不调用上游，流式请求以 SSE 重放缓存的结果；未命中时成功的结果写入缓存。
     """
     # --- 初始化和信息提取 ---
     key_config = auth_data.get("config", {})
@@ -73,18 +100,19 @@ async def process_request(
     log_request_start(request_id, request_type, model_name)
 
     # --- 初始 IP 速率限制检查 ---
-    try:
-        await protect_from_abuse(
-            http_request,
-            config.MAX_REQUESTS_PER_MINUTE,
-            config.MAX_REQUESTS_PER_DAY_PER_IP,
-        )
-        logger.debug(f"请求 {request_id}: IP {client_ip} 通过滥用检查。")
-    except HTTPException as ip_limit_exc:
-        logger.warning(
-            f"请求 {request_id}: IP {client_ip} 未通过滥用检查: {ip_limit_exc.detail}"
-        )
-        raise ip_limit_exc
+    if enforce_ip_limits:
+        try:
+            await protect_from_abuse(
+                http_request,
+                config.MAX_REQUESTS_PER_MINUTE,
+                config.MAX_REQUESTS_PER_DAY_PER_IP,
+            )
+            logger.debug(f"请求 {request_id}: IP {client_ip} 通过滥用检查。")
+        except HTTPException as ip_limit_exc:
+            logger.warning(
+                f"请求 {request_id}: IP {client_ip} 未通过滥用检查: {ip_limit_exc.detail}"
+            )
+            raise ip_limit_exc
 
     # --- 模型名称规范化和验证 ---
     model_name = validate_model_name(model_name, request_id)
@@ -119,6 +147,14 @@ async def process_request(
         )
     )
 
+    # --- 创建本请求独立的尝试上下文 (已尝试 Key、尝试预算、截止时间、Token 估算) ---
+    attempt_context = AttemptContext.create(
+        request_id=request_id,
+        max_attempts=key_manager.get_active_keys_count() + 1,
+        timeout_seconds=config.REQUEST_DEADLINE_SECONDS,
+        model_name=model_name,
+    )
+
     # --- 原生缓存查找逻辑 ---
     cached_content_id_to_use = None
     content_to_cache_on_success = None
@@ -136,7 +172,10 @@ async def process_request(
                 track_cache_hit(
                     request_id,
                     cached_content_id_to_use,
-                    estimate_token_count(initial_contents + gemini_contents),
+                    attempt_context.get_estimated_input_tokens(
+                        initial_contents + gemini_contents,
+                        attempt_context.token_estimates.estimate,
+                    ),
                 )
             else:
                 content_to_cache_on_success = {
@@ -160,116 +199,268 @@ async def process_request(
             f"请求 {request_id}: 原生缓存已启用但未提供 user_id，无法进行缓存查找或创建。"
         )
 
-    # --- Key 选择与 API 调用重试循环 ---
-    max_attempts = key_manager.get_active_keys_count() + 1
-    attempt_count = 0
-    last_error_info = None
-
-    key_manager.tried_keys_for_request.clear()
-    logger.debug(f"请求 {request_id}: 重置已尝试 Key 列表。")
-
-    while attempt_count < max_attempts:
-        attempt_count += 1
-        logger.info(
-            f"请求 {request_id}: 尝试 API 调用 (尝试 {attempt_count}/{max_attempts})"
+    # --- 确定性响应缓存 ---
+    response_cache_key = None  # 非 None 时本请求使用响应缓存
+    if (
+        config.ENABLE_RESPONSE_CACHE
+        and not enable_native_caching
+        and is_cacheable_request(
+            chat_request, http_request.headers.get(config.RESPONSE_CACHE_HEADER)
         )
-
-        # --- 选择最佳 API Key 并准备内容 ---
-        selected_key, truncated_contents_for_api, should_skip = (
-            await select_and_prepare_key(
-                key_manager=key_manager,
-                model_name=model_name,
-                limits=limits,
-                initial_contents=initial_contents,
-                gemini_contents=gemini_contents,
-                user_id=chat_request.user_id,
-                enable_sticky_session=config.ENABLE_STICKY_SESSION,
-                request_id=request_id,
-                cached_content_id=cached_content_id_to_use,
-                db=db,
-            )
-        )
-
-        if should_skip:
-            if selected_key is not None:
-                key_manager.tried_keys_for_request.add(selected_key)
-            continue
-
-        if not selected_key:
-            logger.warning(
-                f"请求 {request_id}: 第 {attempt_count} 次尝试未找到可用 Key。"
-            )
-            last_error_info = {
-                "message": "所有可用 API Key 均尝试失败或达到限制。",
-                "type": "key_error",
-                "code": status.HTTP_503_SERVICE_UNAVAILABLE,
-            }
-            await asyncio.sleep(0.5)
-            continue
-
-        # --- 尝试调用 API ---
-        response, error_info, needs_retry = await attempt_api_call(
-            chat_request=chat_request,
-            contents=truncated_contents_for_api,
-            system_instruction=system_instruction,
-            current_api_key=selected_key,
-            http_client=http_client,
-            key_manager=key_manager,
-            model_name=model_name,
-            limits=limits,
-            client_ip=client_ip,
-            today_date_str_pt=today_date_str_pt,
-            enable_native_caching=enable_native_caching,
-            cache_manager_instance=cache_manager_instance,
-            request_id=request_id,
-            cached_content_id_to_use=cached_content_id_to_use,
-            content_to_cache_on_success=content_to_cache_on_success,
-            user_id=chat_request.user_id,
-            db=db,
-            context_store=context_store,
+    ):
+        response_cache_key = request_fingerprint(
+            model_name,
+            initial_contents + gemini_contents,
+            system_instruction,
+            chat_request,
         )
-
-        # --- 处理 API 调用结果 ---
-        if response:
+        cached_response = await response_cache.get(response_cache_key)
+        if cached_response is not None:
             logger.info(
-                f"请求 {request_id}: API 调用成功 (Key: {selected_key[:8]}..., 尝试 {attempt_count})"
+                f"请求 {request_id}: 响应缓存命中 (指纹 {response_cache_key[:12]})，不调用上游。"
             )
-
-            # --- 后处理 (用户关联更新, 上下文保存) ---
             await handle_post_processing(
-                response=response,
+                response=cached_response,
                 request_type=request_type,
                 chat_request=chat_request,
-                selected_key=selected_key,
+                selected_key=None,
                 model_name=model_name,
-                merged_contents=initial_contents
-                + gemini_contents,  # Use original merged contents for context saving
+                merged_contents=initial_contents + gemini_contents,
                 enable_native_caching=enable_native_caching,
                 enable_context=enable_context,
                 key_manager=key_manager,
                 db=db,
                 request_id=request_id,
                 context_store=context_store,
+                token_estimates=attempt_context.token_estimates,
             )
+            if request_type == "stream":
+                return StreamingResponse(
+                    replay_as_sse(cached_response), media_type="text/event-stream"
+                )
+            return cached_response
 
-            return response
+    # --- 相同非流式请求合并 (single-flight) ---
+    flight: Optional[asyncio.Future] = None  # 本请求作为领导者登记的 Future
+    flight_key = None
+    if (
+        request_type == "non-stream"
+        and config.ENABLE_REQUEST_COALESCING
+        and not enable_native_caching
+        and (
+            chat_request.temperature == 0
+            or not config.REQUEST_COALESCING_DETERMINISTIC_ONLY
+        )
+    ):
+        flight_key = response_cache_key or request_fingerprint(
+            model_name,
+            initial_contents + gemini_contents,
+            system_instruction,
+            chat_request,
+        )
+        while True:
+            flight, is_leader = request_coalescer.join(flight_key)
+            if is_leader:
+                break
+            logger.info(
+                f"请求 {request_id}: 相同请求正在进行中，等待其结果 (指纹 {flight_key[:12]})。"
+            )
+            shared = await request_coalescer.follow(
+                flight, config.REQUEST_COALESCING_MAX_WAIT_SECONDS
+            )
+            if shared is not None:
+                shared_response, shared_key = shared
+                response = shared_response.model_copy(deep=True)
+                await handle_post_processing(
+                    response=response,
+                    request_type=request_type,
+                    chat_request=chat_request,
+                    selected_key=shared_key,
+                    model_name=model_name,
+                    merged_contents=initial_contents + gemini_contents,
+                    enable_native_caching=enable_native_caching,
+                    enable_context=enable_context,
+                    key_manager=key_manager,
+                    db=db,
+                    request_id=request_id,
+                    context_store=context_store,
+                    token_estimates=attempt_context.token_estimates,
+                )
+                if outcome is not None:
+                    outcome["api_key"] = shared_key
+                return response
+            if not flight.done():
+                # 等待超时：不再等待，自行调用上游
+                logger.warning(
+                    f"请求 {request_id}: 等待相同请求的结果超时，自行调用上游。"
+                )
+                flight = None
+                break
+            # 领导者未给出结果就结束：重新登记，可能成为新的领导者
 
-        elif needs_retry:
-            logger.warning(
-                f"请求 {request_id}: API 调用失败，需要重试 (Key: {selected_key[:8]}...). 错误: {error_info.get('message', '未知错误') if error_info else '未知错误'}"
+    # --- Key 选择与 API 调用重试循环 ---
+    last_error_info = None
+    admission_ticket = None  # 第一次需要等待容量时创建的准入队列凭证
+
+    try:
+        while attempt_context.start_attempt():
+            attempt_count = attempt_context.attempt_count
+            logger.info(
+                f"请求 {request_id}: 尝试 API 调用 (尝试 {attempt_count}/{attempt_context.max_attempts})"
             )
-            last_error_info = error_info
-            key_manager.tried_keys_for_request.add(selected_key)
-            continue
 
-        else:
-            logger.error(
-                f"请求 {request_id}: API 调用失败，无需重试 (Key: {selected_key[:8]}...). 错误: {error_info.get('message', '未知错误') if error_info else '未知错误'}"
+            # --- 选择最佳 API Key 并准备内容 ---
+            selected_key, truncated_contents_for_api, should_skip = (
+                await select_and_prepare_key(
+                    key_manager=key_manager,
+                    model_name=model_name,
+                    limits=limits,
+                    initial_contents=initial_contents,
+                    gemini_contents=gemini_contents,
+                    user_id=chat_request.user_id,
+                    enable_sticky_session=config.ENABLE_STICKY_SESSION,
+                    request_id=request_id,
+                    cached_content_id=cached_content_id_to_use,
+                    db=db,
+                    attempt_context=attempt_context,
+                    http_client=http_client,
+                )
+            )
+
+            if should_skip:
+                attempt_context.mark_tried(selected_key)
+                continue
+
+            if not selected_key:
+                logger.warning(
+                    f"请求 {request_id}: 第 {attempt_count} 次尝试未找到可用 Key。"
+                )
+                last_error_info = {
+                    "message": "所有可用 API Key 均尝试失败或达到限制。",
+                    "type": "key_error",
+                    "code": status.HTTP_503_SERVICE_UNAVAILABLE,
+                }
+                if attempt_context.capacity_retry_at is None:
+                    # 没有 Key 是因容量不足被跳过的 (全部已尝试或当天耗尽)，等待没有意义
+                    break
+                if not wait_for_capacity:
+                    # 调用方 (批处理) 自行退避，不占用交互请求的准入队列
+                    break
+                # 所有 Key 暂时饱和：进入准入队列，等待某个 Key 释放容量或到达最早恢复时间
+                if admission_ticket is None:
+                    admission_ticket = admission_queue.ticket(
+                        ADMIN_PRIORITY
+                        if auth_data.get("config", {}).get("is_admin")
+                        else DEFAULT_PRIORITY
+                    )
+                admitted = await admission_queue.wait(
+                    model_name,
+                    admission_ticket,
+                    retry_at=attempt_context.capacity_retry_at,
+                    deadline_seconds=attempt_context.remaining_seconds(),
+                )
+                if not admitted:
+                    logger.warning(
+                        f"请求 {request_id}: 准入队列已满或等待超时 (已等待 {admission_ticket.waited_seconds:.1f} 秒)。"
+                    )
+                    break
+                attempt_context.refund_attempt()  # 等待容量的这次选择不计入尝试预算
+                continue
+
+            if admission_ticket is not None and admission_ticket.notified:
+                # 被容量释放事件唤醒并选到了 Key：释放的容量可能不止一份，继续唤醒下一个等待者
+                admission_ticket.notified = False
+                admission_queue.notify(model_name)
+
+            # --- 尝试调用 API ---
+            response, error_info, needs_retry = await attempt_api_call(
+                chat_request=chat_request,
+                contents=truncated_contents_for_api,
+                system_instruction=system_instruction,
+                current_api_key=selected_key,
+                http_client=http_client,
+                key_manager=key_manager,
+                model_name=model_name,
+                limits=limits,
+                client_ip=client_ip,
+                today_date_str_pt=today_date_str_pt,
+                enable_native_caching=enable_native_caching,
+                cache_manager_instance=cache_manager_instance,
+                request_id=request_id,
+                cached_content_id_to_use=cached_content_id_to_use,
+                content_to_cache_on_success=content_to_cache_on_success,
+                user_id=chat_request.user_id,
+                db=db,
+                context_store=context_store,
+                attempt_context=attempt_context,
+                http_request=http_request,
+                response_cache_key=response_cache_key,
             )
-            last_error_info = error_info
-            break
+
+            # --- 处理 API 调用结果 ---
+            if response:
+                logger.info(
+                    f"请求 {request_id}: API 调用成功 (Key: {selected_key[:8]}..., 尝试 {attempt_count})"
+                )
+                if flight is not None:
+                    # 先把结果交给等待中的相同请求，再做本请求的后处理
+                    request_coalescer.resolve(
+                        flight_key, flight, (response, selected_key)
+                    )
+                if response_cache_key is not None and request_type == "non-stream":
+                    # 流式响应的结果由流生成器在流正常结束后写入缓存
+                    await response_cache.put(response_cache_key, response)
+
+                # --- 后处理 (用户关联更新, 上下文保存) ---
+                await handle_post_processing(
+                    response=response,
+                    request_type=request_type,
+                    chat_request=chat_request,
+                    selected_key=selected_key,
+                    model_name=model_name,
+                    merged_contents=initial_contents
+                    + gemini_contents,  # Use original merged contents for context saving
+                    enable_native_caching=enable_native_caching,
+                    enable_context=enable_context,
+                    key_manager=key_manager,
+                    db=db,
+                    request_id=request_id,
+                    context_store=context_store,
+                    token_estimates=attempt_context.token_estimates,
+                )
+
+                if outcome is not None:
+                    outcome["api_key"] = selected_key
+                return response
+
+            elif needs_retry:
+                logger.warning(
+                    f"请求 {request_id}: API 调用失败，需要重试 (Key: {selected_key[:8]}...). 错误: {error_info.get('message', '未知错误') if error_info else '未知错误'}"
+                )
+                last_error_info = error_info
+                continue
+
+            else:
+                logger.error(
+                    f"请求 {request_id}: API 调用失败，无需重试 (Key: {selected_key[:8]}...). 错误: {error_info.get('message', '未知错误') if error_info else '未知错误'}"
+                )
+                last_error_info = error_info
+                break
+    except BaseException:
+        if flight is not None:
+            # 领导者被取消或意外出错：等待中的相同请求各自调用上游
+            request_coalescer.abandon(flight_key, flight)
+        raise
+    finally:
+        # 未转交给调用结果结算的预留和并发名额 (例如请求在调用途中被取消) 全额退还
+        attempt_context.release_token_reservation()
+        attempt_context.release_concurrency_permit()
 
     # --- 循环结束仍未成功 ---
+    if attempt_context.is_expired():
+        logger.error(
+            f"请求 {request_id}: 已超过请求截止时间 ({config.REQUEST_DEADLINE_SECONDS} 秒)，停止重试。"
+        )
     logger.error(f"请求 {request_id}: 所有 API 调用尝试均失败。")
     error_detail = (
         last_error_info.get("message", "所有尝试均失败，无法处理请求。")
@@ -291,4 +482,14 @@ async def process_request(
     else:
         status_code_int = status.HTTP_503_SERVICE_UNAVAILABLE
 
-    raise HTTPException(status_code=status_code_int, detail=error_detail)
+    final_error = HTTPException(status_code=status_code_int, detail=error_detail)
+    if flight is not None:
+        if not wait_for_capacity and status_code_int in (
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        ):
+            # 领导者 (批处理) 不等待容量就放弃，这一容量错误不应交给跟随者：跟随者各自调用上游 (可进入准入队列)
+            request_coalescer.abandon(flight_key, flight)
+        else:
+            request_coalescer.reject(flight_key, flight, final_error)
+    raise final_error
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
-from typing import Any, Dict, List, Literal
+from typing import Any, Dict, List, Literal, Optional
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -8,6 +8,7 @@ from gap import config
 from gap.api.models import ChatCompletionResponse
 from gap.core.keys.manager import APIKeyManager
 from gap.core.context.store import ContextStore
+from gap.core.processing.token_estimate import TokenEstimateCache
 from gap.core.processing.utils import save_context_after_success
 
 logger = logging.getLogger("my_logger")
@@ -17,7 +18,7 @@ async def handle_post_processing(
     response: Any,
     request_type: Literal["stream", "non-stream"],
     chat_request: Any,
-    selected_key: str,
+    selected_key: Optional[str],
     model_name: str,
     merged_contents: List[Dict[str, Any]],
     enable_native_caching: bool,
@@ -26,15 +27,24 @@ async def handle_post_processing(
     db: AsyncSession,
     request_id: str,
     context_store: ContextStore | None = None,
+    token_estimates: TokenEstimateCache | None = None,
 ):
     """
     Handles post-processing tasks after a successful API call:
     - Updating user-key association.
-    - Saving context (for non-stream requests).
+    - Saving context (for non-stream requests, and for stream requests
+      replayed from the response cache when STREAM_SAVE_REPLY is enabled),
+      reusing the request's per-message token estimates for truncation.
+    ``selected_key`` is None for responses served from the response cache;
+    the user-key association is left unchanged in that case.
     """
 
     # 1. Update User-Key Association
-    if chat_request.user_id and config.KEY_STORAGE_MODE == "database":
+    if (
+        chat_request.user_id
+        and selected_key
+        and config.KEY_STORAGE_MODE == "database"
+    ):
         try:
             await key_manager.update_user_key_association(
                 db, chat_request.user_id, selected_key
@@ -75,6 +85,7 @@ async def handle_post_processing(
                     ),
                     db=db,
                     context_store=context_store,
+                    token_estimates=token_estimates,
                 )
             else:
                 logger.warning(
@@ -84,3 +95,42 @@ async def handle_post_processing(
             logger.warning(
                 f"Request {request_id}: Unexpected response type {type(response)}, skipping context save."
             )
+
+    # 3. Save Context (Stream replayed from the response cache, STREAM_SAVE_REPLY)
+    # A live stream saves its reply in the stream generator; a cache hit never
+    # runs the generator, so the replayed reply is saved here the same way.
+    if (
+        request_type == "stream"
+        and selected_key is None
+        and config.STREAM_SAVE_REPLY
+        and chat_request.user_id
+        and isinstance(response, ChatCompletionResponse)
+        and response.choices
+        and response.choices[0].message
+        and (
+            response.choices[0].message.content
+            or response.choices[0].message.tool_calls
+        )
+    ):
+        if not db:
+            logger.warning(
+                f"Request {request_id}: STREAM_SAVE_REPLY enabled but no database session, skipping context save."
+            )
+        else:
+            try:
+                await save_context_after_success(
+                    proxy_key=chat_request.user_id,
+                    contents_to_send=merged_contents,
+                    model_reply_content=response.choices[0].message.content or "",
+                    model_name=model_name,
+                    enable_context=True,
+                    final_tool_calls=response.choices[0].message.tool_calls,
+                    db=db,
+                    context_store=context_store,
+                    token_estimates=token_estimates,
+                )
+            except Exception as context_save_err:
+                logger.error(
+                    f"Request {request_id}: Failed to save replayed stream context: {context_save_err}",
+                    exc_info=True,
+                )
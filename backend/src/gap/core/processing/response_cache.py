@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+确定性请求的响应缓存。
+
+CacheManager 只管理 Gemini 原生缓存 (缓存发送给 Gemini 的消息)，不缓存模型输出。
+对于 temperature 为 0 的请求 (或通过 RESPONSE_CACHE_HEADER 请求头显式启用缓存的请求)，
+本模块按请求指纹 (模型、实际发送的 contents、系统指令和全部生成参数，见 single_flight.request_fingerprint)
+缓存完整的补全结果，重复的评测 / CI 提示词不再调用上游：
+- 第一级：进程内 LRU，按条目过期时间 (RESPONSE_CACHE_TTL_SECONDS) 和总字节数 (RESPONSE_CACHE_MAX_BYTES) 淘汰；
+- 第二级 (可选，RESPONSE_CACHE_BACKEND)："sqlite" 为本机文件，"redis" 可在多个 worker / 多台机器间共享。
+  第二级命中的条目会回填到第一级。
+流式请求命中时，把缓存的结果按 SSE 数据块重放；流式和非流式请求共用同一份缓存。
+只缓存正常结束 (finish_reason 为 STOP) 且有内容或工具调用的结果。
+"""
+
+import asyncio  # 导入异步 IO 库
+import logging  # 导入日志库
+import os  # 导入操作系统库
+import sqlite3  # 导入 SQLite (第二级缓存)
+import threading  # 导入线程库
+import time  # 导入时间库
+import uuid  # 导入 UUID 库
+from collections import OrderedDict  # 导入有序字典 (LRU)
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple  # 导入类型提示
+
+from gap import config  # 应用配置
+from gap.api.models import ChatCompletionRequest, ChatCompletionResponse  # 导入模型
+from gap.core.processing.sse_encoder import SSE_DONE, SSEChunkEncoder  # SSE 编码
+
+logger = logging.getLogger("my_logger")
+
+# 请求头取这些值时跳过缓存 (不查找也不写入)
+_BYPASS_VALUES = {"0", "false", "no", "off", "bypass"}
+# 请求头取这些值时，即使 temperature 不为 0 也使用缓存
+_OPT_IN_VALUES = {"1", "true", "yes", "on"}
+
+
+def is_cacheable_request(
+    chat_request: ChatCompletionRequest, header_value: Optional[str] = None
+) -> bool:
+    """
+    判断请求是否使用响应缓存。
+
+    Args:
+        chat_request (ChatCompletionRequest): 聊天请求。
+        header_value (Optional[str]): RESPONSE_CACHE_HEADER 请求头的值。
+
+    Returns:
+        bool: 请求头显式启用时为 True，显式跳过时为 False，否则仅 temperature 为 0 的单选项请求为 True。
+    """
+    if header_value is not None:
+        value = header_value.strip().lower()
+        if value in _BYPASS_VALUES:
+            return False
+        if value in _OPT_IN_VALUES:
+            return True
+    return chat_request.temperature == 0 and chat_request.n == 1
+
+
+def is_cacheable_response(response: ChatCompletionResponse) -> bool:
+    """只缓存正常结束且有文本或工具调用的结果 (截断、安全拦截等结果不缓存)。"""
+    if not response.choices:
+        return False
+    choice = response.choices[0]
+    if (choice.finish_reason or "").upper() != "STOP" or choice.message is None:
+        return False
+    return bool(choice.message.content or choice.message.tool_calls)
+
+
+async def replay_as_sse(
+    response: ChatCompletionResponse,
+) -> AsyncGenerator[bytes, None]:
+    """把缓存的补全结果按流式响应的数据块顺序重放：文本、工具调用、结束块和 [DONE] 标记。"""
+    encoder = SSEChunkEncoder(response.id, response.model, response.created)
+    choice = response.choices[0]
+    if choice.message is not None and choice.message.content:
+        yield encoder.content(choice.message.content)
+    if choice.message is not None and choice.message.tool_calls:
+        yield encoder.tool_calls(choice.message.tool_calls)
+    yield encoder.finish(choice.finish_reason)
+    yield SSE_DONE
+
+
+class ResponseCacheStore:
+    """
+    第二级缓存接口。方法均为同步操作，由 ResponseCache 在线程池中调用。
+    """
+
+    name = "base"
+
+    def get(self, key: str, now: float) -> Optional[Tuple[bytes, float]]:
+        """返回未过期的 (条目内容, 过期时间戳)，不存在时返回 None。"""
+        raise NotImplementedError
+
+    def set(self, key: str, payload: bytes, expires_at: float) -> None:
+        """写入条目，expires_at 之后失效。"""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """删除所有条目。"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """释放后端持有的资源。"""
+
+
+class SQLiteResponseStore(ResponseCacheStore):
+    """
+    基于本机 SQLite 文件的第二级缓存 (进程重启后仍然有效，同一台机器上的 worker 共享)。
+    过期条目在读取时删除，并每写入 PRUNE_EVERY 次批量清理一次。
+    """
+
+    name = "sqlite"
+    PRUNE_EVERY = 256
+
+    def __init__(self, path: Optional[str] = None):
+        path = path or config.RESPONSE_CACHE_SQLITE_PATH
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, payload BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._writes = 0
+
+    def get(self, key: str, now: float) -> Optional[Tuple[bytes, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return bytes(row[0]), row[1]
+
+    def set(self, key: str, payload: bytes, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, expires_at, payload) "
+                "VALUES (?, ?, ?)",
+                (key, expires_at, payload),
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),)
+                )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisResponseStore(ResponseCacheStore):
+    """基于 Redis 的第二级缓存，过期由 Redis 的 PX 处理，可在多台机器间共享。"""
+
+    name = "redis"
+
+    def __init__(self, url: Optional[str] = None, prefix: Optional[str] = None):
+        import redis  # 已是项目依赖
+
+        url = url or config.REDIS_URL
+        if not url:
+            raise ValueError("RESPONSE_CACHE_BACKEND=redis 需要设置 REDIS_URL")
+        self._prefix = config.RESPONSE_CACHE_REDIS_PREFIX if prefix is None else prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str, now: float) -> Optional[Tuple[bytes, float]]:
+        pipe = self._client.pipeline()
+        pipe.get(self._prefix + key)
+        pipe.pttl(self._prefix + key)
+        payload, ttl_ms = pipe.execute()
+        if payload is None:
+            return None
+        return payload, now + max(ttl_ms or 0, 0) / 1000.0
+
+    def set(self, key: str, payload: bytes, expires_at: float) -> None:
+        ttl_ms = int((expires_at - time.time()) * 1000)
+        if ttl_ms > 0:
+            self._client.set(self._prefix + key, payload, px=ttl_ms)
+
+    def clear(self) -> None:
+        keys = list(self._client.scan_iter(match=f"{self._prefix}*"))
+        if keys:
+            self._client.delete(*keys)
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_response_cache_store(
+    backend_name: Optional[str] = None,
+) -> Optional[ResponseCacheStore]:
+    """
+    按 RESPONSE_CACHE_BACKEND 创建第二级缓存。
+    "memory" 返回 None (只使用进程内 LRU)；创建失败时记录错误并同样只使用进程内 LRU。
+    """
+    backend_name = (backend_name or config.RESPONSE_CACHE_BACKEND).lower()
+    if backend_name == "memory" or not config.ENABLE_RESPONSE_CACHE:
+        return None
+    try:
+        if backend_name == "sqlite":
+            store: ResponseCacheStore = SQLiteResponseStore()
+        elif backend_name == "redis":
+            store = RedisResponseStore()
+        else:
+            raise ValueError(f"未知的 RESPONSE_CACHE_BACKEND: {backend_name}")
+    except Exception as e:
+        logger.error(f"创建响应缓存后端 '{backend_name}' 失败，只使用进程内缓存: {e}")
+        return None
+    logger.info(f"响应缓存使用第二级后端: {store.name}。")
+    return store
+
+
+class ResponseCache:
+    """
+    两级响应缓存。条目为 ChatCompletionResponse 的 JSON 字节，按请求指纹存取。
+    第一级按最近使用顺序淘汰，保证条目总字节数不超过 max_bytes；第二级读写在线程池中执行，出错时只记录日志。
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        store: Optional[ResponseCacheStore] = None,
+    ):
+        self.max_bytes = (
+            max_bytes if max_bytes is not None else config.RESPONSE_CACHE_MAX_BYTES
+        )
+        self.ttl_seconds = (
+            ttl_seconds
+            if ttl_seconds is not None
+            else config.RESPONSE_CACHE_TTL_SECONDS
+        )
+        self.store = store
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0  # 第一级条目的总字节数
+        self.memory_hits = 0  # 第一级命中数
+        self.store_hits = 0  # 第二级命中数
+        self.misses = 0  # 未命中数
+        self.stored = 0  # 写入的条目数
+        self.evictions = 0  # 因字节预算被淘汰的第一级条目数
+
+    async def get(self, key: str) -> Optional[ChatCompletionResponse]:
+        """
+        查找缓存的结果。命中时返回新的响应对象 (新的 id 和 created)，未命中时返回 None。
+        """
+        now = time.time()
+        payload = self._memory_get(key, now)
+        if payload is not None:
+            with self._lock:
+                self.memory_hits += 1
+        elif self.store is not None:
+            try:
+                found = await asyncio.to_thread(self.store.get, key, now)
+            except Exception as store_err:
+                logger.warning(f"读取响应缓存后端失败: {store_err}")
+                found = None
+            if found is not None:
+                payload, expires_at = found
+                self._memory_put(key, payload, expires_at)
+                with self._lock:
+                    self.store_hits += 1
+        if payload is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        response = ChatCompletionResponse.model_validate_json(payload)
+        response.id = f"chatcmpl-{uuid.uuid4().hex}"
+        response.created = int(now)
+        return response
+
+    async def put(self, key: str, response: ChatCompletionResponse) -> bool:
+        """
+        缓存一个补全结果。不满足 is_cacheable_response 时不缓存。
+
+        Returns:
+            bool: 是否已写入缓存。
+        """
+        if self.ttl_seconds <= 0 or not is_cacheable_response(response):
+            return False
+        payload = response.model_dump_json().encode("utf-8")
+        expires_at = time.time() + self.ttl_seconds
+        self._memory_put(key, payload, expires_at)
+        with self._lock:
+            self.stored += 1
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.set, key, payload, expires_at)
+            except Exception as store_err:
+                logger.warning(f"写入响应缓存后端失败: {store_err}")
+        return True
+
+    def _memory_get(self, key: str, now: float) -> Optional[bytes]:
+        """(内部辅助函数) 查找第一级条目，过期的条目直接删除。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.bytes -= len(payload)
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def _memory_put(self, key: str, payload: bytes, expires_at: float) -> None:
+        """(内部辅助函数) 写入第一级条目，超过字节预算时淘汰最久未使用的条目。"""
+        size = len(payload)
+        if size > self.max_bytes:
+            return  # 单个条目超过整个预算：只写入第二级
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+            self._entries[key] = (expires_at, payload)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回统计数据；upstream_calls_saved 即命中数。"""
+        with self._lock:
+            hits = self.memory_hits + self.store_hits
+            lookups = hits + self.misses
+            return {
+                "backend": self.store.name if self.store is not None else "memory",
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "stored": self.stored,
+                "evictions": self.evictions,
+                "upstream_calls_saved": hits,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        """清空第一级条目和统计 (第二级条目不受影响，主要用于测试)。"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.memory_hits = self.store_hits = self.misses = 0
+            self.stored = self.evictions = 0
+
+
+# 全局实例
+response_cache = ResponseCache(store=create_response_cache_store())
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+相同的非流式请求合并 (single-flight)。
+同一时刻内容完全相同的请求 (模型、发送给 Gemini 的内容、系统指令和生成参数都相同) 只由第一个请求
+(领导者) 选择 Key 并调用上游，其余请求 (跟随者) 等待领导者的结果，不再单独占用 Key 和配额。
+"""
+
+import asyncio  # 导入异步 IO 库
+import copy  # 导入拷贝模块
+import hashlib  # 导入哈希库
+import json  # 导入 JSON 处理库
+import logging  # 导入日志库
+from typing import Any, Dict, List, Optional, Tuple  # 导入类型提示
+
+from fastapi import HTTPException  # 导入 FastAPI HTTP 异常
+
+from gap.api.models import ChatCompletionRequest  # 导入请求模型
+
+logger = logging.getLogger("my_logger")
+
+# 不影响上游生成结果的请求字段，不参与请求指纹
+_NON_GENERATION_FIELDS = {"model", "messages", "stream", "user_id"}
+
+
+def request_fingerprint(
+    model_name: str,
+    contents: List[Dict[str, Any]],
+    system_instruction: Optional[Dict[str, Any]],
+    chat_request: ChatCompletionRequest,
+) -> str:
+    """
+    计算请求的规范化指纹：模型、实际发送的 contents、系统指令和全部生成参数的 SHA-256。
+
+    Args:
+        model_name (str): 规范化后的模型名称。
+        contents (List[Dict[str, Any]]): 发送给 Gemini 的内容 (已合并上下文)。
+        system_instruction (Optional[Dict[str, Any]]): 系统指令。
+        chat_request (ChatCompletionRequest): 原始请求 (取其中的生成参数)。
+
+    Returns:
+        str: 十六进制哈希字符串。
+    """
+    payload = {
+        "model": model_name,
+        "contents": contents,
+        "system_instruction": system_instruction,
+        "params": chat_request.model_dump(exclude=_NON_GENERATION_FIELDS),
+    }
+    encoded = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    ).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _clone_exception(exc: Exception) -> Exception:
+    """(内部辅助函数) 为每个跟随者复制领导者的异常，避免多个任务共用同一个异常对象的 traceback。"""
+    if isinstance(exc, HTTPException):
+        # HTTPException 的 args 为空，copy.copy 无法重建，按字段重新构造
+        return HTTPException(
+            status_code=exc.status_code, detail=exc.detail, headers=exc.headers
+        )
+    try:
+        return copy.copy(exc)
+    except Exception:
+        return exc
+
+
+class RequestCoalescer:
+    """
+    按请求指纹登记进行中的请求。
+    领导者通过 resolve()/reject()/abandon() 结束自己的登记；跟随者通过 follow() 等待结果。
+    领导者被取消或意外出错 (abandon) 以及等待超时时，跟随者收到 None，自行调用上游。
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, asyncio.Future] = {}
+        self.leaders = 0  # 实际调用上游的请求数
+        self.hits = 0  # 直接使用领导者结果的跟随者数
+        self.shared_errors = 0  # 收到领导者错误的跟随者数
+        self.fallbacks = 0  # 等待超时或领导者中途放弃、自行调用上游的跟随者数
+
+    def join(self, fingerprint: str) -> Tuple[asyncio.Future, bool]:
+        """
+        登记一个请求。
+
+        Returns:
+            Tuple[asyncio.Future, bool]: (本次请求所属的 Future, 是否为领导者)。
+        """
+        future = self._flights.get(fingerprint)
+        if future is not None and not future.done():
+            return future, False
+        future = asyncio.get_running_loop().create_future()
+        self._flights[fingerprint] = future
+        self.leaders += 1
+        return future, True
+
+    async def follow(self, future: asyncio.Future, max_wait_seconds: float) -> Any:
+        """
+        等待领导者的结果。领导者失败时抛出相同的异常；超时或领导者放弃时返回 None。
+        """
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(future), max_wait_seconds or None
+            )
+        except asyncio.TimeoutError:
+            self.fallbacks += 1
+            return None
+        except Exception as leader_exc:
+            self.shared_errors += 1
+            raise _clone_exception(leader_exc) from None
+        if result is None:
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        return result
+
+    def resolve(self, fingerprint: str, future: asyncio.Future, result: Any) -> None:
+        """领导者成功：把结果交给所有跟随者。"""
+        if not future.done():
+            future.set_result(result)
+        self._forget(fingerprint, future)
+
+    def reject(
+        self, fingerprint: str, future: asyncio.Future, exc: BaseException
+    ) -> None:
+        """领导者最终失败：把异常交给所有跟随者。"""
+        if not future.done():
+            future.set_exception(exc)
+            future.exception()  # 没有跟随者时也不记录 "exception was never retrieved"
+        self._forget(fingerprint, future)
+
+    def abandon(self, fingerprint: str, future: asyncio.Future) -> None:
+        """领导者未给出结果就结束 (被取消或意外出错)：跟随者各自调用上游。"""
+        if not future.done():
+            future.set_result(None)
+        self._forget(fingerprint, future)
+
+    def _forget(self, fingerprint: str, future: asyncio.Future) -> None:
+        """(内部辅助函数) 移除登记，之后到达的相同请求成为新的领导者。"""
+        if self._flights.get(fingerprint) is future:
+            del self._flights[fingerprint]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回统计数据。"""
+        total = self.leaders + self.hits
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "hits": self.hits,
+            "shared_errors": self.shared_errors,
+            "fallbacks": self.fallbacks,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def clear(self) -> None:
+        """清空登记和统计 (主要用于测试)。"""
+        self._flights.clear()
+        self.leaders = self.hits = self.shared_errors = self.fallbacks = 0
+
+
+# 全局实例
+request_coalescer = RequestCoalescer()
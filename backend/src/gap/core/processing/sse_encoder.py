@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+OpenAI 兼容的流式响应 (SSE) 数据块编码。
+每个流只拼接一次固定的信封 (id、created、model 和 choices 结构)，
+此后每个文本增量只需转义文本本身并直接输出 bytes，输出与 json.dumps 逐字节一致。
+"""
+
+import asyncio  # 导入异步 IO 库
+import json  # 导入 JSON 处理库
+import time  # 导入时间库
+from json.encoder import encode_basestring_ascii  # json.dumps 默认的 C 实现字符串转义
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Optional
+
+SSE_DONE = b"data: [DONE]\n\n"  # SSE 流结束标记
+
+# 上游迭代器超过合并时限仍未产出数据时，with_flush_deadlines 产出此标记
+FLUSH = object()
+
+
+class SSEChunkEncoder:
+    """
+    单个流的 chat.completion.chunk 编码器。
+    创建时固定 id、created 和 model，content() 只转义增量文本。
+    """
+
+    def __init__(
+        self, response_id: str, model_name: str, created: Optional[int] = None
+    ):
+        """
+        初始化编码器并预先拼接信封前缀。
+
+        Args:
+            response_id: 本次流式响应的唯一 ID。
+            model_name: 写入每个数据块的模型名称。
+            created: 创建时间戳 (秒)，默认为当前时间。
+        """
+        self.response_id = response_id
+        self.model_name = model_name
+        self.created = int(time.time()) if created is None else int(created)
+        head = (
+            f'data: {{"id": {encode_basestring_ascii(response_id)}, '
+            f'"object": "chat.completion.chunk", "created": {self.created}, '
+            f'"model": {encode_basestring_ascii(model_name)}, "choices": [{{"delta": '
+        )
+        self._content_head = (head + '{"role": "assistant", "content": ').encode(
+            "ascii"
+        )
+        self._tool_calls_head = (head + '{"role": "assistant", "tool_calls": ').encode(
+            "ascii"
+        )
+        self._finish_head = (head + '{}, "index": 0, "finish_reason": ').encode("ascii")
+        self._delta_tail = b'}, "index": 0, "finish_reason": null}]}\n\n'
+
+    def content(self, text: str) -> bytes:
+        """编码一个文本增量块。"""
+        return (
+            self._content_head
+            + encode_basestring_ascii(text).encode("ascii")
+            + self._delta_tail
+        )
+
+    def tool_calls(self, tool_calls: List[Dict[str, Any]]) -> bytes:
+        """编码一个工具调用块。"""
+        return (
+            self._tool_calls_head
+            + json.dumps(tool_calls).encode("ascii")
+            + self._delta_tail
+        )
+
+    def finish(self, finish_reason: Optional[str]) -> bytes:
+        """编码 delta 为空、只带 finish_reason 的结束块。"""
+        return (
+            self._finish_head + json.dumps(finish_reason).encode("ascii") + b"}]}\n\n"
+        )
+
+    @staticmethod
+    def error(error_info: Dict[str, Any]) -> bytes:
+        """编码一个错误块 ({"error": ...})。"""
+        return b"data: " + json.dumps({"error": error_info}).encode("ascii") + b"\n\n"
+
+
+class SSEDeltaCoalescer:
+    """
+    文本增量合并策略：缓冲相邻的文本增量，达到时间或大小上限时合并为一个 SSE 块。
+    两项上限均为 0 时不做缓冲，push() 直接返回编码后的块。
+    """
+
+    def __init__(
+        self, encoder: SSEChunkEncoder, max_delay_ms: float = 0, max_bytes: int = 0
+    ):
+        """
+        Args:
+            encoder: 本流的数据块编码器。
+            max_delay_ms: 第一段缓冲文本最多等待的毫秒数，0 表示不按时间合并。
+            max_bytes: 缓冲文本 (UTF-8) 达到此字节数时立即发送，0 表示不按大小合并。
+        """
+        self.encoder = encoder
+        self.max_delay = max(0.0, max_delay_ms) / 1000
+        self.max_bytes = max(0, max_bytes)
+        self.enabled = self.max_delay > 0 or self.max_bytes > 0
+        self._parts: List[str] = []
+        self._size = 0
+        self._deadline = 0.0
+        self.chunks_emitted = 0  # 实际发出的文本块数
+        self.deltas_received = 0  # 收到的文本增量数
+
+    def push(self, text: str) -> Optional[bytes]:
+        """
+        加入一个文本增量，需要发送时返回编码后的块，否则返回 None。
+        """
+        self.deltas_received += 1
+        if not self.enabled:
+            self.chunks_emitted += 1
+            return self.encoder.content(text)
+        if not self._parts:
+            self._deadline = time.monotonic() + self.max_delay
+        self._parts.append(text)
+        if self.max_bytes:
+            self._size += len(text.encode("utf-8"))
+            if self._size >= self.max_bytes:
+                return self.flush()
+        if self.max_delay and time.monotonic() >= self._deadline:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[bytes]:
+        """发送缓冲中的全部文本，缓冲为空时返回 None。"""
+        if not self._parts:
+            return None
+        text = self._parts[0] if len(self._parts) == 1 else "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self.chunks_emitted += 1
+        return self.encoder.content(text)
+
+    def time_until_flush(self) -> Optional[float]:
+        """距缓冲文本必须发送的剩余秒数；缓冲为空或未设置时间上限时返回 None。"""
+        if not self._parts or not self.max_delay:
+            return None
+        return max(0.0, self._deadline - time.monotonic())
+
+
+async def with_flush_deadlines(
+    source: AsyncIterable[Any], coalescer: SSEDeltaCoalescer
+) -> AsyncIterator[Any]:
+    """
+    包装上游异步迭代器：合并缓冲中有待发送的文本且上游超过时限仍未产出数据时，
+    产出 FLUSH 标记，使调用方在上游停顿期间也能按时发送缓冲的文本。
+    """
+    iterator = source.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = coalescer.time_until_flush()
+            if timeout is not None:
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield FLUSH
+                    continue
+            try:
+                item = await pending
+            except StopAsyncIteration:
+                pending = None
+                return
+            pending = None
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
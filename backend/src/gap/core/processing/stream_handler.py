@@ -3,42 +3,163 @@
 处理流式响应的逻辑。
 """
 import asyncio  # 导入异步 IO 库
-import json  # 导入 JSON 处理库
 import logging  # 导入日志库
+import math  # 导入数学库
 import time  # 导入时间库
 from collections import defaultdict  # 导入 defaultdict
-from typing import Any, AsyncGenerator, Dict, List, Optional  # 导入类型提示
+from typing import (  # 导入类型提示
+    Any,
+    AsyncGenerator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 import httpx  # 导入 HTTP 客户端库，用于处理可能的 HTTP 错误
+from fastapi import Request  # 导入 FastAPI 请求对象
+from fastapi.responses import StreamingResponse  # 流式响应
+from starlette.types import Receive, Scope, Send  # ASGI 类型
 from sqlalchemy.ext.asyncio import AsyncSession  # 导入异步数据库会话类型
 
 # 导入配置
 from gap import config  # 应用配置
 
 # 导入核心模块和类型
-from gap.api.models import ChatCompletionRequest  # 导入请求模型
+from gap.api.models import (  # 导入请求和响应模型
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+    Choice,
+    ResponseMessage,
+    Usage,
+)
 from gap.core.cache.manager import CacheManager  # 导入缓存管理器类型
 from gap.core.context.store import ContextStore
+from gap.core.keys.concurrency import ConcurrencyPermit  # 选择 Key 时占用的并发名额
+from gap.core.keys.limiter import TokenReservation  # 选择 Key 时预留的输入 Token
 from gap.core.keys.manager import APIKeyManager  # 导入 Key 管理器类型
+from gap.core.processing.disconnect import (  # 客户端断开检测与提前结束的流统计
+    DisconnectWatcher,
+    stream_cancellation_stats,
+)
+from gap.core.processing.response_cache import response_cache  # 确定性响应缓存
+from gap.core.processing.sse_encoder import (  # 预拼接信封的 SSE 数据块编码与增量合并
+    FLUSH,
+    SSE_DONE,
+    SSEChunkEncoder,
+    SSEDeltaCoalescer,
+    with_flush_deadlines,
+)
+from gap.core.processing.token_estimate import (  # 逐条消息 Token 估算缓存与校准
+    TokenEstimateCache,
+    calibrate_from_usage,
+    estimate_text_tokens,
+    token_calibration,
+)
 
 # 导入需要在这里使用的工具函数
 from gap.core.processing.utils import (  # 导入工具函数
     save_context_after_success,
+    update_token_counts,
 )
 from gap.core.services.gemini import GeminiClient  # 导入 Gemini 客户端
 
 # 导入跟踪相关
-from gap.core.tracking import usage_data, usage_lock  # 导入共享的使用数据和锁
+from gap.core.tracking import (  # 导入共享的使用数据和锁
+    mark_usage_dirty,
+    usage_data,
+    usage_lock,
+)
 
 logger = logging.getLogger("my_logger")  # 获取日志记录器实例
 
 
+class GuardedStreamingResponse(StreamingResponse):
+    """
+    响应结束后一定执行清理回调的流式响应。
+
+    生成器的 finally 只有在开始迭代之后才会执行：客户端在响应头发出前断开、
+    响应在发送前被丢弃或发送失败时，生成器从未启动，其中持有的资源 (Token 预留、并发名额) 不会归还。
+    本类在响应处理结束 (正常、异常或被取消) 后先关闭生成器 (已启动时执行其 finally)，
+    再调用 on_close；响应从未被发送时在对象回收时调用 on_close。on_close 必须是幂等的同步函数。
+    """
+
+    def __init__(self, content: Any, on_close: Callable[[], None], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self._on_close: Optional[Callable[[], None]] = on_close
+
+    def _run_on_close(self) -> None:
+        """(内部方法) 调用一次清理回调。"""
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            except (asyncio.CancelledError, Exception) as close_err:
+                logger.debug(f"关闭流式响应生成器时出错: {close_err}")
+            finally:
+                self._run_on_close()
+
+    def __del__(self) -> None:
+        self._run_on_close()
+
+
+def _stream_token_usage(
+    usage_metadata: Optional[Dict[str, Any]],
+    token_reservation: Optional[TokenReservation],
+    token_estimates: Optional[TokenEstimateCache],
+    model_name: str,
+    contents: List[Dict[str, Any]],
+    system_instruction: Optional[Dict[str, Any]],
+    reply_text: str,
+) -> Tuple[Optional[int], Optional[int], bool]:
+    """
+    计算流式响应需要记账的输入/输出 Token 数。
+    收到 usage metadata 时使用实际值；流在收到之前结束 (客户端断开或中途出错) 时，
+    输入按选择 Key 时的预留估算值 (或现场估算)，输出按已收到的回复文本估算。
+
+    Returns:
+        Tuple[Optional[int], Optional[int], bool]: (输入 Token 数, 输出 Token 数, 是否为估算值)。
+    """
+    if usage_metadata and usage_metadata.get("prompt_token_count"):
+        # GeminiClient 输出的 usage metadata 使用 snake_case 字段名
+        return (
+            usage_metadata.get("prompt_token_count"),
+            usage_metadata.get("candidates_token_count"),
+            False,
+        )
+    if token_reservation is not None:
+        prompt_tokens = token_reservation.tokens
+    else:
+        cache = (
+            token_estimates
+            if token_estimates is not None
+            else TokenEstimateCache(model_name)
+        )
+        prompt_tokens = cache.estimate(
+            contents + [system_instruction] if system_instruction else contents
+        )
+    completion_tokens = math.ceil(
+        estimate_text_tokens(reply_text) * token_calibration.factor(model_name)
+    )
+    return prompt_tokens, completion_tokens, True
+
+
 async def handle_stream_end(
     response_id: str,
     assistant_message_yielded: bool,
     actual_finish_reason: str,
     safety_issue_detail_received: Optional[Dict[str, Any]],
-) -> AsyncGenerator[str, None]:
+    encoder: Optional[SSEChunkEncoder] = None,
+) -> AsyncGenerator[bytes, None]:
     """
     处理流式响应结束时的逻辑，根据不同情况发送合适的结束块或错误块。
     确保最后发送 [DONE] 标记。
@@ -48,10 +169,13 @@ async def handle_stream_end(
         assistant_message_yielded (bool): 标记在流传输过程中是否已成功生成并发送了至少一个有效的助手消息块 (content 或 tool_calls)。
         actual_finish_reason (str): 从 Gemini API 获取的实际完成原因 (例如 "STOP", "MAX_TOKENS", "SAFETY" 等)。
         safety_issue_detail_received (Optional[Dict[str, Any]]): 如果完成原因是 SAFETY，这里会包含安全问题的详细信息。
+        encoder (Optional[SSEChunkEncoder]): 本流的数据块编码器；未提供时使用 model 为 "ignored" 的新编码器。
 
     Yields:
-        str: Server-Sent Events (SSE) 格式的字符串，包含结束块、错误块或最终的 [DONE] 标记。
+        bytes: Server-Sent Events (SSE) 格式的数据，包含结束块、错误块或最终的 [DONE] 标记。
     """
+    if encoder is None:
+        encoder = SSEChunkEncoder(response_id, "ignored")
     if not assistant_message_yielded:  # 检查是否从未生成过有效内容
         # --- 处理未生成任何内容就结束的情况 ---
         if actual_finish_reason == "STOP":  # 如果完成原因是正常停止 (STOP)
@@ -73,50 +197,30 @@ async def handle_stream_end(
                 error_type = "model_error"  # 定义错误类型
 
             # 构造并发送错误负载
-            error_payload = {
-                "error": {
-                    "message": error_message_detail,
-                    "type": error_type,
-                    "code": error_code,
-                }
+            error_info = {
+                "message": error_message_detail,
+                "type": error_type,
+                "code": error_code,
             }
-            yield f"data: {json.dumps(error_payload)}\n\n"  # 发送 SSE 格式的错误数据
+            yield encoder.error(error_info)  # 发送 SSE 格式的错误数据
         else:
             # 情况3：因其他原因（如 MAX_TOKENS）完成，但在此之前未输出任何内容。
             logger.warning(
                 f"流 {response_id}: 结束时未产生助手内容 (完成原因: {actual_finish_reason})。发送包含 finish_reason 的结束块。"
             )  # 记录警告日志
-            # 发送一个包含 finish_reason 的空 choice 块，符合 OpenAI 格式
-            end_chunk = {
-                "id": response_id,
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": "ignored",  # 模型信息通常在第一个块中提供，这里忽略
-                "choices": [
-                    {"delta": {}, "index": 0, "finish_reason": actual_finish_reason}
-                ],  # delta 为空，但包含 finish_reason
-            }
-            yield f"data: {json.dumps(end_chunk)}\n\n"  # 发送 SSE 格式的结束块
+            # 发送一个包含 finish_reason 的空 choice 块 (delta 为空)，符合 OpenAI 格式
+            yield encoder.finish(actual_finish_reason)  # 发送 SSE 格式的结束块
     else:
         # --- 处理已生成内容后正常结束的情况 ---
         # 情况4：流中已成功生成并发送了内容，现在发送最终的结束块，包含 finish_reason。
         logger.debug(
             f"流 {response_id}: 正常结束，发送包含 finish_reason '{actual_finish_reason}' 的结束块。"
         )  # 记录调试日志
-        end_chunk = {
-            "id": response_id,
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": "ignored",  # 模型信息已在之前的块中提供
-            "choices": [
-                {"delta": {}, "index": 0, "finish_reason": actual_finish_reason}
-            ],  # delta 为空，包含 finish_reason
-        }
-        yield f"data: {json.dumps(end_chunk)}\n\n"  # 发送 SSE 格式的结束块
+        yield encoder.finish(actual_finish_reason)  # 发送 SSE 格式的结束块 (delta 为空)
 
     # --- 最终标记 ---
     # 无论以上哪种情况，最后都需要发送 [DONE] 标记，表示 SSE 流结束。
-    yield "data: [DONE]\n\n"  # 发送 SSE 流结束标记
+    yield SSE_DONE  # 发送 SSE 流结束标记
 
 
 async def generate_stream_response(
@@ -149,17 +253,29 @@ async def generate_stream_response(
     # enable_context: bool, # 是否启用传统上下文保存 (目前不在流中处理)
     # merged_contents_for_context: List[Dict[str, Any]], # 用于保存上下文的完整内容 (目前不在流中处理)
     context_store: ContextStore | None = None,
-) -> AsyncGenerator[str, None]:
+    token_reservation: Optional[TokenReservation] = None,  # 选择 Key 时预留的输入 Token
+    concurrency_permit: Optional[ConcurrencyPermit] = None,  # 选择 Key 时占用的并发名额
+    token_estimates: Optional[TokenEstimateCache] = None,  # 请求级的逐条消息 Token 估算缓存
+    http_request: Optional[Request] = None,  # 客户端请求，用于检测连接断开
+    response_cache_key: Optional[str] = None,  # 非 None 时流正常结束后把结果写入响应缓存
+) -> AsyncGenerator[bytes, None]:
     """
     异步生成器函数，负责调用 Gemini API 的流式接口，处理返回的数据块，
     并将其格式化为 Server-Sent Events (SSE) 发送给客户端。
     同时处理流结束、错误、Token 计数、缓存创建和 Key 状态更新等逻辑。
+    流成功结束时按 usage metadata 把输入/输出 Token 记入限流器、TPD 和 IP 计数，
+    选择 Key 时的输入 Token 预留随之对账；已产生输出后客户端断开或上游出错时按估算值部分记账，
+    未产生任何输出就结束时预留全额退还。Key 的并发名额在流结束时归还。
+    数据块由本流的 SSEChunkEncoder 直接编码为 bytes，文本增量按 STREAM_COALESCE_* 配置合并。
+    提供 http_request 且启用了 ENABLE_STREAM_DISCONNECT_WATCH 时，客户端断开会立即取消上游流，
+    提前结束的流计入 stream_cancellation_stats。
+    提供 response_cache_key 时，流正常结束后把完整结果写入响应缓存，供之后的相同请求直接重放。
 
     Args:
         (参数说明见上方的类型提示)
 
     Yields:
-        str: Server-Sent Events (SSE) 格式的字符串数据块。
+        bytes: Server-Sent Events (SSE) 格式的数据块。
              可能的块类型包括：内容块 (delta)、工具调用块 (tool_calls)、错误块 (error)、结束块 (finish_reason)、[DONE] 标记。
     """
     # --- 初始化状态变量 ---
@@ -172,18 +288,42 @@ async def generate_stream_response(
     actual_finish_reason = "stop"  # 初始化默认的完成原因为 "stop"
     safety_issue_detail_received = None  # 存储可能的安全问题详情
     final_tool_calls = None  # 存储可能的工具调用信息
+    stream_started_at = time.monotonic()  # 流开始时间，用于计算 Key 的调用延迟
+    usage_accounted = False  # Token 用量是否已记入限流器和 IP 计数
+    upstream = None  # 上游流迭代器
+    upstream_finished = False  # 上游流是否已完整读完
+    disconnect_watcher: Optional[DisconnectWatcher] = None  # 客户端断开监听器
+    # 每个流只拼接一次信封 (id、created、model)，之后每个文本增量只转义文本本身
+    encoder = SSEChunkEncoder(response_id, model_name)
+    coalescer = SSEDeltaCoalescer(
+        encoder, config.STREAM_COALESCE_MS, config.STREAM_COALESCE_MAX_BYTES
+    )
 
     try:
         # --- 调用 Gemini 客户端的流式聊天方法 ---
         # gemini_client_instance.stream_chat 是一个异步生成器
-        async for chunk_data in gemini_client_instance.stream_chat(
+        upstream = gemini_client_instance.stream_chat(
             request=chat_request,  # 传递原始请求对象
             contents=contents,  # 传递处理后的内容
             safety_settings=safety_settings,  # 传递安全设置
             system_instruction=system_instruction,  # 传递系统指令
             cached_content_id=cached_content_id,  # 传递缓存 ID (如果命中)
-        ):
+        )
+        if coalescer.max_delay:
+            # 按时间合并时，上游停顿超过时限也要发送已缓冲的文本
+            upstream = with_flush_deadlines(upstream, coalescer)
+        if http_request is not None and config.ENABLE_STREAM_DISCONNECT_WATCH:
+            # 客户端断开时立即取消对上游的等待，而不是等下一个数据块写入失败
+            disconnect_watcher = DisconnectWatcher(http_request)
+            upstream = disconnect_watcher.guard(upstream)
+            disconnect_watcher.start()
+        async for chunk_data in upstream:
             # --- 处理接收到的数据块 ---
+            if chunk_data is FLUSH:  # 合并时限已到，发送缓冲的文本
+                buffered = coalescer.flush()
+                if buffered is not None:
+                    yield buffered
+                continue
             if isinstance(chunk_data, dict):  # 如果是字典类型的数据块
                 # 检查是否为特殊元数据块
                 if "_usage_metadata" in chunk_data:  # 使用量元数据
@@ -216,24 +356,12 @@ async def generate_stream_response(
                     logger.info(
                         f"流 {response_id}: 接收到工具调用: {final_tool_calls}"
                     )  # 记录日志
+                    # 先发送缓冲的文本，保持与上游一致的顺序
+                    buffered = coalescer.flush()
+                    if buffered is not None:
+                        yield buffered
                     # 将工具调用信息格式化为 OpenAI SSE chunk 格式发送给客户端
-                    formatted_chunk = {
-                        "id": response_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model_name,  # 包含模型名称
-                        "choices": [
-                            {
-                                "delta": {
-                                    "role": "assistant",
-                                    "tool_calls": final_tool_calls,
-                                },  # delta 中包含 tool_calls
-                                "index": 0,
-                                "finish_reason": None,  # 工具调用不是流的最终结束
-                            }
-                        ],
-                    }
-                    yield f"data: {json.dumps(formatted_chunk)}\n\n"  # 发送 SSE 数据块
+                    yield encoder.tool_calls(final_tool_calls)  # 发送 SSE 数据块
                     assistant_message_yielded = True  # 标记已产生有效内容
                     continue  # 工具调用块处理完毕，继续处理下一个块
 
@@ -242,73 +370,135 @@ async def generate_stream_response(
             ):  # 如果是字符串类型的数据块（通常是文本内容）
                 # 处理文本块
                 if chunk_data:  # 忽略空字符串块
-                    # 格式化为 OpenAI SSE chunk 格式
-                    formatted_chunk = {
-                        "id": response_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model_name,  # 在第一个有效内容块中包含模型名称
-                        "choices": [
-                            {
-                                "delta": {
-                                    "role": "assistant",
-                                    "content": chunk_data,
-                                },  # delta 中包含 content
-                                "index": 0,
-                                "finish_reason": None,  # 文本块不是最终结束
-                            }
-                        ],
-                    }
-                    yield f"data: {json.dumps(formatted_chunk)}\n\n"  # 发送 SSE 数据块
+                    # 先累积文本内容：客户端在 yield 处断开时，部分记账也要计入这段已生成的文本
+                    full_reply_content += chunk_data
+                    # 格式化为 OpenAI SSE chunk 格式 (合并开启时可能暂存在缓冲中)
+                    encoded_chunk = coalescer.push(chunk_data)
+                    if encoded_chunk is not None:
+                        yield encoded_chunk  # 发送 SSE 数据块
                     assistant_message_yielded = True  # 标记已产生有效内容
-                    full_reply_content += chunk_data  # 累积文本内容
             else:
                 # 处理未知类型的块（基于当前 GeminiClient 返回类型定义，此分支理论上不会触发）
                 logger.warning(  # type: ignore[unreachable]
                     f"流 {response_id}: 接收到未知类型的块: {type(chunk_data)}"
                 )  # 记录警告日志
 
+        upstream_finished = True
+
         # --- 流正常结束后处理 ---
         if not stream_error_occurred:  # 确保流处理过程中没有发生错误
+            buffered = coalescer.flush()  # 发送合并缓冲中剩余的文本
+            if buffered is not None:
+                yield buffered
             # 调用 handle_stream_end 生成并发送结束块或错误块，以及最终的 [DONE] 标记
             async for end_chunk_data in handle_stream_end(
                 response_id,
                 assistant_message_yielded,
                 actual_finish_reason,
                 safety_issue_detail_received,
+                encoder,
             ):
                 yield end_chunk_data  # 发送结束处理逻辑生成的 SSE 数据
 
             # --- 流成功结束后的附加处理逻辑 ---
             # 只有在成功生成了内容或工具调用时才执行后续操作
             if assistant_message_yielded or final_tool_calls:
-                # 1. 更新 Token 计数 (如果收到了元数据)
-                if usage_metadata_received:
-                    prompt_tokens = usage_metadata_received.get(
-                        "promptTokenCount"
-                    )
-                    logger.debug(
-                        "流 %s: 请求成功，接收到 usage metadata，promptTokenCount=%s (当前仅记录，不更新配额计数)。",
-                        response_id,
-                        prompt_tokens,
-                    )
-                else:
-                    # 如果没有收到使用量元数据，记录警告
+                # 1. 更新 Token 计数 (TPD/TPM 输入输出和 IP 计数，预留按实际用量对账)
+                prompt_tokens, completion_tokens, estimated = _stream_token_usage(
+                    usage_metadata_received,
+                    token_reservation,
+                    token_estimates,
+                    model_name,
+                    contents,
+                    system_instruction,
+                    full_reply_content,
+                )
+                if estimated:
+                    # 如果没有收到使用量元数据，按估算值记账
                     logger.warning(
-                        f"流 {response_id}: 响应成功但未找到 usage metadata。Token 计数未更新。"
+                        f"流 {response_id}: 响应成功但未找到 usage metadata。按估算值更新 Token 计数 (输入 {prompt_tokens}, 输出 {completion_tokens})。"
                     )  # 记录警告
+                elif cached_content_id is None:
+                    # 缓存内容的 Token 也计入 promptTokenCount，只用未使用缓存的调用校准本地估算
+                    calibrate_from_usage(
+                        token_estimates,
+                        model_name,
+                        contents,
+                        system_instruction,
+                        prompt_tokens,
+                    )
+                update_token_counts(
+                    selected_key,
+                    model_name,
+                    limits,
+                    prompt_tokens,
+                    client_ip,
+                    today_date_str_pt,
+                    completion_tokens=completion_tokens,
+                    reservation=token_reservation,
+                )
+                usage_accounted = True
+
+                # 2. 记录本次成功调用到 Key 健康度评分 (延迟为整个流的耗时)
+                key_manager.record_call_outcome(
+                    selected_key,
+                    model_name,
+                    success=True,
+                    latency_seconds=time.monotonic() - stream_started_at,
+                    limits=limits,
+                )
 
-                # 2. 更新 Key 的最后使用时间戳
+                # 更新 Key 的最后使用时间戳
                 with usage_lock:  # 使用锁保证线程安全
                     # 确保 usage_data 中存在对应的 Key 和模型条目
                     key_usage = usage_data.setdefault(
                         selected_key, defaultdict(lambda: defaultdict(int))
                     )[model_name]
                     key_usage["last_used_timestamp"] = time.time()  # 更新时间戳
+                    mark_usage_dirty(selected_key, model_name)
                     logger.debug(
                         f"流 {response_id}: 请求成功，更新 Key {selected_key[:8]}... ({model_name}) 的 last_used_timestamp"
                     )  # 记录日志
 
+                # 写入响应缓存 (只缓存正常结束的结果，之后的相同请求直接重放)
+                # 上游未返回用量时计数为 None，按 0 记录；写入失败不影响之后的关联更新和上下文保存
+                if response_cache_key is not None:
+                    try:
+                        cached_prompt_tokens = prompt_tokens or 0
+                        cached_completion_tokens = completion_tokens or 0
+                        await response_cache.put(
+                            response_cache_key,
+                            ChatCompletionResponse(
+                                id=response_id,
+                                created=encoder.created,
+                                model=model_name,
+                                choices=[
+                                    Choice(
+                                        index=0,
+                                        message=ResponseMessage(
+                                            role="assistant",
+                                            content=full_reply_content or None,
+                                            tool_calls=final_tool_calls,
+                                        ),
+                                        finish_reason=actual_finish_reason,
+                                    )
+                                ],
+                                usage=Usage(
+                                    prompt_tokens=cached_prompt_tokens,
+                                    completion_tokens=cached_completion_tokens,
+                                    total_tokens=cached_prompt_tokens
+                                    + cached_completion_tokens,
+                                ),
+                            ),
+                        )
+                    except Exception as cache_put_err:
+                        logger.error(
+                            "流 %s: 写入响应缓存失败: %s",
+                            response_id,
+                            cache_put_err,
+                            exc_info=True,
+                        )
+
                 # 3. 更新用户与 Key 的关联（如果提供了用户 ID 且数据库会话有效）
                 if user_id_for_mapping and db_for_cache:  # 确保有 user_id 和 db session
                     try:
@@ -402,6 +592,7 @@ async def generate_stream_response(
                                 final_tool_calls=final_tool_calls,
                                 db=db_for_cache,
                                 context_store=context_store,
+                                token_estimates=token_estimates,
                             )
                             logger.info(
                                 "流 %s: 流式响应上下文已保存。",
@@ -433,7 +624,14 @@ async def generate_stream_response(
 
     except asyncio.CancelledError:
         # --- 处理客户端连接中断 ---
-        logger.info(f"流 {response_id}: 客户端连接已中断 (IP: {client_ip})")  # 记录日志
+        if disconnect_watcher is not None and disconnect_watcher.consume_cancel():
+            logger.info(
+                f"流 {response_id}: 检测到客户端断开，已取消上游流 (IP: {client_ip})"
+            )  # 记录日志
+        else:
+            logger.info(
+                f"流 {response_id}: 客户端连接已中断 (IP: {client_ip})"
+            )  # 记录日志
         # 连接已断开，生成器停止，不需要 yield 任何东西，FastAPI 会处理
     except httpx.HTTPStatusError as http_err:
         # --- 处理 API 调用时的 HTTP 错误 ---
@@ -442,14 +640,32 @@ async def generate_stream_response(
             exc_info=False,
         )  # 记录错误日志
         stream_error_occurred = True  # 标记发生错误
+        # 限流、服务端错误和认证错误计入 Key 健康度评分 (请求体问题与 Key 无关)
+        if http_err.response.status_code != 400:
+            key_manager.record_call_outcome(
+                selected_key,
+                model_name,
+                success=False,
+                status_code=http_err.response.status_code,
+            )
+        # 限流和服务端错误断开该 Key 在此模型下的熔断器
+        if http_err.response.status_code in (429, 500, 503):
+            key_manager.trip_circuit(
+                selected_key,
+                model_name,
+                issue_type=f"Stream HTTP {http_err.response.status_code}",
+            )
         # 格式化错误信息 (需要 _format_api_error 函数，此处简化)
         error_info = {
             "message": f"API Error: {http_err.response.status_code}",
             "type": "api_error",
             "code": http_err.response.status_code,
         }
-        yield f"data: {json.dumps({'error': error_info})}\n\n"  # 发送错误信息给客户端
-        yield "data: [DONE]\n\n"  # 发送结束标记
+        buffered = coalescer.flush()  # 出错前已收到的文本仍发送给客户端
+        if buffered is not None:
+            yield buffered
+        yield encoder.error(error_info)  # 发送错误信息给客户端
+        yield SSE_DONE  # 发送结束标记
     except Exception as stream_e:
         # --- 处理流处理过程中的其他意外异常 ---
         logger.error(
@@ -462,5 +678,70 @@ async def generate_stream_response(
             "type": "internal_error",
             "code": 500,  # 使用 500 状态码表示内部错误
         }
-        yield f"data: {json.dumps({'error': error_info})}\n\n"  # 发送错误信息给客户端
-        yield "data: [DONE]\n\n"  # 发送结束标记
+        buffered = coalescer.flush()  # 出错前已收到的文本仍发送给客户端
+        if buffered is not None:
+            yield buffered
+        yield encoder.error(error_info)  # 发送错误信息给客户端
+        yield SSE_DONE  # 发送结束标记
+    finally:
+        if disconnect_watcher is not None:
+            disconnect_watcher.stop()
+        if upstream is not None and not upstream_finished:
+            # 提前结束 (客户端断开或出错) 时立即关闭上游流，释放连接并停止生成
+            try:
+                await upstream.aclose()
+            except (asyncio.CancelledError, Exception) as close_err:
+                logger.debug(f"流 {response_id}: 关闭上游流时出错: {close_err}")
+        partial_completion_tokens = 0  # 提前结束时已生成的输出 Token (估算)
+        if not usage_accounted and (full_reply_content or final_tool_calls):
+            # 流已产生输出但未正常结算 (客户端中途断开或上游中途出错)：
+            # 上游已按生成的内容计费，按实际值 (如已收到) 或估算值部分记账
+            try:
+                prompt_tokens, completion_tokens, estimated = _stream_token_usage(
+                    usage_metadata_received,
+                    token_reservation,
+                    token_estimates,
+                    model_name,
+                    contents,
+                    system_instruction,
+                    full_reply_content,
+                )
+                update_token_counts(
+                    selected_key,
+                    model_name,
+                    limits,
+                    prompt_tokens,
+                    client_ip,
+                    today_date_str_pt,
+                    completion_tokens=completion_tokens,
+                    reservation=token_reservation,
+                )
+                partial_completion_tokens = completion_tokens or 0
+                logger.info(
+                    "流 %s: 流未正常结束，部分记账 Token 用量 (输入 %s, 输出 %s, %s)。",
+                    response_id,
+                    prompt_tokens,
+                    completion_tokens,
+                    "估算值" if estimated else "实际值",
+                )
+            except Exception as accounting_err:
+                logger.error(
+                    "流 %s: 部分记账 Token 用量失败: %s",
+                    response_id,
+                    accounting_err,
+                    exc_info=True,
+                )
+        if not upstream_finished and not stream_error_occurred:
+            # 上游未读完且未出错：客户端提前断开，剩余的输出预算不再生成
+            output_budget = getattr(chat_request, "max_tokens", None) or (
+                limits or {}
+            ).get("output_token_limit", 0)
+            stream_cancellation_stats.record(
+                partial_completion_tokens, output_budget - partial_completion_tokens
+            )
+        # 流未成功结算预留时 (出错、被取消或未产生内容) 全额退还
+        if token_reservation is not None:
+            token_reservation.release()
+        # 上游流结束 (完成、出错或客户端断开)，归还 Key 的并发名额
+        if concurrency_permit is not None:
+            concurrency_permit.release()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+上游 countTokens 精确计数与按消息前缀的增量缓存。
+
+本地估算在上下文接近模型限制时决定"截断还是直接发送"，判断失误要么白白截掉历史，
+要么换来一次必然失败的上游调用。启用 ENABLE_UPSTREAM_TOKEN_COUNT 后，
+估算值落在截断阈值上下 UPSTREAM_TOKEN_COUNT_MARGIN 比例以内的请求 (只有这些请求)
+会调用 Gemini countTokens 获取精确值。
+
+精确值按消息前缀缓存：前缀的键是逐条消息内容哈希的链式哈希 (以模型名为起点)，
+值为该前缀的 Token 总数。多轮对话的后续请求只需对新增的后缀调用 countTokens，
+再加上最长已缓存前缀的总数；完全相同的内容直接命中缓存。
+countTokens 失败或超时时返回 None，调用方回退到本地估算。
+"""
+
+import asyncio  # 超时控制
+import hashlib  # 前缀链式哈希
+import logging  # 日志
+import threading  # 保护统计计数
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from gap import config  # 应用配置
+from gap.core.processing.token_estimate import (  # 请求级估算缓存与校准
+    TokenEstimateCache,
+    token_calibration,
+)
+from gap.core.utils.lru import LRUMap  # 线程安全的有界 LRU 映射
+
+logger = logging.getLogger("my_logger")
+
+# 对一段 contents (后缀) 调用 countTokens 的函数，返回其 Token 数
+CountFunction = Callable[[List[Dict[str, Any]]], Awaitable[int]]
+
+
+def prefix_chain_hashes(
+    model_name: str, contents: Sequence[Any], token_estimates: TokenEstimateCache
+) -> List[Optional[str]]:
+    """
+    计算 contents 每个前缀的链式哈希，返回列表的第 i 项对应前 i + 1 条消息。
+
+    某条消息无法序列化时，该条及其后所有前缀的哈希为 None (不参与缓存)。
+    """
+    hashes: List[Optional[str]] = []
+    previous: Optional[str] = model_name
+    for message in contents:
+        digest = token_estimates.message_hash(message)
+        if previous is None or digest is None:
+            previous = None
+        else:
+            previous = hashlib.blake2b(
+                f"{previous}:{digest}".encode("utf-8"), digest_size=16
+            ).hexdigest()
+        hashes.append(previous)
+    return hashes
+
+
+def is_borderline(estimated_tokens: int, threshold: int, margin: float) -> bool:
+    """估算值是否落在阈值上下 margin 比例以内 (只有这类请求才值得调用 countTokens)。"""
+    return abs(estimated_tokens - threshold) <= threshold * margin
+
+
+class UpstreamTokenCounter:
+    """
+    带前缀缓存的上游 Token 计数器。
+
+    Attributes:
+        calls (int): 实际发出的 countTokens 调用次数。
+        full_hits (int): 整个 contents 直接命中缓存的次数。
+        prefix_hits (int): 命中部分前缀、只对新增后缀调用 countTokens 的次数。
+        messages_counted (int): 通过 countTokens 计数的消息条数。
+        messages_reused (int): 通过缓存前缀复用、无需再次计数的消息条数。
+        failures (int): countTokens 调用失败或超时的次数。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self._prefix_tokens: LRUMap[int] = LRUMap(
+            max_entries
+            if max_entries is not None
+            else config.UPSTREAM_TOKEN_COUNT_CACHE_SIZE
+        )
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.full_hits = 0
+        self.prefix_hits = 0
+        self.messages_counted = 0
+        self.messages_reused = 0
+        self.failures = 0
+
+    async def count(
+        self,
+        model_name: str,
+        contents: Sequence[Any],
+        count_fn: CountFunction,
+        token_estimates: Optional[TokenEstimateCache] = None,
+        timeout_seconds: Optional[float] = None,
+    ) -> Optional[int]:
+        """
+        返回 contents 的精确 Token 数，优先复用最长的已缓存前缀。
+
+        Args:
+            model_name (str): 模型名称 (不同模型的计数分开缓存)。
+            contents (Sequence[Any]): 要计数的 Gemini contents。
+            count_fn (CountFunction): 对一段后缀调用 countTokens 的函数。
+            token_estimates (Optional[TokenEstimateCache]): 请求级估算缓存，用于复用消息哈希，
+                并用精确值校准本地估算。
+            timeout_seconds (Optional[float]): countTokens 调用的超时时间，None 时使用配置值。
+
+        Returns:
+            Optional[int]: 精确 Token 数；调用失败或超时时返回 None。
+        """
+        if not contents:
+            return 0
+        if token_estimates is None:
+            token_estimates = TokenEstimateCache(model_name)
+        hashes = prefix_chain_hashes(model_name, contents, token_estimates)
+
+        # 从最长的前缀开始查找已缓存的 Token 总数
+        cached_count = 0
+        cached_tokens = 0
+        for length in range(len(contents), 0, -1):
+            digest = hashes[length - 1]
+            if digest is None:
+                continue
+            value = self._prefix_tokens.get(digest, None)
+            if value is not None:
+                cached_count, cached_tokens = length, value  # type: ignore[assignment]
+                break
+
+        if cached_count == len(contents):
+            with self._lock:
+                self.full_hits += 1
+                self.messages_reused += cached_count
+            return cached_tokens
+
+        suffix = list(contents[cached_count:])
+        if timeout_seconds is None:
+            timeout_seconds = config.UPSTREAM_TOKEN_COUNT_TIMEOUT_SECONDS
+        try:
+            suffix_tokens = await asyncio.wait_for(count_fn(suffix), timeout_seconds)
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            logger.warning(
+                f"countTokens 调用失败，回退到本地估算 (Model: {model_name}): {type(e).__name__}: {e}"
+            )
+            return None
+
+        total = cached_tokens + suffix_tokens
+        with self._lock:
+            self.calls += 1
+            self.messages_counted += len(suffix)
+            if cached_count:
+                self.prefix_hits += 1
+                self.messages_reused += cached_count
+        if hashes[-1] is not None:
+            self._prefix_tokens.set(hashes[-1], total)
+        # 精确值同时用于校准本地估算
+        token_calibration.observe(
+            model_name, token_estimates.raw_estimate(contents), total
+        )
+        return total
+
+    def get_stats(self) -> Dict[str, int]:
+        """返回计数器统计和缓存条目数。"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "full_hits": self.full_hits,
+                "prefix_hits": self.prefix_hits,
+                "messages_counted": self.messages_counted,
+                "messages_reused": self.messages_reused,
+                "failures": self.failures,
+                "cached_prefixes": len(self._prefix_tokens),
+            }
+
+    def clear(self) -> None:
+        """清空前缀缓存和统计。"""
+        self._prefix_tokens.clear()
+        with self._lock:
+            self.calls = self.full_hits = self.prefix_hits = 0
+            self.messages_counted = self.messages_reused = self.failures = 0
+
+
+# 全局实例
+upstream_token_counter = UpstreamTokenCounter()
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+本地 Token 估算引擎与请求级的逐条消息估算缓存。
+
+原先的估算使用 len(json.dumps(contents)) // 4：JSON 标点、role 键和图片的整段 base64
+都被计入，中文等 CJK 文本 (一个字符约一个 Token) 却被低估到四分之一左右，
+导致截断和 TPM 预检查都不准确。
+
+本模块按 Gemini 的计费方式逐个 part 估算：
+- 文本按字符类别计数：CJK 字符每字约 1 Token，数字逐位计 Token，ASCII 标点各计 1 Token，
+  拉丁字母约 4 个字符 1 Token，其他非 ASCII 字符约 2 个字符 1 Token；
+- 图片按固定的分块成本计算 (两边都不超过 384 像素为 258 Token，否则每 768x768 分块 258 Token)，
+  尺寸从 PNG / GIF / JPEG / WebP 的文件头解析，无法解析时按一个分块计算；
+  其他内联或文件数据 (音频、视频、PDF) 按一个分块的固定成本计算；
+- functionCall / functionResponse 按名称和参数 (或返回值) 的文本估算，另加少量结构开销。
+
+单条消息的估算值缓存在以内容哈希为键的全局 LRU 中 (多轮对话的历史消息在后续请求中直接命中)，
+请求内再以消息对象为键缓存一次，避免重复哈希。
+可选的校准根据 API 返回的 promptTokenCount 按模型维护实际值与估算值之比 (指数移动平均)，
+估算结果乘以该系数。
+"""
+
+import base64  # 解码图片文件头
+import hashlib  # 消息内容哈希
+import json  # 序列化消息用于哈希，以及函数参数的文本估算
+import logging  # 导入日志模块
+import math  # 向上取整
+import re  # 按字符类别计数
+import struct  # 解析图片文件头中的尺寸
+import threading  # 保护校准系数
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from gap import config as app_config  # 导入应用配置
+from gap.core.utils.lru import LRUMap  # 线程安全的有界 LRU 映射
+
+logger = logging.getLogger("my_logger")
+
+# --- 文本的字符类别与每字符 Token 数 ---
+CJK_TOKENS_PER_CHAR = 1.0  # 中日韩文字 (含假名、谚文和全角标点)
+DIGIT_TOKENS_PER_CHAR = 1.0  # 数字逐位切分
+PUNCT_TOKENS_PER_CHAR = 1.0  # ASCII 标点和符号
+LATIN_TOKENS_PER_CHAR = 0.25  # ASCII 字母 (约 4 个字符 1 Token，空白并入相邻的词)
+# 其他非 ASCII 字符 (西里尔字母、带重音的拉丁字母、表情符号等)
+OTHER_TOKENS_PER_CHAR = 0.5
+
+# --- 多模态与结构开销 ---
+IMAGE_TOKENS_PER_TILE = 258  # 每个图片分块的固定成本
+IMAGE_SMALL_MAX_SIDE = 384  # 两边都不超过此尺寸的图片只算一个分块
+IMAGE_TILE_SIDE = 768  # 大图按此边长分块
+MEDIA_PART_TOKENS = IMAGE_TOKENS_PER_TILE  # 无法解析尺寸的图片及其他媒体数据的固定成本
+FUNCTION_PART_OVERHEAD_TOKENS = 4  # functionCall / functionResponse 的结构开销
+MESSAGE_OVERHEAD_TOKENS = 1  # 每条消息 (role 与分隔) 的开销
+
+# 解析图片尺寸时最多解码的 base64 字符数 (JPEG 的 SOF 段通常位于文件开头的几十 KB 内)
+_IMAGE_HEADER_BASE64_CHARS = 64 * 1024
+
+_CJK_RE = re.compile(
+    r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+_DIGIT_RE = re.compile(r"[0-9]")
+_PUNCT_RE = re.compile(r"[!-/:-@\[-`{-~]")
+_LATIN_RE = re.compile(r"[A-Za-z]")
+
+
+def estimate_text_tokens(text: str) -> float:
+    """
+    按字符类别估算一段文本的 Token 数。
+
+    Args:
+        text (str): 文本内容。
+
+    Returns:
+        float: 估算的 Token 数 (未取整)。
+    """
+    if not text:
+        return 0.0
+    tokens = (
+        len(_LATIN_RE.findall(text)) * LATIN_TOKENS_PER_CHAR
+        + len(_DIGIT_RE.findall(text)) * DIGIT_TOKENS_PER_CHAR
+        + len(_PUNCT_RE.findall(text)) * PUNCT_TOKENS_PER_CHAR
+    )
+    if not text.isascii():
+        cjk = len(_CJK_RE.findall(text))
+        other = len(_NON_ASCII_RE.findall(text)) - cjk
+        tokens += cjk * CJK_TOKENS_PER_CHAR + other * OTHER_TOKENS_PER_CHAR
+    return tokens
+
+
+def _image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """(内部辅助函数) 从 PNG / GIF / JPEG / WebP 文件头解析图片的 (宽, 高)，无法识别时返回 None。"""
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+            width, height = struct.unpack(">II", data[16:24])
+            return width, height
+        if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+            width, height = struct.unpack("<HH", data[6:10])
+            return width, height
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+            chunk = data[12:16]
+            if chunk == b"VP8X":
+                width = int.from_bytes(data[24:27], "little") + 1
+                height = int.from_bytes(data[27:30], "little") + 1
+                return width, height
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            return None
+        if data[:2] == b"\xff\xd8":
+            # 逐段扫描 JPEG，直到遇到 SOF (帧头) 段
+            offset = 2
+            while offset + 9 < len(data):
+                if data[offset] != 0xFF:
+                    return None
+                marker = data[offset + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                    offset += 2
+                    continue
+                (segment_length,) = struct.unpack(">H", data[offset + 2 : offset + 4])
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+                    return width, height
+                offset += 2 + segment_length
+    except struct.error:
+        return None
+    return None
+
+
+def estimate_image_tokens(data: Any) -> int:
+    """
+    估算一张内联图片的 Token 数。
+
+    Args:
+        data (Any): base64 编码的图片数据 (str) 或原始字节。
+
+    Returns:
+        int: 估算的 Token 数；尺寸无法解析时按一个分块计算。
+    """
+    header: bytes = b""
+    try:
+        if isinstance(data, (bytes, bytearray)):
+            header = bytes(data[: _IMAGE_HEADER_BASE64_CHARS * 3 // 4])
+        elif isinstance(data, str):
+            prefix = data[:_IMAGE_HEADER_BASE64_CHARS]
+            header = base64.b64decode(prefix[: len(prefix) // 4 * 4])
+    except (ValueError, TypeError):
+        header = b""
+    dimensions = _image_dimensions(header) if header else None
+    if dimensions is None:
+        return MEDIA_PART_TOKENS
+    width, height = dimensions
+    if width <= IMAGE_SMALL_MAX_SIDE and height <= IMAGE_SMALL_MAX_SIDE:
+        return IMAGE_TOKENS_PER_TILE
+    tiles = math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE)
+    return max(1, tiles) * IMAGE_TOKENS_PER_TILE
+
+
+def _estimate_structured_tokens(value: Any) -> float:
+    """(内部辅助函数) 函数参数、返回值等结构化数据按其 JSON 文本估算。"""
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        return estimate_text_tokens(value)
+    try:
+        return estimate_text_tokens(json.dumps(value, ensure_ascii=False))
+    except TypeError:
+        return estimate_text_tokens(str(value))
+
+
+def estimate_part_tokens(part: Any) -> float:
+    """
+    估算单个 Gemini part 的 Token 数。同时支持 snake_case 和 camelCase 字段名。
+
+    Args:
+        part (Any): Gemini 格式的 part (通常为字典)。
+
+    Returns:
+        float: 估算的 Token 数 (未取整)。
+    """
+    if isinstance(part, str):
+        return estimate_text_tokens(part)
+    if not isinstance(part, dict):
+        return _estimate_structured_tokens(part)
+
+    text = part.get("text")
+    if isinstance(text, str):
+        return estimate_text_tokens(text)
+
+    inline_data = part.get("inline_data") or part.get("inlineData")
+    if isinstance(inline_data, dict):
+        mime_type = inline_data.get("mime_type") or inline_data.get("mimeType") or ""
+        if str(mime_type).startswith("image/"):
+            return estimate_image_tokens(inline_data.get("data"))
+        return MEDIA_PART_TOKENS
+
+    if part.get("file_data") or part.get("fileData"):
+        return MEDIA_PART_TOKENS
+
+    function_call = part.get("function_call") or part.get("functionCall")
+    if isinstance(function_call, dict):
+        return (
+            FUNCTION_PART_OVERHEAD_TOKENS
+            + estimate_text_tokens(str(function_call.get("name", "")))
+            + _estimate_structured_tokens(function_call.get("args"))
+        )
+
+    function_response = part.get("function_response") or part.get("functionResponse")
+    if isinstance(function_response, dict):
+        return (
+            FUNCTION_PART_OVERHEAD_TOKENS
+            + estimate_text_tokens(str(function_response.get("name", "")))
+            + _estimate_structured_tokens(function_response.get("response"))
+        )
+
+    # 未识别的 part 类型 (例如 executableCode)，按其 JSON 文本估算
+    return _estimate_structured_tokens(part)
+
+
+def estimate_message_tokens(message: Any) -> float:
+    """
+    估算单条 Gemini 消息 (content) 的 Token 数，不使用缓存。
+
+    Args:
+        message (Any): Gemini 格式的单条消息，或 system_instruction 字典。
+
+    Returns:
+        float: 估算的 Token 数 (未取整，未校准)。
+    """
+    if not isinstance(message, dict):
+        return _estimate_structured_tokens(message)
+    parts = message.get("parts")
+    if not isinstance(parts, list):
+        return MESSAGE_OVERHEAD_TOKENS + _estimate_structured_tokens(parts)
+    return MESSAGE_OVERHEAD_TOKENS + sum(estimate_part_tokens(part) for part in parts)
+
+
+def message_content_hash(message: Any) -> Optional[str]:
+    """
+    单条消息内容的哈希，用作全局估算缓存的键。
+
+    Returns:
+        Optional[str]: 十六进制哈希值；消息无法序列化时返回 None (不缓存)。
+    """
+    try:
+        serialized = json.dumps(message, ensure_ascii=False, sort_keys=True)
+    except TypeError:
+        return None
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class TokenCalibration:
+    """
+    按模型维护的估算校准系数 (实际 promptTokenCount / 本地估算值) 的指数移动平均。
+
+    系数被限制在 [min_factor, max_factor] 之间，估算值过小的样本不参与校准。
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.1,
+        min_factor: float = 0.5,
+        max_factor: float = 2.0,
+        min_sample_tokens: int = 32,
+    ):
+        self.alpha = alpha
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.min_sample_tokens = min_sample_tokens
+        self._factors: Dict[str, float] = {}
+        self._samples: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def factor(self, model_name: Optional[str]) -> float:
+        """返回模型当前的校准系数；未启用校准或没有样本时为 1.0。"""
+        if not model_name or not getattr(
+            app_config, "ENABLE_TOKEN_ESTIMATE_CALIBRATION", True
+        ):
+            return 1.0
+        return self._factors.get(model_name, 1.0)
+
+    def observe(
+        self, model_name: str, estimated_tokens: float, actual_tokens: Optional[int]
+    ) -> None:
+        """
+        记录一次 API 返回的实际输入 Token 数。
+
+        Args:
+            model_name (str): 模型名称。
+            estimated_tokens (float): 发送内容的本地估算值 (未校准)。
+            actual_tokens (Optional[int]): API 返回的 promptTokenCount。
+        """
+        if (
+            not actual_tokens
+            or actual_tokens <= 0
+            or estimated_tokens < self.min_sample_tokens
+        ):
+            return
+        ratio = min(
+            self.max_factor, max(self.min_factor, actual_tokens / estimated_tokens)
+        )
+        with self._lock:
+            current = self._factors.get(model_name)
+            self._factors[model_name] = (
+                ratio if current is None else current + self.alpha * (ratio - current)
+            )
+            self._samples[model_name] = self._samples.get(model_name, 0) + 1
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """返回各模型的校准系数和样本数。"""
+        with self._lock:
+            return {
+                model: {"factor": round(factor, 4), "samples": self._samples[model]}
+                for model, factor in self._factors.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._factors.clear()
+            self._samples.clear()
+
+
+# 全局实例：按内容哈希缓存的单条消息估算值，以及按模型的校准系数
+message_token_memo: LRUMap[float] = LRUMap(
+    getattr(app_config, "TOKEN_ESTIMATE_MEMO_SIZE", 50000)
+)
+token_calibration = TokenCalibration()
+
+
+def _memoized_message_tokens(message: Any) -> Tuple[float, Optional[str]]:
+    """(内部辅助函数) 通过全局 LRU 查找单条消息的估算值，未命中时计算并写入；同时返回内容哈希。"""
+    digest = message_content_hash(message)
+    if digest is not None:
+        cached = message_token_memo.get(digest, None)
+        if cached is not None:
+            return cached, digest  # type: ignore[return-value]
+    tokens = estimate_message_tokens(message)
+    if digest is not None:
+        message_token_memo.set(digest, tokens)
+    return tokens, digest
+
+
+class TokenEstimateCache:
+    """
+    请求级的逐条消息 Token 估算缓存。
+
+    以消息对象的 id 为键，并同时持有消息对象本身，保证缓存存活期间 id 不会被复用。
+    同一请求中 initial_contents + gemini_contents 每次拼接出的新列表引用的是同一批消息对象，
+    因此每条消息在一个请求内只会被哈希和估算一次；跨请求的重复消息由全局 LRU 命中。
+    """
+
+    def __init__(self, model_name: Optional[str] = None) -> None:
+        self.model_name = model_name  # 用于查找校准系数
+        self._tokens: Dict[int, Tuple[Any, float, Optional[str]]] = {}
+        self.computed = 0  # 本请求内实际估算 (或查询全局缓存) 的消息数 (用于调试和测试)
+
+    def _entry(self, message: Any) -> Tuple[Any, float, Optional[str]]:
+        """(内部辅助函数) 返回消息的 (消息对象, 估算值, 内容哈希)，首次遇到时计算并缓存。"""
+        entry = self._tokens.get(id(message))
+        if entry is not None and entry[0] is message:
+            return entry
+        tokens, digest = _memoized_message_tokens(message)
+        self.computed += 1
+        entry = (message, tokens, digest)
+        self._tokens[id(message)] = entry
+        return entry
+
+    def message_tokens(self, message: Any) -> float:
+        """返回单条消息的估算值 (未校准)。"""
+        return self._entry(message)[1]
+
+    def message_hash(self, message: Any) -> Optional[str]:
+        """返回单条消息的内容哈希 (与估算共用一次序列化)；无法序列化时为 None。"""
+        return self._entry(message)[2]
+
+    def _calibrated(self, raw_tokens: float, scale: float = 1.0) -> int:
+        """(内部辅助函数) 对估算值应用校准系数 (以及额外的缩放比例) 并向上取整。"""
+        if raw_tokens <= 0:
+            return 0
+        factor = token_calibration.factor(self.model_name) * scale
+        return math.ceil(raw_tokens * factor - 1e-9)
+
+    def prefix_sums(self, contents: Sequence[Any]) -> List[float]:
+        """
+        返回逐条消息估算值的前缀和，长度为 len(contents) + 1，
+        prefix[i] 为前 i 条消息的估算值之和 (未校准)。
+        """
+        prefix = [0.0] * (len(contents) + 1)
+        total = 0.0
+        for i, message in enumerate(contents):
+            total += self.message_tokens(message)
+            prefix[i + 1] = total
+        return prefix
+
+    def raw_estimate(self, contents: Sequence[Any]) -> float:
+        """contents 列表的估算值 (未校准、未取整)，用于校准。"""
+        return sum(self.message_tokens(message) for message in contents)
+
+    def estimate(self, contents: Sequence[Any]) -> int:
+        """估算 contents 列表的 Token 数 (已校准)。"""
+        if not contents:
+            return 0
+        return self._calibrated(self.raw_estimate(contents))
+
+    def find_truncation_start(
+        self,
+        contents: Sequence[Any],
+        threshold: int,
+        prefix: Optional[List[float]] = None,
+        scale: float = 1.0,
+    ) -> Tuple[int, int]:
+        """
+        找到需要从开头成对移除的最少消息数，使剩余消息的估算 Token 数不超过 threshold。
+
+        剩余部分的估算值随移除的消息数单调不增，因此在偶数切点上二分查找。
+        与逐对移除的策略一致：剩余消息少于 2 条时不再继续移除。
+
+        Args:
+            contents (Sequence[Any]): 完整的对话历史。
+            threshold (int): 截断目标 Token 数。
+            prefix (Optional[List[float]]): 已计算好的前缀和，None 时现场计算。
+            scale (float): 额外的缩放比例，例如上游精确计数与本地估算之比。
+
+        Returns:
+            Tuple[int, int]: (切点下标 start, contents[start:] 的估算 Token 数)。
+        """
+        if prefix is None:
+            prefix = self.prefix_sums(contents)
+        total_count = len(contents)
+
+        def suffix_tokens(start: int) -> int:
+            return self._calibrated(prefix[total_count] - prefix[start], scale)
+
+        # 可选的切点为 0, 2, 4, ..., max_pairs * 2
+        max_pairs = total_count // 2
+        low, high = 0, max_pairs
+        while low < high:
+            mid = (low + high) // 2
+            if suffix_tokens(mid * 2) <= threshold:
+                high = mid
+            else:
+                low = mid + 1
+        start = low * 2
+        return start, suffix_tokens(start)
+
+
+def calibrate_from_usage(
+    token_estimates: Optional[TokenEstimateCache],
+    model_name: str,
+    contents: Sequence[Any],
+    system_instruction: Optional[Dict[str, Any]],
+    prompt_token_count: Optional[int],
+) -> None:
+    """
+    用 API 返回的 promptTokenCount 校准本地估算。
+
+    Args:
+        token_estimates (Optional[TokenEstimateCache]): 请求级估算缓存 (发送的内容通常已在其中)。
+        model_name (str): 模型名称。
+        contents (Sequence[Any]): 实际发送的 contents。
+        system_instruction (Optional[Dict[str, Any]]): 实际发送的系统指令 (也计入 promptTokenCount)。
+        prompt_token_count (Optional[int]): API 返回的输入 Token 数。
+    """
+    if not prompt_token_count or not getattr(
+        app_config, "ENABLE_TOKEN_ESTIMATE_CALIBRATION", True
+    ):
+        return
+    cache = token_estimates if token_estimates is not None else TokenEstimateCache()
+    estimated = cache.raw_estimate(contents)
+    if system_instruction:
+        estimated += cache.message_tokens(system_instruction)
+    token_calibration.observe(model_name, estimated, prompt_token_count)
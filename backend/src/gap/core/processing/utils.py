@@ -5,8 +5,16 @@
 import json  # 导入 JSON 处理模块
 import logging  # 导入日志模块
 import time  # 导入时间模块
-from collections import Counter, defaultdict  # 导入集合类型
-from typing import Any, Dict, List, Optional, Tuple  # 导入类型提示
+from collections import Counter  # 导入集合类型
+from typing import (  # 导入类型提示
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from sqlalchemy.ext.asyncio import AsyncSession  # 导入 AsyncSession 类型
 
@@ -18,12 +26,24 @@ from gap.core.context.store import ContextStore
 # 导入核心模块
 from gap.core.database import utils as db_utils  # 导入数据库工具模块
 
-# 导入跟踪相关的数据结构和常量
-from gap.core.tracking import TPM_WINDOW_SECONDS  # 使用数据、锁及时间窗口常量
+from gap.core.keys.limiter import (  # RPM / TPM 滑动窗口速率限制器与 Token 预留
+    TokenReservation,
+    key_rate_limiter,
+)
+
+from gap.core.processing.token_count import is_borderline  # 是否接近截断阈值
+from gap.core.processing.token_estimate import (  # 逐条消息 Token 估算缓存
+    TokenEstimateCache,
+)
+from gap.core.shared_state import shared_state_backend  # 多 worker 共享的状态后端
+
+# 导入跟踪相关的数据结构和锁
 from gap.core.tracking import ip_input_token_counts_lock  # IP 每日输入 Token 计数及锁
+from gap.core.utils.request_helpers import get_current_timestamps  # 太平洋时区日期
 from gap.core.tracking import (
-    RPM_WINDOW_SECONDS,
+    dirty_ip_token_counts,
     ip_daily_input_token_counts,
+    mark_usage_dirty,
     usage_data,
     usage_lock,
 )
@@ -34,34 +54,24 @@ logger = logging.getLogger("my_logger")  # 获取日志记录器实例
 # --- Token 估算与上下文截断 (来自 token_utils.py) ---
 
 
-def estimate_token_count(contents: List[Dict[str, Any]]) -> int:
+def estimate_token_count(
+    contents: List[Dict[str, Any]], model_name: Optional[str] = None
+) -> int:
     """
     估算 Gemini contents 列表的 Token 数量。
-    使用简单的字符数估算方法 (1 个 token 大约等于 4 个字符)。
-    注意：这是一个非常粗略的估算，实际 Token 数可能因模型和内容而异。
+    使用本地估算引擎逐条消息估算 (文本按字符类别、图片按分块成本、函数调用按参数文本)，
+    单条消息的结果按内容哈希缓存；提供 model_name 时应用该模型的校准系数。
 
     Args:
         contents (List[Dict[str, Any]]): Gemini 格式的内容列表。
+        model_name (Optional[str]): 模型名称，用于查找校准系数。
 
     Returns:
         int: 估算的 Token 数量。
     """
     if not contents:  # 检查列表是否为空
         return 0  # 如果为空，返回 0
-    try:
-        # 计算 JSON 序列化后的字符数
-        # ensure_ascii=False 确保中文字符等非 ASCII 字符按实际字符数计算，而不是转义序列
-        char_count = len(
-            json.dumps(contents, ensure_ascii=False)
-        )  # 序列化为 JSON 字符串并获取长度
-        # 使用 1 token ≈ 4 chars 的简化规则进行估算
-        return char_count // 4  # 返回估算的 Token 数
-    except TypeError as e:
-        # 捕获并记录序列化过程中可能发生的类型错误
-        logger.error(
-            f"序列化 contents 进行 Token 估算时出错: {e}", exc_info=True
-        )  # 记录错误日志
-        return 0  # 如果序列化失败，返回 0
+    return TokenEstimateCache(model_name).estimate(contents)
 
 
 async def truncate_context(  # 改为 async 函数，因为内部可能调用 async 函数 (如 estimate_token_count 未来可能改为调用 API)
@@ -70,17 +80,27 @@ async def truncate_context(  # 改为 async 函数，因为内部可能调用 as
     dynamic_max_tokens_limit: Optional[
         int
     ] = None,  # 新增可选参数，表示基于 Key 实时容量的动态限制
+    token_estimates: Optional[TokenEstimateCache] = None,  # 请求级的逐条消息估算缓存
+    precise_counter: Optional[  # 可选的上游精确计数函数 (仅用于接近阈值的请求)
+        Callable[[List[Dict[str, Any]]], Awaitable[Optional[int]]]
+    ] = None,
 ) -> Tuple[List[Dict[str, Any]], bool]:
     """
     根据模型限制和可选的动态限制截断对话历史 (contents)。
     采用从开头成对移除消息（通常是 user/model 对）的策略，
-    直到估算的 Token 数量满足限制要求。
+    直到估算的 Token 数量满足限制要求。切点基于逐条消息估算值的前缀和二分查找，
+    整体为 O(n)。
 
     Args:
         contents (List[Dict[str, Any]]): 完整的对话历史列表 (Gemini 格式)。
         model_name (str): 当前请求使用的模型名称，用于查找其 Token 限制。
         dynamic_max_tokens_limit (Optional[int]): 可选的动态 Token 限制，
             通常基于 API Key 的实时可用容量。如果提供，将使用此限制与模型静态限制中的较小值。
+        token_estimates (Optional[TokenEstimateCache]): 请求级的逐条消息 Token 估算缓存，
+            同一请求内多次截断时复用已计算的消息估算值。None 表示仅在本次调用内使用临时缓存。
+        precise_counter (Optional[Callable]): 返回 contents 精确 Token 数的异步函数 (通常调用
+            countTokens)。仅当估算值落在阈值上下 UPSTREAM_TOKEN_COUNT_MARGIN 比例以内时调用，
+            返回 None 时沿用本地估算。
 
     Returns:
         Tuple[List[Dict[str, Any]], bool]:
@@ -150,33 +170,44 @@ async def truncate_context(  # 改为 async 函数，因为内部可能调用 as
     )  # 计算最终的截断目标 Token 数
 
     # --- 执行截断 ---
-    # 估算当前内容的 Token 数量
-    estimated_tokens = estimate_token_count(contents)  # 调用 Token 估算函数
+    # 逐条消息的估算值只计算一次 (同一请求内复用)，再用前缀和估算任意后缀的 Token 数
+    if token_estimates is None:
+        token_estimates = TokenEstimateCache(model_name)
+    prefix = token_estimates.prefix_sums(contents)
+    estimated_tokens = token_estimates.estimate(contents)  # 调用 Token 估算函数
+    precise_scale = 1.0  # 上游精确计数与本地估算之比，用于确定截断切点
+
+    # 估算值接近阈值时，用上游 countTokens 的精确值决定是否截断 (失败时沿用估算值)
+    if precise_counter is not None and is_borderline(
+        estimated_tokens,
+        truncation_threshold,
+        getattr(app_config, "UPSTREAM_TOKEN_COUNT_MARGIN", 0.1),
+    ):
+        counted_tokens = await precise_counter(contents)
+        if counted_tokens is not None:
+            logger.debug(
+                f"上下文接近阈值，使用 countTokens 精确值 {counted_tokens} (本地估算 {estimated_tokens})"
+            )
+            # 精确计数会更新校准系数，按更新后的估算值计算比例
+            recalibrated_tokens = token_estimates.estimate(contents)
+            if recalibrated_tokens > 0:
+                precise_scale = counted_tokens / recalibrated_tokens
+            estimated_tokens = counted_tokens
 
     # 判断是否需要截断
     if estimated_tokens > truncation_threshold:  # 如果估算 Token 数超过了阈值
         logger.info(
             f"上下文估算 Token ({estimated_tokens}) 超出阈值 ({truncation_threshold} for model {model_name}, actual max tokens {actual_max_tokens})，开始截断..."
         )  # 记录开始截断的日志
-        # 创建内容的副本进行操作，避免修改原始列表
-        truncated_contents = list(contents)  # 复制列表
-        # 循环移除消息对，直到满足 Token 限制或无法再移除
-        while (
-            estimate_token_count(truncated_contents) > truncation_threshold
-            and len(truncated_contents) >= 2
-        ):
-            # 从列表开头移除两个元素（假设是 user/model 对）
-            removed_first = truncated_contents.pop(0)  # 移除第一个元素 (通常是 user)
-            removed_second = truncated_contents.pop(0)  # 移除第二个元素 (通常是 model)
-            # 记录被移除的消息的角色，用于调试
-            logger.debug(
-                f"移除旧消息对: roles={removed_first.get('role')}, {removed_second.get('role')}"
-            )  # 记录移除的消息角色
-
-        # 重新估算截断后的 Token 数量
-        final_estimated_tokens = estimate_token_count(
-            truncated_contents
-        )  # 估算最终 Token 数
+        # 从列表开头成对移除消息（假设是 user/model 对），直到满足 Token 限制或无法再移除；
+        # 切点通过前缀和上的二分查找一次确定，不再逐对移除并重新序列化
+        cut_index, final_estimated_tokens = token_estimates.find_truncation_start(
+            contents, truncation_threshold, prefix, scale=precise_scale
+        )
+        truncated_contents = list(contents[cut_index:])  # 复制剩余部分，避免修改原始列表
+        logger.debug(
+            f"移除旧消息 {cut_index} 条 (共 {len(contents)} 条)"
+        )  # 记录移除的消息数量
 
         # 检查截断后是否仍然超限
         if final_estimated_tokens > truncation_threshold:  # 如果截断后仍然超过阈值
@@ -200,15 +231,75 @@ async def truncate_context(  # 改为 async 函数，因为内部可能调用 as
 
 # --- 速率限制检查与计数更新 (来自 rate_limit_utils.py) ---
 
+# 共享状态后端中每日计数器的保留时间（秒），名称中已包含日期，过期只用于回收空间
+DAILY_COUNTER_TTL_SECONDS = 2 * 24 * 3600
+
+
+def _daily_counter_name(kind: str, api_key: str, model_name: str) -> str:
+    """(内部辅助函数) 共享状态后端中当天 (太平洋时间) 的 RPD / TPD 计数器名称。"""
+    return f"{kind}:{get_current_timestamps()[1]}:{model_name}:{api_key}"
+
+
+def _check_shared_daily_limits(
+    api_key: str, model_name: str, limits: Dict[str, Any], now: float
+) -> bool:
+    """
+    (内部辅助函数) 多 worker 部署时的 RPD / TPD_Input 检查和 RPD、RPM 占用。
+    以共享计数为准 (RPD 的检查和累加是一次原子操作)，
+    本进程的 usage_data 同步为共享计数的最新值，供报告和 Key 评分使用。
+    """
+    backend = shared_state_backend
+    assert backend is not None
+    tpd_input_limit = limits.get("tpd_input")
+    if tpd_input_limit is not None:
+        tpd_used = backend.counter_get(_daily_counter_name("tpd", api_key, model_name))
+        if tpd_used >= tpd_input_limit:
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): TPD_Input 达到限制 ({tpd_used}/{tpd_input_limit})。跳过此 Key。"
+            )
+            return False
+
+    rpd_limit = limits.get("rpd")
+    rpd_count: Optional[int] = None
+    if rpd_limit is not None:
+        rpd_name = _daily_counter_name("rpd", api_key, model_name)
+        added, rpd_count = backend.counter_add(
+            rpd_name, 1, rpd_limit, DAILY_COUNTER_TTL_SECONDS
+        )
+        if not added:
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPD 达到限制 ({rpd_count}/{rpd_limit})。跳过此 Key。"
+            )
+            return False
+
+    rpm_limit = limits.get("rpm")
+    if not key_rate_limiter.try_acquire(api_key, model_name, "rpm", rpm_limit, 1, now):
+        if rpd_count is not None:  # 归还已占用的 RPD
+            backend.counter_add(rpd_name, -1, None, DAILY_COUNTER_TTL_SECONDS)
+        logger.warning(
+            f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPM 达到限制 ({rpm_limit})。跳过此 Key。"
+        )
+        return False
+
+    with usage_lock:
+        key_usage = usage_data[api_key][model_name]
+        if rpd_count is not None:
+            key_usage["rpd_count"] = rpd_count
+        key_usage["last_request_timestamp"] = now
+        mark_usage_dirty(api_key, model_name)
+    return True
+
+
 
 def check_rate_limits_and_update_counts(
     api_key: str, model_name: str, limits: Optional[Dict[str, Any]]
 ) -> bool:
     """
-    检查给定 API Key 和模型的速率限制 (RPD, TPD_Input, RPM, TPM_Input)。
+    检查给定 API Key 和模型的速率限制 (RPD, TPD_Input, RPM, TPM_Input, TPM_Output)。
     此函数在选择 Key *之前* 调用，用于预检查 Key 是否已达到已知限制。
-    如果未达到限制，则更新 RPM 和 RPD 计数（假设本次请求会发生），并返回 True。
-    如果达到任何限制，则记录警告并返回 False，表示不应选择此 Key。
+    如果未达到限制，则占用一次 RPM 额度并增加 RPD 计数（假设本次请求会发生），并返回 True。
+    如果达到任何限制，则记录警告并返回 False，且不修改任何计数。
+    RPM / TPM 通过滑动窗口速率限制器 (key_rate_limiter) 判断，不存在固定窗口边界的突发。
 
     Args:
         api_key (str): 当前尝试使用的 API Key。
@@ -224,108 +315,62 @@ def check_rate_limits_and_update_counts(
         )  # 记录警告：模型不在限制配置中
         return True  # 没有限制信息，默认允许调用
 
-    now = time.time()  # 获取当前时间戳，用于 RPM 和 TPM 检查
-    perform_api_call = True  # 初始化标志：假设可以执行 API 调用
+    now = time.time()  # 获取当前时间戳
+
+    # --- 检查 TPM_Input / TPM_Output (每分钟 Token 数) ---
+    # 仅检查，不在此处占用额度，因为此时还不知道实际的 Token 数。
+    # 用量在 API 调用成功后的 update_token_counts 函数中记录。
+    tpm_dimensions = ("tpm_input", "tpm_output")
+    tpm_usage = key_rate_limiter.usage_many(  # 两个维度合并为一次读取
+        [(api_key, model_name, d, limits.get(d)) for d in tpm_dimensions], now
+    )
+    for dimension, tpm_used in zip(tpm_dimensions, tpm_usage):
+        tpm_limit = limits.get(dimension)
+        if tpm_limit and tpm_used >= tpm_limit:
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): {dimension.upper()} 达到限制 ({tpm_used:.0f}/{tpm_limit})。跳过此 Key。"
+            )  # 记录 TPM 超限警告
+            return False
+
+    if shared_state_backend is not None:
+        return _check_shared_daily_limits(api_key, model_name, limits, now)
 
     with usage_lock:  # 获取使用数据锁，保证对共享数据 usage_data 的访问是线程安全的
-        # 使用 setdefault 确保 key 和 model 的条目存在于 usage_data 中，避免 KeyError
-        # 如果键不存在，会使用 defaultdict 的默认工厂（这里是另一个 defaultdict）创建新条目
-        key_usage = usage_data.setdefault(
-            api_key, defaultdict(lambda: defaultdict(int))
-        )[
-            model_name
-        ]  # 获取或创建 Key 和模型的用法数据字典
-
-        # --- 检查并更新 RPM (每分钟请求数) ---
+        key_usage = usage_data[api_key][model_name]  # 获取或创建 Key 和模型的用法数据字典
+
+        # --- 检查 RPD (每日请求数) 和 TPD_Input (每日输入 Token 数) ---
+        rpd_limit = limits.get("rpd")  # 获取 RPD 限制值
+        if rpd_limit is not None and key_usage.get("rpd_count", 0) + 1 > rpd_limit:
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPD 达到限制 ({key_usage.get('rpd_count', 0)}/{rpd_limit})。跳过此 Key。"
+            )  # 记录 RPD 超限警告
+            return False
+        tpd_input_limit = limits.get("tpd_input")  # 获取 TPD_Input 限制值
+        if (
+            tpd_input_limit is not None
+            and key_usage.get("tpd_input_count", 0) >= tpd_input_limit
+        ):  # 如果设置了限制且当前计数已达到或超过限制
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): TPD_Input 达到限制 ({key_usage.get('tpd_input_count', 0)}/{tpd_input_limit})。跳过此 Key。"
+            )  # 记录 TPD_Input 超限警告
+            return False
+
+        # --- 占用 RPM (每分钟请求数) 额度 ---
+        # 速率限制器使用独立的锁，且不会获取其他锁，因此可以在此处调用
         rpm_limit = limits.get("rpm")  # 从模型限制中获取 RPM 限制值
-        if rpm_limit is not None:  # 如果配置了 RPM 限制
-            current_rpm_count = key_usage.get(
-                "rpm_count", 0
-            )  # 获取当前 RPM 计数，默认为 0
-            rpm_timestamp = key_usage.get(
-                "rpm_timestamp", 0
-            )  # 获取上次 RPM 窗口开始时间戳，默认为 0
-
-            if (
-                now - rpm_timestamp >= RPM_WINDOW_SECONDS
-            ):  # 检查当前时间是否已经超过了 RPM 窗口时长
-                # RPM 窗口已过期，重置计数并将当前请求计为 1
-                key_usage["rpm_count"] = 1  # 新窗口的第一个请求
-                key_usage["rpm_timestamp"] = now  # 更新窗口开始时间戳为当前时间
-                logger.debug(
-                    f"RPM 窗口过期，重置计数并增加 (Key: {api_key[:8]}, Model: {model_name}): 新 RPM=1"
-                )  # 记录 RPM 窗口过期和重置
-            else:
-                # RPM 窗口未过期，检查加上当前这个预期的请求是否会超限
-                if current_rpm_count + 1 > rpm_limit:  # 如果当前计数加 1 超过限制
-                    logger.warning(
-                        f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPM 达到限制 ({current_rpm_count}/{rpm_limit})。跳过此 Key。"
-                    )  # 记录 RPM 超限警告
-                    perform_api_call = False  # 设置标志为 False，表示不能选择此 Key
-                else:
-                    # 未达到限制，预先增加计数（假设此 Key 会被选中并使用）
-                    key_usage["rpm_count"] = current_rpm_count + 1  # RPM 计数加 1
-                    # 时间戳保持不变，因为仍在当前窗口内
-                    logger.debug(
-                        f"RPM 计数增加 (Key: {api_key[:8]}, Model: {model_name}): 新 RPM={key_usage['rpm_count']}"
-                    )  # 记录 RPM 计数增加
-
-        # --- 检查并更新 RPD (每日请求数) ---
-        # 仅在之前的检查（RPM）通过时才进行 RPD 检查
-        if perform_api_call:
-            rpd_limit = limits.get("rpd")  # 获取 RPD 限制值
-            if rpd_limit is not None:  # 如果配置了 RPD 限制
-                current_rpd_count = key_usage.get(
-                    "rpd_count", 0
-                )  # 获取当前 RPD 计数，默认为 0
-                # RPD 是每日计数，不需要时间窗口检查，直接判断是否超限
-                if current_rpd_count + 1 > rpd_limit:  # 如果当前计数加 1 超过限制
-                    logger.warning(
-                        f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPD 达到限制 ({current_rpd_count}/{rpd_limit})。跳过此 Key。"
-                    )  # 记录 RPD 超限警告
-                    perform_api_call = False  # 设置标志为 False
-                else:
-                    # 未达到限制，预先增加计数
-                    key_usage["rpd_count"] = current_rpd_count + 1  # RPD 计数加 1
-                    logger.debug(
-                        f"RPD 计数增加 (Key: {api_key[:8]}, Model: {model_name}): 新 RPD={key_usage['rpd_count']}"
-                    )  # 记录 RPD 计数增加
-
-        # --- 检查 TPD_Input (每日输入 Token 数) ---
-        # 仅检查，不在此处增加计数，因为此时还不知道实际的输入 Token 数。
-        # 计数更新在 API 调用成功后的 update_token_counts 函数中进行。
-        if perform_api_call:
-            tpd_input_limit = limits.get("tpd_input")  # 获取 TPD_Input 限制值
-            if (
-                tpd_input_limit is not None
-                and key_usage.get("tpd_input_count", 0) >= tpd_input_limit
-            ):  # 如果设置了限制且当前计数已达到或超过限制
-                logger.warning(
-                    f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): TPD_Input 达到限制 ({key_usage.get('tpd_input_count', 0)}/{tpd_input_limit})。跳过此 Key。"
-                )  # 记录 TPD_Input 超限警告
-                perform_api_call = False  # 设置标志为 False
-
-        # --- 检查 TPM_Input (每分钟输入 Token 数) ---
-        # 同样仅检查，不在此处增加计数。
-        if perform_api_call:
-            tpm_input_limit = limits.get("tpm_input")  # 获取 TPM_Input 限制值
-            if tpm_input_limit is not None:  # 如果设置了 TPM_Input 限制
-                # 检查是否仍在当前 TPM 窗口内
-                if now - key_usage.get("tpm_input_timestamp", 0) < TPM_WINDOW_SECONDS:
-                    # 如果在窗口内，检查当前 Token 计数是否已达到或超过限制
-                    if key_usage.get("tpm_input_count", 0) >= tpm_input_limit:
-                        logger.warning(
-                            f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): TPM_Input 达到限制 ({key_usage.get('tpm_input_count', 0)}/{tpm_input_limit})。跳过此 Key。"
-                        )  # 记录 TPM_Input 超限警告
-                        perform_api_call = False  # 设置标志为 False
-                # 注意：这里没有 else 块来在窗口过期时重置 TPM_Input 计数/时间戳，
-                # 因为 update_token_counts 函数会处理 TPM_Input 的重置和增加。
-
-        # 如果所有检查都通过，更新此 Key 的最后请求时间戳（用于 Key 选择策略）
-        if perform_api_call:
-            key_usage["last_request_timestamp"] = now  # 更新最后请求时间戳
-
-    return perform_api_call  # 返回最终的检查结果
+        if not key_rate_limiter.try_acquire(api_key, model_name, "rpm", rpm_limit, 1, now):
+            logger.warning(
+                f"速率限制预检查失败 (Key: {api_key[:8]}, Model: {model_name}): RPM 达到限制 ({rpm_limit})。跳过此 Key。"
+            )  # 记录 RPM 超限警告
+            return False
+
+        # 所有检查都通过：增加 RPD 计数并更新最后请求时间戳（用于 Key 选择策略）
+        if rpd_limit is not None:
+            key_usage["rpd_count"] = key_usage.get("rpd_count", 0) + 1  # RPD 计数加 1
+        key_usage["last_request_timestamp"] = now  # 更新最后请求时间戳
+        mark_usage_dirty(api_key, model_name)  # 等待写入增量日志
+
+    return True
 
 
 def update_token_counts(
@@ -335,10 +380,14 @@ def update_token_counts(
     prompt_tokens: Optional[int],
     client_ip: str,
     today_date_str_pt: str,
+    completion_tokens: Optional[int] = None,
+    reservation: Optional[TokenReservation] = None,
 ) -> None:
     """
-    在 API 调用成功 *之后* 更新给定 API Key 和模型的 TPD_Input 和 TPM_Input 计数。
+    在 API 调用成功 *之后* 记录给定 API Key 和模型的 Token 用量：
+    TPD_Input 累加到 usage_data，TPM_Input / TPM_Output 记入滑动窗口速率限制器。
     同时记录基于 IP 的每日输入 Token 消耗。
+    如果选择 Key 时已预留了输入 Token，TPM_Input 只按实际用量与预留的差额对账。
 
     Args:
         api_key (str): 当前成功使用的 API Key。
@@ -347,9 +396,13 @@ def update_token_counts(
         prompt_tokens (Optional[int]): 从 API 响应中获取的实际输入 Token 数量。
         client_ip (str): 客户端 IP 地址。
         today_date_str_pt (str): 当前的太平洋时区日期字符串 (YYYY-MM-DD)，用于 IP 每日计数。
+        completion_tokens (Optional[int]): 从 API 响应中获取的实际输出 Token 数量 (可选)。
+        reservation (Optional[TokenReservation]): 选择 Key 时的输入 Token 预留 (可选)。
     """
     # 检查输入有效性：需要有效的限制信息和大于 0 的 prompt_tokens
     if not limits or not prompt_tokens or prompt_tokens <= 0:
+        if reservation is not None:
+            reservation.reconcile(None)  # 没有实际用量时保留估算值
         if limits and (
             not prompt_tokens or prompt_tokens <= 0
         ):  # 如果有限制但 prompt_tokens 无效
@@ -359,40 +412,40 @@ def update_token_counts(
         # 如果没有限制信息或 prompt_tokens 无效，则不执行更新
         return  # 直接返回
 
-    with usage_lock:  # 获取使用数据锁，保证线程安全
-        # 确保 key 和 model 的条目存在
-        key_usage = usage_data.setdefault(
-            api_key, defaultdict(lambda: defaultdict(int))
-        )[
-            model_name
-        ]  # 获取或创建 Key 和模型的用法数据字典
+    shared_tpd_count: Optional[int] = None
+    if shared_state_backend is not None:
+        # 多 worker 部署：累加共享的 TPD_Input 计数，本进程的 usage_data 同步为共享计数
+        _, shared_tpd_count = shared_state_backend.counter_add(
+            _daily_counter_name("tpd", api_key, model_name),
+            prompt_tokens,
+            None,
+            DAILY_COUNTER_TTL_SECONDS,
+        )
 
+    with usage_lock:  # 获取使用数据锁，保证线程安全
+        key_usage = usage_data[api_key][model_name]  # 获取或创建 Key 和模型的用法数据字典
         # --- 更新 TPD_Input (每日输入 Token 数) ---
-        # 直接累加本次请求的 prompt_tokens
         key_usage["tpd_input_count"] = (
             key_usage.get("tpd_input_count", 0) + prompt_tokens
+            if shared_tpd_count is None
+            else shared_tpd_count
         )  # 累加 TPD_Input 计数
+        mark_usage_dirty(api_key, model_name)  # 等待写入增量日志
 
-        # --- 更新 TPM_Input (每分钟输入 Token 数) ---
-        tpm_input_limit = limits.get("tpm_input")  # 获取 TPM_Input 限制值
-        if tpm_input_limit is not None:  # 只有在配置了 TPM 限制时才更新
-            now_tpm = time.time()  # 获取当前时间戳
-            # 检查 TPM 窗口是否已过期
-            if now_tpm - key_usage.get("tpm_input_timestamp", 0) >= TPM_WINDOW_SECONDS:
-                # 窗口已过期，重置计数为当前请求的 Token 数，并更新时间戳
-                key_usage["tpm_input_count"] = (
-                    prompt_tokens  # 新窗口的第一个请求的 Token 数
-                )
-                key_usage["tpm_input_timestamp"] = now_tpm  # 更新窗口开始时间戳
-            else:
-                # 窗口未过期，累加 Token 数
-                key_usage["tpm_input_count"] = (
-                    key_usage.get("tpm_input_count", 0) + prompt_tokens
-                )  # 累加 TPM_Input 计数
-            # 记录详细的 Token 更新日志
-            logger.debug(
-                f"输入 Token 计数更新 (Key: {api_key[:8]}, Model: {model_name}): Added TPD_Input={prompt_tokens}, TPM_Input={key_usage['tpm_input_count']}"
-            )  # 记录 Token 计数更新详情
+    # --- 记录 TPM_Input / TPM_Output (每分钟 Token 数) ---
+    if reservation is not None:
+        reservation.reconcile(prompt_tokens)
+    else:
+        key_rate_limiter.consume(
+            api_key, model_name, "tpm_input", limits.get("tpm_input"), prompt_tokens
+        )
+    if completion_tokens:
+        key_rate_limiter.consume(
+            api_key, model_name, "tpm_output", limits.get("tpm_output"), completion_tokens
+        )
+    logger.debug(
+        f"输入 Token 计数更新 (Key: {api_key[:8]}, Model: {model_name}): Added TPD_Input={prompt_tokens}, TPM_Output={completion_tokens or 0}"
+    )  # 记录 Token 计数更新详情
 
     # --- 记录 IP 输入 Token 消耗 (独立于 Key 的限制) ---
     # 使用单独的锁来保护 IP 计数数据
@@ -402,6 +455,7 @@ def update_token_counts(
         ip_daily_input_token_counts.setdefault(today_date_str_pt, Counter())[
             client_ip
         ] += prompt_tokens  # 增加指定 IP 在当天的输入 Token 计数
+        dirty_ip_token_counts.add((today_date_str_pt, client_ip))
 
 
 # --- 上下文保存逻辑 (来自 utils.py 原始版本) ---
@@ -414,6 +468,7 @@ async def save_context_after_success(
     final_tool_calls: Optional[List[Dict[str, Any]]] = None,
     db: AsyncSession | None = None,
     context_store: Optional[ContextStore] = None,
+    token_estimates: Optional[TokenEstimateCache] = None,
 ):
     """
     在 API 调用成功后保存上下文（如果启用）。
@@ -425,6 +480,8 @@ async def save_context_after_success(
         model_name (str): 使用的模型名称。
         enable_context (bool): 是否启用上下文保存功能。
         final_tool_calls (Optional[List[Dict[str, Any]]]): 模型返回的工具调用信息（目前暂未处理）。
+        token_estimates (Optional[TokenEstimateCache]): 请求级的逐条消息 Token 估算缓存，
+            截断时只需额外估算模型的回复。
     """
     if not enable_context:  # 如果未启用上下文保存
         logger.debug(
@@ -460,7 +517,7 @@ async def save_context_after_success(
     # 注意：这里调用了 truncate_context 函数，它会根据 model_name 查找静态限制。
     # 第二个返回参数 still_over_limit_final 指示即使截断后是否仍然超限。
     truncated_contents_to_save, still_over_limit_final = await truncate_context(
-        final_contents_to_save, model_name
+        final_contents_to_save, model_name, token_estimates=token_estimates
     )  # 对最终内容进行截断
 
     if not still_over_limit_final:  # 如果截断后内容没有超限
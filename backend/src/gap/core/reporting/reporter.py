@@ -19,13 +19,13 @@ from gap.core.keys.checker import (  # 从 checker 模块导入启动时 Key 统
 )
 
 # 从其他模块导入必要的组件
-from gap.core.tracking import TPM_WINDOW_SECONDS  # Key 使用数据、锁、时间窗口常量
+from gap.core.keys.admission import admission_queue  # 准入等待队列指标
+from gap.core.keys.limiter import key_rate_limiter  # RPM / TPM 滑动窗口用量
 from gap.core.tracking import cache_lock  # Key 分数缓存和锁
 from gap.core.tracking import cache_tracking_lock  # 缓存统计变量和锁
 from gap.core.tracking import daily_totals_lock  # 每日 RPD 总计和锁
 from gap.core.tracking import ip_input_token_counts_lock  # IP 每日输入 Token 计数和锁
 from gap.core.tracking import (  # 从 tracking 模块导入共享数据和锁
-    RPM_WINDOW_SECONDS,
     cache_hit_count,
     cache_miss_count,
     daily_rpd_totals,
@@ -159,9 +159,9 @@ def report_usage(key_manager: "APIKeyManager") -> Dict[str, Any]:  # 返回类
 
     with ip_input_token_counts_lock:  # IP 输入 Token 计数锁
         ip_input_token_counts_copy = copy.deepcopy(ip_daily_input_token_counts)
-    with key_manager.keys_lock:  # Key 管理器锁
-        active_keys = key_manager.api_keys[:]  # 获取当前活动 Key 列表的副本
-        active_keys_count = len(active_keys)  # 计算活动 Key 数量
+    # Key 状态快照不可变，直接读取即可，无需加锁
+    active_keys = list(key_manager.snapshot.active_keys)  # 获取当前活动 Key 列表的副本
+    active_keys_count = len(active_keys)  # 计算活动 Key 数量
 
     # --- 初始化报告数据字典结构 ---
     # 定义报告的基本结构，并设置默认值
@@ -227,16 +227,18 @@ def report_usage(key_manager: "APIKeyManager") -> Dict[str, Any]:  # 返回类
     selection_reason_counts = Counter()  # 初始化原因计数器
     key_reason_counts = defaultdict(Counter)  # 初始化按 Key 分组的原因计数器
 
-    # 获取并清空 KeyManager 中的筛选记录 (确保每次报告都是新的统计周期)
-    key_selection_records = key_manager.get_and_clear_all_selection_records()
+    # 读取并重置 KeyManager 中的聚合筛选统计 (确保每次报告都是新的统计周期)
+    selection_stats = key_manager.get_selection_stats(reset=True)
+    model_reason_counts = defaultdict(Counter)  # 按模型分组的原因计数器
 
-    # 遍历记录并统计
-    for record in key_selection_records:
-        # 获取 Key (可能已截断) 和原因
-        key = record.get("key", "未知 Key")  # 使用 get 提供默认值
-        reason = record.get("reason", "未知原因")  # 使用 get 提供默认值
-        selection_reason_counts[reason] += 1  # 增加总原因计数
-        key_reason_counts[key][reason] += 1  # 增加特定 Key 的原因计数
+    # 遍历聚合计数器并统计
+    for counter in selection_stats["counters"]:
+        key = counter.get("key", "未知 Key")  # 使用 get 提供默认值
+        reason = counter.get("reason", "未知原因")  # 使用 get 提供默认值
+        count = counter.get("count", 0)
+        selection_reason_counts[reason] += count  # 增加总原因计数
+        key_reason_counts[key][reason] += count  # 增加特定 Key 的原因计数
+        model_reason_counts[counter.get("model", "N/A")][reason] += count
 
     # 将统计结果添加到报告数据中
     # 防御性检查
@@ -252,6 +254,19 @@ def report_usage(key_manager: "APIKeyManager") -> Dict[str, Any]:  # 返回类
     report_data["key_selection_stats"]["details_by_key"] = {
         key: dict(reasons) for key, reasons in key_reason_counts.items()
     }
+    # 存储按模型分组的原因统计、统计周期起始时间、溢出次数和采样轨迹数量
+    report_data["key_selection_stats"]["details_by_model"] = {
+        model: dict(reasons) for model, reasons in model_reason_counts.items()
+    }
+    report_data["key_selection_stats"]["since"] = selection_stats["since"]
+    report_data["key_selection_stats"]["overflowed"] = selection_stats["overflowed"]
+    report_data["key_selection_stats"]["sampled_traces"] = len(
+        selection_stats["traces"]
+    )
+    # 准入等待队列指标 (入队、唤醒、超时、拒绝次数和等待时间)，与筛选统计同周期重置
+    report_data["key_selection_stats"]["admission_queue"] = admission_queue.get_stats(
+        reset=True
+    )
 
     # --- 初始化用于聚合的字典 ---
     key_status_summary = defaultdict(
@@ -313,44 +328,34 @@ def report_usage(key_manager: "APIKeyManager") -> Dict[str, Any]:  # 返回类
                 tpd_input_limit = limits.get("tpd_input")
 
                 rpd_count = usage.get("rpd_count", 0)
-                rpm_count = usage.get("rpm_count", 0)
-                tpm_input_count = usage.get("tpm_input_count", 0)
                 tpd_input_count = usage.get("tpd_input_count", 0)
-                rpm_ts = usage.get("rpm_timestamp", 0)
-                tpm_input_ts = usage.get("tpm_input_timestamp", 0)
 
                 # 累加模型的总 RPD 和 TPD 输入
                 model_total_rpd[model_name] += rpd_count
                 model_total_tpd_input[model_name] += tpd_input_count
 
                 # --- 计算 RPM 和 TPM 的窗口内使用情况和剩余百分比 ---
-                rpm_in_window = 0  # 初始化窗口内 RPM
-                rpm_remaining_pct = 1.0  # 初始化 RPM 剩余百分比
-                if rpm_limit is not None:  # 如果有 RPM 限制
-                    if now - rpm_ts < RPM_WINDOW_SECONDS:  # 如果在窗口期内
-                        rpm_in_window = rpm_count  # 获取窗口内计数
-                        # 计算剩余百分比，避免除零错误
-                        rpm_remaining_pct = (
-                            max(0, (rpm_limit - rpm_in_window) / rpm_limit)
-                            if rpm_limit > 0
-                            else 0
-                        )
-
-                tpm_input_in_window = 0  # 初始化窗口内 TPM 输入
-                tpm_input_remaining_pct = 1.0  # 初始化 TPM 输入剩余百分比
-                if tpm_input_limit is not None:  # 如果有 TPM 输入限制
-                    if now - tpm_input_ts < TPM_WINDOW_SECONDS:  # 如果在窗口期内
-                        tpm_input_in_window = tpm_input_count  # 获取窗口内计数
-                        # 计算剩余百分比，避免除零错误
-                        tpm_input_remaining_pct = (
-                            max(
-                                0,
-                                (tpm_input_limit - tpm_input_in_window)
-                                / tpm_input_limit,
-                            )
-                            if tpm_input_limit > 0
-                            else 0
-                        )
+                # 滑动窗口内的用量由速率限制器提供 (未配置限制时为 0，两个维度一次读取)
+                rpm_used, tpm_input_used = key_rate_limiter.usage_many(
+                    [
+                        (key, model_name, "rpm", rpm_limit),
+                        (key, model_name, "tpm_input", tpm_input_limit),
+                    ],
+                    now,
+                )
+                rpm_in_window = round(rpm_used)
+                rpm_remaining_pct = (
+                    max(0, (rpm_limit - rpm_in_window) / rpm_limit)
+                    if rpm_limit is not None and rpm_limit > 0
+                    else 1.0
+                )
+
+                tpm_input_in_window = round(tpm_input_used)
+                tpm_input_remaining_pct = (
+                    max(0, (tpm_input_limit - tpm_input_in_window) / tpm_input_limit)
+                    if tpm_input_limit is not None and tpm_input_limit > 0
+                    else 1.0
+                )
 
                 # --- 计算 RPD 和 TPD 输入的剩余百分比 ---
                 rpd_remaining_pct = (
@@ -882,6 +887,20 @@ def report_usage(key_manager: "APIKeyManager") -> Dict[str, Any]:  # 返回类
                 reasons.items(), key=lambda item: item[1], reverse=True
             ):
                 report_lines.append(f"      - {reason}: {count} 次")  # 添加原因详情
+
+        report_lines.append(
+            f"\n  {COLOR_INFO}详情 (按模型和原因):{COLOR_RESET}"
+        )  # 添加子标题
+        for model, reasons in sorted(model_reason_counts.items()):
+            report_lines.append(f"    - 模型 '{model}':")  # 添加模型标题
+            for reason, count in sorted(
+                reasons.items(), key=lambda item: item[1], reverse=True
+            ):
+                report_lines.append(f"      - {reason}: {count} 次")  # 添加原因详情
+        if selection_stats["overflowed"]:  # 计数器达到上限后计入溢出桶的次数
+            report_lines.append(
+                f"\n  {COLOR_WARNING}计数器已达上限，{selection_stats['overflowed']} 次记录计入溢出桶。{COLOR_RESET}"
+            )
     else:  # 如果没有筛选记录
         report_lines.append(
             f"  {COLOR_WARNING}暂无 Key 筛选记录。{COLOR_RESET}"
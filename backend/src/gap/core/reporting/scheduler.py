@@ -5,11 +5,14 @@
 - 清理旧日志文件。
 - 每日重置 API Key 的使用计数 (RPD, TPD)。
 - 定期生成并记录使用情况报告。
-- 定期刷新 Key 分数缓存。
+- 定期刷新 Key 分数缓存，并将分数持久化到数据库。
 - 定期清理内存数据库中的旧上下文记录 (如果使用内存数据库)。
+- 定期将使用计数与配额状态写入增量日志和快照。
+- 多 worker 部署时定期同步其他 worker 标记的耗尽 / 临时不可用 Key。
 """
+import asyncio  # 在线程中执行文件写入
 import logging  # 导入日志模块
-from typing import TYPE_CHECKING, Any, Dict, List  # 导入类型提示
+from typing import TYPE_CHECKING, Any, Dict, List, Optional  # 导入类型提示
 
 from apscheduler.executors.asyncio import (  # 导入 APScheduler 的异步执行器
     AsyncIOExecutor,
@@ -17,6 +20,7 @@ from apscheduler.executors.asyncio import (  # 导入 APScheduler 的异步执
 from apscheduler.schedulers.asyncio import (  # 导入 APScheduler 的异步调度器
     AsyncIOScheduler,
 )
+from sqlalchemy.ext.asyncio import async_sessionmaker  # 异步会话工厂类型
 
 # 从其他模块导入必要的组件
 from gap import config  # 导入应用配置模块
@@ -29,12 +33,15 @@ from gap.core.context.store import ContextStore
 
 # 导入 Key 检查器模块中的分数刷新函数 (注意：下划线前缀表示内部使用)
 from gap.core.keys.checker import _refresh_all_key_scores  # (新路径)
+from gap.core.keys.scoring import key_scoring_engine  # Key 健康度评分引擎
 
 # 导入报告模块中的任务函数
 from gap.core.reporting.daily_reset import (  # 每日计数重置函数 (新路径)
     reset_daily_counts,
 )
 from gap.core.reporting.reporter import report_usage  # 使用情况报告生成函数 (新路径)
+from gap.core.shared_state import shared_state_backend  # 多 worker 共享的状态后端
+from gap.core.usage_persistence import usage_persistence  # 使用计数与配额状态持久化
 
 # 导入日志配置模块中的日志清理函数
 from gap.utils.log_config import cleanup_old_logs  # (路径修正)
@@ -360,13 +367,92 @@ def _add_memory_context_cleanup_job(context_store_manager: ContextStore):
         logger.info("非内存上下文存储模式，跳过添加内存上下文清理任务 (ContextStore)。")
 
 
-def setup_scheduler(key_manager: "APIKeyManager", context_store_manager: ContextStore):
+async def _persist_key_scores(session_factory: async_sessionmaker):
+    """
+    (内部辅助函数) 将评分引擎中有变化的 Key 分数写入数据库 KeyScore 表。
+
+    Args:
+        session_factory (async_sessionmaker): 用于创建数据库会话的异步会话工厂。
+    """
+    try:
+        async with session_factory() as db:
+            saved = await key_scoring_engine.persist_scores(db)
+        logger.debug(f"Key 分数持久化任务完成，写入 {saved} 条记录。")
+    except Exception as e:
+        logger.error(f"持久化 Key 分数时发生错误: {e}", exc_info=True)
+
+
+async def _flush_key_affinity(
+    key_manager: "APIKeyManager", session_factory: async_sessionmaker
+):
+    """
+    (内部辅助函数) 将累积的用户-Key 关联更新批量写入数据库 user_key_associations 表。
+
+    Args:
+        key_manager (APIKeyManager): APIKeyManager 的实例。
+        session_factory (async_sessionmaker): 用于创建数据库会话的异步会话工厂。
+    """
+    if not key_manager.key_affinity.pending_count():
+        return
+    try:
+        async with session_factory() as db:
+            saved = await key_manager.key_affinity.flush(db)
+        logger.debug(f"用户-Key 关联写回任务完成，写入 {saved} 条记录。")
+    except Exception as e:
+        logger.error(f"写回用户-Key 关联时发生错误: {e}", exc_info=True)
+
+
+async def _flush_usage_journal(key_manager: "APIKeyManager"):
+    """
+    (内部辅助函数) 将变化的使用计数与配额状态追加到增量日志。
+
+    Args:
+        key_manager (APIKeyManager): APIKeyManager 的实例。
+    """
+    try:
+        await asyncio.to_thread(usage_persistence.flush_journal, key_manager)
+    except Exception as e:
+        logger.error(f"写入使用状态增量日志时发生错误: {e}", exc_info=True)
+
+
+async def _write_usage_snapshot(key_manager: "APIKeyManager"):
+    """
+    (内部辅助函数) 写入使用计数与配额状态的完整快照并清空增量日志。
+
+    Args:
+        key_manager (APIKeyManager): APIKeyManager 的实例。
+    """
+    try:
+        await asyncio.to_thread(usage_persistence.write_snapshot, key_manager)
+    except Exception as e:
+        logger.error(f"写入使用状态快照时发生错误: {e}", exc_info=True)
+
+
+async def _sync_shared_key_marks(key_manager: "APIKeyManager"):
+    """
+    (内部辅助函数) 从共享状态后端同步其他 worker 标记的每日耗尽 / 临时不可用 Key。
+
+    Args:
+        key_manager (APIKeyManager): APIKeyManager 的实例。
+    """
+    try:
+        await asyncio.to_thread(key_manager.sync_shared_marks)
+    except Exception as e:
+        logger.error(f"同步共享 Key 标记时发生错误: {e}", exc_info=True)
+
+
+def setup_scheduler(
+    key_manager: "APIKeyManager",
+    context_store_manager: ContextStore,
+    session_factory: Optional[async_sessionmaker] = None,
+):
     """
     设置 APScheduler，添加所有需要的后台定时任务。
 
     Args:
         key_manager (APIKeyManager): APIKeyManager 的实例。
         context_store_manager (ContextStore): ContextStore 的实例。
+        session_factory (Optional[async_sessionmaker]): 异步会话工厂，提供时添加 Key 分数持久化和用户-Key 关联写回任务。
     """
 
     logger.info("正在设置后台任务调度器...")  # 记录开始设置日志
@@ -426,6 +512,74 @@ def setup_scheduler(key_manager: "APIKeyManager", context_store_manager: Context
         executor="asyncio",
     )
 
+    # --- 添加 Key 分数持久化任务 ---
+    if session_factory is not None and config.KEY_SCORE_PERSIST_INTERVAL_SECONDS > 0:
+        scheduler.add_job(
+            _persist_key_scores,
+            "interval",
+            seconds=config.KEY_SCORE_PERSIST_INTERVAL_SECONDS,
+            args=[session_factory],
+            id="key_score_persist",
+            name="Key 得分持久化",
+            replace_existing=True,
+            executor="asyncio",
+        )
+
+    # --- 添加用户-Key 关联写回任务 ---
+    if (
+        session_factory is not None
+        and config.KEY_STORAGE_MODE == "database"
+        and config.KEY_AFFINITY_FLUSH_INTERVAL_SECONDS > 0
+    ):
+        scheduler.add_job(
+            _flush_key_affinity,
+            "interval",
+            seconds=config.KEY_AFFINITY_FLUSH_INTERVAL_SECONDS,
+            args=[key_manager, session_factory],
+            id="key_affinity_flush",
+            name="用户-Key 关联写回",
+            replace_existing=True,
+            executor="asyncio",
+        )
+
+    # --- 添加使用计数与配额状态持久化任务 ---
+    if usage_persistence.enabled:
+        if config.USAGE_JOURNAL_FLUSH_INTERVAL_SECONDS > 0:
+            scheduler.add_job(
+                _flush_usage_journal,
+                "interval",
+                seconds=config.USAGE_JOURNAL_FLUSH_INTERVAL_SECONDS,
+                args=[key_manager],
+                id="usage_journal_flush",
+                name="使用状态增量日志",
+                replace_existing=True,
+                executor="asyncio",
+            )
+        if config.USAGE_SNAPSHOT_INTERVAL_SECONDS > 0:
+            scheduler.add_job(
+                _write_usage_snapshot,
+                "interval",
+                seconds=config.USAGE_SNAPSHOT_INTERVAL_SECONDS,
+                args=[key_manager],
+                id="usage_snapshot",
+                name="使用状态快照",
+                replace_existing=True,
+                executor="asyncio",
+            )
+
+    # --- 添加共享 Key 标记同步任务 (多 worker 部署) ---
+    if shared_state_backend is not None and config.SHARED_STATE_SYNC_INTERVAL_SECONDS > 0:
+        scheduler.add_job(
+            _sync_shared_key_marks,
+            "interval",
+            seconds=config.SHARED_STATE_SYNC_INTERVAL_SECONDS,
+            args=[key_manager],
+            id="shared_key_marks_sync",
+            name="共享 Key 标记同步",
+            replace_existing=True,
+            executor="asyncio",
+        )
+
     # --- 添加内存数据库上下文清理任务 (如果需要) ---
     _add_memory_context_cleanup_job(context_store_manager)
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 IP 速率限制功能。
+配置了共享状态后端 (gap.core.shared_state) 时，每分钟和每日计数在所有 worker 之间共享。
 """
 import asyncio  # 导入异步IO库
 import logging  # 导入日志模块
@@ -11,6 +12,8 @@ from typing import Dict, Optional, Tuple  # 导入类型提示
 
 from fastapi import HTTPException, Request, status  # 导入 FastAPI 相关组件
 
+from gap.core.shared_state import shared_state_backend  # 多 worker 共享的状态后端
+
 logger = logging.getLogger("my_logger")  # 获取日志记录器实例
 
 # 导入统一锁管理器
@@ -98,6 +101,12 @@ async def protect_from_abuse(
 
     current_time = time.time()  # 获取当前时间戳 (秒)
 
+    if shared_state_backend is not None:
+        _protect_with_shared_state(
+            client_ip, current_time, max_requests_per_minute, max_requests_per_day_per_ip
+        )
+        return
+
     # --- 每分钟请求限制检查 ---
     if max_requests_per_minute > 0:  # 仅在配置了限制时检查
         lock = await _get_async_lock("ip_timestamps")
@@ -160,3 +169,46 @@ async def protect_from_abuse(
         f"IP {client_ip} 请求通过速率限制检查。分钟内请求数: {len(ip_timestamps.get(client_ip, []))}, 今日请求数: {ip_daily_counts.get(client_ip, (0, 0))[0]}"
     )
     return  # 所有检查通过
+
+
+def _protect_with_shared_state(
+    client_ip: str,
+    current_time: float,
+    max_requests_per_minute: int,
+    max_requests_per_day_per_ip: int,
+) -> None:
+    """
+    (内部辅助函数) 多 worker 部署时的 IP 限流：每分钟限制使用共享的 GCRA 状态，
+    每日限制使用共享计数器 (名称包含 UTC 日期，与进程内实现的 UTC 午夜重置一致)。
+
+    Raises:
+        HTTPException (429 Too Many Requests): 如果请求超过限制。
+    """
+    backend = shared_state_backend
+    assert backend is not None
+    if max_requests_per_minute > 0 and not backend.gcra_acquire(
+        f"ip_rpm:{client_ip}", 60 / max_requests_per_minute, 60, current_time
+    ):
+        logger.warning(f"IP {client_ip} 每分钟请求超限。限制: {max_requests_per_minute}")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"请求过于频繁，请稍后再试 (每分钟限制: {max_requests_per_minute} 次)。",
+        )
+    if max_requests_per_day_per_ip > 0:
+        utc_date = datetime.fromtimestamp(current_time, tz=timezone.utc).strftime(
+            "%Y-%m-%d"
+        )
+        added, count = backend.counter_add(
+            f"ip_rpd:{utc_date}:{client_ip}",
+            1,
+            max_requests_per_day_per_ip,
+            2 * 24 * 3600,
+        )
+        if not added:
+            logger.warning(
+                f"IP {client_ip} 每日请求超限。限制: {max_requests_per_day_per_ip}, 当前已达: {count}"
+            )
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"今日请求已达上限 (每日限制: {max_requests_per_day_per_ip} 次)，请明天再试。",
+            )
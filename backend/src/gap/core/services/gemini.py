@@ -1,19 +1,21 @@
 # -*- coding: utf-8 -*-
 """
 Gemini API 客户端模块。
-封装了与 Google Gemini API 交互的逻辑，使用 google-generativeai SDK。
+封装了与 Google Gemini API 交互的逻辑，直接调用 REST 接口 (generateContent /
+streamGenerateContent)，复用应用级共享的 httpx.AsyncClient 连接池，
+API Key 按请求通过 `x-goog-api-key` 请求头传递，不再依赖 SDK 的全局配置。
 """
+import json  # 用于解析 SSE 数据块
 import logging  # 日志库
 
 # 导入必要的库和类型
 import os  # 用于访问环境变量
 from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, Union  # 类型提示
 
-import google.generativeai as genai  # Google Gemini SDK
-import httpx  # HTTP 客户端库，用于配置 SDK
-from google.api_core import exceptions as google_exceptions  # Google API 核心异常
+import httpx  # HTTP 客户端库，所有请求均通过共享的 AsyncClient 发出
 
 # 导入应用内部的模型和工具类
+from gap import config as app_config  # 应用配置 (API 基础地址等)
 from gap.api.models import ChatCompletionRequest  # OpenAI 格式的聊天请求模型
 from gap.core.utils.response_wrapper import (  # 用于包装和处理 Gemini 响应的工具类 (新路径)
     ResponseWrapper,
@@ -27,8 +29,11 @@ logger = logging.getLogger("my_logger")
 class GeminiClient:
     """
     Gemini API 客户端类。
-    封装了使用 google-generativeai SDK 与 Gemini API 进行通信的方法。
-    包括配置 SDK、转换数据格式、发送流式和非流式请求、处理响应等。
+    封装了通过原生 REST 接口与 Gemini API 进行通信的方法。
+    包括转换数据格式、构建请求体、发送流式和非流式请求、处理响应等。
+
+    实例本身是轻量的：不持有连接，也不修改任何全局状态，
+    因此可以在并发请求中为不同的 Key 各自创建实例而互不干扰。
     """
 
     # 类变量，用于存储可用的模型列表，将在首次调用 list_available_models 时填充
@@ -46,7 +51,7 @@ class GeminiClient:
 
         Args:
             api_key (str): 用于访问 Gemini API 的 API 密钥。
-            http_client (httpx.AsyncClient): 共享的异步 HTTP 客户端实例，用于配置 SDK 的传输。
+            http_client (httpx.AsyncClient): 共享的异步 HTTP 客户端实例 (连接池)，所有请求均通过它发出。
 
         Raises:
             ValueError: 如果 api_key 或 http_client 为空。
@@ -58,37 +63,74 @@ class GeminiClient:
             raise ValueError("http_client 不能为空")
 
         # 存储 API Key 和 HTTP 客户端
+        # 注意：Key 仅用于构建每个请求的请求头，不会写入任何进程级全局配置
         self.api_key = api_key
         self.http_client = http_client
 
-        # --- 配置 Google Gemini SDK ---
-        try:
-            # 移除 client_options={"transport": self.http_client}
-            # 如果 google-generativeai==0.8.5 的 transport 参数可以直接接受 httpx.AsyncClient，
-            # 则应改为 transport=self.http_client。
-            # 但首先，我们解决 ClientOptions 的错误。
-            # 保守的改法是只用 transport="rest"，让 SDK 自己处理 HTTP client。
-            # 或者，如果确定 0.8.5 版本支持，可以尝试 transport=self.http_client
-            # 查阅相关资料，0.x 版本似乎不直接支持在 configure 时注入 httpx_client 给 transport。
-            # 它更多的是依赖 google-auth 来处理 transport。
-            # 因此，最安全的初始修复是仅保留 api_key 和 transport="rest"。
-            genai.configure(
-                api_key=self.api_key,  # 设置 API Key
-                transport="rest",  # 指定使用 REST API 传输层
-                # client_options 已移除，因为它导致了 ValueError
-            )
-            logger.debug(
-                f"Gemini SDK 已为 Key {self.api_key[:8]}... 配置完成 (移除了 client_options 中的 transport)。"
+    # --- 内部辅助方法：REST 请求构建 ---
+
+    @staticmethod
+    def _build_model_url(model_name: str, method: str) -> str:
+        """构建模型方法的完整 URL，例如 .../models/gemini-pro:generateContent。"""
+        if model_name.startswith("models/"):
+            model_name = model_name[len("models/") :]
+        return f"{app_config.GEMINI_API_BASE_URL}/models/{model_name}:{method}"
+
+    def _build_headers(self) -> Dict[str, str]:
+        """构建请求头，API Key 通过 x-goog-api-key 按请求传递。"""
+        return {
+            "Content-Type": "application/json",
+            "x-goog-api-key": self.api_key,
+        }
+
+    def _build_generate_payload(
+        self,
+        request: ChatCompletionRequest,
+        contents: List[Dict[str, Any]],
+        safety_settings: List[Dict[str, Any]],
+        system_instruction: Optional[Dict[str, Any]],
+        cached_content_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """根据 OpenAI 格式的请求构建 generateContent 的 REST 请求体。"""
+        payload: Dict[str, Any] = {
+            "contents": self._convert_contents_to_api_format(contents)
+        }
+        api_safety_settings = self._convert_safety_settings_to_api_format(
+            safety_settings
+        )
+        if api_safety_settings:
+            payload["safetySettings"] = api_safety_settings
+        api_system_instruction = self._convert_system_instruction_to_api_format(
+            system_instruction
+        )
+        if api_system_instruction:
+            payload["systemInstruction"] = api_system_instruction
+        generation_config = {
+            "temperature": request.temperature,
+            "topP": request.top_p,
+            "maxOutputTokens": request.max_tokens,
+        }
+        if request.stop:
+            generation_config["stopSequences"] = (
+                [request.stop] if isinstance(request.stop, str) else request.stop
             )
-        except Exception as config_err:
-            logger.error(
-                f"配置 Gemini SDK 时出错 (Key: {self.api_key[:8]}...): {config_err}",
-                exc_info=True,
+        generation_config = {
+            k: v for k, v in generation_config.items() if v is not None
+        }
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        if cached_content_id:
+            # REST 接口要求完整的资源名 cachedContents/{id}
+            payload["cachedContent"] = (
+                cached_content_id
+                if cached_content_id.startswith("cachedContents/")
+                else f"cachedContents/{cached_content_id}"
             )
+        return payload
 
     # --- 内部辅助方法：数据格式转换 ---
 
-    def _convert_contents_to_sdk_format(
+    def _convert_contents_to_api_format(
         self, contents: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
         processed_contents = []
@@ -108,7 +150,7 @@ class GeminiClient:
                 )
         return processed_contents
 
-    def _convert_safety_settings_to_sdk_format(
+    def _convert_safety_settings_to_api_format(
         self, safety_settings: List[Dict[str, Any]]
     ) -> List[Dict[str, str]]:
         processed_safety_settings = []
@@ -125,7 +167,7 @@ class GeminiClient:
                 )
         return processed_safety_settings
 
-    def _convert_system_instruction_to_sdk_format(
+    def _convert_system_instruction_to_api_format(
         self, system_instruction: Optional[Dict[str, Any]]
     ) -> Optional[Dict[str, Any]]:
         if (
@@ -136,17 +178,17 @@ class GeminiClient:
             return system_instruction
         return None
 
-    # --- 内部辅助方法：处理 SDK 响应 ---
-    def _process_sdk_response(
+    # --- 内部辅助方法：处理 API 响应 ---
+    def _process_api_response(
         self, response: Dict[str, Any]
     ) -> Tuple[
         str, Optional[Dict[str, Any]], Optional[str], Optional[str], Optional[str]
-    ]:  # 类型注解已修改
+    ]:
         text_content = ""
         usage_metadata = None
         safety_issue_detail = None
         finish_reason = None
-        cached_content_id = None  # 假设 0.8.5 版本不直接通过此方法返回缓存 ID
+        cached_content_id = None
 
         candidates = response.get("candidates")
         if candidates and isinstance(candidates, list) and len(candidates) > 0:
@@ -164,9 +206,7 @@ class GeminiClient:
                             text_content += part["text"]
 
                 # finish_reason 的处理：假设它直接是字符串或 None
-                raw_finish_reason = candidate.get(
-                    "finishReason"
-                )  # 注意大小写可能与 GenerateContentResponse 对象不同
+                raw_finish_reason = candidate.get("finishReason")
                 if isinstance(raw_finish_reason, str):
                     finish_reason = raw_finish_reason
                 elif raw_finish_reason is not None:  # 如果存在但不是字符串，记录警告
@@ -196,23 +236,23 @@ class GeminiClient:
                                 )
                                 logger.log(
                                     log_level,
-                                    f"SDK 响应安全评分: Category={category}, Probability={probability}, Blocked={blocked}, Key: {self.api_key[:8]}...",
+                                    f"API 响应安全评分: Category={category}, Probability={probability}, Blocked={blocked}, Key: {self.api_key[:8]}...",
                                 )
                                 if blocked or probability == "HIGH":
                                     safety_issue_detail = f"安全问题: {category}"
             else:
                 logger.warning(f"候选者格式不正确: {candidate}")
 
-        sdk_usage_metadata = response.get("usageMetadata")  # 注意大小写
-        if sdk_usage_metadata and isinstance(sdk_usage_metadata, dict):
+        raw_usage_metadata = response.get("usageMetadata")  # 注意大小写
+        if raw_usage_metadata and isinstance(raw_usage_metadata, dict):
             usage_metadata = {
-                "prompt_token_count": sdk_usage_metadata.get(
+                "prompt_token_count": raw_usage_metadata.get(
                     "promptTokenCount"
                 ),  # 注意大小写
-                "candidates_token_count": sdk_usage_metadata.get(
+                "candidates_token_count": raw_usage_metadata.get(
                     "candidatesTokenCount"
                 ),  # 注意大小写
-                "total_token_count": sdk_usage_metadata.get(
+                "total_token_count": raw_usage_metadata.get(
                     "totalTokenCount"
                 ),  # 注意大小写
             }
@@ -238,6 +278,7 @@ class GeminiClient:
             cached_content_id,
         )
 
+
     # --- API 调用方法 ---
 
     async def stream_chat(
@@ -259,76 +300,81 @@ class GeminiClient:
         final_finish_reason = "STOP"
 
         try:
-            model = genai.GenerativeModel(model_name=request.model)
-            sdk_contents = self._convert_contents_to_sdk_format(contents)
-            sdk_safety_settings = self._convert_safety_settings_to_sdk_format(
-                safety_settings
+            payload = self._build_generate_payload(
+                request, contents, safety_settings, system_instruction, cached_content_id
             )
-            sdk_system_instruction = self._convert_system_instruction_to_sdk_format(
-                system_instruction
-            )
-            sdk_generation_config = {
-                "temperature": request.temperature,
-                "max_output_tokens": request.max_tokens,
-            }
-            sdk_generation_config = {
-                k: v for k, v in sdk_generation_config.items() if v is not None
-            }
-
-            if cached_content_id:
-                logger.warning(
-                    f"google-generativeai==0.8.5 时 CachedContent 的用法未知，暂时不使用缓存 ID: {cached_content_id}"
-                )
-
-            async for chunk in await model.generate_content(  # type: ignore[call-arg]
-                contents=sdk_contents,
-                stream=True,
-                safety_settings=sdk_safety_settings,
-                system_instruction=sdk_system_instruction,
-                generation_config=sdk_generation_config,
-            ):
-                (
-                    text_in_chunk,
-                    usage_metadata,
-                    safety_issue_detail,
-                    finish_reason,
-                    cached_content_id_from_response,
-                ) = self._process_sdk_response(chunk)
-
-                if text_in_chunk:
-                    yield text_in_chunk
-
-                if cached_content_id_from_response:
-                    yield {
-                        "_cache_metadata": {
-                            "cached_content_id": cached_content_id_from_response
+            url = self._build_model_url(request.model, "streamGenerateContent")
+            async with self.http_client.stream(
+                "POST",
+                url,
+                params={"alt": "sse"},  # 以 SSE 格式返回增量响应
+                headers=self._build_headers(),
+                json=payload,
+            ) as response:
+                if response.is_error:
+                    # 先读取错误响应体，便于 error_handler 解析 error.details
+                    await response.aread()
+                    response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    # SSE 格式：每个事件以 "data: " 开头，空行分隔
+                    if not line.startswith("data:"):
+                        continue
+                    data_str = line[len("data:") :].strip()
+                    if not data_str:
+                        continue
+                    try:
+                        chunk = json.loads(data_str)
+                    except json.JSONDecodeError:
+                        logger.warning(f"无法解析流式数据块: {data_str[:200]}")
+                        continue
+                    if not isinstance(chunk, dict):
+                        continue
+
+                    (
+                        text_in_chunk,
+                        usage_metadata,
+                        safety_issue_detail,
+                        finish_reason,
+                        cached_content_id_from_response,
+                    ) = self._process_api_response(chunk)
+
+                    if text_in_chunk:
+                        yield text_in_chunk
+
+                    if cached_content_id_from_response:
+                        yield {
+                            "_cache_metadata": {
+                                "cached_content_id": cached_content_id_from_response
+                            }
                         }
-                    }
 
-                if usage_metadata:
-                    usage_metadata_received = usage_metadata
+                    if usage_metadata:
+                        usage_metadata_received = usage_metadata
 
-                if safety_issue_detail and not safety_issue_detail_sent:
-                    yield {"_safety_issue": safety_issue_detail}
-                    safety_issue_detail_sent = True
+                    if safety_issue_detail and not safety_issue_detail_sent:
+                        yield {"_safety_issue": safety_issue_detail}
+                        safety_issue_detail_sent = True
 
-                if finish_reason and finish_reason != "STOP":
-                    final_finish_reason = finish_reason
+                    if finish_reason and finish_reason != "STOP":
+                        final_finish_reason = finish_reason
 
-        except google_exceptions.GoogleAPIError as e:
-            logger.error(f"SDK 流处理 Google API 错误: {e}", exc_info=True)
-            raise RuntimeError(f"SDK 流处理 Google API 错误: {e}") from e
+        except (httpx.HTTPStatusError, httpx.RequestError):
+            # HTTP 状态错误、超时和网络错误原样抛出，由 error_handler 按类型分类处理
+            raise
         except Exception as e:
-            error_detail = f"SDK 流处理意外错误: {e}"
+            error_detail = f"流处理意外错误: {e}"
             logger.error(error_detail, exc_info=True)
             raise RuntimeError(error_detail) from e
         finally:
             logger.info(
                 f"流式请求结束 (Key: {self.api_key[:8]}..., Model: {request.model}, CachedContentId: {cached_content_id}) ←"
             )
-            yield {"_final_finish_reason": final_finish_reason}
-            if usage_metadata_received:
-                yield {"_usage_metadata": usage_metadata_received}
+
+        # 流正常读完后才产出完成原因和用量；提前关闭 (aclose) 或出错时不再产出
+        yield {"_final_finish_reason": final_finish_reason}
+        if usage_metadata_received:
+            yield {"_usage_metadata": usage_metadata_received}
 
     async def complete_chat(
         self,
@@ -345,54 +391,32 @@ class GeminiClient:
             cached_content_id,
         )
         try:
-            model = genai.GenerativeModel(model_name=request.model)
-            sdk_contents = self._convert_contents_to_sdk_format(contents)
-            sdk_safety_settings = self._convert_safety_settings_to_sdk_format(
-                safety_settings
+            payload = self._build_generate_payload(
+                request, contents, safety_settings, system_instruction, cached_content_id
             )
-            sdk_system_instruction = self._convert_system_instruction_to_sdk_format(
-                system_instruction
-            )
-            sdk_generation_config = {
-                "temperature": request.temperature,
-                "max_output_tokens": request.max_tokens,
-            }
-            sdk_generation_config = {
-                k: v for k, v in sdk_generation_config.items() if v is not None
-            }
-
-            if cached_content_id:
-                logger.warning(
-                    f"google-generativeai==0.8.5 时 CachedContent 的用法未知，暂时不使用缓存 ID: {cached_content_id}"
-                )
-
-            # 假设 model.generate_content 在非流式模式下直接返回一个字典
-            response_dict: Dict[str, Any] = await model.generate_content(  # type: ignore[call-arg]
-                contents=sdk_contents,
-                stream=False,
-                safety_settings=sdk_safety_settings,
-                system_instruction=sdk_system_instruction,
-                generation_config=sdk_generation_config,
+            response = await self.http_client.post(
+                self._build_model_url(request.model, "generateContent"),
+                headers=self._build_headers(),
+                json=payload,
             )
+            response.raise_for_status()
+            response_dict: Dict[str, Any] = response.json()
             (
                 text_content,
                 usage_metadata,
                 safety_issue_detail,
                 finish_reason,
                 cached_content_id_from_response,
-            ) = self._process_sdk_response(
-                response_dict
-            )  # 使用修改后的 response_dict
+            ) = self._process_api_response(response_dict)
 
             # 构建 ResponseWrapper 需要的数据结构
             wrapped_response_data = {
                 "candidates": [],
-                "usageMetadata": usage_metadata,  # 来自 _process_sdk_response
+                "usageMetadata": usage_metadata,  # 来自 _process_api_response
             }
 
-            # 基于 _process_sdk_response 的输出来构建 candidate 数据
-            # 注意：_process_sdk_response 返回的是聚合的 text_content，而不是原始的 parts 结构
-            # 如果需要更精细的 parts 结构，需要在 _process_sdk_response 中调整或在这里重新处理 response_dict
+            # 基于 _process_api_response 的输出来构建 candidate 数据
+            # 注意：_process_api_response 返回的是聚合的 text_content，而不是原始的 parts 结构
             if (
                 text_content or finish_reason
             ):  # 只要有文本或完成原因，就尝试构建 candidate
@@ -402,31 +426,12 @@ class GeminiClient:
                             {"text": text_content if text_content else ""}
                         ]  # 确保 text 字段存在
                     },
-                    "finishReason": finish_reason,  # 来自 _process_sdk_response
-                    # safetyRatings 可以在这里从 response_dict 中提取并转换，如果需要的话
+                    "finishReason": finish_reason,  # 来自 _process_api_response
                 }
                 wrapped_response_data["candidates"].append(candidate_data)
 
-            if (
-                safety_issue_detail
-            ):  # 如果存在安全问题，可以考虑如何体现在 ResponseWrapper 中
+            if safety_issue_detail:
                 logger.warning(f"检测到安全问题，将包含在响应中: {safety_issue_detail}")
-                # 可以在 wrapped_response_data 中添加一个字段来表示安全问题，例如：
-                # wrapped_response_data["safetyFeedback"] = {"blockReason": safety_issue_detail}
-                # 或者根据 OpenAI 的格式，如果被阻止，finish_reason 可能是 "SAFETY"
-                if (
-                    wrapped_response_data["candidates"]
-                    and isinstance(wrapped_response_data["candidates"], list)
-                    and len(wrapped_response_data["candidates"]) > 0
-                ):
-                    # 如果是因为安全问题导致内容为空，可以更新 finish_reason
-                    if (
-                        not text_content and finish_reason != "SAFETY"
-                    ):  # 假设 "SAFETY" 是一个可能的 finish_reason
-                        logger.info(
-                            f"内容为空且存在安全问题，将 finish_reason 更新为 SAFETY (原: {finish_reason})"
-                        )
-                        # wrapped_response_data["candidates"][0]["finishReason"] = "SAFETY" # 取决于API具体行为
 
             if cached_content_id_from_response:
                 wrapped_response_data["cacheMetadata"] = {
@@ -443,11 +448,11 @@ class GeminiClient:
             )
             return ResponseWrapper(wrapped_response_data)
 
-        except google_exceptions.GoogleAPIError as e:
-            logger.error(f"SDK 非流处理 Google API 错误: {e}", exc_info=True)
-            raise RuntimeError(f"SDK 非流处理 Google API 错误: {e}") from e
+        except (httpx.HTTPStatusError, httpx.RequestError):
+            # HTTP 状态错误、超时和网络错误原样抛出，由 error_handler 按类型分类处理
+            raise
         except Exception as e:
-            error_detail = f"SDK 非流处理意外错误: {e}"
+            error_detail = f"非流处理意外错误: {e}"
             logger.error(error_detail, exc_info=True)
             raise RuntimeError(error_detail) from e
 
@@ -456,85 +461,138 @@ class GeminiClient:
     ) -> Dict[str, Any]:
         """通用的 generateContent 调用封装，供 /v2 端点使用。
 
-        注意：在测试中通常会通过 patch 覆盖此方法，因此这里的实现主要用于
-        满足运行时属性存在，并在需要真实调用时走 SDK。
+        请求体按 Gemini 原生格式直接透传给 REST 接口，响应以原始字典返回。
         """
         logger.info(
             f"/v2 generateContent 调用开始 (Key: {self.api_key[:8]}..., Model: {model_name})"
         )
         try:
-            model = genai.GenerativeModel(model_name=model_name)
-            # 对于 v2，我们直接将 request_payload 透传给 SDK；
-            # 这里假设 SDK 返回的对象可以通过 dict() 或 to_dict() 转换为字典。
-            sdk_response = await model.generate_content(**request_payload)
-
-            # 尝试将响应转换为普通字典
-            if isinstance(sdk_response, dict):
-                response_dict = sdk_response
-            else:
-                # 尝试使用 to_dict() 或 __dict__ 进行转换，作为保守实现
-                to_dict = getattr(sdk_response, "to_dict", None)
-                if callable(to_dict):
-                    response_dict = to_dict()
-                else:
-                    try:
-                        response_dict = dict(sdk_response)  # type: ignore[arg-type]
-                    except TypeError:
-                        logger.warning(
-                            "generate_content 返回了非字典类型且无法直接转换，返回空结构以避免崩溃: %s",
-                            type(sdk_response),
-                        )
-                        response_dict = {}
+            response = await self.http_client.post(
+                self._build_model_url(model_name, "generateContent"),
+                headers=self._build_headers(),
+                json=request_payload,
+            )
+            response.raise_for_status()
+            response_dict = response.json()
+            if not isinstance(response_dict, dict):
+                logger.warning(
+                    "generateContent 返回了非字典类型，返回空结构以避免崩溃: %s",
+                    type(response_dict),
+                )
+                response_dict = {}
 
             logger.info(
                 f"/v2 generateContent 调用成功 (Key: {self.api_key[:8]}..., Model: {model_name})"
             )
             return response_dict
 
-        except google_exceptions.GoogleAPIError as e:
-            logger.error(f"/v2 generateContent Google API 错误: {e}", exc_info=True)
-            raise RuntimeError(f"/v2 generateContent Google API 错误: {e}") from e
+        except httpx.HTTPStatusError as e:
+            # 原样抛出，调用方可以按上游状态码处理
+            logger.error(
+                f"/v2 generateContent API 错误 (状态码 {e.response.status_code}): {e.response.text[:200]}"
+            )
+            raise
         except Exception as e:
             error_detail = f"/v2 generateContent 意外错误: {e}"
             logger.error(error_detail, exc_info=True)
             raise RuntimeError(error_detail) from e
 
+    async def count_tokens(
+        self, model_name: str, contents: List[Dict[str, Any]]
+    ) -> int:
+        """调用 countTokens 接口，返回 contents 的精确输入 Token 数。
+
+        HTTP 状态错误、超时和网络错误原样抛出，由调用方决定是否回退到本地估算。
+        """
+        response = await self.http_client.post(
+            self._build_model_url(model_name, "countTokens"),
+            headers=self._build_headers(),
+            json={"contents": self._convert_contents_to_api_format(contents)},
+        )
+        response.raise_for_status()
+        response_dict = response.json()
+        total_tokens = (
+            response_dict.get("totalTokens") if isinstance(response_dict, dict) else None
+        )
+        if not isinstance(total_tokens, int):
+            raise ValueError(f"countTokens 响应缺少 totalTokens: {response_dict}")
+        logger.debug(
+            f"countTokens 调用成功 (Key: {self.api_key[:8]}..., Model: {model_name}, Tokens: {total_tokens})"
+        )
+        return total_tokens
+
+    async def batch_embed_contents(
+        self,
+        model_name: str,
+        texts: List[str],
+        output_dimensionality: Optional[int] = None,
+    ) -> List[List[float]]:
+        """调用 batchEmbedContents 接口，一次请求返回多段文本的向量 (顺序与 texts 一致)。
+
+        HTTP 状态错误、超时和网络错误原样抛出，由调用方按 Key 错误处理。
+        """
+        request_template: Dict[str, Any] = {"model": f"models/{model_name}"}
+        if output_dimensionality:
+            request_template["outputDimensionality"] = output_dimensionality
+        response = await self.http_client.post(
+            self._build_model_url(model_name, "batchEmbedContents"),
+            headers=self._build_headers(),
+            json={
+                "requests": [
+                    {**request_template, "content": {"parts": [{"text": text}]}}
+                    for text in texts
+                ]
+            },
+        )
+        response.raise_for_status()
+        response_dict = response.json()
+        embeddings = (
+            response_dict.get("embeddings") if isinstance(response_dict, dict) else None
+        )
+        if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+            raise ValueError(
+                f"batchEmbedContents 响应的向量数与请求不一致 (请求 {len(texts)} 条)"
+            )
+        logger.debug(
+            f"batchEmbedContents 调用成功 (Key: {self.api_key[:8]}..., Model: {model_name}, 条数: {len(texts)})"
+        )
+        return [embedding.get("values", []) for embedding in embeddings]
+
     @staticmethod
     async def list_available_models(
         api_key: str, http_client: httpx.AsyncClient
     ) -> List[str]:
         if not api_key:
             raise ValueError("API Key 不能为空")
-        logger.info(f"尝试使用 Key {api_key[:8]}... 获取模型列表 (通过 SDK)")
-        try:
-            # 同样移除 client_options={"transport": http_client}
-            genai.configure(
-                api_key=api_key,
-                transport="rest",
-                # client_options 已移除
-            )
-        except Exception as config_err:
-            logger.error(
-                f"配置 Gemini SDK 以获取模型列表时出错: {config_err}", exc_info=True
-            )
-            raise Exception(f"配置 SDK 失败: {config_err}") from config_err
-
+        logger.info(f"尝试使用 Key {api_key[:8]}... 获取模型列表 (通过 REST)")
         try:
-            # genai.list_models() 在旧版本中可能返回同步生成器
-            models_iterable = genai.list_models()  # 移除 await
-            model_names = []
-            for model in models_iterable:  # 改为同步 for 循环
-                model_name = model.name
-                if model_name.startswith("models/"):
-                    model_name = model_name[len("models/") :]
-                model_names.append(model_name)
+            model_names: List[str] = []
+            page_token: Optional[str] = None
+            while True:
+                params: Dict[str, Any] = {"pageSize": 1000}
+                if page_token:
+                    params["pageToken"] = page_token
+                response = await http_client.get(
+                    f"{app_config.GEMINI_API_BASE_URL}/models",
+                    params=params,
+                    headers={"x-goog-api-key": api_key},
+                )
+                response.raise_for_status()
+                data = response.json()
+                for model in data.get("models", []):
+                    model_name = model.get("name", "")
+                    if model_name.startswith("models/"):
+                        model_name = model_name[len("models/") :]
+                    if model_name:
+                        model_names.append(model_name)
+                page_token = data.get("nextPageToken")
+                if not page_token:
+                    break
 
             logger.info(
-                f"成功获取到 {len(model_names)} 个模型 (Key: {api_key[:8]}..., 通过 SDK)"
+                f"成功获取到 {len(model_names)} 个模型 (Key: {api_key[:8]}..., 通过 REST)"
             )
             return model_names
         except Exception as e:
-            logger.error(f"获取模型列表失败 (通过 SDK): {e}", exc_info=True)
-            # 确保在异步函数中正确处理同步代码可能引发的异常，或者将此部分变为同步（如果可以）
-            # 但由于整个 list_available_models 是 async def，同步迭代本身是允许的。
+            logger.error(f"获取模型列表失败 (通过 REST): {e}", exc_info=True)
             raise Exception(f"获取模型列表失败: {e}") from e
@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+"""
+多 worker 共享的配额状态后端。
+
+配额相关的状态 (RPM/TPM 速率限制器、RPD/TPD 计数、IP 限流、每日耗尽 / 临时不可用标记)
+原先都只存在于单个进程中。以多个 uvicorn/gunicorn worker 运行时，每个 worker 都看不到
+其他 worker 的消耗，实际用量会达到限额的 N 倍。本模块提供可插拔的共享状态后端，
+通过 SHARED_STATE_BACKEND 选择：
+- "local" (默认)：不共享，沿用各模块的进程内实现 (create_shared_state_backend 返回 None)；
+- "shm"：单机多 worker。使用 multiprocessing.shared_memory 中固定布局的数组
+  (开放寻址哈希表 + 标记表)，跨进程用文件锁 (fcntl.flock) 串行化，每次操作只需几微秒；
+- "redis"：多机部署。每个原子操作对应一个 Lua 脚本，在 Redis 中一次往返完成。
+
+后端只提供少量原子原语，由调用方组合：
+- GCRA 理论到达时间 (gcra_acquire / gcra_refund / gcra_tat)：IP 每分钟限流；
+- 计数器 (counter_add / counter_get / counter_get_many)：带"不超过上限才累加"语义，
+  用于速率限制器的滑动窗口时间段、RPD/TPD 和 IP 每日限流，计数器名称中包含日期或时间段编号，
+  过期后自动失效；批量读取 (counter_get_many) 在 Redis 中为一次 MGET；
+- 滑动窗口占用 (window_reserve)：在一次原子操作中读取窗口内所有时间段计数器，
+  总和加上本次用量不超过上限时累加到当前时间段，Redis 中为一次 Lua 往返；
+- 标记 (set_mark / get_marks / clear_marks)：成员 → 过期时间戳，用于在 worker 之间同步
+  每日耗尽和临时不可用的 Key。
+Key 分数等派生状态仍由各 worker 自行维护 (它们基于共享计数计算，不影响配额正确性)。
+
+remote 为 True 的后端 (Redis) 每次操作都是一次网络往返。run_shared_state_call 在这种情况下
+把同步调用放到线程池中执行，避免 Key 选择等在请求路径上的操作阻塞事件循环。
+"""
+
+import asyncio  # 在线程池中执行需要网络往返的后端操作
+import hashlib  # 共享内存哈希表的键摘要
+import logging  # 日志记录
+import os  # 文件路径
+import struct  # 共享内存的固定布局
+import tempfile  # 文件锁的默认目录
+import threading  # 进程内的线程锁
+import time  # 时间戳
+from contextlib import contextmanager  # 锁上下文
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from gap import config  # 应用配置
+
+logger = logging.getLogger("my_logger")
+
+_T = TypeVar("_T")
+
+
+class SharedStateBackend:
+    """
+    共享状态后端接口。所有方法都是原子的同步操作 (调用方可能持有线程锁，不能 await)。
+    """
+
+    name = "base"
+    remote = (
+        False  # 每次操作是否需要网络往返 (为 True 时请求路径上的调用应离开事件循环)
+    )
+
+    def gcra_acquire(
+        self, key: str, increment: float, window: float, now: float, force: bool = False
+    ) -> bool:
+        """
+        把 GCRA 理论到达时间 (TAT) 推后 increment 秒：new_tat = max(tat, now) + increment。
+        force 为 False 且 new_tat - now 超过 window 时不做修改并返回 False。
+        """
+        raise NotImplementedError
+
+    def gcra_refund(self, key: str, decrement: float, now: float) -> None:
+        """把 TAT 提前 decrement 秒 (不早于 now)。"""
+        raise NotImplementedError
+
+    def gcra_tat(self, key: str) -> float:
+        """返回当前 TAT (不存在时为 0)。"""
+        raise NotImplementedError
+
+    def counter_add(
+        self, key: str, amount: int, limit: Optional[int], ttl_seconds: int
+    ) -> Tuple[bool, int]:
+        """
+        累加计数器。limit 不为 None 且累加后会超过 limit 时不做修改。
+
+        Returns:
+            Tuple[bool, int]: (是否已累加, 操作后的计数)。
+        """
+        raise NotImplementedError
+
+    def counter_get(self, key: str) -> int:
+        """返回计数器的当前值 (不存在或已过期时为 0)。"""
+        raise NotImplementedError
+
+    def counter_get_many(self, keys: List[str]) -> List[int]:
+        """按顺序返回多个计数器的当前值 (一次读取，不存在或已过期时为 0)。"""
+        raise NotImplementedError
+
+    def window_reserve(
+        self, keys: List[str], amount: int, limit: int, ttl_seconds: int
+    ) -> Tuple[bool, List[int]]:
+        """
+        读取 keys 中所有计数器 (负值按 0 计)，总和加上 amount 不超过 limit 时把 amount
+        累加到最后一个计数器 (当前时间段)；否则不做修改。读取与累加是同一个原子操作。
+
+        Returns:
+            Tuple[bool, List[int]]: (是否已累加, 累加前各计数器的值)。
+        """
+        raise NotImplementedError
+
+    def set_mark(self, namespace: str, member: str, expires_at: float) -> None:
+        """设置标记，expires_at 之后自动失效。"""
+        raise NotImplementedError
+
+    def get_marks(self, namespace: str, now: float) -> Dict[str, float]:
+        """返回命名空间中所有未过期的标记 {成员: 过期时间戳}。"""
+        raise NotImplementedError
+
+    def clear_marks(self, namespace: str) -> None:
+        """清空命名空间中的所有标记。"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """释放后端持有的资源 (不删除共享状态本身)。"""
+
+
+class SharedMemoryStateBackend(SharedStateBackend):
+    """
+    基于 multiprocessing.shared_memory 的单机共享状态。
+
+    布局 (小端)：
+    - 头部：魔数 8s、槽位数 Q、标记数 Q；
+    - 槽位表：slots 个 (键摘要 16s, 值 d, 过期时间戳 d)，开放寻址 + 线性探测。
+      过期的槽位保留摘要 (探测链不断开)，可被新键复用；
+    - 标记表：marks 个 (名称 128s, 过期时间戳 d)，名称为 "命名空间\\x1f成员"，线性扫描。
+    共享内存段在所有 worker 退出后仍然保留 (worker 重启不丢失状态)，直到机器重启或手动删除。
+    """
+
+    name = "shm"
+
+    MAGIC = b"GAPSHM01"
+    HEADER = struct.Struct("<8sQQ")
+    SLOT = struct.Struct("<16sdd")
+    SLOT_VALUE = struct.Struct("<dd")
+    MARK = struct.Struct("<128sd")
+    EMPTY_DIGEST = b"\x00" * 16
+    MAX_PROBES = 64  # 单次查找最多探测的槽位数，超过后淘汰探测范围内最早过期的槽位
+
+    def __init__(
+        self,
+        segment_name: Optional[str] = None,
+        slots: Optional[int] = None,
+        marks: Optional[int] = None,
+    ):
+        import fcntl  # 仅 POSIX 可用；其他平台在此处失败并回退到进程内状态
+        from multiprocessing import resource_tracker, shared_memory
+
+        self._fcntl = fcntl
+        segment_name = segment_name or config.SHARED_STATE_SHM_NAME
+        slots = slots or config.SHARED_STATE_SHM_SLOTS
+        marks = marks or config.SHARED_STATE_SHM_MARKS
+        self._thread_lock = threading.Lock()  # flock 不排斥同一进程内的其他线程
+        self._lock_file = open(
+            os.path.join(tempfile.gettempdir(), f"{segment_name}.lock"), "a+b"
+        )
+        with self._locked():
+            size = self.HEADER.size + slots * self.SLOT.size + marks * self.MARK.size
+            try:
+                self._shm = shared_memory.SharedMemory(
+                    name=segment_name, create=True, size=size
+                )
+                self.HEADER.pack_into(self._shm.buf, 0, self.MAGIC, slots, marks)
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=segment_name)
+                magic, slots, marks = self.HEADER.unpack_from(self._shm.buf, 0)
+                if magic != self.MAGIC:
+                    raise RuntimeError(f"共享内存段 {segment_name} 的布局不兼容")
+        # 3.13 之前 attach 也会注册到 resource_tracker，任一 worker 退出时都会删除共享内存段
+        try:
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+        except Exception:
+            pass
+        self._buf = self._shm.buf
+        self._slots = slots
+        self._marks = marks
+        self._marks_offset = self.HEADER.size + slots * self.SLOT.size
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with self._thread_lock:
+            self._fcntl.flock(self._lock_file.fileno(), self._fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._fcntl.flock(self._lock_file.fileno(), self._fcntl.LOCK_UN)
+
+    # --- 槽位表 ---
+
+    def _find_slot(self, key: str, now: float, create: bool) -> Tuple[int, float]:
+        """
+        (内部方法) 查找键所在的槽位偏移量和当前值 (已过期视为 0)。调用者必须持有锁。
+        create 为 False 且键不存在时返回 (-1, 0.0)。
+        """
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        index = int.from_bytes(digest[:8], "little") % self._slots
+        reusable, oldest, oldest_expires = -1, -1, float("inf")
+        for _ in range(min(self.MAX_PROBES, self._slots)):
+            offset = self.HEADER.size + index * self.SLOT.size
+            slot_digest, value, expires_at = self.SLOT.unpack_from(self._buf, offset)
+            if slot_digest == digest:
+                return offset, (value if expires_at > now else 0.0)
+            if slot_digest == self.EMPTY_DIGEST:
+                if reusable < 0:
+                    reusable = offset
+                break  # 探测链结束
+            if expires_at <= now and reusable < 0:
+                reusable = offset
+            if expires_at < oldest_expires:
+                oldest, oldest_expires = offset, expires_at
+            index = (index + 1) % self._slots
+        if not create:
+            return -1, 0.0
+        if reusable < 0:
+            logger.warning(
+                "共享内存状态表已满，淘汰最早过期的条目 (考虑增大 SHARED_STATE_SHM_SLOTS)。"
+            )
+            reusable = oldest
+        self.SLOT.pack_into(self._buf, reusable, digest, 0.0, 0.0)
+        return reusable, 0.0
+
+    def _write_slot(self, offset: int, value: float, expires_at: float) -> None:
+        """(内部方法) 写入槽位的值和过期时间戳 (摘要不变)。调用者必须持有锁。"""
+        self.SLOT_VALUE.pack_into(self._buf, offset + 16, value, expires_at)
+
+    def gcra_acquire(
+        self, key: str, increment: float, window: float, now: float, force: bool = False
+    ) -> bool:
+        with self._locked():
+            offset, tat = self._find_slot(key, now, create=True)
+            new_tat = max(tat, now) + increment
+            if not force and new_tat - now > window + 1e-9:
+                return False
+            self._write_slot(offset, new_tat, new_tat)
+            return True
+
+    def gcra_refund(self, key: str, decrement: float, now: float) -> None:
+        with self._locked():
+            offset, tat = self._find_slot(key, now, create=False)
+            if offset >= 0 and tat > now:
+                new_tat = max(now, tat - decrement)
+                self._write_slot(offset, new_tat, new_tat)
+
+    def gcra_tat(self, key: str) -> float:
+        with self._locked():
+            # TAT 早于当前时间时与空闲状态等价，无需按过期时间过滤
+            return self._find_slot(key, 0.0, create=False)[1]
+
+    def counter_add(
+        self, key: str, amount: int, limit: Optional[int], ttl_seconds: int
+    ) -> Tuple[bool, int]:
+        now = time.time()
+        with self._locked():
+            offset, value = self._find_slot(key, now, create=True)
+            if limit is not None and value + amount > limit:
+                return False, int(value)
+            self._write_slot(offset, value + amount, now + ttl_seconds)
+            return True, int(value + amount)
+
+    def counter_get(self, key: str) -> int:
+        now = time.time()
+        with self._locked():
+            return int(self._find_slot(key, now, create=False)[1])
+
+    def counter_get_many(self, keys: List[str]) -> List[int]:
+        now = time.time()
+        with self._locked():
+            return [int(self._find_slot(key, now, create=False)[1]) for key in keys]
+
+    def window_reserve(
+        self, keys: List[str], amount: int, limit: int, ttl_seconds: int
+    ) -> Tuple[bool, List[int]]:
+        now = time.time()
+        with self._locked():
+            counts = [
+                max(0, int(self._find_slot(key, now, create=False)[1])) for key in keys
+            ]
+            if sum(counts) + amount > limit:
+                return False, counts
+            offset, value = self._find_slot(keys[-1], now, create=True)
+            self._write_slot(offset, value + amount, now + ttl_seconds)
+            return True, counts
+
+    # --- 标记表 ---
+
+    def _iter_marks(self) -> Iterator[Tuple[int, str, float]]:
+        """(内部方法) 遍历标记表中的 (偏移量, 名称, 过期时间戳)。调用者必须持有锁。"""
+        for i in range(self._marks):
+            offset = self._marks_offset + i * self.MARK.size
+            raw_name, expires_at = self.MARK.unpack_from(self._buf, offset)
+            yield offset, raw_name.rstrip(b"\x00").decode("utf-8", "ignore"), expires_at
+
+    def set_mark(self, namespace: str, member: str, expires_at: float) -> None:
+        name = f"{namespace}\x1f{member}"
+        encoded = name.encode("utf-8")[: self.MARK.size - 8]
+        now = time.time()
+        with self._locked():
+            free = -1
+            for offset, mark_name, mark_expires in self._iter_marks():
+                if mark_name == name:
+                    free = offset
+                    break
+                if free < 0 and (not mark_name or mark_expires <= now):
+                    free = offset
+            if free < 0:
+                logger.warning(
+                    "共享内存标记表已满 (考虑增大 SHARED_STATE_SHM_MARKS)，标记未同步。"
+                )
+                return
+            self.MARK.pack_into(self._buf, free, encoded, expires_at)
+
+    def get_marks(self, namespace: str, now: float) -> Dict[str, float]:
+        prefix = f"{namespace}\x1f"
+        with self._locked():
+            return {
+                name[len(prefix) :]: expires_at
+                for _, name, expires_at in self._iter_marks()
+                if expires_at > now and name.startswith(prefix)
+            }
+
+    def clear_marks(self, namespace: str) -> None:
+        prefix = f"{namespace}\x1f"
+        with self._locked():
+            for offset, name, _ in self._iter_marks():
+                if name.startswith(prefix):
+                    self.MARK.pack_into(self._buf, offset, b"", 0.0)
+
+    def close(self) -> None:
+        self._buf = None  # type: ignore[assignment]
+        self._shm.close()
+        self._lock_file.close()
+
+    def unlink(self) -> None:
+        """删除共享内存段 (主要用于测试)。"""
+        from multiprocessing import resource_tracker
+
+        # SharedMemory.unlink 会向 resource_tracker 注销，先恢复初始化时取消的注册
+        resource_tracker.register(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+        self._shm.unlink()
+
+
+class LocalStateBackend(SharedStateBackend):
+    """
+    进程内的状态后端 (不在 worker 之间共享)。
+    Redis 不可用时作为 RedisStateBackend 的临时替代，保证配额检查在故障期间仍按单 worker 的语义工作。
+    """
+
+    name = "local"
+    PRUNE_INTERVAL = 1024  # 每多少次写入清理一次过期条目
+
+    def __init__(self):
+        self._lock = threading.Lock()  # 保护以下状态
+        self._values: Dict[str, Tuple[float, float]] = {}  # 键 -> (值, 过期时间戳)
+        self._marks: Dict[str, Dict[str, float]] = {}  # 命名空间 -> {成员: 过期时间戳}
+        self._writes = 0  # 距上次清理的写入次数
+
+    def _get(self, key: str, now: float) -> float:
+        """(内部方法) 返回键的当前值 (不存在或已过期时为 0)。调用者必须持有锁。"""
+        value, expires_at = self._values.get(key, (0.0, 0.0))
+        return value if expires_at > now else 0.0
+
+    def _set(self, key: str, value: float, expires_at: float, now: float) -> None:
+        """(内部方法) 写入键的值，并定期清理过期条目。调用者必须持有锁。"""
+        self._values[key] = (value, expires_at)
+        self._writes += 1
+        if self._writes >= self.PRUNE_INTERVAL:
+            self._writes = 0
+            for expired in [k for k, (_, e) in self._values.items() if e <= now]:
+                del self._values[expired]
+
+    def gcra_acquire(
+        self, key: str, increment: float, window: float, now: float, force: bool = False
+    ) -> bool:
+        with self._lock:
+            new_tat = max(self._get(key, now), now) + increment
+            if not force and new_tat - now > window + 1e-9:
+                return False
+            self._set(key, new_tat, new_tat, now)
+            return True
+
+    def gcra_refund(self, key: str, decrement: float, now: float) -> None:
+        with self._lock:
+            tat = self._get(key, now)
+            if tat > now:
+                new_tat = max(now, tat - decrement)
+                self._set(key, new_tat, new_tat, now)
+
+    def gcra_tat(self, key: str) -> float:
+        with self._lock:
+            return self._get(key, 0.0)
+
+    def counter_add(
+        self, key: str, amount: int, limit: Optional[int], ttl_seconds: int
+    ) -> Tuple[bool, int]:
+        now = time.time()
+        with self._lock:
+            value = self._get(key, now)
+            if limit is not None and value + amount > limit:
+                return False, int(value)
+            self._set(key, value + amount, now + ttl_seconds, now)
+            return True, int(value + amount)
+
+    def counter_get(self, key: str) -> int:
+        with self._lock:
+            return int(self._get(key, time.time()))
+
+    def counter_get_many(self, keys: List[str]) -> List[int]:
+        now = time.time()
+        with self._lock:
+            return [int(self._get(key, now)) for key in keys]
+
+    def window_reserve(
+        self, keys: List[str], amount: int, limit: int, ttl_seconds: int
+    ) -> Tuple[bool, List[int]]:
+        now = time.time()
+        with self._lock:
+            counts = [max(0, int(self._get(key, now))) for key in keys]
+            if sum(counts) + amount > limit:
+                return False, counts
+            value = self._get(keys[-1], now)
+            self._set(keys[-1], value + amount, now + ttl_seconds, now)
+            return True, counts
+
+    def set_mark(self, namespace: str, member: str, expires_at: float) -> None:
+        with self._lock:
+            self._marks.setdefault(namespace, {})[member] = expires_at
+
+    def get_marks(self, namespace: str, now: float) -> Dict[str, float]:
+        with self._lock:
+            marks = self._marks.get(namespace, {})
+            for expired in [m for m, e in marks.items() if e <= now]:
+                del marks[expired]
+            return dict(marks)
+
+    def clear_marks(self, namespace: str) -> None:
+        with self._lock:
+            self._marks.pop(namespace, None)
+
+
+class RedisStateBackend(SharedStateBackend):
+    """
+    基于 Redis 的共享状态。每个原子操作是一个 Lua 脚本 (一次往返)，批量读取使用 MGET。
+    使用同步客户端：调用方位于同步代码路径 (并且可能持有线程锁)。
+    Key 选择等请求路径上的调用通过 run_shared_state_call 在线程池中执行，不阻塞事件循环；
+    连接和读写都设置了较短的超时 (SHARED_STATE_REDIS_TIMEOUT_SECONDS)，
+    避免 Redis 故障时其余仍在事件循环中的调用长时间阻塞。
+
+    连接失败或超时时记录警告，并在 SHARED_STATE_REDIS_RETRY_SECONDS 内改用进程内状态
+    (LocalStateBackend)，之后再重新尝试 Redis。故障期间的配额只在本 worker 内生效。
+    """
+
+    name = "redis"
+    remote = True
+
+    _GCRA_ACQUIRE = """
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+local increment, now, window = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local new_tat = math.max(tat, now) + increment
+if ARGV[4] ~= '1' and new_tat - now > window + 1e-9 then
+    return 0
+end
+redis.call('SET', KEYS[1], string.format('%.6f', new_tat), 'PX', math.ceil((new_tat - now) * 1000) + 1000)
+return 1
+"""
+    _GCRA_REFUND = """
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+local decrement, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+if tat <= now then
+    return 0
+end
+local new_tat = math.max(now, tat - decrement)
+redis.call('SET', KEYS[1], string.format('%.6f', new_tat), 'PX', math.ceil((new_tat - now) * 1000) + 1000)
+return 1
+"""
+    _COUNTER_ADD = """
+local value = tonumber(redis.call('GET', KEYS[1]) or '0')
+local amount, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+if limit >= 0 and value + amount > limit then
+    return {0, value}
+end
+value = redis.call('INCRBY', KEYS[1], amount)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return {1, value}
+"""
+    _WINDOW_RESERVE = """
+local values = redis.call('MGET', unpack(KEYS))
+local counts, used = {}, 0
+for i = 1, #KEYS do
+    counts[i] = math.max(0, tonumber(values[i] or '0'))
+    used = used + counts[i]
+end
+if used + tonumber(ARGV[1]) > tonumber(ARGV[2]) then
+    return {0, counts}
+end
+redis.call('INCRBY', KEYS[#KEYS], ARGV[1])
+redis.call('EXPIRE', KEYS[#KEYS], ARGV[3])
+return {1, counts}
+"""
+
+    def __init__(self, url: Optional[str] = None, prefix: Optional[str] = None):
+        import redis  # 已是项目依赖
+
+        url = url or config.REDIS_URL
+        if not url:
+            raise ValueError("SHARED_STATE_BACKEND=redis 需要设置 REDIS_URL")
+        self._prefix = config.SHARED_STATE_REDIS_PREFIX if prefix is None else prefix
+        timeout = config.SHARED_STATE_REDIS_TIMEOUT_SECONDS
+        self._client = redis.Redis.from_url(
+            url,
+            decode_responses=True,
+            socket_timeout=timeout,
+            socket_connect_timeout=timeout,
+        )
+        self._gcra_acquire = self._client.register_script(self._GCRA_ACQUIRE)
+        self._gcra_refund = self._client.register_script(self._GCRA_REFUND)
+        self._counter_add = self._client.register_script(self._COUNTER_ADD)
+        self._window_reserve = self._client.register_script(self._WINDOW_RESERVE)
+        self._errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+        self._fallback = LocalStateBackend()  # Redis 不可用期间使用的进程内状态
+        self._fallback_until = 0.0  # 在此时间 (time.monotonic) 之前直接使用进程内状态
+
+    def _key(self, key: str) -> str:
+        return f"{self._prefix}{key}"
+
+    def _call(self, operation: str, redis_call: Callable[..., _T], *args: Any) -> _T:
+        """
+        (内部方法) 执行一次 Redis 操作；Redis 连接失败或超时时改用进程内状态完成同一操作，
+        并在 SHARED_STATE_REDIS_RETRY_SECONDS 内不再尝试 Redis。
+        """
+        if time.monotonic() < self._fallback_until:
+            return getattr(self._fallback, operation)(*args)
+        try:
+            return redis_call(*args)
+        except self._errors as e:
+            retry = config.SHARED_STATE_REDIS_RETRY_SECONDS
+            self._fallback_until = time.monotonic() + retry
+            logger.warning(
+                f"共享状态 Redis 不可用 ({operation}: {e})，"
+                f"{retry:g} 秒内改用进程内状态 (配额不在 worker 之间共享)。"
+            )
+            return getattr(self._fallback, operation)(*args)
+
+    def gcra_acquire(
+        self, key: str, increment: float, window: float, now: float, force: bool = False
+    ) -> bool:
+        return self._call(
+            "gcra_acquire", self._redis_gcra_acquire, key, increment, window, now, force
+        )
+
+    def _redis_gcra_acquire(
+        self, key: str, increment: float, window: float, now: float, force: bool
+    ) -> bool:
+        return bool(
+            self._gcra_acquire(
+                keys=[self._key(key)],
+                args=[increment, now, window, "1" if force else "0"],
+            )
+        )
+
+    def gcra_refund(self, key: str, decrement: float, now: float) -> None:
+        self._call("gcra_refund", self._redis_gcra_refund, key, decrement, now)
+
+    def _redis_gcra_refund(self, key: str, decrement: float, now: float) -> None:
+        self._gcra_refund(keys=[self._key(key)], args=[decrement, now])
+
+    def gcra_tat(self, key: str) -> float:
+        return self._call("gcra_tat", self._redis_gcra_tat, key)
+
+    def _redis_gcra_tat(self, key: str) -> float:
+        return float(self._client.get(self._key(key)) or 0.0)
+
+    def counter_add(
+        self, key: str, amount: int, limit: Optional[int], ttl_seconds: int
+    ) -> Tuple[bool, int]:
+        return self._call(
+            "counter_add", self._redis_counter_add, key, amount, limit, ttl_seconds
+        )
+
+    def _redis_counter_add(
+        self, key: str, amount: int, limit: Optional[int], ttl_seconds: int
+    ) -> Tuple[bool, int]:
+        added, value = self._counter_add(
+            keys=[self._key(key)],
+            args=[int(amount), -1 if limit is None else int(limit), int(ttl_seconds)],
+        )
+        return bool(added), int(value)
+
+    def counter_get(self, key: str) -> int:
+        return self._call("counter_get", self._redis_counter_get, key)
+
+    def _redis_counter_get(self, key: str) -> int:
+        return int(self._client.get(self._key(key)) or 0)
+
+    def counter_get_many(self, keys: List[str]) -> List[int]:
+        if not keys:
+            return []
+        return self._call("counter_get_many", self._redis_counter_get_many, keys)
+
+    def _redis_counter_get_many(self, keys: List[str]) -> List[int]:
+        values = self._client.mget([self._key(key) for key in keys])
+        return [int(value or 0) for value in values]
+
+    def window_reserve(
+        self, keys: List[str], amount: int, limit: int, ttl_seconds: int
+    ) -> Tuple[bool, List[int]]:
+        return self._call(
+            "window_reserve",
+            self._redis_window_reserve,
+            keys,
+            amount,
+            limit,
+            ttl_seconds,
+        )
+
+    def _redis_window_reserve(
+        self, keys: List[str], amount: int, limit: int, ttl_seconds: int
+    ) -> Tuple[bool, List[int]]:
+        added, counts = self._window_reserve(
+            keys=[self._key(key) for key in keys],
+            args=[int(amount), int(limit), int(ttl_seconds)],
+        )
+        return bool(added), [int(count) for count in counts]
+
+    def set_mark(self, namespace: str, member: str, expires_at: float) -> None:
+        self._call("set_mark", self._redis_set_mark, namespace, member, expires_at)
+
+    def _redis_set_mark(self, namespace: str, member: str, expires_at: float) -> None:
+        self._client.hset(self._key(f"marks:{namespace}"), member, expires_at)
+
+    def get_marks(self, namespace: str, now: float) -> Dict[str, float]:
+        return self._call("get_marks", self._redis_get_marks, namespace, now)
+
+    def _redis_get_marks(self, namespace: str, now: float) -> Dict[str, float]:
+        marks_key = self._key(f"marks:{namespace}")
+        marks = {m: float(v) for m, v in self._client.hgetall(marks_key).items()}
+        expired = [m for m, v in marks.items() if v <= now]
+        if expired:
+            self._client.hdel(marks_key, *expired)
+        return {m: v for m, v in marks.items() if v > now}
+
+    def clear_marks(self, namespace: str) -> None:
+        self._call("clear_marks", self._redis_clear_marks, namespace)
+
+    def _redis_clear_marks(self, namespace: str) -> None:
+        self._client.delete(self._key(f"marks:{namespace}"))
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_shared_state_backend(
+    backend_name: Optional[str] = None,
+) -> Optional[SharedStateBackend]:
+    """
+    按 SHARED_STATE_BACKEND 创建共享状态后端。
+    "local" 返回 None (各模块使用进程内状态)；创建失败时记录错误并同样回退到进程内状态。
+    """
+    backend_name = (backend_name or config.SHARED_STATE_BACKEND).lower()
+    if backend_name == "local":
+        return None
+    try:
+        if backend_name == "shm":
+            backend: SharedStateBackend = SharedMemoryStateBackend()
+        elif backend_name == "redis":
+            backend = RedisStateBackend()
+        else:
+            raise ValueError(f"未知的 SHARED_STATE_BACKEND: {backend_name}")
+    except Exception as e:
+        logger.error(f"创建共享状态后端 '{backend_name}' 失败，回退到进程内状态: {e}")
+        return None
+    logger.info(f"配额状态使用共享后端: {backend.name} (pid {os.getpid()})。")
+    return backend
+
+
+# 全局的共享状态后端 (None 表示进程内状态)
+shared_state_backend: Optional[SharedStateBackend] = create_shared_state_backend()
+
+
+async def run_shared_state_call(func: Callable[..., _T], *args: Any) -> _T:
+    """
+    执行一个会访问共享状态后端的同步调用。
+    后端需要网络往返 (remote) 时在线程池中执行，不阻塞事件循环；否则直接调用 (避免线程切换的开销)。
+    """
+    if shared_state_backend is not None and shared_state_backend.remote:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
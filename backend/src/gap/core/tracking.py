@@ -3,7 +3,8 @@
 全局跟踪模块。
 定义用于在内存中跟踪 API 使用情况、速率限制、缓存统计、Key 分数等的全局变量和线程锁。
 提供更新这些统计数据的辅助函数。
-注意：这些数据是内存中的，应用重启后会丢失（除非有持久化机制）。
+注意：这些数据是内存中的；使用计数、每日总量和 IP 计数由 gap.core.usage_persistence
+周期性写入快照和增量日志，并在应用启动时恢复。
 """
 import logging  # 导入日志模块
 import threading  # 导入线程模块，用于创建锁保护共享数据
@@ -12,7 +13,7 @@ from collections import (  # 导入 defaultdict 和 Counter，方便数据统计
     Counter,
     defaultdict,
 )
-from typing import Any, Dict  # 导入类型提示
+from typing import Any, Dict, Set, Tuple  # 导入类型提示
 
 logger = logging.getLogger(__name__)  # 获取当前模块的 logger 实例
 
@@ -28,28 +29,25 @@ except ImportError:
 # `usage_data`: 存储每个 API Key 对每个模型的使用情况统计。
 # 结构: {api_key: {model_name: {统计项: 值}}}
 # 统计项包括:
-#   - 'rpm_count': 当前 RPM (每分钟请求数) 窗口内的请求计数。
-#   - 'rpm_timestamp': 当前 RPM 窗口的开始时间戳。
 #   - 'rpd_count': 当日 (太平洋时间) 的总请求计数。
 #   - 'tpd_input_count': 当日 (太平洋时间) 的总输入 Token 计数。
-#   - 'tpm_input_count': 当前 TPM (每分钟输入 Token 数) 窗口内的输入 Token 计数。
-#   - 'tpm_input_timestamp': 当前 TPM 输入窗口的开始时间戳。
 #   - 'last_request_timestamp': 此 Key-模型组合最后一次被请求的时间戳 (用于 Key 选择策略)。
+#   - 'last_used_timestamp': 此 Key-模型组合最后一次成功调用的时间戳。
+# 每分钟的 RPM / TPM 用量由滑动窗口速率限制器 (gap.core.keys.limiter) 单独维护。
 usage_data: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(
     lambda: defaultdict(
         lambda: {  # 使用嵌套 defaultdict 简化初始化
-            "rpm_count": 0,
-            "rpm_timestamp": 0.0,
             "rpd_count": 0,
             "tpd_input_count": 0,
-            "tpm_input_count": 0,
-            "tpm_input_timestamp": 0.0,
             "last_request_timestamp": 0.0,
         }
     )
 )
 # `usage_lock`: 用于保护对 `usage_data` 并发访问的线程锁。
 usage_lock = threading.Lock()  # 保留传统锁作为备用
+# `dirty_usage_entries`: 自上次持久化以来有变化的 (api_key, model_name) 组合 (由 usage_lock 保护)。
+# 增量日志只写入这些条目，避免每次都遍历全部 Key。
+dirty_usage_entries: Set[Tuple[str, str]] = set()
 
 
 # --- Key 健康度评分缓存 ---
@@ -80,6 +78,8 @@ ip_daily_input_token_counts: Dict[str, Counter[str]] = defaultdict(
 )  # 使用 Counter 更方便计数
 # `ip_input_token_counts_lock`: 用于保护对 `ip_daily_input_token_counts` 并发访问的线程锁。
 ip_input_token_counts_lock = threading.Lock()  # 保留传统锁作为备用
+# `dirty_ip_token_counts`: 自上次持久化以来有变化的 (日期, IP) 组合 (由 ip_input_token_counts_lock 保护)。
+dirty_ip_token_counts: Set[Tuple[str, str]] = set()
 
 # --- 缓存使用情况跟踪 ---
 
@@ -121,6 +121,11 @@ def _get_lock(lock_name: str):
         return lock_map.get(lock_name)
 
 
+def mark_usage_dirty(api_key: str, model_name: str) -> None:
+    """标记 usage_data 中的条目已变化，等待写入增量日志。调用者必须持有 usage_lock。"""
+    dirty_usage_entries.add((api_key, model_name))
+
+
 # --- 缓存统计更新函数 ---
 
 
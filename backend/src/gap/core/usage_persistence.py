@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+使用计数与配额状态的持久化 (快照 + 增量日志)。
+
+gap.core.tracking 中的 usage_data、daily_rpd_totals、ip_daily_input_token_counts 以及
+APIKeyManager 的每日耗尽 / 临时不可用标记原先只存在于进程内存中，每次部署或崩溃都会把
+当天的 RPD/TPD 计数清零，代理随即重新使用已耗尽的 Key，引发一波 429。
+本模块把这些状态写入 USAGE_STATE_DIR：
+- 快照 (snapshot.json)：完整状态的紧凑 JSON，先写临时文件再原子替换；
+- 增量日志 (journal.jsonl)：每隔几秒追加一行，只包含自上次写入以来变化的条目的最新值
+  (绝对值而非增量，重放是幂等的)。写入快照后清空日志。
+启动时先读取快照，再按序号重放日志中更新的行 (忽略崩溃时写了一半的最后一行)。
+记录的太平洋日期与今天不同时 (期间错过了每日重置)，只恢复时间戳，不恢复当天计数和耗尽标记。
+RPM/TPM 为 60 秒滑动窗口，重启后很快恢复，不做持久化。
+"""
+
+import json  # 快照和日志的序列化格式
+import logging  # 日志记录
+import os  # 文件操作
+import threading  # 串行化快照和日志写入
+import time  # 时间戳
+from collections import Counter  # IP 计数
+from datetime import datetime  # 太平洋日期
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import pytz  # 时区
+
+from gap import config  # 应用配置
+from gap.core import tracking  # 内存中的使用数据和锁
+from gap.core.shared_state import shared_state_backend  # 多 worker 共享的状态后端
+
+if TYPE_CHECKING:
+    from gap.core.keys.manager import APIKeyManager
+
+logger = logging.getLogger("my_logger")
+
+SNAPSHOT_FILE_NAME = "snapshot.json"
+JOURNAL_FILE_NAME = "journal.jsonl"
+SNAPSHOT_FORMAT_VERSION = 1
+# usage_data 中需要持久化的字段 (每日计数和时间戳)
+COUNT_FIELDS = ("rpd_count", "tpd_input_count")
+TIMESTAMP_FIELDS = ("last_request_timestamp", "last_used_timestamp")
+
+_PT_TIMEZONE = pytz.timezone("America/Los_Angeles")
+
+
+def _today_pt() -> str:
+    """当前的太平洋时区日期字符串 (与每日重置任务使用的日期一致)。"""
+    return datetime.now(_PT_TIMEZONE).strftime("%Y-%m-%d")
+
+
+def _pick_fields(key_usage: Dict[str, Any]) -> Dict[str, Any]:
+    """从 usage_data 的条目中提取需要持久化的字段。"""
+    return {
+        name: key_usage[name]
+        for name in COUNT_FIELDS + TIMESTAMP_FIELDS
+        if key_usage.get(name)
+    }
+
+
+class UsageStatePersistence:
+    """
+    使用计数与配额状态的快照和增量日志。写入方法是同步的文件操作，
+    由调度任务通过 asyncio.to_thread 调用，不阻塞事件循环。
+    """
+
+    def __init__(self, state_dir: Optional[str] = None):
+        self.state_dir = config.USAGE_STATE_DIR if state_dir is None else state_dir
+        self._seq = 0  # 最近一次写入 (快照或日志行) 的序号
+        # 最近一次写入时的耗尽 / 临时不可用映射 (快照中的只读映射，按对象标识判断是否变化)
+        self._last_daily_exhausted: Any = None
+        self._last_temporary_issues: Any = None
+        self._last_rpd_totals: Dict[str, int] = {}
+        # 串行化快照和日志写入 (持锁期间只获取 tracking 的锁)
+        self._io_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        # 配置了共享状态后端时，配额状态由后端保存 (Redis 自身持久化，共享内存在 worker 重启后保留)
+        return bool(self.state_dir) and shared_state_backend is None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.state_dir, SNAPSHOT_FILE_NAME)
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.join(self.state_dir, JOURNAL_FILE_NAME)
+
+    # --- 写入 ---
+
+    def write_snapshot(self, key_manager: "APIKeyManager") -> int:
+        """
+        写入完整快照并清空增量日志。
+
+        Returns:
+            int: 快照中的 (Key, 模型) 条目数量。
+        """
+        if not self.enabled:
+            return 0
+        with self._io_lock:
+            with tracking.usage_lock:
+                usage = {
+                    api_key: {
+                        model_name: _pick_fields(key_usage)
+                        for model_name, key_usage in models.items()
+                    }
+                    for api_key, models in tracking.usage_data.items()
+                }
+                tracking.dirty_usage_entries.clear()
+            with tracking.ip_input_token_counts_lock:
+                ip_counts = {
+                    date: dict(counter)
+                    for date, counter in tracking.ip_daily_input_token_counts.items()
+                }
+                tracking.dirty_ip_token_counts.clear()
+            state = self._collect_common(key_manager, force=True)
+            self._seq += 1
+            state.update(
+                version=SNAPSHOT_FORMAT_VERSION,
+                seq=self._seq,
+                usage=usage,
+                ip_counts=ip_counts,
+            )
+            os.makedirs(self.state_dir, exist_ok=True)
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            # 快照已包含日志中的所有内容；即使清空前崩溃，日志中的旧行也会因序号较小而被忽略
+            with open(self.journal_path, "w", encoding="utf-8"):
+                pass
+        entries = sum(len(models) for models in usage.values())
+        logger.debug(f"已写入使用状态快照: {entries} 个 (Key, 模型) 条目。")
+        return entries
+
+    def flush_journal(self, key_manager: "APIKeyManager") -> int:
+        """
+        把自上次写入以来变化的条目追加到增量日志。日志超过 USAGE_JOURNAL_MAX_BYTES 时改为写入快照。
+
+        Returns:
+            int: 写入的变化条目数量。
+        """
+        if not self.enabled:
+            return 0
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            journal_size = 0
+        if journal_size > config.USAGE_JOURNAL_MAX_BYTES:
+            return self.write_snapshot(key_manager)
+        with self._io_lock:
+            with tracking.usage_lock:
+                dirty = list(tracking.dirty_usage_entries)
+                tracking.dirty_usage_entries.clear()
+                usage: Dict[str, Dict[str, Any]] = {}
+                for api_key, model_name in dirty:
+                    key_usage = tracking.usage_data.get(api_key, {}).get(model_name)
+                    if key_usage is not None:
+                        usage.setdefault(api_key, {})[model_name] = _pick_fields(
+                            key_usage
+                        )
+            with tracking.ip_input_token_counts_lock:
+                dirty_ips = list(tracking.dirty_ip_token_counts)
+                tracking.dirty_ip_token_counts.clear()
+                ip_counts: Dict[str, Dict[str, int]] = {}
+                for date, ip in dirty_ips:
+                    counter = tracking.ip_daily_input_token_counts.get(date)
+                    if counter is not None and ip in counter:
+                        ip_counts.setdefault(date, {})[ip] = counter[ip]
+            entry = self._collect_common(key_manager, force=False)
+            if usage:
+                entry["usage"] = usage
+            if ip_counts:
+                entry["ip_counts"] = ip_counts
+            if len(entry) <= 2:  # 只有 saved_at 和 pt_date，没有任何变化
+                return 0
+            self._seq += 1
+            entry["seq"] = self._seq
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        return len(dirty) + len(dirty_ips)
+
+    def _collect_common(
+        self, key_manager: "APIKeyManager", force: bool
+    ) -> Dict[str, Any]:
+        """
+        (内部方法) 收集每日 RPD 总量和 Key 管理器的耗尽 / 临时不可用标记。
+        force 为 False 时只包含自上次写入以来变化的部分。调用者必须持有 _io_lock。
+        """
+        state: Dict[str, Any] = {"saved_at": time.time(), "pt_date": _today_pt()}
+        with tracking.daily_totals_lock:
+            rpd_totals = dict(tracking.daily_rpd_totals)
+        if force or rpd_totals != self._last_rpd_totals:
+            state["daily_rpd_totals"] = rpd_totals
+            self._last_rpd_totals = rpd_totals
+        snapshot = key_manager.snapshot
+        if force or snapshot.daily_exhausted is not self._last_daily_exhausted:
+            state["daily_exhausted"] = dict(snapshot.daily_exhausted)
+            self._last_daily_exhausted = snapshot.daily_exhausted
+        if force or snapshot.temporary_issues is not self._last_temporary_issues:
+            state["temporary_issues"] = dict(snapshot.temporary_issues)
+            self._last_temporary_issues = snapshot.temporary_issues
+        return state
+
+    # --- 恢复 ---
+
+    def _read_records(self) -> List[Dict[str, Any]]:
+        """(内部方法) 依次读取快照和快照之后的日志行。"""
+        records: List[Dict[str, Any]] = []
+        snapshot_seq = 0
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == SNAPSHOT_FORMAT_VERSION:
+                records.append(snapshot)
+                snapshot_seq = snapshot.get("seq", 0)
+            else:
+                logger.warning(
+                    f"使用状态快照格式版本不匹配 ({snapshot.get('version')})，已忽略。"
+                )
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"读取使用状态快照失败，已忽略: {e}")
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # 崩溃时写了一半的最后一行
+                    if entry.get("seq", 0) > snapshot_seq:
+                        records.append(entry)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"读取使用状态增量日志失败，已忽略: {e}")
+        return records
+
+    def load(self, key_manager: "APIKeyManager") -> Dict[str, int]:
+        """
+        从快照和增量日志恢复使用计数与配额状态 (应用启动时、处理请求之前调用)。
+
+        Returns:
+            Dict[str, int]: 恢复的条目统计。
+        """
+        stats = {"usage_entries": 0, "daily_exhausted": 0, "temporary_issues": 0}
+        if not self.enabled:
+            return stats
+        started_at = time.monotonic()
+        records = self._read_records()
+        if not records:
+            return stats
+        today = _today_pt()
+        # (Key, 模型) -> (记录的太平洋日期, 字段)，后写入的记录覆盖先写入的
+        latest_usage: Dict[Tuple[str, str], Tuple[str, Dict[str, Any]]] = {}
+        ip_counts: Dict[str, Dict[str, int]] = {}
+        rpd_totals: Dict[str, int] = {}
+        daily_exhausted: Dict[str, str] = {}
+        temporary_issues: Dict[str, float] = {}
+        for record in records:
+            pt_date = record.get("pt_date", "")
+            for api_key, models in record.get("usage", {}).items():
+                for model_name, fields in models.items():
+                    latest_usage[(api_key, model_name)] = (pt_date, fields)
+            for date, counts in record.get("ip_counts", {}).items():
+                ip_counts.setdefault(date, {}).update(counts)
+            if "daily_rpd_totals" in record:
+                rpd_totals = record["daily_rpd_totals"]
+            if "daily_exhausted" in record:
+                daily_exhausted = record["daily_exhausted"] if pt_date == today else {}
+            if "temporary_issues" in record:
+                temporary_issues = record["temporary_issues"]
+            self._seq = max(self._seq, record.get("seq", 0))
+
+        # 错过每日重置的计数不恢复，但补记到对应日期的 RPD 总量 (重置任务原本会记录)
+        missed_rpd_totals: Dict[str, int] = Counter()
+        with tracking.usage_lock:
+            for (api_key, model_name), (pt_date, fields) in latest_usage.items():
+                key_usage = tracking.usage_data[api_key][model_name]
+                for name in TIMESTAMP_FIELDS:
+                    if name in fields:
+                        key_usage[name] = max(key_usage.get(name, 0.0), fields[name])
+                if pt_date == today:
+                    for name in COUNT_FIELDS:
+                        if name in fields:
+                            key_usage[name] = key_usage.get(name, 0) + fields[name]
+                else:
+                    missed_rpd_totals[pt_date] += fields.get("rpd_count", 0)
+        with tracking.daily_totals_lock:
+            for date, total in rpd_totals.items():
+                tracking.daily_rpd_totals.setdefault(date, total)
+            for date, total in missed_rpd_totals.items():
+                if total > 0:
+                    tracking.daily_rpd_totals.setdefault(date, total)
+        with tracking.ip_input_token_counts_lock:
+            for date, counts in ip_counts.items():
+                tracking.ip_daily_input_token_counts.setdefault(date, Counter()).update(
+                    counts
+                )
+        stats["usage_entries"] = len(latest_usage)
+        stats["daily_exhausted"], stats["temporary_issues"] = (
+            key_manager.restore_quota_state(daily_exhausted, temporary_issues)
+        )
+        logger.info(
+            f"已从 {self.state_dir} 恢复使用状态: {stats['usage_entries']} 个 (Key, 模型) 条目, "
+            f"{stats['daily_exhausted']} 个每日耗尽 Key, {stats['temporary_issues']} 个临时不可用 Key "
+            f"(耗时 {(time.monotonic() - started_at) * 1000:.0f} ms)。"
+        )
+        return stats
+
+
+# 全局的使用状态持久化实例
+usage_persistence = UsageStatePersistence()
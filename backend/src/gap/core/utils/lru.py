@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+线程安全的有界 LRU 映射。
+用于 Key 关联映射、逐条消息 Token 估算、countTokens 前缀缓存和嵌入向量缓存等进程内缓存。
+"""
+
+import threading  # 保护映射的线程锁
+from collections import OrderedDict  # LRU 映射
+from typing import Generic, Optional, TypeVar
+
+MISSING = object()  # 映射中没有条目 (区别于值为 None 的条目)
+
+V = TypeVar("V")
+
+
+class LRUMap(Generic[V]):
+    """
+    线程安全的有界 LRU 映射。值可以为 None (例如表示已确认不存在关联)。
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[str, Optional[V]]" = OrderedDict()
+        self._lock = threading.Lock()  # 保护 _data (不在持锁期间获取其他锁)
+
+    def get(self, key: str, default: object = MISSING) -> object:
+        """读取条目并将其标记为最近使用；不存在时返回 default。"""
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Optional[V]) -> None:
+        """写入条目，超出容量时淘汰最久未使用的条目。"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def remove_value(self, value: V) -> int:
+        """移除所有值等于 value 的条目 (例如 Key 被删除时)，返回移除的数量。"""
+        with self._lock:
+            stale = [k for k, v in self._data.items() if v == value]
+            for k in stale:
+                del self._data[k]
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -58,6 +58,7 @@ from gap.core.security.jwt import create_access_token  # 导入创建 JWT token
 from . import config
 
 # 导入 API 端点路由
+from .api import batch_endpoints  # OpenAI 兼容的文件与批处理 API
 from .api import cache_endpoints  # 缓存管理 API
 from .api import context_endpoints  # 上下文管理 API
 from .api import v2_endpoints  # Gemini 原生 API (v2)
@@ -75,10 +76,13 @@ from .core.database import utils as db_utils  # 数据库工具函数
 # 导入 Key 管理相关模块
 from .core.keys import checker as key_checker  # Key 检查器 (重命名以区分)
 from .core.keys.manager import APIKeyManager  # Key 管理器类
+from .core.keys.scoring import key_scoring_engine  # Key 健康度评分引擎
 
 # 导入报告和调度相关模块
 from .core.reporting import scheduler as reporting_scheduler  # 报告调度器 (重命名以区分)
 from .core.resource import resource_manager  # 统一资源管理器
+from .core.usage_persistence import usage_persistence  # 使用计数与配额状态持久化
+from .core.processing.batch import app_dispatcher, batch_manager  # 批处理任务调度
 from .core.resource.bootstrap import bootstrap_resource_management  # 资源管理引导程序
 
 # 导入核心服务和工具类
@@ -149,9 +153,16 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         write=config.HTTP_TIMEOUT_WRITE,
         pool=config.HTTP_TIMEOUT_POOL,
     )
-    http_client = httpx.AsyncClient(timeout=timeout_config)
+    # 连接池上限：所有 Key 的 Gemini REST 请求复用同一个连接池 (API Key 按请求头传递)
+    limits_config = httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    http_client = httpx.AsyncClient(timeout=timeout_config, limits=limits_config)
     logger.info(
-        f"共享 HTTP 客户端已初始化，超时设置为: connect={timeout_config.connect}s, read={timeout_config.read}s, write={timeout_config.write}s, pool={timeout_config.pool}s"
+        f"共享 HTTP 客户端已初始化，超时设置为: connect={timeout_config.connect}s, read={timeout_config.read}s, write={timeout_config.write}s, pool={timeout_config.pool}s, "
+        f"连接池: max_connections={config.HTTP_MAX_CONNECTIONS}, max_keepalive={config.HTTP_MAX_KEEPALIVE_CONNECTIONS}"
     )
     cache_manager = CacheManager()  # 创建缓存管理器实例
     context_store_manager = ContextStore()  # 创建上下文存储管理器实例
@@ -261,6 +272,28 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     else:
         logger.error("数据库引擎未初始化，无法创建表！应用可能无法正常运行。")
 
+    # --- 预热加载 Key 健康度分数 ---
+    try:
+        async with app.state.AsyncSessionFactory() as db_session_for_scores:
+            await key_scoring_engine.load_scores(db_session_for_scores)
+    except Exception as e:
+        logger.error(f"预热加载 Key 分数失败: {e}", exc_info=True)
+
+    # --- 加载用户/缓存内容与 Key 的关联映射 (粘性会话和缓存关联) ---
+    if config.KEY_STORAGE_MODE == "database":
+        try:
+            async with app.state.AsyncSessionFactory() as db_session_for_affinity:
+                await key_manager.key_affinity.load(db_session_for_affinity)
+        except Exception as e:
+            logger.error(f"加载 Key 关联映射失败: {e}", exc_info=True)
+
+    # --- 恢复使用计数与配额状态 (快照 + 增量日志) ---
+    if config.TESTING != "true":
+        try:
+            usage_persistence.load(key_manager)
+        except Exception as e:
+            logger.error(f"恢复使用计数与配额状态失败: {e}", exc_info=True)
+
     # --- 执行启动时的 API Key 检查 ---
     logger.info("正在执行初始 API 密钥检查...")  # 记录日志
     testing_mode = os.environ.get("TESTING", "false").lower() == "true"
@@ -337,7 +370,9 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     else:
         logger.info("设置后台调度器...")  # 记录日志
         reporting_scheduler.setup_scheduler(
-            key_manager, app.state.context_store_manager
+            key_manager,
+            app.state.context_store_manager,
+            app.state.AsyncSessionFactory,
         )
 
         # --- 启动缓存清理调度器 (如果需要) ---
@@ -369,6 +404,12 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         logger.info("启动后台调度器...")
         reporting_scheduler.start_scheduler()
 
+        # --- 启动批处理调度 (恢复重启前未完成的任务) ---
+        try:
+            await batch_manager.start(app_dispatcher(app), key_manager)
+        except Exception as e:
+            logger.error(f"启动批处理调度失败: {e}", exc_info=True)
+
     # --- 应用运行阶段 ---
     yield  # lifespan 函数在此暂停，FastAPI 应用开始处理请求
 
@@ -378,6 +419,33 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     # 使用统一资源管理器进行清理
     logger.info("启动统一资源清理...")
 
+    # 持久化最新的 Key 分数，供下次启动预热
+    try:
+        async with app.state.AsyncSessionFactory() as db_session_for_scores:
+            await key_scoring_engine.persist_scores(db_session_for_scores)
+    except Exception as e:
+        logger.error(f"关闭时持久化 Key 分数失败: {e}")
+
+    # 写回尚未持久化的用户-Key 关联
+    try:
+        async with app.state.AsyncSessionFactory() as db_session_for_affinity:
+            await key_manager.key_affinity.flush(db_session_for_affinity)
+    except Exception as e:
+        logger.error(f"关闭时写回用户-Key 关联失败: {e}")
+
+    # 停止批处理调度 (在途条目在下次启动时重新执行)
+    try:
+        await batch_manager.stop()
+    except Exception as e:
+        logger.error(f"停止批处理调度失败: {e}")
+
+    # 写入使用计数与配额状态的最终快照，供下次启动恢复
+    if config.TESTING != "true":
+        try:
+            usage_persistence.write_snapshot(key_manager)
+        except Exception as e:
+            logger.error(f"关闭时写入使用状态快照失败: {e}")
+
     # 停止锁管理器清理任务
     try:
         await lock_manager.stop_cleanup_task()
@@ -455,6 +523,10 @@ app.include_router(
     v2_endpoints.v2_router, prefix="/v2", tags=["Gemini Native API v2"]
 )  # 包含 Gemini 原生 API (v2)
 logger.info("已包含 Gemini 原生 API 端点路由器 (/v2)。")
+app.include_router(
+    batch_endpoints.router, tags=["OpenAI Compatible API v1"]
+)  # 包含 OpenAI 兼容的文件与批处理 API
+logger.info("已包含文件与批处理 API 端点路由器 (/v1/files, /v1/batches)。")
 app.include_router(cache_endpoints.router, prefix="/api")  # 包含缓存管理 API
 logger.info("已包含缓存管理 API 路由器 (/api)。")
 app.include_router(context_endpoints.router, prefix="/api")  # 包含上下文管理 API
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.api.models import (  # noqa: E402
+    ChatCompletionResponse,
+    Choice,
+    ResponseMessage,
+)
+from gap.core import tracking  # noqa: E402
+from gap.core.keys.concurrency import KeyConcurrencyLimiter  # noqa: E402
+from gap.core.keys.manager import APIKeyManager  # noqa: E402
+from gap.core.processing import main_handler  # noqa: E402
+
+
+@pytest.fixture
+def make_key_manager():
+    """返回创建 APIKeyManager 的工厂：所有 Key 均为活跃状态，并写入模型的分数缓存。"""
+    models = []
+
+    def make(model, keys, scores=None, strategy=None, concurrency_limit=None):
+        manager = APIKeyManager()
+        manager.set_keys(keys, {k: {"is_active": True} for k in keys})
+        if concurrency_limit is not None:
+            manager.concurrency_limiter = KeyConcurrencyLimiter(
+                initial_limit=concurrency_limit, max_limit=concurrency_limit
+            )
+        if strategy is not None:
+            manager.set_selection_strategy(model, strategy)
+        with tracking.cache_lock:
+            tracking.key_scores_cache[model] = (
+                dict(scores) if scores is not None else {k: 1.0 for k in keys}
+            )
+            tracking.cache_last_updated[model] = time.time()
+        models.append(model)
+        return manager
+
+    yield make
+    with tracking.cache_lock:
+        for model in models:
+            tracking.key_scores_cache.pop(model, None)
+            tracking.cache_last_updated.pop(model, None)
+
+
+def _response(model):
+    return ChatCompletionResponse(
+        id="chatcmpl-1",
+        created=0,
+        model=model,
+        choices=[
+            Choice(
+                index=0,
+                message=ResponseMessage(role="assistant", content="answer"),
+                finish_reason="STOP",
+            )
+        ],
+    )
+
+
+class FakePipeline:
+    """替换 process_request 的上下文准备、Key 选择和上游调用，并记录调用情况。
+
+    ``failure`` 非空时此后开始的上游调用返回该错误；``upstream_delay`` 用于让并发请求
+    在上游调用期间重叠。后处理仍走真实实现，只额外记录所用的 Key。
+    """
+
+    key = "key-aaaaaaaaaaaa"
+
+    def __init__(self):
+        self.upstream_calls = 0
+        self.post_processed_keys = []
+        self.failure = {}
+        self.upstream_delay = 0.0
+        self.model_limits = {}
+
+    async def prepare(self, chat_request, *args, **kwargs):
+        text = chat_request.messages[0].content
+        return [], [{"role": "user", "parts": [{"text": text}]}], None
+
+    async def select(self, **kwargs):
+        return self.key, kwargs["gemini_contents"], False
+
+    async def attempt(self, **kwargs):
+        self.upstream_calls += 1
+        failure = dict(self.failure)  # 调用开始时的失败设置，之后修改只影响新的调用
+        if self.upstream_delay:
+            await asyncio.sleep(self.upstream_delay)
+        if failure:
+            return None, failure, False
+        return _response(kwargs["chat_request"].model), None, False
+
+    def process(self, chat_request, headers=None, db=None, **kwargs):
+        self.model_limits.setdefault(chat_request.model, {"rpm": 10})
+        http_request = SimpleNamespace(
+            headers=headers or {},
+            client=SimpleNamespace(host="127.0.0.1"),
+            app=SimpleNamespace(state=SimpleNamespace()),
+        )
+        return main_handler.process_request(
+            chat_request=chat_request,
+            http_request=http_request,
+            request_type="stream" if chat_request.stream else "non-stream",
+            auth_data={"config": {"enable_context_completion": False}},
+            key_manager=SimpleNamespace(get_active_keys_count=lambda: 1),
+            http_client=None,
+            cache_manager_instance=None,
+            db=db,
+            enforce_ip_limits=False,
+            **kwargs,
+        )
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    pipeline = FakePipeline()
+    handle_post_processing = main_handler.handle_post_processing
+
+    async def post_processing(**kwargs):
+        pipeline.post_processed_keys.append(kwargs["selected_key"])
+        await handle_post_processing(**kwargs)
+
+    monkeypatch.setattr(main_handler, "prepare_context_and_messages", pipeline.prepare)
+    monkeypatch.setattr(main_handler, "select_and_prepare_key", pipeline.select)
+    monkeypatch.setattr(main_handler, "attempt_api_call", pipeline.attempt)
+    monkeypatch.setattr(main_handler, "handle_post_processing", post_processing)
+    monkeypatch.setattr(app_config, "MODEL_LIMITS", pipeline.model_limits)
+    monkeypatch.setattr(app_config, "ENABLE_NATIVE_CACHING", False)
+    return pipeline
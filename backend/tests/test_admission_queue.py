@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.admission import AdmissionQueue  # noqa: E402
+from gap.core.keys.concurrency import KeyConcurrencyLimiter  # noqa: E402
+
+
+def test_waiters_wake_in_priority_then_fifo_order():
+    queue = AdmissionQueue(max_depth=3, max_wait_seconds=5)
+
+    async def run():
+        woken = []
+
+        async def waiter(name, ticket):
+            if await queue.wait("m", ticket):
+                woken.append(name)
+
+        tickets = {
+            "first": queue.ticket(10),
+            "second": queue.ticket(10),
+            "admin": queue.ticket(0),
+        }
+        tasks = [asyncio.create_task(waiter(n, t)) for n, t in tickets.items()]
+        await asyncio.sleep(0)
+        assert queue.depth == 3
+        # 队列已满时立即拒绝
+        assert not await queue.wait("m", queue.ticket())
+        # 其他模型释放容量不唤醒该模型的等待者
+        assert queue.notify("other") == 0
+        for _ in range(3):
+            assert queue.notify("m") == 1
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return woken
+
+    assert asyncio.run(run()) == ["admin", "first", "second"]
+    stats = queue.get_stats()
+    assert (
+        stats["notified"] == 3 and stats["rejected_full"] == 1 and stats["depth"] == 0
+    )
+
+
+def test_timer_wakeup_deadline_and_permit_release():
+    queue = AdmissionQueue(max_depth=8, max_wait_seconds=0.2)
+
+    async def run():
+        ticket = queue.ticket()
+        # 到达最早恢复时间时被定时唤醒，不需要释放事件
+        assert await queue.wait("m", ticket, retry_at=time.time() + 0.01)
+        # 累计等待超过上限后超时
+        assert not await queue.wait("m", ticket)
+        assert not await queue.wait("m", ticket)
+
+    asyncio.run(run())
+    stats = queue.get_stats(reset=True)
+    assert stats["timer_wakeups"] == 1 and stats["timed_out"] == 2
+    assert queue.get_stats()["timed_out"] == 0
+
+
+def test_concurrency_permit_release_wakes_global_queue_but_discard_does_not():
+    from gap.core.keys.admission import admission_queue
+
+    limiter = KeyConcurrencyLimiter(initial_limit=1)
+
+    async def run():
+        permit = limiter.try_acquire("k", "admission-test-model")
+        ticket = admission_queue.ticket()
+        waiter = asyncio.create_task(
+            admission_queue.wait("admission-test-model", ticket, deadline_seconds=5)
+        )
+        await asyncio.sleep(0)
+        limiter.try_acquire("k2", "admission-test-model").discard()
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        permit.release()
+        assert await waiter
+        assert ticket.notified
+
+    asyncio.run(run())
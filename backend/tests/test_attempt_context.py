@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.processing.attempt_context import AttemptContext  # noqa: E402
+
+MODEL = "attempt-context-test-model"
+LIMITS = {"tpm_input": 0}
+
+
+def test_concurrent_requests_keep_independent_tried_keys(make_key_manager):
+    keys = [f"key-{i}" for i in range(5)]
+    # 这里只模拟选择、不发出调用，放宽并发上限使 200 个请求可以同时持有名额
+    manager = make_key_manager(MODEL, keys, concurrency_limit=1000)
+
+    async def one_request(index):
+        ctx = AttemptContext.create(f"req-{index}", max_attempts=len(keys))
+        selected = []
+        while ctx.start_attempt():
+            key, _ = await manager.select_best_key(
+                MODEL, LIMITS, 10, request_id=ctx.request_id, attempt_context=ctx
+            )
+            if key is None:
+                break
+            selected.append(key)
+            # 让出事件循环，使其他请求的选择与当前请求交错执行
+            await asyncio.sleep(0)
+        return selected
+
+    async def run():
+        return await asyncio.gather(*(one_request(i) for i in range(200)))
+
+    results = asyncio.run(run())
+    for selected in results:
+        # 每个请求都恰好把所有 Key 各尝试一次，不会因为其他请求而重复尝试同一个 Key
+        assert sorted(selected) == sorted(keys)
+
+
+def test_attempt_budget_and_deadline():
+    ctx = AttemptContext.create("req-budget", max_attempts=2)
+    assert ctx.start_attempt() and ctx.start_attempt()
+    assert not ctx.start_attempt()
+
+    expired = AttemptContext.create("req-deadline", max_attempts=5, timeout_seconds=1)
+    expired.deadline = time.monotonic() - 1
+    assert expired.is_expired()
+    assert not expired.start_attempt()
+
+
+def test_token_estimate_is_cached_per_request():
+    calls = []
+
+    def estimator(contents):
+        calls.append(contents)
+        return 42
+
+    ctx = AttemptContext.create("req-estimate", max_attempts=1)
+    assert ctx.get_estimated_input_tokens([{"role": "user"}], estimator) == 42
+    assert ctx.get_estimated_input_tokens([{"role": "user"}], estimator) == 42
+    assert len(calls) == 1
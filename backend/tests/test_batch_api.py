@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.core.processing import batch as batch_module  # noqa: E402
+from gap.core.processing.batch import BatchManager  # noqa: E402
+
+ENDPOINT = "/v1/chat/completions"
+
+
+def _input_file(manager, count):
+    lines = [
+        {
+            "custom_id": f"item-{i}",
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": {
+                "model": "gemini-test",
+                "messages": [{"role": "user", "content": f"question {i}"}],
+            },
+        }
+        for i in range(count)
+    ]
+    content = "".join(json.dumps(line) + "\n" for line in lines).encode()
+    return manager.create_file(content, "input.jsonl", "batch")["id"]
+
+
+def _read_lines(manager, file_id):
+    with open(manager.file_path(file_id), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class FakeDispatcher:
+    """按 custom_id 中的问题序号返回结果；指定的条目先被退回若干次或直接失败。"""
+
+    def __init__(self, busy=None, invalid=()):
+        self.busy = dict(busy or {})
+        self.invalid = set(invalid)
+        self.calls = []
+
+    async def __call__(self, body):
+        question = body["messages"][0]["content"]
+        self.calls.append(question)
+        await asyncio.sleep(0)
+        if question in self.invalid:
+            raise HTTPException(status_code=400, detail="bad request")
+        if self.busy.get(question):
+            self.busy[question] -= 1
+            raise HTTPException(status_code=503, detail="all keys busy")
+        usage = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        return {"choices": [{"message": {"content": question}}], "usage": usage}, (
+            "key-aaaaaaaaaaaa" if len(self.calls) % 2 else "key-bbbbbbbbbbbb"
+        )
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(app_config, "BATCH_POLL_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(app_config, "BATCH_MAX_CONCURRENCY", 4)
+
+
+def test_batch_drains_items_and_records_results(tmp_path):
+    manager = BatchManager(str(tmp_path))
+    dispatcher = FakeDispatcher(busy={"question 1": 2}, invalid={"question 3"})
+
+    async def run():
+        await manager.start(dispatcher)
+        batch = manager.create_batch(_input_file(manager, 6), ENDPOINT)
+        await manager.wait(batch["id"])
+        return manager.get_batch(batch["id"])
+
+    batch = asyncio.run(run())
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 6, "completed": 5, "failed": 1}
+    outputs = _read_lines(manager, batch["output_file_id"])
+    assert sorted(o["custom_id"] for o in outputs) == [
+        "item-0",
+        "item-1",
+        "item-2",
+        "item-4",
+        "item-5",
+    ]
+    assert all(o["response"]["status_code"] == 200 for o in outputs)
+    errors = _read_lines(manager, batch["error_file_id"])
+    assert [(e["custom_id"], e["response"]["status_code"]) for e in errors] == [
+        ("item-3", 400)
+    ]
+    # 被退回 (503) 的条目退避后重新执行，不写入错误文件
+    assert dispatcher.calls.count("question 1") == 3
+    progress = batch["gap_progress"]
+    assert progress["usage"]["total_tokens"] == 5 * 15
+    assert sum(k["requests"] for k in progress["per_key"].values()) == 5
+    assert set(progress["per_key"]) <= {"key-aaaa...", "key-bbbb..."}
+
+
+def test_invalid_input_lines_fail_the_batch(tmp_path):
+    manager = BatchManager(str(tmp_path))
+    content = b'{"custom_id": "a", "method": "POST", "url": "/v1/embeddings", "body": {}}\nnot json\n'
+    file_id = manager.create_file(content, "input.jsonl", "batch")["id"]
+    batch = manager.create_batch(file_id, ENDPOINT)
+    assert batch["status"] == "failed"
+    assert [e["line"] for e in batch["errors"]["data"]] == [1, 2]
+
+
+def test_batch_resumes_after_restart(tmp_path):
+    manager = BatchManager(str(tmp_path))
+    batch = manager.create_batch(_input_file(manager, 4), ENDPOINT)
+    # 模拟上次运行：item-0 已写入结果，item-1 的结果只写了一半就崩溃
+    batch_state = json.loads(
+        (tmp_path / "batches" / f"{batch['id']}.json").read_text(encoding="utf-8")
+    )
+    output_id = manager.create_file(b"", "out.jsonl", "batch_output")["id"]
+    with open(manager.file_path(output_id), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"custom_id": "item-0", "response": {}}) + "\n")
+        f.write('{"custom_id": "item-1", "resp')
+    batch_state.update({"status": "in_progress", "output_file_id": output_id})
+    (tmp_path / "batches" / f"{batch['id']}.json").write_text(
+        json.dumps(batch_state), encoding="utf-8"
+    )
+
+    restarted = BatchManager(str(tmp_path))
+    dispatcher = FakeDispatcher()
+
+    async def run():
+        assert await restarted.start(dispatcher) == 1
+        await restarted.wait(batch["id"])
+        return restarted.get_batch(batch["id"])
+
+    result = asyncio.run(run())
+    assert sorted(dispatcher.calls) == ["question 1", "question 2", "question 3"]
+    assert result["status"] == "completed"
+    assert result["request_counts"]["completed"] == 4
+    assert [o["custom_id"] for o in _read_lines(restarted, output_id)][0] == "item-0"
+
+
+def test_dispatch_pauses_while_interactive_requests_wait(tmp_path, monkeypatch):
+    manager = BatchManager(str(tmp_path))
+    monkeypatch.setattr(batch_module.admission_queue, "_depth", 1)
+    assert manager._spare_capacity("gemini-test") == "interactive_requests_waiting"
+    monkeypatch.setattr(batch_module.admission_queue, "_depth", 0)
+    monkeypatch.setattr(batch_module, "pool_headroom", lambda *_: 0.1)
+    assert manager._spare_capacity("gemini-test") == "headroom_reserved"
+    manager._headroom_cache.clear()
+    monkeypatch.setattr(batch_module, "pool_headroom", lambda *_: 0.9)
+    assert manager._spare_capacity("gemini-test") is None
@@ -0,0 +1,35 @@
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.circuit_breaker import KeyCircuitBreaker  # noqa: E402
+
+
+def test_backoff_grows_and_half_open_allows_single_probe():
+    breaker = KeyCircuitBreaker(
+        base_seconds=10, max_seconds=100, probe_timeout_seconds=30
+    )
+    first_until = breaker.record_failure("k", "m", "HTTP 503", now=0.0)
+    assert 5.0 <= first_until <= 10.0
+    assert breaker.allow("k", "m", now=1.0) == (False, first_until)
+    # 其他模型不受影响
+    assert breaker.allow("k", "other", now=1.0) == (True, None)
+    # 断开期间到达的失败不延长退避
+    assert breaker.record_failure("k", "m", now=2.0) == first_until
+
+    # 到期后只放行一个探测请求
+    assert breaker.allow("k", "m", now=10.0)[0]
+    assert not breaker.allow("k", "m", now=10.0)[0]
+    # 探测失败：第二次断开的退避翻倍，且不短于上游建议的重试间隔
+    second_until = breaker.record_failure("k", "m", retry_after_seconds=18, now=10.0)
+    assert 28.0 <= second_until <= 30.0
+    # 探测请求超时未报告结果时允许新的探测 (second_until 带随机抖动，留出浮点误差余量)
+    assert breaker.allow("k", "m", now=second_until)[0]
+    assert not breaker.allow("k", "m", now=second_until + 29)[0]
+    assert breaker.allow("k", "m", now=second_until + 31)[0]
+
+    # 探测成功关闭熔断器并清零退避
+    assert breaker.record_success("k", "m")
+    assert not breaker.record_success("k", "m")
+    assert breaker.get_open_circuits() == []
+    assert breaker.record_failure("k", "m", now=100.0) <= 110.0
@@ -0,0 +1,39 @@
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.concurrency import KeyConcurrencyLimiter  # noqa: E402
+
+
+def test_inflight_cap_and_aimd_adjustment():
+    limiter = KeyConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=4)
+    first = limiter.try_acquire("k", "m")
+    second = limiter.try_acquire("k", "m")
+    assert first is not None and second is not None
+    # 达到上限的 Key 被拒绝，其他模型不受影响
+    assert limiter.try_acquire("k", "m") is None
+    assert limiter.try_acquire("k", "other") is not None
+    # release() 是幂等的
+    first.release()
+    first.release()
+    assert limiter.try_acquire("k", "m") is not None
+    assert limiter.try_acquire("k", "m") is None
+
+    # 加性增：每次成功增加 1/上限，不超过最大值
+    assert limiter.record_outcome("k", "m", True, latency_seconds=1.0, now=0.0) == 2.5
+    for _ in range(20):
+        limiter.record_outcome("k", "m", True, latency_seconds=1.0, now=0.0)
+    assert limiter.record_outcome("k", "m", True, latency_seconds=1.0, now=0.0) == 4.0
+
+    # 乘性减：429 使上限减半，同一往返时间内的后续 429 不再减小
+    assert limiter.record_outcome("k", "m", False, status_code=429, now=100.0) == 2.0
+    assert limiter.record_outcome("k", "m", False, status_code=429, now=100.5) == 2.0
+    assert limiter.record_outcome("k", "m", False, status_code=503, now=200.0) == 2.0
+    assert limiter.record_outcome("k", "m", False, status_code=429, now=200.0) == 1.0
+
+    # 延迟明显上升时乘性减
+    limiter.record_outcome("k", "m", True, latency_seconds=1.0, now=300.0)
+    limit_before = limiter.get_limits()[0]["limit"]
+    for step in range(5):
+        limiter.record_outcome("k", "m", True, latency_seconds=10.0, now=400.0 + step)
+    assert limiter.get_limits()[0]["limit"] < limit_before + 1
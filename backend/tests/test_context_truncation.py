@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.core.processing.token_estimate import TokenEstimateCache  # noqa: E402
+from gap.core.processing.utils import (  # noqa: E402
+    estimate_token_count,
+    truncate_context,
+)
+
+MODEL = "context-truncation-test-model"
+
+
+def _history(turns, text="你好，这是一条用于测试的消息 hello world " * 4):
+    contents = []
+    for i in range(turns):
+        contents.append({"role": "user", "parts": [{"text": f"{i}: {text}"}]})
+        contents.append({"role": "model", "parts": [{"text": f"{i}: {text[::-1]}"}]})
+    return contents
+
+
+def _pairwise_truncate(contents, threshold):
+    """原来的逐对移除实现，作为对照。"""
+    truncated = list(contents)
+    while estimate_token_count(truncated) > threshold and len(truncated) >= 2:
+        truncated.pop(0)
+        truncated.pop(0)
+    return truncated
+
+
+@pytest.fixture
+def model_limit(monkeypatch):
+    def set_limit(limit):
+        monkeypatch.setattr(
+            app_config, "MODEL_LIMITS", {MODEL: {"input_token_limit": limit}}
+        )
+        monkeypatch.setattr(app_config, "CONTEXT_TOKEN_SAFETY_MARGIN", 0, raising=False)
+
+    return set_limit
+
+
+def test_cached_estimate_matches_full_estimate():
+    cache = TokenEstimateCache()
+    for contents in ([], _history(1)[:1], _history(3), _history(7) + _history(1)[:1]):
+        assert cache.estimate(contents) == estimate_token_count(contents)
+    # 同一批消息对象重复估算不会再次计算
+    contents = _history(20)
+    cache = TokenEstimateCache()
+    cache.estimate(contents)
+    cache.estimate(contents[4:] + contents[:4])
+    assert cache.computed == len(contents)
+
+
+@pytest.mark.parametrize("extra", [0, 1])
+def test_truncation_matches_pairwise_removal(model_limit, extra):
+    contents = _history(30) + _history(1)[:extra]
+    full = estimate_token_count(contents)
+    for limit in (1, 10, full // 7, full // 2, full - 1, full, full * 2):
+        model_limit(limit)
+        truncated, over_limit = asyncio.run(truncate_context(contents, MODEL))
+        expected = _pairwise_truncate(contents, limit)
+        assert truncated == expected
+        assert over_limit == (estimate_token_count(expected) > limit)
+
+
+def test_truncation_reuses_request_cache(model_limit):
+    contents = _history(50)
+    model_limit(estimate_token_count(contents) // 3)
+    cache = TokenEstimateCache()
+    cache.estimate(contents)
+    asyncio.run(truncate_context(contents, MODEL, token_estimates=cache))
+    # 保存上下文时只多出模型回复一条消息
+    reply = {"role": "model", "parts": [{"text": "reply"}]}
+    asyncio.run(truncate_context(contents + [reply], MODEL, token_estimates=cache))
+    assert cache.computed == len(contents) + 1
+
+
+@pytest.mark.slow
+def test_truncation_benchmark_500_turn_history(model_limit):
+    contents = _history(500)
+    model_limit(estimate_token_count(contents) // 10)
+
+    started = time.perf_counter()
+    expected = _pairwise_truncate(
+        contents, app_config.MODEL_LIMITS[MODEL]["input_token_limit"]
+    )
+    pairwise_seconds = time.perf_counter() - started
+
+    async def timed_truncate():
+        started = time.perf_counter()
+        result, _ = await truncate_context(contents, MODEL)
+        return result, time.perf_counter() - started
+
+    truncated, prefix_seconds = asyncio.run(timed_truncate())
+
+    assert truncated == expected
+    # 逐对移除需要约 450 次整表序列化，前缀和只需每条消息序列化一次
+    assert prefix_seconds * 10 < pairwise_seconds, (
+        f"500 turns: pairwise {pairwise_seconds * 1e3:.1f} ms, "
+        f"prefix sums {prefix_seconds * 1e3:.1f} ms"
+    )
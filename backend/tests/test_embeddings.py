@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+
+import httpx
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.processing.embeddings import EmbeddingBatcher  # noqa: E402
+from gap.core.services.gemini import GeminiClient  # noqa: E402
+
+MODEL = "text-embedding-test"
+
+
+class FakeUpstream:
+    """记录每次批次调用的文本，向量为 [文本长度, 批次序号]。"""
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    async def __call__(self, model_name, dimensions, texts, client_ips):
+        self.batches.append(list(texts))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return [[float(len(text)), float(len(self.batches))] for text in texts]
+
+
+def test_concurrent_requests_are_coalesced_into_batches():
+    upstream = FakeUpstream()
+    batcher = EmbeddingBatcher(max_batch_size=4, max_linger_ms=20, cache_size=100)
+
+    async def run():
+        callers = [batcher.embed(MODEL, [f"text {i % 6}"], upstream) for i in range(10)]
+        return await asyncio.gather(*callers)
+
+    results = asyncio.run(run())
+    # 6 段不同文本：一个满批 (4 条) 立即发送，剩余 2 条在等待时间到达后发送
+    assert sorted(len(batch) for batch in upstream.batches) == [2, 4]
+    assert [r[0][0] for r in results] == [
+        float(len(f"text {i % 6}")) for i in range(10)
+    ]
+    stats = batcher.get_stats()
+    assert stats["upstream_calls"] == 2 and stats["coalesced"] == 4
+    assert stats["batch_factor"] == 3.0
+
+
+def test_cached_texts_skip_upstream():
+    upstream = FakeUpstream()
+    batcher = EmbeddingBatcher(max_batch_size=10, max_linger_ms=1, cache_size=100)
+
+    async def run():
+        first = await batcher.embed(MODEL, ["a", "bb"], upstream)
+        second = await batcher.embed(MODEL, ["bb", "a"], upstream)
+        other_dims = await batcher.embed(MODEL, ["a"], upstream, dimensions=8)
+        return first, second, other_dims
+
+    first, second, _ = asyncio.run(run())
+    assert second == [first[1], first[0]]
+    # 不同输出维度的向量分开缓存
+    assert upstream.batches == [["a", "bb"], ["a"]]
+    assert batcher.get_stats()["cache_hits"] == 2
+
+
+def test_batch_failure_reaches_every_caller():
+    upstream = FakeUpstream(fail=True)
+    batcher = EmbeddingBatcher(max_batch_size=10, max_linger_ms=1, cache_size=0)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.embed(MODEL, ["x"], upstream),
+            batcher.embed(MODEL, ["y"], upstream),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(upstream.batches) == 1
+    assert batcher.get_stats()["failures"] == 1
+
+
+def test_gemini_client_batch_embed_contents():
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path.endswith(f"/models/{MODEL}:batchEmbedContents")
+        payload = json.loads(request.content)
+        assert payload["requests"][0]["outputDimensionality"] == 3
+        return httpx.Response(
+            200,
+            json={
+                "embeddings": [
+                    {"values": [float(i)] * 3} for i in range(len(payload["requests"]))
+                ]
+            },
+        )
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+            client = GeminiClient("test-key", http)
+            return await client.batch_embed_contents(MODEL, ["a", "b"], 3)
+
+    assert asyncio.run(run()) == [[0.0] * 3, [1.0] * 3]
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.api.models import ChatCompletionRequest  # noqa: E402
+from gap.core.services.gemini import GeminiClient  # noqa: E402
+
+MODEL = "gemini-client-test-model"
+
+
+def _sse(*chunks):
+    return "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks)
+
+
+def _chunk(text, finish_reason=None):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return {"candidates": [candidate]}
+
+
+def _run_with(handler, use_client):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+            return await use_client(GeminiClient("test-key", http))
+
+    return asyncio.run(run())
+
+
+def test_closing_stream_early_does_not_yield_trailer():
+    def handler(request):
+        body = _sse(_chunk("Hello"), _chunk(" world", "STOP"))
+        return httpx.Response(200, text=body)
+
+    request = ChatCompletionRequest(
+        model=MODEL, messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    async def use_client(client):
+        stream = client.stream_chat(request, [], [], None)
+        first = await stream.__anext__()
+        # 客户端断开时提前关闭：不能再产出完成原因 (否则 aclose 抛出 RuntimeError)
+        await stream.aclose()
+        full = [item async for item in client.stream_chat(request, [], [], None)]
+        return first, full
+
+    first, full = _run_with(handler, use_client)
+    assert first == "Hello"
+    assert full == ["Hello", " world", {"_final_finish_reason": "STOP"}]
+
+
+def test_generate_content_keeps_http_status_error():
+    def handler(request):
+        return httpx.Response(429, json={"error": {"code": 429}})
+
+    async def use_client(client):
+        return await client.generate_content(MODEL, {"contents": []})
+
+    with pytest.raises(httpx.HTTPStatusError) as exc_info:
+        _run_with(handler, use_client)
+    assert exc_info.value.response.status_code == 429
@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from sqlalchemy import select  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+
+from gap.core.database.models import ApiKey, Base, UserKeyAssociation  # noqa: E402
+from gap.core.keys.affinity import KeyAffinityStore  # noqa: E402
+from gap.core.utils.lru import LRUMap  # noqa: E402
+
+
+def test_lru_map_evicts_least_recently_used():
+    lru = LRUMap(2)
+    lru.set("a", "k1")
+    lru.set("b", "k2")
+    assert lru.get("a") == "k1"  # a 变为最近使用
+    lru.set("c", "k3")
+    assert lru.get("b", None) is None and len(lru) == 2
+    assert lru.remove_value("k1") == 1
+
+
+def test_affinity_loads_once_and_writes_back_in_batches():
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as db:
+            db.add_all(
+                [ApiKey(id=1, key_string="key-one"), ApiKey(id=2, key_string="key-two")]
+            )
+            db.add(
+                UserKeyAssociation(user_id="alice", key_id=1, last_used_timestamp=1.0)
+            )
+            await db.commit()
+
+        store = KeyAffinityStore(max_entries=10)
+        async with session_factory() as db:
+            await store.load(db)
+        # 加载后的查找不需要数据库会话
+        assert await store.get_user_key("alice") == "key-one"
+        assert await store.get_user_key("bob") is None
+
+        # 同一用户的多次更新合并为一条待写入记录
+        for key in ("key-one", "key-two", "key-two"):
+            store.record_user_key("bob", key)
+        store.record_user_key("alice", "key-two")
+        assert (
+            store.pending_count() == 2 and await store.get_user_key("bob") == "key-two"
+        )
+
+        async with session_factory() as db:
+            assert await store.flush(db) == 2
+            rows = (await db.execute(select(UserKeyAssociation))).scalars().all()
+        assert store.pending_count() == 0
+        assert sorted((r.user_id, r.key_id) for r in rows) == [
+            ("alice", 1),
+            ("alice", 2),
+            ("bob", 2),
+        ]
+        await engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import asyncio
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys import limiter as limiter_module  # noqa: E402
+from gap.core.keys.limiter import KeyRateLimiter, key_rate_limiter  # noqa: E402
+from gap.core.processing.attempt_context import AttemptContext  # noqa: E402
+
+
+def test_every_sliding_window_stays_within_limit():
+    limiter = KeyRateLimiter()
+    # 每 0.5 秒连续尝试 10 RPM 的占用直到被拒绝，持续 5 个窗口
+    grants = []
+    for step in range(600):
+        while limiter.try_acquire("k", "m", "rpm", 10, now=step * 0.5):
+            grants.append(step * 0.5)
+    # 空闲的 Key 可以一次用满限额
+    assert grants[:10] == [0.0] * 10
+    # 任意长度为 60 秒的滑动窗口 [t, t + 60) 内的放行次数都不超过限额
+    for start in grants:
+        assert len([t for t in grants if start <= t < start + 60]) <= 10
+    # 满载时的吞吐不低于 L / (W + W / 12)
+    assert len(grants) >= 10 * 300 // 65
+
+
+def test_window_edge_burst_is_rejected():
+    limiter = KeyRateLimiter()
+    for _ in range(10):
+        assert limiter.try_acquire("k", "m", "rpm", 10, now=59.0)
+    # 固定窗口在 60 秒时会整体清零；滑动窗口要等这些请求移出窗口才恢复额度
+    assert not limiter.try_acquire("k", "m", "rpm", 10, now=61.0)
+    assert not limiter.try_acquire("k", "m", "rpm", 10, now=118.9)
+    assert limiter.available_at("k", "m", "rpm", 10, cost=1, now=61.0) == 120.0
+    assert limiter.try_acquire("k", "m", "rpm", 10, now=120.0)
+
+
+def test_refund_and_consume_tokens():
+    limiter = KeyRateLimiter()
+    assert limiter.try_acquire("k", "m", "tpm_input", 1000, cost=800, now=0.0)
+    assert not limiter.try_acquire("k", "m", "tpm_input", 1000, cost=300, now=0.0)
+    limiter.refund("k", "m", "tpm_input", 1000, cost=500, now=0.0)
+    assert limiter.usage("k", "m", "tpm_input", 1000, now=0.0) == 300
+    # 按实际用量记账可以超过限额，之后的占用在用量回落前都会失败
+    limiter.consume("k", "m", "tpm_input", 1000, cost=900, now=0.0)
+    assert not limiter.try_acquire("k", "m", "tpm_input", 1000, cost=1, now=0.0)
+    # 不限制的维度不记录任何状态
+    assert limiter.try_acquire("k", "m", "tpm_output", None, cost=10**9)
+    assert limiter.usage("k", "m", "tpm_output", None) == 0.0
+
+
+def test_release_only_refunds_undrained_reservation(monkeypatch):
+    limiter = KeyRateLimiter()
+    now = [0.0]
+    monkeypatch.setattr(limiter_module.time, "time", lambda: now[0])
+    reservation, used = limiter.reserve("k", "m", 1000, 500)
+    assert used == 0
+    now[0] = 40.0
+    assert limiter.try_acquire("k", "m", "tpm_input", 1000, cost=500)
+    # 退还第一笔预留只扣除它自己的用量，不会抵消 40 秒时的占用
+    reservation.release()
+    assert limiter.usage("k", "m", "tpm_input", 1000) == 500
+    # 预留已经移出窗口后再退还不产生任何效果
+    late, used = limiter.reserve("k", "m", 1000, 300)
+    assert used == 500  # 预留前的用量与放行来自同一次检查
+    now[0] = 105.0
+    assert limiter.try_acquire("k", "m", "tpm_input", 1000, cost=1000)
+    late.reconcile(0)
+    assert limiter.usage("k", "m", "tpm_input", 1000) == 1000
+    assert limiter.reserve("k", "m", 1000, 1) == (None, 1000)
+
+
+def test_selection_reserves_tokens_until_reconciled(make_key_manager):
+    model, limits = "reservation-test-model", {"tpm_input": 1000}
+    manager = make_key_manager(model, ["only-key"])
+
+    async def select(request_id):
+        ctx = AttemptContext.create(request_id, max_attempts=1)
+        key, _ = await manager.select_best_key(
+            model, limits, 600, request_id=request_id, attempt_context=ctx
+        )
+        return key, ctx
+
+    async def run():
+        first_key, first = await select("r1")
+        # 并发的第二个长请求不能再通过同一份余量
+        second_key, second = await select("r2")
+        assert first_key == "only-key" and second_key is None
+        assert second.token_reservation is None
+        # 实际只用了 200 Token，对账后退还差额，余量足够再选一次
+        first.take_token_reservation().reconcile(200)
+        third_key, third = await select("r3")
+        assert third_key == "only-key"
+        # 调用失败时全额退还
+        third.release_token_reservation()
+        assert (
+            round(key_rate_limiter.usage("only-key", model, "tpm_input", 1000)) == 200
+        )
+
+    try:
+        asyncio.run(run())
+    finally:
+        key_rate_limiter.forget_key("only-key")
@@ -0,0 +1,47 @@
+import asyncio
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core import tracking  # noqa: E402
+from gap.core.keys import scoring  # noqa: E402
+from gap.core.keys.limiter import key_rate_limiter  # noqa: E402
+
+MODEL = "key-scoring-test-model"
+LIMITS = {"rpm": 10}
+
+
+def test_persisted_health_excludes_headroom(monkeypatch):
+    saved = {}
+
+    async def save_key_scores(db, scores):
+        saved.update(scores)
+        return sum(len(s) for s in scores.values())
+
+    async def get_key_scores(db):
+        return saved
+
+    monkeypatch.setattr(scoring.db_utils, "save_key_scores", save_key_scores)
+    monkeypatch.setattr(scoring.db_utils, "get_key_scores", get_key_scores)
+    engine = scoring.KeyScoringEngine()
+    # 滑动窗口已用满：余量为 0，分数只剩健康度部分
+    for _ in range(10):
+        key_rate_limiter.try_acquire("score-key", MODEL, "rpm", 10)
+    try:
+        score = engine.record_outcome("score-key", MODEL, True, 0.0, limits=LIMITS)
+        asyncio.run(engine.persist_scores(None))
+        health = saved[MODEL]["score-key"]
+        assert score == scoring.HEALTH_WEIGHT * health
+
+        # 重启后的先验只是健康度，不会与旧的余量再次混合
+        restarted = scoring.KeyScoringEngine()
+        asyncio.run(restarted.load_scores(None))
+        key_rate_limiter.forget_key("score-key")
+        refreshed = restarted.refresh_model_scores(MODEL, ["score-key"], LIMITS)
+        expected = scoring.HEALTH_WEIGHT * health + (1.0 - scoring.HEALTH_WEIGHT)
+        assert abs(refreshed["score-key"] - expected) < 1e-9
+    finally:
+        key_rate_limiter.forget_key("score-key")
+        with tracking.cache_lock:
+            tracking.key_scores_cache.pop(MODEL, None)
+            tracking.cache_last_updated.pop(MODEL, None)
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.candidate_index import CandidateIndex  # noqa: E402
+from gap.core.keys.selection_telemetry import SelectionTelemetry  # noqa: E402
+from gap.core.processing.attempt_context import AttemptContext  # noqa: E402
+
+MODEL = "key-selection-benchmark-model"
+LIMITS = {"tpm_input": 0}
+SELECTIONS = 2000
+
+
+def _time_selections(manager, key_count):
+    async def run():
+        started = time.perf_counter()
+        for i in range(SELECTIONS):
+            # 每个请求先尝试两次，第二次会跳过第一次选中的 Key
+            ctx = AttemptContext.create(f"bench-{key_count}-{i}", max_attempts=2)
+            while ctx.start_attempt():
+                key, _ = await manager.select_best_key(
+                    MODEL, LIMITS, 10, request_id=ctx.request_id, attempt_context=ctx
+                )
+                assert key is not None
+            ctx.release_concurrency_permit()  # 与 main_handler 一样在请求结束时归还名额
+        return (time.perf_counter() - started) / (SELECTIONS * 2)
+
+    return asyncio.run(run())
+
+
+def test_candidate_index_rotates_within_best_band():
+    index = CandidateIndex({"a": 1.0, "b": 0.99, "c": 0.5}, {"a": 5.0, "b": 1.0})
+    accept = lambda key, score: (True, None)  # noqa: E731
+    # 最高分段内按最久未选中的顺序轮转，低分段的 Key 不参与
+    picked = [index.pick(10.0 + i, accept)[0] for i in range(4)]
+    assert picked == ["b", "a", "b", "a"]
+
+    # 高分段的 Key 都被挂起时，退回到下一个分数段；到期后自动恢复
+    index.suspend("a", until=100.0)
+    index.suspend("b", until=100.0)
+    assert index.pick(20.0, accept)[0] == "c"
+    assert index.pick(101.0, accept)[0] in {"a", "b"}
+
+
+def test_rotation_spans_band_edges_within_95_percent_of_best():
+    # 0.951 与 0.949 落在不同的分数段，但都在最高分的 95% 以内；0.9 不在
+    index = CandidateIndex({"a": 0.951, "b": 0.949, "c": 0.9}, {"a": 5.0, "b": 1.0})
+    accept = lambda key, score: (True, None)  # noqa: E731
+    picked = [index.pick(10.0 + i, accept)[0] for i in range(4)]
+    assert picked == ["b", "a", "b", "a"]
+
+    # 轮转范围内的 Key 都未通过检查时，才退回到范围以外的 Key
+    reject_top = lambda key, score: (key == "c", None)  # noqa: E731
+    assert index.pick(20.0, reject_top)[0] == "c"
+
+
+def test_check_runs_without_holding_the_index_lock():
+    index = CandidateIndex({"a": 1.0, "b": 1.0}, {"a": 1.0, "b": 2.0})
+    accept = lambda key, score: (True, None)  # noqa: E731
+    concurrent = []
+
+    def slow_check(key, score):
+        # 检查期间另一个线程的选择不被阻塞，且不会选中正在检查的 Key
+        worker = threading.Thread(
+            target=lambda: concurrent.append(index.pick(10.0, accept))
+        )
+        worker.start()
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+        return True, None
+
+    assert index.pick(10.0, slow_check)[0] == "a"
+    assert concurrent == [("b", 1.0)]
+    # 两个 Key 都已放回索引，继续参与轮转
+    assert sorted(index.pick(11.0 + i, accept)[0] for i in range(2)) == ["a", "b"]
+
+
+def test_selection_telemetry_stays_bounded():
+    telemetry = SelectionTelemetry(max_counters=3, sample_rate=1.0, buffer_size=2)
+    for i in range(1000):
+        handle = telemetry.begin_trace(f"req-{i}", "m")
+        telemetry.record(
+            f"key-{i}",
+            f"Score Selection - Successful Selection (Score: {i / 1000})",
+            "m",
+        )
+        telemetry.end_trace(handle, f"key-{i}")
+
+    stats = telemetry.snapshot(reset=True)
+    # 分数被归一化，超出上限的新 Key 计入溢出桶，轨迹只保留最近的 2 条
+    assert len(stats["counters"]) == 4
+    assert stats["overflowed"] == 997
+    assert {c["reason"] for c in stats["counters"]} == {
+        "Score Selection - Successful Selection"
+    }
+    assert [t["request_id"] for t in stats["traces"]] == ["req-998", "req-999"]
+    assert stats["traces"][-1]["decisions"][0]["key"] == "key-999"
+    assert telemetry.snapshot()["counters"] == []
+
+
+@pytest.mark.slow
+def test_selection_cost_stays_flat_as_key_pool_grows(make_key_manager):
+    timings = {}
+    for key_count in (10, 1_000, 10_000):
+        keys = [f"bench-key-{i}" for i in range(key_count)]
+        # 分数分布在多个分数段中，最高分段只包含少量 Key
+        scores = {k: 1.0 - (i % 50) / 100 for i, k in enumerate(keys)}
+        manager = make_key_manager(MODEL, keys, scores=scores)
+        timings[key_count] = _time_selections(manager, key_count)
+    # 线性扫描 + 排序在 10,000 个 Key 时会比 10 个 Key 慢约三个数量级
+    assert timings[10_000] < timings[10] * 10, ", ".join(
+        f"{count} keys: {seconds * 1e6:.1f} us per selection"
+        for count, seconds in timings.items()
+    )
@@ -0,0 +1,228 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.responses import StreamingResponse
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.api.models import (  # noqa: E402
+    ChatCompletionRequest,
+    ChatCompletionResponse,
+    Choice,
+    ResponseMessage,
+)
+from gap.core import tracking  # noqa: E402
+from gap.core.processing import post_processing  # noqa: E402
+from gap.core.processing import response_cache as response_cache_module  # noqa: E402
+from gap.core.processing.response_cache import (  # noqa: E402
+    ResponseCache,
+    SQLiteResponseStore,
+    is_cacheable_request,
+    response_cache,
+)
+from gap.core.processing.stream_handler import generate_stream_response  # noqa: E402
+
+MODEL = "gemini-response-cache-test"
+
+
+def _response(text="answer", finish_reason="STOP"):
+    return ChatCompletionResponse(
+        id="chatcmpl-1",
+        created=0,
+        model=MODEL,
+        choices=[
+            Choice(
+                index=0,
+                message=ResponseMessage(role="assistant", content=text),
+                finish_reason=finish_reason,
+            )
+        ],
+    )
+
+
+def _chat_request(temperature=0.0, stream=False):
+    return ChatCompletionRequest(
+        model=MODEL,
+        messages=[{"role": "user", "content": "same question"}],
+        temperature=temperature,
+        stream=stream,
+    )
+
+
+def test_cacheable_request_rules():
+    assert is_cacheable_request(_chat_request())
+    assert not is_cacheable_request(_chat_request(temperature=0.7))
+    assert is_cacheable_request(_chat_request(temperature=0.7), "true")
+    assert not is_cacheable_request(_chat_request(), "bypass")
+    assert is_cacheable_request(_chat_request(), "unrelated")
+
+
+def test_memory_tier_enforces_byte_budget_and_ttl(monkeypatch):
+    size = len(_response("x" * 100).model_dump_json())
+    cache = ResponseCache(max_bytes=size * 2, ttl_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(response_cache_module.time, "time", lambda: now[0])
+
+    async def run():
+        for key in ("a", "b"):
+            await cache.put(key, _response("x" * 100))
+        assert await cache.get("a") is not None  # a 成为最近使用的条目
+        await cache.put("c", _response("x" * 100))
+        evicted = await cache.get("b")
+        now[0] += 61
+        expired = await cache.get("a")
+        return evicted, expired
+
+    evicted, expired = asyncio.run(run())
+    assert evicted is None and expired is None
+    stats = cache.get_stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 1
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+def test_truncated_responses_are_not_cached():
+    cache = ResponseCache(max_bytes=1 << 20, ttl_seconds=60)
+
+    async def run():
+        stored = await cache.put("k", _response(finish_reason="MAX_TOKENS"))
+        return stored, await cache.get("k")
+
+    assert asyncio.run(run()) == (False, None)
+
+
+def test_sqlite_tier_survives_a_new_process(tmp_path):
+    path = str(tmp_path / "response_cache.db")
+    writer = ResponseCache(
+        max_bytes=1 << 20, ttl_seconds=60, store=SQLiteResponseStore(path)
+    )
+    reader = ResponseCache(
+        max_bytes=1 << 20, ttl_seconds=60, store=SQLiteResponseStore(path)
+    )
+
+    async def run():
+        await writer.put("k", _response("persisted"))
+        first = await reader.get("k")
+        second = await reader.get("k")
+        return first, second
+
+    try:
+        first, second = asyncio.run(run())
+        assert first.choices[0].message.content == "persisted"
+        assert first.id != "chatcmpl-1"  # 命中时生成新的响应 ID
+        assert second is not None
+        # 第二级命中后回填第一级
+        assert reader.get_stats()["store_hits"] == 1
+        assert reader.get_stats()["memory_hits"] == 1
+    finally:
+        writer.store.close()
+        reader.store.close()
+
+
+def test_completed_stream_is_stored():
+    class FakeClient:
+        async def stream_chat(self, **kwargs):
+            yield "Hello"
+            yield " world"
+            yield {"_final_finish_reason": "STOP"}
+            # 上游只返回输入 Token 数 (输出 Token 数为 None)
+            yield {"_usage_metadata": {"prompt_token_count": 5}}
+
+    class FakeKeyManager:
+        def record_call_outcome(self, *args, **kwargs):
+            pass
+
+    response_cache.clear()
+
+    async def run():
+        stream = generate_stream_response(
+            gemini_client_instance=FakeClient(),
+            chat_request=None,
+            contents=[{"role": "user", "parts": [{"text": "hi"}]}],
+            safety_settings=[],
+            system_instruction=None,
+            cached_content_id=None,
+            response_id="chatcmpl-stream",
+            enable_native_caching=False,
+            cache_manager_instance=None,
+            content_to_cache_on_success=None,
+            db_for_cache=None,
+            user_id_for_mapping=None,
+            key_manager=FakeKeyManager(),
+            selected_key="stream-cache-key",
+            model_name=MODEL,
+            limits=None,
+            client_ip="10.0.2.1",
+            today_date_str_pt="2026-01-03",
+            response_cache_key="stream-fingerprint",
+        )
+        [chunk async for chunk in stream]
+        return await response_cache.get("stream-fingerprint")
+
+    try:
+        cached = asyncio.run(run())
+        assert cached.choices[0].message.content == "Hello world"
+        assert cached.choices[0].finish_reason == "STOP"
+        assert cached.usage.prompt_tokens == 5 and cached.usage.completion_tokens == 0
+    finally:
+        response_cache.clear()
+        with tracking.usage_lock:
+            tracking.usage_data.pop("stream-cache-key", None)
+
+
+@pytest.fixture
+def caching_pipeline(fake_pipeline, monkeypatch):
+    """启用响应缓存，并记录流式缓存命中时保存的回复。"""
+    saved_replies = []
+
+    async def save_context(**kwargs):
+        saved_replies.append(kwargs["model_reply_content"])
+
+    monkeypatch.setattr(app_config, "ENABLE_RESPONSE_CACHE", True)
+    monkeypatch.setattr(app_config, "STREAM_SAVE_REPLY", True)
+    monkeypatch.setattr(post_processing, "save_context_after_success", save_context)
+    fake_pipeline.saved_replies = saved_replies
+    response_cache.clear()
+    yield fake_pipeline
+    response_cache.clear()
+
+
+def test_repeated_prompt_costs_zero_upstream_calls(caching_pipeline):
+    pipeline = caching_pipeline
+    header = app_config.RESPONSE_CACHE_HEADER
+
+    async def run():
+        first = await pipeline.process(_chat_request())
+        second = await pipeline.process(_chat_request())
+        streamed = await pipeline.process(_chat_request(stream=True))
+        body = b"".join([chunk async for chunk in streamed.body_iterator])
+        await pipeline.process(_chat_request(), {header: "bypass"})
+        await pipeline.process(_chat_request(temperature=0.7))
+        await pipeline.process(_chat_request(temperature=0.7), {header: "true"})
+        await pipeline.process(_chat_request(temperature=0.7), {header: "true"})
+        return first, second, streamed, body
+
+    first, second, streamed, body = asyncio.run(run())
+    assert second.choices[0].message.content == "answer"
+    assert second.id != first.id
+    # 流式请求以 SSE 重放同一份缓存结果
+    assert isinstance(streamed, StreamingResponse)
+    assert b'"content": "answer"' in body and body.endswith(b"data: [DONE]\n\n")
+    # 首次请求、bypass、非 0 temperature、首次显式启用各调用一次上游
+    assert pipeline.upstream_calls == 4
+    assert response_cache.get_stats()["upstream_calls_saved"] == 3
+
+
+def test_replayed_stream_saves_context(caching_pipeline):
+    pipeline = caching_pipeline
+    stream_request = _chat_request(stream=True).model_copy(update={"user_id": "u"})
+
+    async def run():
+        await pipeline.process(_chat_request())
+        await pipeline.process(stream_request, db=object())
+
+    asyncio.run(run())
+    assert pipeline.upstream_calls == 1
+    # 流式缓存命中与未命中一样，在 STREAM_SAVE_REPLY 启用时保存回复
+    assert pipeline.saved_replies == ["answer"]
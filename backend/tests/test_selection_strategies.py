@@ -0,0 +1,79 @@
+import asyncio
+import os
+import time
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.limiter import key_rate_limiter  # noqa: E402
+from gap.core.processing.attempt_context import AttemptContext  # noqa: E402
+
+MODEL = "selection-strategy-test-model"
+LIMITS = {"tpm_input": 0}
+KEYS = [f"strategy-key-{i}" for i in range(4)]
+
+
+def _select(manager, limits=LIMITS, ctx=None):
+    ctx = ctx or AttemptContext.create("req", max_attempts=1)
+    key, _ = asyncio.run(
+        manager.select_best_key(
+            MODEL, limits, 10, request_id="req", attempt_context=ctx
+        )
+    )
+    return key, ctx
+
+
+def test_round_robin_cycles_and_skips_tried_keys(make_key_manager):
+    manager = make_key_manager(MODEL, KEYS, strategy="round_robin")
+    picked = []
+    for _ in range(5):
+        key, ctx = _select(manager)
+        ctx.release_concurrency_permit()
+        picked.append(key)
+    assert picked == KEYS + KEYS[:1]
+
+    ctx = AttemptContext.create("req", max_attempts=2)
+    ctx.mark_tried(KEYS[1])
+    assert _select(manager, ctx=ctx)[0] == KEYS[2]
+
+
+def test_least_outstanding_and_p2c_prefer_idle_keys(make_key_manager):
+    manager = make_key_manager(MODEL, KEYS, strategy="least_outstanding")
+    held = [_select(manager)[1] for _ in range(len(KEYS))]
+    # 每个 Key 各有一个在途请求；归还其中一个后，它成为在途最少的 Key
+    assert sorted(ctx.concurrency_permit.api_key for ctx in held) == sorted(KEYS)
+    idle = held[2].concurrency_permit.api_key
+    held[2].release_concurrency_permit()
+    assert _select(manager)[0] == idle
+
+    manager = make_key_manager(MODEL, KEYS, strategy="p2c")
+    # 前三个 Key 达到并发上限：抽到时被跳过，抽样轮数用尽后回退到检查所有候选
+    busy = [
+        manager.concurrency_limiter.try_acquire(k, MODEL)
+        for k in KEYS[:3]
+        for _ in range(4)
+    ]
+    for _ in range(20):
+        key, ctx = _select(manager)
+        ctx.release_concurrency_permit()
+        assert key == KEYS[3]
+    for permit in busy:
+        permit.release()
+
+
+def test_headroom_weighting_avoids_keys_near_their_limit(make_key_manager):
+    manager = make_key_manager(MODEL, KEYS, strategy="headroom")
+    limits = {"rpm": 10, "tpm_input": 0}
+    now = time.time()
+    for key in KEYS[:3]:
+        for _ in range(9):
+            key_rate_limiter.try_acquire(key, MODEL, "rpm", 10, 1, now)
+    try:
+        # 前三个 Key 扣除本次请求后没有余量 (权重为 0)，总是排在有余量的 Key 之后
+        for _ in range(10):
+            key, ctx = _select(manager, limits=limits)
+            ctx.release_concurrency_permit()
+            ctx.release_token_reservation()
+            assert key == KEYS[3]
+    finally:
+        for key in KEYS:
+            key_rate_limiter.forget_key(key)
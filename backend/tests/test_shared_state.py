@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import time
+import uuid
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.keys.limiter import KeyRateLimiter  # noqa: E402
+from gap.core.shared_state import (  # noqa: E402
+    LocalStateBackend,
+    RedisStateBackend,
+    SharedMemoryStateBackend,
+)
+
+NOW = 1_000_000.0
+
+
+def _worker(segment_name, results):
+    backend = SharedMemoryStateBackend(segment_name, slots=1024, marks=16)
+    limiter = KeyRateLimiter(backend)
+    acquired = sum(
+        limiter.try_acquire("k", "m", "rpm", 100, now=NOW) for _ in range(50)
+    )
+    counted = sum(backend.counter_add("rpd", 1, 120, 3600)[0] for _ in range(50))
+    results.put((acquired, counted))
+    backend.close()
+
+
+def test_shared_memory_quota_is_exact_across_processes():
+    segment_name = f"gap_test_{uuid.uuid4().hex[:12]}"
+    backend = SharedMemoryStateBackend(segment_name, slots=1024, marks=16)
+    try:
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        workers = [
+            ctx.Process(target=_worker, args=(segment_name, results)) for _ in range(4)
+        ]
+        for p in workers:
+            p.start()
+        totals = [results.get(timeout=30) for _ in workers]
+        for p in workers:
+            p.join(timeout=30)
+        # 4 个进程各尝试 50 次，共享额度只放行限额内的次数
+        assert sum(a for a, _ in totals) == 100
+        assert sum(c for _, c in totals) == 120
+        assert backend.counter_get("rpd") == 120
+        assert (
+            round(KeyRateLimiter(backend).usage("k", "m", "rpm", 100, now=NOW)) == 100
+        )
+
+        now = time.time()
+        backend.set_mark("exhausted", "key-a", now + 10)
+        backend.set_mark("exhausted", "key-b", now - 10)
+        assert backend.get_marks("exhausted", now) == {"key-a": now + 10}
+        backend.clear_marks("exhausted")
+        assert backend.get_marks("exhausted", now) == {}
+    finally:
+        backend.unlink()
+        backend.close()
+
+
+def test_redis_backend_counters():
+    redis = pytest.importorskip("redis")
+    url = os.environ.get("REDIS_URL", "redis://localhost:6379/15")
+    try:
+        redis.Redis.from_url(url).ping()
+    except redis.exceptions.RedisError:
+        pytest.skip("redis-server 不可用")
+    backend = RedisStateBackend(url, prefix=f"gap:test:{uuid.uuid4().hex[:8]}:")
+    try:
+        assert backend.gcra_acquire("tat", 30, 60, NOW)
+        assert backend.gcra_acquire("tat", 30, 60, NOW)
+        assert not backend.gcra_acquire("tat", 30, 60, NOW)
+        backend.gcra_refund("tat", 30, NOW)
+        assert backend.gcra_acquire("tat", 30, 60, NOW)
+        assert backend.counter_add("rpd", 2, 3, 60) == (True, 2)
+        assert backend.counter_add("rpd", 2, 3, 60) == (False, 2)
+        assert backend.counter_get("rpd") == 2
+        assert backend.counter_get_many(["rpd", "missing"]) == [2, 0]
+    finally:
+        backend.close()
+
+
+def test_redis_outage_falls_back_to_local_state():
+    pytest.importorskip("redis")
+    # 没有服务监听的端口：连接立即被拒绝
+    backend = RedisStateBackend("redis://127.0.0.1:1/0", prefix="gap:test:")
+    limiter = KeyRateLimiter(backend)
+    try:
+        assert limiter.try_acquire("k", "m", "rpm", 2, now=NOW)
+        assert limiter.try_acquire("k", "m", "rpm", 2, now=NOW)
+        assert not limiter.try_acquire("k", "m", "rpm", 2, now=NOW)
+        assert backend.counter_add("rpd", 1, 1, 60) == (True, 1)
+        backend.set_mark("exhausted", "k", time.time() + 60)
+        assert list(backend.get_marks("exhausted", time.time())) == ["k"]
+    finally:
+        backend.close()
+
+
+def test_usage_of_many_keys_is_one_backend_read():
+    class CountingBackend(LocalStateBackend):
+        reads = 0
+
+        def counter_get_many(self, keys):
+            CountingBackend.reads += 1
+            return super().counter_get_many(keys)
+
+    limiter = KeyRateLimiter(CountingBackend())
+    for key in ("a", "b", "c"):
+        assert limiter.try_acquire(key, "m", "tpm_input", 1000, cost=100, now=NOW)
+    CountingBackend.reads = 0
+    queries = [
+        (key, "m", dimension, 1000)
+        for key in ("a", "b", "c")
+        for dimension in ("rpm", "tpm_input", "tpm_output")
+    ]
+    used = limiter.usage_many(queries, now=NOW)
+    assert CountingBackend.reads == 1
+    assert used == [0, 100, 0] * 3
+
+
+def test_reserve_reports_usage_from_the_same_check():
+    limiter = KeyRateLimiter(LocalStateBackend())
+    reservation, used = limiter.reserve("k", "m", 1000, 600, now=NOW)
+    assert reservation is not None and used == 0
+    assert limiter.reserve("k", "m", 1000, 300, now=NOW)[1] == 600
+    # 被拒绝时不做修改，仍返回当时的用量
+    assert limiter.reserve("k", "m", 1000, 200, now=NOW) == (None, 900)
+
+
+@pytest.mark.parametrize("shared_memory", [False, True])
+def test_window_reserve_checks_and_adds_in_one_call(shared_memory):
+    if shared_memory:
+        backend = SharedMemoryStateBackend(
+            f"gap_test_{uuid.uuid4().hex[:12]}", slots=64, marks=4
+        )
+    else:
+        backend = LocalStateBackend()
+    try:
+        keys = ["w:0", "w:1", "w:2"]
+        backend.counter_add("w:0", 300, 10_000, 60)
+        # 范围内的计数之和加上本次数量不超过限额时，只累加到最后一个桶
+        assert backend.window_reserve(keys, 500, 1000, 60) == (True, [300, 0, 0])
+        assert backend.window_reserve(keys, 300, 1000, 60) == (False, [300, 0, 500])
+        assert backend.counter_get_many(keys) == [300, 0, 500]
+    finally:
+        if shared_memory:
+            backend.unlink()
+        backend.close()
@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.api.models import ChatCompletionRequest  # noqa: E402
+from gap.core.processing.single_flight import (  # noqa: E402
+    RequestCoalescer,
+    request_coalescer,
+    request_fingerprint,
+)
+
+MODEL = "gemini-coalesce-test"
+
+
+def _chat_request(text="same question", temperature=0.0):
+    return ChatCompletionRequest(
+        model=MODEL,
+        messages=[{"role": "user", "content": text}],
+        temperature=temperature,
+    )
+
+
+def test_fingerprint_covers_contents_and_generation_params():
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    base = request_fingerprint(MODEL, contents, None, _chat_request())
+    assert base == request_fingerprint(
+        MODEL,
+        [dict(contents[0])],
+        None,
+        _chat_request().model_copy(update={"user_id": "u"}),
+    )
+    assert base != request_fingerprint(
+        MODEL, contents, None, _chat_request(temperature=0.5)
+    )
+    assert base != request_fingerprint(
+        MODEL, contents, {"parts": [{"text": "sys"}]}, _chat_request()
+    )
+
+
+def test_abandoned_flight_lets_followers_rejoin():
+    coalescer = RequestCoalescer()
+
+    async def run():
+        leader, is_leader = coalescer.join("k")
+        follower, follower_is_leader = coalescer.join("k")
+        assert is_leader and not follower_is_leader and follower is leader
+        waiting = asyncio.create_task(coalescer.follow(follower, 5))
+        await asyncio.sleep(0)
+        coalescer.abandon("k", leader)
+        assert await waiting is None
+        # 登记已移除，重新登记的请求成为新的领导者
+        return coalescer.join("k")[1]
+
+    assert asyncio.run(run()) is True
+    assert coalescer.get_stats()["fallbacks"] == 1
+
+
+@pytest.fixture
+def coalescing_pipeline(fake_pipeline, monkeypatch):
+    # 上游调用期间保持在途，使并发的相同请求能够合并
+    fake_pipeline.upstream_delay = 0.05
+    monkeypatch.setattr(app_config, "ENABLE_REQUEST_COALESCING", True)
+    request_coalescer.clear()
+    yield fake_pipeline
+    request_coalescer.clear()
+
+
+def test_identical_requests_share_one_upstream_call(coalescing_pipeline):
+    pipeline = coalescing_pipeline
+
+    async def run():
+        return await asyncio.gather(
+            *[pipeline.process(_chat_request()) for _ in range(5)],
+            pipeline.process(_chat_request("other question")),
+            pipeline.process(_chat_request(temperature=0.7)),
+        )
+
+    responses = asyncio.run(run())
+    # 5 个相同请求合并为 1 次上游调用；不同内容和非 0 temperature 的请求各自调用
+    assert pipeline.upstream_calls == 3
+    assert all(r.choices[0].message.content == "answer" for r in responses)
+    assert len({id(r) for r in responses[:5]}) == 5  # 跟随者拿到各自的副本
+    assert pipeline.post_processed_keys == [pipeline.key] * 7
+    stats = request_coalescer.get_stats()
+    assert stats["hits"] == 4 and stats["in_flight"] == 0
+
+
+def test_leader_error_reaches_followers(coalescing_pipeline):
+    pipeline = coalescing_pipeline
+    pipeline.failure.update(
+        {"message": "bad request", "type": "invalid_request", "code": 400}
+    )
+
+    async def run():
+        return await asyncio.gather(
+            *[pipeline.process(_chat_request()) for _ in range(3)],
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert pipeline.upstream_calls == 1
+    assert all(isinstance(r, HTTPException) and r.status_code == 400 for r in results)
+    assert request_coalescer.get_stats()["shared_errors"] == 2
+
+
+def test_batch_leader_backpressure_does_not_reach_followers(coalescing_pipeline):
+    pipeline = coalescing_pipeline
+    pipeline.failure.update(
+        {"message": "all keys busy", "type": "key_error", "code": 503}
+    )
+
+    async def run():
+        # 批处理条目 (不等待容量) 成为领导者，交互请求作为跟随者等待
+        leader = asyncio.create_task(
+            pipeline.process(_chat_request(), wait_for_capacity=False)
+        )
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(pipeline.process(_chat_request()))
+        await asyncio.sleep(0.01)
+        pipeline.failure.clear()
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader_result, follower_result = asyncio.run(run())
+    assert isinstance(leader_result, HTTPException)
+    assert leader_result.status_code == 503
+    # 跟随者不接收领导者的 503，而是自行调用上游
+    assert follower_result.choices[0].message.content == "answer"
+    assert pipeline.upstream_calls == 2
+    stats = request_coalescer.get_stats()
+    assert stats["shared_errors"] == 0 and stats["fallbacks"] == 1
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.processing.sse_encoder import (  # noqa: E402
+    FLUSH,
+    SSEChunkEncoder,
+    SSEDeltaCoalescer,
+    with_flush_deadlines,
+)
+
+RESPONSE_ID = "chatcmpl-1700000000000"
+MODEL = "gemini-sse-test"
+CREATED = 1700000000
+
+
+def _legacy_chunk(delta, finish_reason=None):
+    """编码器替换前 generate_stream_response 的逐块构造方式。"""
+    chunk = {
+        "id": RESPONSE_ID,
+        "object": "chat.completion.chunk",
+        "created": CREATED,
+        "model": MODEL,
+        "choices": [{"delta": delta, "index": 0, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "text", ["hello", 'quote " and \\ slash', "换行\n制表\t", "emoji 😀", "\x00\x1f"]
+)
+def test_content_chunk_matches_json_dumps(text):
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL, created=CREATED)
+    assert encoder.content(text) == _legacy_chunk(
+        {"role": "assistant", "content": text}
+    )
+
+
+def test_tool_calls_finish_and_error_chunks():
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL, created=CREATED)
+    tool_calls = [{"id": "call_1", "type": "function", "function": {"name": "f"}}]
+    assert encoder.tool_calls(tool_calls) == _legacy_chunk(
+        {"role": "assistant", "tool_calls": tool_calls}
+    )
+    assert encoder.finish("STOP") == _legacy_chunk({}, "STOP")
+    error_info = {"message": "错误", "type": "api_error", "code": 429}
+    assert encoder.error(error_info) == (
+        f"data: {json.dumps({'error': error_info})}\n\n".encode("utf-8")
+    )
+
+
+def test_coalescer_merges_until_byte_limit():
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL, created=CREATED)
+    coalescer = SSEDeltaCoalescer(encoder, max_bytes=6)
+    emitted = [coalescer.push(text) for text in ["ab", "cd", "ef", "g"]]
+    assert emitted[:2] == [None, None]
+    assert emitted[2] == encoder.content("abcdef")
+    assert emitted[3] is None
+    assert coalescer.flush() == encoder.content("g")
+    assert coalescer.flush() is None
+    assert (coalescer.deltas_received, coalescer.chunks_emitted) == (4, 2)
+
+
+def test_disabled_coalescer_passes_every_delta_through():
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL, created=CREATED)
+    coalescer = SSEDeltaCoalescer(encoder)
+    assert coalescer.push("a") == encoder.content("a")
+    assert coalescer.time_until_flush() is None
+
+
+def test_flush_deadline_fires_while_upstream_stalls():
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL, created=CREATED)
+    coalescer = SSEDeltaCoalescer(encoder, max_delay_ms=20)
+
+    async def upstream():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.2)  # 上游停顿远超合并时限
+        yield "c"
+
+    async def run():
+        emitted = []
+        async for item in with_flush_deadlines(upstream(), coalescer):
+            chunk = coalescer.flush() if item is FLUSH else coalescer.push(item)
+            if chunk is not None:
+                emitted.append((chunk, time.monotonic()))
+        tail = coalescer.flush()
+        if tail is not None:
+            emitted.append((tail, time.monotonic()))
+        return emitted
+
+    started = time.monotonic()
+    emitted = asyncio.run(run())
+    assert [chunk for chunk, _ in emitted] == [
+        encoder.content("ab"),
+        encoder.content("c"),
+    ]
+    # "ab" 在停顿期间按时发出，而不是等到 "c" 到达
+    assert emitted[0][1] - started < 0.15
+
+
+@pytest.mark.slow
+def test_encoder_cpu_per_token_benchmark():
+    tokens = [f"token {i} “引号” \n" for i in range(50_000)]
+
+    started = time.process_time()
+    for text in tokens:
+        chunk = {
+            "id": RESPONSE_ID,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": MODEL,
+            "choices": [
+                {
+                    "delta": {"role": "assistant", "content": text},
+                    "index": 0,
+                    "finish_reason": None,
+                }
+            ],
+        }
+        # StreamingResponse 会把 str 块再编码为 bytes
+        f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+    legacy_seconds = time.process_time() - started
+
+    encoder = SSEChunkEncoder(RESPONSE_ID, MODEL)
+    started = time.process_time()
+    for text in tokens:
+        encoder.content(text)
+    encoder_seconds = time.process_time() - started
+
+    assert encoder_seconds * 3 < legacy_seconds, (
+        f"per token: dict + json.dumps {legacy_seconds / len(tokens) * 1e6:.2f} us, "
+        f"encoder {encoder_seconds / len(tokens) * 1e6:.2f} us"
+    )
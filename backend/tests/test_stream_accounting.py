@@ -0,0 +1,127 @@
+import asyncio
+import os
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core import tracking  # noqa: E402
+from gap.core.keys.limiter import key_rate_limiter  # noqa: E402
+from gap.core.processing.stream_handler import generate_stream_response  # noqa: E402
+
+MODEL = "stream-accounting-model"
+LIMITS = {"tpm_input": 100_000, "tpm_output": 100_000}
+DAY = "2026-01-01"
+CONTENTS = [{"role": "user", "parts": [{"text": "hello"}]}]
+
+
+class FakeClient:
+    def __init__(self, pieces, usage=None):
+        self.pieces = pieces
+        self.usage = usage
+
+    async def stream_chat(self, **kwargs):
+        for piece in self.pieces:
+            await asyncio.sleep(0)
+            yield piece
+        if self.usage:
+            yield {"_usage_metadata": self.usage}
+
+
+class FakeKeyManager:
+    def record_call_outcome(self, *args, **kwargs):
+        pass
+
+
+def _stream(client, key, client_ip, reservation):
+    return generate_stream_response(
+        gemini_client_instance=client,
+        chat_request=None,
+        contents=CONTENTS,
+        safety_settings=[],
+        system_instruction=None,
+        cached_content_id=None,
+        response_id="chatcmpl-test",
+        enable_native_caching=False,
+        cache_manager_instance=None,
+        content_to_cache_on_success=None,
+        db_for_cache=None,
+        user_id_for_mapping=None,
+        key_manager=FakeKeyManager(),
+        selected_key=key,
+        model_name=MODEL,
+        limits=LIMITS,
+        client_ip=client_ip,
+        today_date_str_pt=DAY,
+        token_reservation=reservation,
+    )
+
+
+def _cleanup(key, client_ip):
+    key_rate_limiter.forget_key(key)
+    with tracking.usage_lock:
+        tracking.usage_data.pop(key, None)
+    with tracking.ip_input_token_counts_lock:
+        tracking.ip_daily_input_token_counts.get(DAY, {}).pop(client_ip, None)
+
+
+def test_completed_stream_records_actual_usage():
+    key, client_ip = "stream-key-a", "10.0.0.1"
+    reservation, _ = key_rate_limiter.reserve(key, MODEL, LIMITS["tpm_input"], 500)
+    client = FakeClient(
+        ["Hi", " there"], {"prompt_token_count": 120, "candidates_token_count": 30}
+    )
+
+    async def run():
+        return [chunk async for chunk in _stream(client, key, client_ip, reservation)]
+
+    try:
+        chunks = asyncio.run(run())
+        assert chunks[-1] == b"data: [DONE]\n\n"
+        # 预留的 500 按实际 120 对账，输出 Token 计入 TPM_Output
+        # (GCRA 用量随时间衰减，只做近似比较)
+        assert 115 < key_rate_limiter.usage(key, MODEL, "tpm_input", 100_000) <= 120
+        assert 25 < key_rate_limiter.usage(key, MODEL, "tpm_output", 100_000) <= 30
+        assert tracking.usage_data[key][MODEL]["tpd_input_count"] == 120
+        assert tracking.ip_daily_input_token_counts[DAY][client_ip] == 120
+        assert reservation.settled
+    finally:
+        _cleanup(key, client_ip)
+
+
+def test_disconnect_mid_stream_records_partial_usage():
+    key, client_ip = "stream-key-b", "10.0.0.2"
+    reservation, _ = key_rate_limiter.reserve(key, MODEL, LIMITS["tpm_input"], 80)
+    client = FakeClient(["word " * 40] * 10)
+
+    async def run():
+        stream = _stream(client, key, client_ip, reservation)
+        first = await stream.__anext__()
+        await stream.aclose()  # 客户端在收到第一块后断开
+        return first
+
+    try:
+        assert asyncio.run(run()).startswith(b"data: ")
+        # 输入保留预留的估算值，输出按已收到的文本估算
+        assert 75 < key_rate_limiter.usage(key, MODEL, "tpm_input", 100_000) <= 80
+        assert key_rate_limiter.usage(key, MODEL, "tpm_output", 100_000) > 0
+        assert tracking.ip_daily_input_token_counts[DAY][client_ip] == 80
+        assert reservation.settled
+    finally:
+        _cleanup(key, client_ip)
+
+
+def test_stream_without_output_releases_reservation():
+    key, client_ip = "stream-key-c", "10.0.0.3"
+    reservation, _ = key_rate_limiter.reserve(key, MODEL, LIMITS["tpm_input"], 80)
+
+    async def run():
+        return [
+            chunk
+            async for chunk in _stream(FakeClient([]), key, client_ip, reservation)
+        ]
+
+    try:
+        asyncio.run(run())
+        assert key_rate_limiter.usage(key, MODEL, "tpm_input", 100_000) == 0
+        assert client_ip not in tracking.ip_daily_input_token_counts.get(DAY, {})
+    finally:
+        _cleanup(key, client_ip)
@@ -0,0 +1,190 @@
+import asyncio
+import gc
+import os
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.api.models import ChatCompletionRequest  # noqa: E402
+from gap.core import tracking  # noqa: E402
+from gap.core.keys.concurrency import KeyConcurrencyLimiter  # noqa: E402
+from gap.core.keys.limiter import key_rate_limiter  # noqa: E402
+from gap.core.processing.api_caller import attempt_api_call  # noqa: E402
+from gap.core.processing.attempt_context import AttemptContext  # noqa: E402
+from gap.core.processing.disconnect import (  # noqa: E402
+    DisconnectWatcher,
+    stream_cancellation_stats,
+)
+from gap.core.processing.stream_handler import generate_stream_response  # noqa: E402
+
+MODEL = "stream-disconnect-model"
+LIMITS = {"tpm_input": 100_000, "tpm_output": 100_000, "output_token_limit": 1000}
+DAY = "2026-01-02"
+
+
+class FakeRequest:
+    """receive() 在 disconnect 事件触发前一直阻塞，模拟请求体已读完的 ASGI 连接。"""
+
+    def __init__(self):
+        self.disconnect = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnect.wait()
+        return {"type": "http.disconnect"}
+
+
+class SlowClient:
+    """先产出一段文本，然后长时间等待下一段 (模拟模型仍在生成)。"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def stream_chat(self, **kwargs):
+        try:
+            yield "first piece"
+            await asyncio.sleep(30)
+            yield "never sent"
+        finally:
+            self.closed = True
+
+
+class FakeKeyManager:
+    def record_call_outcome(self, *args, **kwargs):
+        pass
+
+
+class FakePermit:
+    released = False
+
+    def release(self):
+        self.released = True
+
+
+def test_client_disconnect_cancels_upstream_immediately():
+    key, client_ip = "disconnect-key", "10.0.1.1"
+    stream_cancellation_stats.reset()
+    reservation, _ = key_rate_limiter.reserve(key, MODEL, LIMITS["tpm_input"], 50)
+    client, permit = SlowClient(), FakePermit()
+
+    async def run():
+        request = FakeRequest()
+        stream = generate_stream_response(
+            gemini_client_instance=client,
+            chat_request=None,
+            contents=[{"role": "user", "parts": [{"text": "hi"}]}],
+            safety_settings=[],
+            system_instruction=None,
+            cached_content_id=None,
+            response_id="chatcmpl-disconnect",
+            enable_native_caching=False,
+            cache_manager_instance=None,
+            content_to_cache_on_success=None,
+            db_for_cache=None,
+            user_id_for_mapping=None,
+            key_manager=FakeKeyManager(),
+            selected_key=key,
+            model_name=MODEL,
+            limits=LIMITS,
+            client_ip=client_ip,
+            today_date_str_pt=DAY,
+            token_reservation=reservation,
+            concurrency_permit=permit,
+            http_request=request,
+        )
+
+        async def consume():
+            # 与 StreamingResponse 相同：在同一个任务中迭代生成器
+            return [chunk async for chunk in stream]
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0.05)  # 第一段已发送，生成器正在等待上游
+        disconnected_at = time.monotonic()
+        request.disconnect.set()
+        chunks = await asyncio.wait_for(consumer, timeout=2)
+        return chunks, time.monotonic() - disconnected_at, consumer
+
+    try:
+        chunks, elapsed, consumer = asyncio.run(run())
+        assert len(chunks) == 1 and b"first piece" in chunks[0]
+        assert elapsed < 0.5
+        # 监听器发起的取消已撤销，消费任务正常结束
+        assert not consumer.cancelled() and consumer.cancelling() == 0
+        assert client.closed and permit.released and reservation.settled
+        stats = stream_cancellation_stats.get_stats()
+        assert stats["cancelled_streams"] == 1
+        assert 0 < stats["output_tokens_generated"] < 1000
+        assert stats["output_tokens_saved"] == 1000 - stats["output_tokens_generated"]
+        # 已生成的部分照常记账
+        assert tracking.ip_daily_input_token_counts[DAY][client_ip] == 50
+    finally:
+        stream_cancellation_stats.reset()
+        key_rate_limiter.forget_key(key)
+        with tracking.usage_lock:
+            tracking.usage_data.pop(key, None)
+        with tracking.ip_input_token_counts_lock:
+            tracking.ip_daily_input_token_counts.get(DAY, {}).pop(client_ip, None)
+
+
+def test_unstarted_stream_returns_permit_and_reservation():
+    concurrency = KeyConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+
+    async def start_stream(api_key):
+        ctx = AttemptContext.create(f"r-{api_key}", max_attempts=1)
+        ctx.hold_concurrency_permit(concurrency.try_acquire(api_key, MODEL))
+        ctx.hold_token_reservation(
+            key_rate_limiter.reserve(api_key, MODEL, LIMITS["tpm_input"], 500)[0]
+        )
+        response, _, _ = await attempt_api_call(
+            chat_request=ChatCompletionRequest(
+                model=MODEL, messages=[{"role": "user", "content": "hi"}], stream=True
+            ),
+            contents=[{"role": "user", "parts": [{"text": "hi"}]}],
+            system_instruction=None,
+            current_api_key=api_key,
+            http_client=SimpleNamespace(),
+            key_manager=None,
+            model_name=MODEL,
+            limits=LIMITS,
+            client_ip="10.0.3.1",
+            today_date_str_pt=DAY,
+            enable_native_caching=False,
+            cache_manager_instance=None,
+            attempt_context=ctx,
+        )
+        return response
+
+    async def gone(message):
+        raise OSError("client disconnected before the response started")
+
+    async def run():
+        # 客户端在响应头发出前断开：生成器从未开始迭代
+        response = await start_stream("unstarted-key")
+        try:
+            await response(
+                {"type": "http", "asgi": {"spec_version": "2.4"}}, None, gone
+            )
+        except Exception:
+            pass
+        # 响应在发送前被丢弃
+        await start_stream("dropped-key")
+        gc.collect()
+
+    try:
+        asyncio.run(run())
+        for api_key in ("unstarted-key", "dropped-key"):
+            assert concurrency.try_acquire(api_key, MODEL) is not None
+            assert key_rate_limiter.usage(api_key, MODEL, "tpm_input", 100_000) == 0
+    finally:
+        key_rate_limiter.forget_key("unstarted-key")
+        key_rate_limiter.forget_key("dropped-key")
+
+
+def test_consume_cancel_without_task_uncancel():
+    # Python 3.10 的 asyncio.Task 没有 uncancel()
+    watcher = DisconnectWatcher(FakeRequest())
+    watcher._consumer = SimpleNamespace(done=lambda: False)
+    watcher._cancel_requested = True
+    watcher.disconnected = True
+    assert watcher.consume_cancel()
+    assert not watcher._cancel_requested
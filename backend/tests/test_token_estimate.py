@@ -0,0 +1,116 @@
+import base64
+import os
+import struct
+
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core.processing import token_estimate  # noqa: E402
+from gap.core.processing.token_estimate import (  # noqa: E402
+    IMAGE_TOKENS_PER_TILE,
+    TokenEstimateCache,
+    calibrate_from_usage,
+    estimate_image_tokens,
+    estimate_message_tokens,
+    estimate_text_tokens,
+    token_calibration,
+)
+
+
+def _png(width, height):
+    header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR"
+    return base64.b64encode(
+        header + struct.pack(">II", width, height) + b"\0" * 64
+    ).decode()
+
+
+def _jpeg(width, height):
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\0" + b"\0" * 9
+    sof0 = b"\xff\xc0" + struct.pack(">HBHH", 17, 8, height, width) + b"\0" * 10
+    return base64.b64encode(b"\xff\xd8" + app0 + sof0 + b"\0" * 64).decode()
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    token_estimate.message_token_memo.clear()
+    token_calibration.reset()
+    yield
+    token_calibration.reset()
+
+
+def test_text_is_estimated_by_script_class():
+    # 中文约一字一 Token，旧算法 (JSON 字符数 / 4) 会低估到四分之一左右
+    assert estimate_text_tokens("你好世界，今天天气很好") == 11
+    assert estimate_text_tokens("hello world") == pytest.approx(2.5)
+    assert estimate_text_tokens("2024") == 4
+    assert estimate_text_tokens("привет") == 3
+
+
+def test_images_use_tile_cost_not_payload_size():
+    small = {
+        "role": "user",
+        "parts": [{"inline_data": {"mime_type": "image/png", "data": _png(300, 200)}}],
+    }
+    large = {
+        "role": "user",
+        "parts": [
+            {"inlineData": {"mimeType": "image/jpeg", "data": _jpeg(1600, 1000)}}
+        ],
+    }
+    assert estimate_message_tokens(small) == 1 + IMAGE_TOKENS_PER_TILE
+    # 1600x1000 → 3 x 2 个 768 分块
+    assert estimate_message_tokens(large) == 1 + 6 * IMAGE_TOKENS_PER_TILE
+    # 无法解析尺寸的图片按一个分块计算，与 base64 长度无关
+    assert estimate_image_tokens("A" * 400_000) == IMAGE_TOKENS_PER_TILE
+
+
+def test_function_parts_count_name_and_arguments():
+    call = {
+        "role": "model",
+        "parts": [{"functionCall": {"name": "get_weather", "args": {"city": "北京"}}}],
+    }
+    response = {
+        "role": "user",
+        "parts": [
+            {"functionResponse": {"name": "get_weather", "response": {"temp": 21}}}
+        ],
+    }
+    assert (
+        estimate_message_tokens(call) > token_estimate.FUNCTION_PART_OVERHEAD_TOKENS + 2
+    )
+    assert (
+        estimate_message_tokens(response) > token_estimate.FUNCTION_PART_OVERHEAD_TOKENS
+    )
+
+
+def test_messages_are_memoized_by_content_hash(monkeypatch):
+    message = {"role": "user", "parts": [{"text": "重复的历史消息"}]}
+    TokenEstimateCache().estimate([message])
+    calls = []
+    original = token_estimate.estimate_message_tokens
+    monkeypatch.setattr(
+        token_estimate,
+        "estimate_message_tokens",
+        lambda m: calls.append(m) or original(m),
+    )
+    # 内容相同的新消息对象 (下一轮请求重新构造的历史) 直接命中全局缓存
+    TokenEstimateCache().estimate([dict(message)])
+    assert calls == []
+
+
+def test_calibration_scales_estimates_per_model():
+    contents = [{"role": "user", "parts": [{"text": "word " * 200}]}]
+    cache = TokenEstimateCache("m")
+    raw = cache.estimate(contents)
+    calibrate_from_usage(cache, "m", contents, None, raw * 2)
+    assert token_calibration.factor("m") == pytest.approx(2.0)
+    assert TokenEstimateCache("m").estimate(contents) == pytest.approx(raw * 2, abs=1)
+    # 其他模型不受影响；系数有上下限，过小的样本被忽略
+    assert TokenEstimateCache("other").estimate(contents) == raw
+    calibrate_from_usage(None, "m", contents, None, raw * 100)
+    assert token_calibration.factor("m") <= token_calibration.max_factor
+    calibrate_from_usage(
+        None, "tiny", [{"role": "user", "parts": [{"text": "hi"}]}], None, 50
+    )
+    assert token_calibration.factor("tiny") == 1.0
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+os.environ.setdefault("TESTING", "true")
+
+from gap import config as app_config  # noqa: E402
+from gap.core.processing.token_count import UpstreamTokenCounter  # noqa: E402
+from gap.core.processing.token_estimate import (  # noqa: E402
+    TokenEstimateCache,
+    token_calibration,
+)
+from gap.core.processing.utils import truncate_context  # noqa: E402
+from gap.core.services.gemini import GeminiClient  # noqa: E402
+
+MODEL = "upstream-count-test-model"
+TOKENS_PER_MESSAGE = 10
+
+
+class MockUpstream:
+    """本地 countTokens 模拟：每条消息固定计 TOKENS_PER_MESSAGE 个 Token。"""
+
+    def __init__(self):
+        self.requests = []
+        self.fail = False
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path.endswith(f"/models/{MODEL}:countTokens")
+        assert request.headers["x-goog-api-key"] == "test-key"
+        if self.fail:
+            return httpx.Response(503, json={"error": {"message": "unavailable"}})
+        contents = json.loads(request.content)["contents"]
+        self.requests.append(len(contents))
+        return httpx.Response(
+            200, json={"totalTokens": len(contents) * TOKENS_PER_MESSAGE}
+        )
+
+
+def _turns(count, offset=0):
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "model",
+            "parts": [{"text": f"message {i} " + "x" * 20}],
+        }
+        for i in range(offset, offset + count)
+    ]
+
+
+@pytest.fixture
+def upstream():
+    mock = MockUpstream()
+    token_calibration.reset()
+    yield mock
+    token_calibration.reset()
+
+
+def _counter_for(upstream, counter, estimates):
+    async def run(contents):
+        async with httpx.AsyncClient(
+            transport=httpx.MockTransport(upstream.handler)
+        ) as http:
+            client = GeminiClient("test-key", http)
+
+            async def count_suffix(suffix):
+                return await client.count_tokens(MODEL, suffix)
+
+            return await counter.count(MODEL, contents, count_suffix, estimates)
+
+    return run
+
+
+def test_follow_up_turns_only_count_the_new_suffix(upstream):
+    counter = UpstreamTokenCounter(max_entries=100)
+    history = _turns(6)
+    count = _counter_for(upstream, counter, TokenEstimateCache(MODEL))
+
+    assert asyncio.run(count(history)) == 60
+    # 同样的内容 (新的消息对象) 直接命中缓存
+    assert asyncio.run(count([dict(m) for m in history])) == 60
+    # 下一轮多出模型回复和新的用户消息，只对这两条调用 countTokens
+    assert asyncio.run(count(history + _turns(2, offset=6))) == 80
+    assert upstream.requests == [6, 2]
+    stats = counter.get_stats()
+    assert stats["full_hits"] == 1 and stats["prefix_hits"] == 1
+    assert stats["messages_reused"] == 12
+
+
+def test_upstream_failure_falls_back_to_estimate(upstream):
+    upstream.fail = True
+    counter = UpstreamTokenCounter(max_entries=100)
+    count = _counter_for(upstream, counter, TokenEstimateCache(MODEL))
+    assert asyncio.run(count(_turns(4))) is None
+    assert counter.get_stats()["failures"] == 1
+
+
+def test_borderline_requests_use_precise_count_for_truncation(upstream, monkeypatch):
+    contents = _turns(10)
+    estimates = TokenEstimateCache(MODEL)
+    estimated = estimates.estimate(contents)
+    precise_calls = []
+
+    async def precise_counter(items):
+        precise_calls.append(len(items))
+        return estimated - 5  # 精确值略低于阈值，不需要截断
+
+    monkeypatch.setattr(app_config, "CONTEXT_TOKEN_SAFETY_MARGIN", 0)
+    monkeypatch.setattr(app_config, "UPSTREAM_TOKEN_COUNT_MARGIN", 0.1)
+
+    def truncate(limit):
+        monkeypatch.setattr(
+            app_config, "MODEL_LIMITS", {MODEL: {"input_token_limit": limit}}
+        )
+        return asyncio.run(
+            truncate_context(
+                contents,
+                MODEL,
+                token_estimates=estimates,
+                precise_counter=precise_counter,
+            )
+        )
+
+    # 估算值略超阈值：精确值在阈值内，整段发送
+    truncated, over_limit = truncate(estimated - 2)
+    assert truncated == contents and not over_limit
+    # 远低于阈值和远超阈值的请求都不调用 countTokens
+    truncate(estimated * 3)
+    truncated, _ = truncate(estimated // 3)
+    assert len(truncated) < len(contents)
+    assert precise_calls == [10]
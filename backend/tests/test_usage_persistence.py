@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+os.environ.setdefault("TESTING", "true")
+
+from gap.core import tracking  # noqa: E402
+from gap.core.keys.manager import APIKeyManager  # noqa: E402
+from gap.core.usage_persistence import UsageStatePersistence, _today_pt  # noqa: E402
+
+
+def _clear_usage(keys):
+    with tracking.usage_lock:
+        for key in keys:
+            tracking.usage_data.pop(key, None)
+        tracking.dirty_usage_entries.clear()
+
+
+def test_snapshot_and_journal_restore_counts(tmp_path):
+    keys = ["persist-a", "persist-b"]
+    manager = APIKeyManager()
+    manager.set_keys(keys, {k: {"is_active": True} for k in keys})
+    persistence = UsageStatePersistence(str(tmp_path))
+    try:
+        with tracking.usage_lock:
+            tracking.usage_data["persist-a"]["m"]["rpd_count"] = 5
+            tracking.mark_usage_dirty("persist-a", "m")
+        persistence.write_snapshot(manager)
+        # 快照之后的变化只进入增量日志
+        with tracking.usage_lock:
+            tracking.usage_data["persist-a"]["m"]["rpd_count"] = 7
+            tracking.usage_data["persist-b"]["m"]["tpd_input_count"] = 1200
+            tracking.mark_usage_dirty("persist-a", "m")
+            tracking.mark_usage_dirty("persist-b", "m")
+        manager.mark_key_daily_exhausted("persist-b")
+        manager.mark_key_temporarily_unavailable("persist-a", duration_seconds=300)
+        assert persistence.flush_journal(manager) == 2
+        assert persistence.flush_journal(manager) == 0
+        # 模拟崩溃：写了一半的最后一行
+        with open(persistence.journal_path, "a") as f:
+            f.write('{"seq": 99, "usage": {"persist-a"')
+
+        _clear_usage(keys)
+        restarted = APIKeyManager()
+        restarted.set_keys(keys, {k: {"is_active": True} for k in keys})
+        stats = UsageStatePersistence(str(tmp_path)).load(restarted)
+        assert stats == {
+            "usage_entries": 2,
+            "daily_exhausted": 1,
+            "temporary_issues": 1,
+        }
+        assert tracking.usage_data["persist-a"]["m"]["rpd_count"] == 7
+        assert tracking.usage_data["persist-b"]["m"]["tpd_input_count"] == 1200
+        assert restarted.is_key_temporarily_unavailable("persist-a")
+        assert "persist-b" in restarted.daily_exhausted_keys
+    finally:
+        _clear_usage(keys)
+
+
+def test_counts_from_previous_day_are_not_restored(tmp_path):
+    manager = APIKeyManager()
+    persistence = UsageStatePersistence(str(tmp_path))
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(persistence.snapshot_path, "w") as f:
+        json.dump(
+            {
+                "version": 1,
+                "seq": 1,
+                "pt_date": "2000-01-01",
+                "usage": {
+                    "stale-key": {"m": {"rpd_count": 9, "last_used_timestamp": 123.0}}
+                },
+                "daily_rpd_totals": {},
+                "daily_exhausted": {"stale-key": "2000-01-01"},
+                "temporary_issues": {"stale-key": time.time() - 10},
+            },
+            f,
+        )
+    try:
+        assert _today_pt() != "2000-01-01"
+        stats = persistence.load(manager)
+        assert stats == {
+            "usage_entries": 1,
+            "daily_exhausted": 0,
+            "temporary_issues": 0,
+        }
+        key_usage = tracking.usage_data["stale-key"]["m"]
+        assert key_usage["rpd_count"] == 0
+        assert key_usage["last_used_timestamp"] == 123.0
+        # 错过的每日重置补记前一天的 RPD 总量
+        assert tracking.daily_rpd_totals["2000-01-01"] == 9
+    finally:
+        _clear_usage(["stale-key"])
+        with tracking.daily_totals_lock:
+            tracking.daily_rpd_totals.pop("2000-01-01", None)